@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+Micro-benchmarks for performance-sensitive parts of the hub tooling.
+
+Each benchmark compares the original implementation of an operation with its
+optimized replacement, and prints per-iteration timings and the speedup.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import re
+import time
+import argparse
+import logging
+import tempfile
+import json
+import yaml
+import urllib.request
+import threading
+import socketserver
+import subprocess
+import http.server
+
+from typing import Dict, List, Callable, Tuple
+
+from tp_hub import (
+    get_project_dir,
+    logger,
+    expand_yaml_template_str,
+    compile_yaml_template_str,
+    clear_yaml_template_cache,
+    current_hub_settings,
+    docker_call,
+    docker_call_output,
+    compile_route_catalog_shard,
+    DockerEngineClient,
+  )
+
+def time_per_iteration(func: Callable[[], object], iterations: int) -> float:
+    """
+    Run func() iterations times and return the best-of-3 mean wall time per call, in seconds.
+    """
+    best: float = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = (time.perf_counter() - start) / iterations
+        best = min(best, elapsed)
+    return best
+
+def print_comparison(title: str, results: List[Tuple[str, float]]) -> None:
+    """
+    Print a table of (label, seconds-per-iteration), with speedup relative to the first entry.
+    """
+    print(f"\n{title}")
+    baseline = results[0][1]
+    for label, seconds in results:
+        speedup = baseline / seconds if seconds > 0 else float('inf')
+        print(f"    {label:<40} {seconds * 1000.0:10.3f} ms   x{speedup:.1f}")
+
+_template_var_re = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}')
+
+def make_template_env(template_str: str) -> Dict[str, str]:
+    """
+    Build a dummy environment that satisfies every ${VAR} referenced in a template.
+    """
+    return { name: f"value-of-{name.lower()}" for name in _template_var_re.findall(template_str) }
+
+def make_large_dynamic_config_template(num_routers: int) -> str:
+    """
+    Generate a large traefik dynamic config template with num_routers routers, services
+    and middlewares, each with several substitutions.
+    """
+    lines: List[str] = [ "http:", "  routers:" ]
+    for i in range(num_routers):
+        lines += [
+            f"    app-{i}:",
+            f"      entryPoints: [ lanwebsecure ]",
+            f"      rule: \"Host(`app-{i}.${{PARENT_DNS_DOMAIN}}`) && PathPrefix(`/app-{i}`)\"",
+            f"      service: app-{i}",
+            f"      middlewares:",
+            f"        - app-{i}-strip",
+          ]
+    lines.append("  middlewares:")
+    for i in range(num_routers):
+        lines += [
+            f"    app-{i}-strip:",
+            f"      stripPrefix:",
+            f"        prefixes:",
+            f"          - \"/app-{i}\"",
+          ]
+    lines.append("  services:")
+    for i in range(num_routers):
+        lines += [
+            f"    app-{i}:",
+            f"      loadBalancer:",
+            f"        servers:",
+            f"          - url: \"http://${{HUB_LAN_IP}}:{8000 + i}\"",
+          ]
+    return "\n".join(lines) + "\n"
+
+def bench_yaml_template(args: argparse.Namespace) -> int:
+    iterations: int = args.iterations
+    project_dir = get_project_dir()
+    traefik_dir = os.path.join(project_dir, "stacks", "traefik")
+    templates: List[Tuple[str, str]] = []
+    for name in ("traefik-config-template.yml", "traefik-dynamic-config-template.yml"):
+        with open(os.path.join(traefik_dir, name), encoding='utf-8') as f:
+            templates.append((name, f.read()))
+    templates.append(
+        (f"synthetic dynamic config ({args.routers} routers)", make_large_dynamic_config_template(args.routers))
+      )
+
+    with tempfile.TemporaryDirectory() as tmp_build_dir:
+        # Keep the benchmark's persisted compiled templates out of the real build dir
+        import tp_hub.yaml_template as yaml_template_module
+        orig_get_cache_dir = yaml_template_module.get_yaml_template_cache_dir
+        yaml_template_module.get_yaml_template_cache_dir = lambda: tmp_build_dir
+        try:
+            for name, template_str in templates:
+                env = make_template_env(template_str)
+                expected = expand_yaml_template_str(template_str, env=env)
+                if compile_yaml_template_str(template_str).render(env) != expected:
+                    print(f"ERROR: compiled rendering of {name} differs from text expansion", file=sys.stderr)
+                    return 1
+
+                def text_expand() -> object:
+                    return expand_yaml_template_str(template_str, env=env)
+
+                def cold_compile_and_render() -> object:
+                    clear_yaml_template_cache()
+                    return compile_yaml_template_str(template_str, persist=False).render(env)
+
+                def persisted_compile_and_render() -> object:
+                    clear_yaml_template_cache()
+                    return compile_yaml_template_str(template_str).render(env)
+
+                compiled = compile_yaml_template_str(template_str)
+                def warm_render() -> object:
+                    return compiled.render(env)
+
+                print_comparison(name, [
+                    ("text expansion + YAML parse", time_per_iteration(text_expand, iterations)),
+                    ("compile (no cache) + render", time_per_iteration(cold_compile_and_render, iterations)),
+                    ("load from build/cache + render", time_per_iteration(persisted_compile_and_render, iterations)),
+                    ("render precompiled", time_per_iteration(warm_render, iterations)),
+                  ])
+        finally:
+            yaml_template_module.get_yaml_template_cache_dir = orig_get_cache_dir
+            clear_yaml_template_cache()
+    return 0
+
+def _get_traefik_api(api_url: str, path: str) -> object:
+    with urllib.request.urlopen(f"{api_url}{path}", timeout=5) as response:
+        return json.loads(response.read())
+
+def _wait_for_routers(api_url: str, provider: str, expected: Dict[str, str], timeout: float) -> float:
+    """
+    Poll the Traefik API until every router name in expected is active from provider
+    with the expected rule. Returns the elapsed time in seconds.
+    """
+    start = time.perf_counter()
+    while True:
+        try:
+            routers = _get_traefik_api(api_url, "/api/http/routers?per_page=100000&search=bench-")
+        except OSError:
+            routers = []
+        actual = {
+            r['name']: r.get('rule') for r in routers  # type: ignore[union-attr]
+                if r.get('provider') == provider and r['name'].startswith('bench-')
+          }
+        if all(actual.get(f"{name}@{provider}") == rule for name, rule in expected.items()):
+            return time.perf_counter() - start
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError(f"Traefik did not load {len(expected)} {provider} routers within {timeout} seconds")
+        time.sleep(0.01)
+
+def _make_bench_rules(num_routes: int, generation: int) -> Dict[str, str]:
+    return { f"bench-{i}": f"Host(`bench-{i}.example.com`) && PathPrefix(`/g{generation}`)" for i in range(num_routes) }
+
+def bench_route_reload(args: argparse.Namespace) -> int:
+    """
+    Start a scratch Traefik container and measure how long it takes for a batch of new
+    or changed routes to become active when declared with docker labels (the container
+    must be recreated) versus a route catalog shard in the watched file provider directory.
+    """
+    num_routes: int = args.routes
+    traefik_version = args.traefik_version or current_hub_settings().traefik_version
+    image = f"traefik:v{traefik_version}"
+    name_prefix = f"hub-bench-route-reload-{os.getpid()}"
+    traefik_container = f"{name_prefix}-traefik"
+    label_container = f"{name_prefix}-labels"
+    containers: List[str] = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dynamic_dir = os.path.join(tmp_dir, "dynamic")
+        os.mkdir(dynamic_dir)
+        static_config = dict(
+            api=dict(insecure=True),
+            entryPoints=dict(web=dict(address=":80")),
+            providers=dict(
+                file=dict(directory="/etc/traefik/dynamic", watch=True),
+                docker=dict(exposedByDefault=False, constraints=f"Label(`hub-bench`,`{name_prefix}`)"),
+              ),
+          )
+        with open(os.path.join(tmp_dir, "traefik.yml"), "w", encoding='utf-8') as f:
+            yaml.dump(static_config, f)
+
+        def write_shard(generation: int) -> Dict[str, str]:
+            rules = _make_bench_rules(num_routes, generation)
+            catalog = dict(routes={ name: dict(entrypoints="web", rule=rule, url="http://127.0.0.1:9") for name, rule in rules.items() })
+            dynamic_config = compile_route_catalog_shard("bench", catalog, set(), set())
+            tmp_pathname = os.path.join(dynamic_dir, ".routes-bench.yml.tmp")
+            with open(tmp_pathname, "w", encoding='utf-8') as f:
+                yaml.dump(dynamic_config, f, sort_keys=True)
+            os.replace(tmp_pathname, os.path.join(dynamic_dir, "routes-bench.yml"))
+            return rules
+
+        def run_label_container(generation: int) -> Dict[str, str]:
+            rules = _make_bench_rules(num_routes, generation)
+            docker_args = [ "run", "-d", "--name", label_container,
+                            "--label", "traefik.enable=true", "--label", f"hub-bench={name_prefix}" ]
+            for name, rule in rules.items():
+                docker_args += [
+                    "--label", f"traefik.http.routers.{name}.entrypoints=web",
+                    "--label", f"traefik.http.routers.{name}.rule={rule}",
+                    "--label", f"traefik.http.routers.{name}.service=bench-svc",
+                  ]
+            docker_args += [ "--label", "traefik.http.services.bench-svc.loadbalancer.server.port=9" ]
+            docker_args += [ "alpine:3.12", "sleep", "3600" ]
+            docker_call(docker_args)
+            return rules
+
+        try:
+            containers.append(traefik_container)
+            docker_call([
+                "run", "-d", "--name", traefik_container,
+                "-p", "127.0.0.1::8080",
+                "-v", "/var/run/docker.sock:/var/run/docker.sock:ro",
+                "-v", f"{os.path.join(tmp_dir, 'traefik.yml')}:/etc/traefik/traefik.yml:ro",
+                "-v", f"{dynamic_dir}:/etc/traefik/dynamic:ro",
+                image,
+              ])
+            host_port = docker_call_output(["port", traefik_container, "8080/tcp"]).splitlines()[0].rsplit(':', 1)[1]
+            api_url = f"http://127.0.0.1:{host_port}"
+            start = time.perf_counter()
+            while True:
+                try:
+                    _get_traefik_api(api_url, "/api/overview")
+                    break
+                except OSError:
+                    if time.perf_counter() - start > args.timeout:
+                        raise
+                    time.sleep(0.1)
+
+            containers.append(label_container)
+            start = time.perf_counter()
+            rules = run_label_container(1)
+            _wait_for_routers(api_url, "docker", rules, args.timeout)
+            add_labels = time.perf_counter() - start
+
+            start = time.perf_counter()
+            docker_call(["rm", "-f", label_container])
+            rules = run_label_container(2)
+            _wait_for_routers(api_url, "docker", rules, args.timeout)
+            change_labels = time.perf_counter() - start
+
+            start = time.perf_counter()
+            rules = write_shard(1)
+            _wait_for_routers(api_url, "file", rules, args.timeout)
+            add_file = time.perf_counter() - start
+
+            start = time.perf_counter()
+            rules = write_shard(2)
+            _wait_for_routers(api_url, "file", rules, args.timeout)
+            change_file = time.perf_counter() - start
+
+            print_comparison(f"Add {num_routes} routes until active", [
+                ("docker labels (start container)", add_labels),
+                ("route catalog shard (file provider)", add_file),
+              ])
+            print_comparison(f"Change {num_routes} routes until active", [
+                ("docker labels (recreate container)", change_labels),
+                ("route catalog shard (file provider)", change_file),
+              ])
+        finally:
+            for container in reversed(containers):
+                try:
+                    docker_call(["rm", "-f", container])
+                except Exception as e:
+                    logger.warning(f"Unable to remove benchmark container {container}: {e}")
+    return 0
+
+class _StubDockerHandler(http.server.BaseHTTPRequestHandler):
+    """Answers the Engine API requests used by the benchmark with canned JSON, keeping connections alive"""
+    protocol_version = "HTTP/1.1"
+    responses: Dict[str, bytes] = {}
+
+    def do_GET(self) -> None:
+        path = re.sub(r'^/v[0-9.]+', '', self.path.split('?', 1)[0])
+        if path == "/_ping":
+            body = b"OK"
+            content_type = "text/plain"
+        else:
+            body = self.responses.get(path, b'{"message": "not found"}')
+            content_type = "application/json"
+        self.send_response(200 if path == "/_ping" or path in self.responses else 404)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Api-Version", "1.43")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+class _StubDockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def bench_docker_api(args: argparse.Namespace) -> int:
+    """
+    Compare listing docker volumes with the docker CLI against the in-process Engine API client,
+    both talking to a stub daemon on a temporary unix socket so that only client overhead is measured.
+    """
+    iterations: int = args.iterations
+    volumes = [
+        dict(Name=f"volume-{i}", Driver="local", Mountpoint=f"/var/lib/docker/volumes/volume-{i}/_data",
+             Labels={}, Scope="local", Options={}, CreatedAt="2023-10-01T00:00:00Z")
+            for i in range(args.volumes)
+      ]
+    _StubDockerHandler.responses = {
+        "/volumes": json.dumps(dict(Volumes=volumes, Warnings=None)).encode('utf-8'),
+      }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        socket_path = os.path.join(tmp_dir, "docker.sock")
+        server = _StubDockerServer(socket_path, _StubDockerHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            cli_env = dict(os.environ, DOCKER_HOST=f"unix://{socket_path}")
+            def cli_list() -> object:
+                return subprocess.check_output(["docker", "volume", "ls", "--format", "json"], env=cli_env)
+
+            def api_list_new_connection() -> object:
+                with DockerEngineClient(socket_path) as client:
+                    return client.list_volumes()
+
+            client = DockerEngineClient(socket_path)
+            def api_list_keepalive() -> object:
+                return client.list_volumes()
+
+            if len(api_list_keepalive()) != args.volumes:  # type: ignore[arg-type]
+                print("ERROR: stub daemon returned the wrong number of volumes", file=sys.stderr)
+                return 1
+            results: List[Tuple[str, float]] = []
+            try:
+                cli_list()
+                # Forking the CLI is slow; keep the total run time reasonable
+                results.append(("docker CLI", time_per_iteration(cli_list, max(1, iterations // 10))))
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f"docker CLI unavailable, skipping CLI timing: {e}", file=sys.stderr)
+            results.append(("Engine API, new connection per call", time_per_iteration(api_list_new_connection, iterations)))
+            results.append(("Engine API, keep-alive connection", time_per_iteration(api_list_keepalive, iterations)))
+            print_comparison(f"List {args.volumes} docker volumes (stub daemon)", results)
+            print(f"\n    keep-alive client: {client.num_requests} requests over {client.num_connects} connection(s)")
+            client.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+    return 0
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Run micro-benchmarks for the hub tooling")
+
+    parser.add_argument( '--loglevel', type=str.lower, default='warning',
+                choices=['debug', 'info', 'warning', 'error', 'critical'],
+                help='Provide logging level. Default="warning"' )
+    parser.add_argument("--iterations", "-n", type=int, default=50,
+                help="Number of iterations per timing run. Default: 50")
+    parser.set_defaults(func=None)
+
+    subparsers = parser.add_subparsers(title='Benchmarks', description='Valid benchmarks')
+
+    sp = subparsers.add_parser('yaml-template',
+                description='''Compare text expansion of Traefik config templates with compiled template rendering.''')
+    sp.add_argument("--routers", type=int, default=500,
+                help="Number of routers in the synthetic large dynamic config. Default: 500")
+    sp.set_defaults(func=bench_yaml_template)
+
+    sp = subparsers.add_parser('route-reload',
+                description='''Using a scratch Traefik container, compare how quickly new and changed routes become
+                               active when declared with docker labels versus a compiled route catalog shard.
+                               Requires docker.''')
+    sp.add_argument("--routes", type=int, default=200,
+                help="Number of routes to add and change. Default: 200")
+    sp.add_argument("--traefik-version", default=None,
+                help="The Traefik version to benchmark. Default: the configured traefik_version")
+    sp.add_argument("--timeout", type=float, default=60.0,
+                help="Seconds to wait for Traefik to load routes. Default: 60")
+    sp.set_defaults(func=bench_route_reload)
+
+    sp = subparsers.add_parser('docker-api',
+                description='''Compare the docker CLI with the in-process Docker Engine API client, against a
+                               stub daemon on a temporary unix socket.''')
+    sp.add_argument("--volumes", type=int, default=20,
+                help="Number of volumes the stub daemon reports. Default: 20")
+    sp.set_defaults(func=bench_docker_api)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel.upper())
+
+    if args.func is None:
+        parser.print_help(sys.stderr)
+        return 1
+
+    return args.func(args)
+
+if __name__ == "__main__":
+    rc = main()
+    sys.exit(rc)
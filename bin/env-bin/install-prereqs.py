@@ -18,21 +18,18 @@ import dotenv
 import argparse
 import json
 import logging
+import concurrent.futures
 
-from typing import Dict, List
+from typing import Any, Dict, List
 
 from tp_hub import (
     Jsonable, JsonableDict, JsonableList,
-    install_docker,
-    docker_is_installed,
-    install_docker_compose,
-    docker_compose_is_installed,
-    install_aws_cli,
-    aws_cli_is_installed,
-    create_docker_network,
-    create_docker_volume,
+    Provisioner,
+    get_hub_prereq_steps,
+    format_provisioning_results,
     should_run_with_group,
     get_public_ipv4_egress_address,
+    get_internet_ipv4_route_info,
     get_gateway_lan_ip4_address,
     get_lan_ipv4_address,
     get_default_ipv4_interface,
@@ -42,39 +39,8 @@ from tp_hub import (
 
 from tp_hub.config.config_yaml_generator import generate_settings_yaml
 
-from project_init_tools.os_packages import update_gpg_keyring, PackageList, update_apt_sources_list, update_and_install_os_packages
+from project_init_tools.util import should_run_with_group
 
-from project_init_tools.util import (
-    command_exists,
-    get_linux_distro_name,
-    should_run_with_group,
-)
-
-
-def install_cloudflared(force: bool=False) -> None:
-    if force or not command_exists("cloudflared"):
-        print("Installing cloudflared")
-
-        cloudflare_keyring_file = "/usr/share/keyrings/cloudflare-main.gpg"
-
-        update_gpg_keyring(
-            "https://pkg.cloudflare.com/cloudflare-main.gpg",
-            cloudflare_keyring_file,
-        )
-
-        update_apt_sources_list(
-            "/etc/apt/sources.list.d/cloudflared.list",
-            cloudflare_keyring_file,
-            "https://pkg.cloudflare.com/cloudflared",
-            get_linux_distro_name(),
-            "main")
-
-        update_and_install_os_packages( [ "cloudflared" ] )
-
-        if not command_exists("cloudflared"):
-            raise RuntimeError("cloudflared command still not available after installation!")
-
-        print("cloudflared package installed successfully")
 
 def main() -> int:
     parser = argparse.ArgumentParser(description="Install prerequisites for this project")
@@ -92,29 +58,18 @@ def main() -> int:
 
     username = os.environ["USER"]
 
-    # Install docker
-    if not docker_is_installed() or args.force:
-        install_docker(force=force)
-
-    # Install docker-compose
-    if not docker_compose_is_installed() or args.force:
-        install_docker_compose(force=force)
-
-    # Install aws-cli
-    if not aws_cli_is_installed() or args.force:
-        install_aws_cli(force=force)
-
-    # Install cloudflared
-    install_cloudflared(force=force)
-
-    # Create the "traefik" network if it doesn't exist:
-    create_docker_network("traefik")
-
-    # Create The "traefik_acme" volume if it doesn't exist:
-    create_docker_volume("traefik_acme")
-
-    # Create the "portainer_data" volume if it doesn't exist:
-    create_docker_volume("portainer_data")
+    # The network probes are independent of provisioning, so they run alongside it
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        probes: List[concurrent.futures.Future[Any]] = [ executor.submit(get_public_ipv4_egress_address), executor.submit(get_internet_ipv4_route_info) ]
+        results = Provisioner(get_hub_prereq_steps()).run(force=force)
+        logger.info(f"Provisioning results:\n{format_provisioning_results(results)}")
+        failed = [ r for r in results if r.action == "failed" ]
+        if len(failed) > 0:
+            print(format_provisioning_results(results), file=sys.stderr)
+            print(f"Failed to provision {failed[0].name}: {failed[0].error}", file=sys.stderr)
+            return 1
+        for probe in probes:
+            probe.result()
 
     project_dir = get_project_dir()
     config_yml_file = os.path.join(project_dir, "config.yml")
@@ -64,11 +64,22 @@ from .util import (
     docker_call_output,
     docker_compose_call,
     docker_compose_call_output,
+    get_docker_command,
     loads_ndjson,
     get_docker_networks,
     get_docker_volumes,
     create_docker_network,
     create_docker_volume,
+    refresh_docker_networks,
+    refresh_docker_volumes,
+    inspect_docker_network,
+    inspect_docker_volume,
+    inspect_docker_container,
+    inspect_docker_image,
+    get_docker_container_logs,
+    get_docker_containers,
+    get_docker_images,
+    normalize_image_reference,
     docker_is_installed,
     install_docker,
     docker_compose_is_installed,
@@ -84,6 +95,8 @@ from .util import (
     raw_resolve_public_dns,
     unindent_text,
     unindent_string_literal,
+    format_bytes,
+    format_table,
     is_valid_ipv4_address,
     is_valid_dns_name,
     is_valid_dns_name_or_ipv4_address,
@@ -92,7 +105,53 @@ from .util import (
     atomic_mv,
   )
 
+from .docker_group_broker import (
+    DOCKER_GROUP_BROKER_DISABLE_ENV_VAR,
+    DockerGroupBroker,
+    get_docker_group_broker,
+    close_docker_group_broker,
+  )
+
+from .subprocess_runner import (
+    SubprocessRecord,
+    SubprocessTracer,
+    TracedPopen,
+    get_subprocess_tracer,
+    trace_subprocess,
+    redact_argv,
+    get_subprocess_command_key,
+  )
+
+from .docker_api import (
+    DockerApiError,
+    DockerApiNotFoundError,
+    DockerEngineClient,
+    DockerStream,
+    iter_docker_stream_frames,
+    get_docker_engine_client,
+    reset_docker_engine_client,
+  )
+
+from .docker_events import (
+    DockerResourceCache,
+    get_docker_resource_cache,
+    reset_docker_resource_cache,
+  )
+
 from .docker_util import (
+    DockerVolumeFileNotFoundError,
+    VolumeSession,
+    DockerRunVolumeSession,
+    HelperContainerVolumeSession,
+    HostPathVolumeSession,
+    get_volume_session,
+    get_volume_access_strategy,
+    get_docker_volume_host_path,
+    close_volume_sessions,
+    VolumeFileWriter,
+    open_volume_file,
+    read_volume_file_chunks,
+    write_volume_file_chunks,
     read_docker_volume_text_file,
     write_docker_volume_text_file,
     list_files_in_docker_volume,
@@ -104,7 +163,9 @@ from .docker_util import (
 from .acme_util import (
     list_traefik_acme_files,
     load_traefik_acme_data,
+    load_all_traefik_acme_data,
     save_traefik_acme_data,
+    save_all_traefik_acme_data,
     get_acme_domain_data
   )
 
@@ -112,6 +173,152 @@ from .password_hash import hash_password, check_password, hash_username_password
 
 from .docker_compose_stack import DockerComposeStack
 
+from .async_docker_compose_stack import AsyncDockerComposeStack, DockerComposeStackGroup
+
+from .readiness import (
+    DEFAULT_READY_TIMEOUT,
+    ReadinessFatalError,
+    ReadinessCheck,
+    ContainerReadinessCheck,
+    HttpReadinessCheck,
+    ReadinessResult,
+    wait_ready,
+    format_readiness_report,
+    http_get_status,
+    get_traefik_readiness_checks,
+    get_portainer_readiness_checks,
+    get_hub_readiness_checks,
+  )
+
+from .compose_fingerprint import (
+    CONFIG_FINGERPRINT_LABEL,
+    CONFIG_FINGERPRINT_ENV_VAR,
+    ComposeStackFingerprint,
+    get_compose_stack_fingerprint,
+    get_stale_compose_stacks,
+  )
+
+from .compose_model import (
+    COMPOSE_MODEL_CACHE_SIZE,
+    ComposeModelError,
+    ComposePort,
+    ComposeVolumeMount,
+    ComposeService,
+    ComposeModel,
+    get_compose_stack_env,
+    get_compose_model,
+    clear_compose_model_cache,
+    merge_compose_data,
+    merge_compose_services,
+  )
+
+from .stack_status import (
+    HUB_STACK_NAMES,
+    ContainerStatus,
+    find_stack_containers,
+    get_stack_statuses,
+    format_stack_statuses,
+    diff_stack_statuses,
+    format_stack_status_change,
+    watch_stack_statuses,
+  )
+
+from .container_stats import (
+    DEFAULT_STATS_HISTORY,
+    StatsSample,
+    ContainerStats,
+    ContainerStatsMonitor,
+    get_stats_containers,
+    format_container_stats,
+    parse_size,
+  )
+
+from .hub_gc import (
+    PROTECTED_VOLUMES,
+    DEFAULT_KEEP_VERSIONS,
+    GC_KINDS,
+    GcItem,
+    GcResult,
+    GcReport,
+    parse_image_version,
+    get_docker_disk_usage,
+    get_gc_report,
+    prune_gc_report,
+    format_gc_report,
+  )
+
+from .provisioning import (
+    APT_LOCK,
+    ProvisioningState,
+    ProvisioningStep,
+    ProvisioningResult,
+    Provisioner,
+    format_provisioning_results,
+    get_hub_prereq_steps,
+    install_cloudflared,
+  )
+
+from .traefik_rollout import (
+    TRAEFIK_CANARY_CONTAINER_NAME,
+    DEFAULT_CANARY_TIMEOUT,
+    LoadProbe,
+    LoadProbeResult,
+    format_load_probe_results,
+    get_traefik_probe_urls,
+    get_traefik_canary_run_args,
+    run_traefik_canary,
+    remove_traefik_canary,
+  )
+
+from .log_follower import (
+    LOG_LEVELS,
+    LogLine,
+    LogFilter,
+    LogSource,
+    MultiplexedLogFollower,
+    get_stack_log_sources,
+    parse_log_level,
+    parse_log_since,
+  )
+
+from .image_manager import (
+    IMAGE_DIGEST_CACHE_FILENAME,
+    DEFAULT_IMAGE_TTL,
+    PORTAINER_RESET_PASSWORD_HELPER_IMAGE,
+    HUB_HELPER_IMAGES,
+    ImageResult,
+    ImageManager,
+    get_compose_stack_images,
+    format_image_results,
+  )
+
+from .compose_interpolation import (
+    ComposeInterpolationError,
+    compose_interpolate,
+    compose_interpolate_data,
+  )
+
+from .route_catalog import (
+    RouteCatalogError,
+    compile_route_rule,
+    compile_route_catalog_shard,
+  )
+
+from .static_assets import (
+    minify_asset,
+    minify_css,
+    minify_markup,
+    rewrite_asset_refs,
+    compress_asset,
+  )
+
+from .traefik_router_index import (
+    TraefikRuleError,
+    TraefikRouter,
+    TraefikRouterIndex,
+    parse_traefik_rule,
+  )
+
 from .x_dotenv import (
     x_dotenv_loads,
     x_dotenv_load_file,
@@ -124,6 +331,24 @@ from .builder import (
     build_traefik,
     build_portainer,
     build_hub,
+    build_router_index,
+    find_project_compose_files,
+    build_route_catalog,
+    find_route_catalog_files,
+    build_static_site,
+    build_static_sites,
+    BuildFs,
+    DiskBuildFs,
+    MemoryBuildFs,
+    diff_memory_build_fs,
   )
 
-from .yaml_template import load_yaml_template_str, load_yaml_template_file
+from .yaml_template import (
+    load_yaml_template_str,
+    load_yaml_template_file,
+    expand_yaml_template_str,
+    compile_yaml_template_str,
+    compile_yaml_template_file,
+    clear_yaml_template_cache,
+    CompiledYamlTemplate,
+  )
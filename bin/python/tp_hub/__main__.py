@@ -18,24 +18,25 @@ import json
 import logging
 import getpass
 import re
+import time
+import asyncio
 import subprocess
+import concurrent.futures
 
 from tp_hub.internal_types import *
 
 from tp_hub import (
     __version__ as pkg_version,
     Jsonable, JsonableDict, JsonableList,
-    install_docker,
-    docker_is_installed,
     docker_call_output,
-    install_docker_compose,
-    docker_compose_is_installed,
-    install_aws_cli,
-    aws_cli_is_installed,
-    create_docker_network,
-    create_docker_volume,
+    get_docker_containers,
+    format_bytes,
+    Provisioner,
+    get_hub_prereq_steps,
+    format_provisioning_results,
     should_run_with_group,
     get_public_ipv4_egress_address,
+    get_internet_ipv4_route_info,
     get_gateway_lan_ip4_address,
     get_lan_ipv4_address,
     get_default_ipv4_interface,
@@ -53,9 +54,52 @@ from tp_hub import (
     build_traefik,
     build_portainer,
     DockerComposeStack,
+    AsyncDockerComposeStack,
+    DockerComposeStackGroup,
+    MemoryBuildFs,
+    diff_memory_build_fs,
+    DEFAULT_READY_TIMEOUT,
+    wait_ready,
+    format_readiness_report,
+    get_hub_readiness_checks,
+    get_traefik_readiness_checks,
+    get_portainer_readiness_checks,
+    CONFIG_FINGERPRINT_ENV_VAR,
+    get_compose_stack_fingerprint,
+    get_stale_compose_stacks,
+    get_stack_statuses,
+    format_stack_statuses,
+    watch_stack_statuses,
+    format_stack_status_change,
+    HUB_STACK_NAMES,
+    LOG_LEVELS,
+    LogFilter,
+    MultiplexedLogFollower,
+    get_stack_log_sources,
+    parse_log_since,
+    ImageManager,
+    HUB_HELPER_IMAGES,
+    PORTAINER_RESET_PASSWORD_HELPER_IMAGE,
+    get_compose_stack_images,
+    format_image_results,
+    get_subprocess_tracer,
+    DEFAULT_STATS_HISTORY,
+    ContainerStatsMonitor,
+    get_stats_containers,
+    format_container_stats,
+    DEFAULT_KEEP_VERSIONS,
+    get_gc_report,
+    prune_gc_report,
+    format_gc_report,
+    LoadProbe,
+    format_load_probe_results,
+    get_traefik_probe_urls,
+    run_traefik_canary,
+    remove_traefik_canary,
   )
 
-from project_init_tools.util import sudo_Popen, CalledProcessErrorWithStderrMessage
+from project_init_tools.util import CalledProcessErrorWithStderrMessage
+from tp_hub.subprocess_runner import sudo_Popen
 from tp_hub.route53_dns_name import create_route53_dns_name, get_aws, AwsContext
 
 PROGNAME = "hub"
@@ -122,8 +166,68 @@ class CommandHandler:
         dc_file = os.path.join(self.get_project_dir(), "stacks", "portainer", "docker-compose.yml")
         return DockerComposeStack(dc_file, **kwargs)
     
-    def traefik_up(self, **kwargs) -> None:
-        self.get_traefik_stack(**kwargs).up()
+    def prepare_stacks_up(self, stacks: List[DockerComposeStack], force: bool=False) -> List[str]:
+        """
+        Set each stack's configuration fingerprint in its environment, so its containers are
+        labeled with it, and determine which stacks are already up to date.
+
+        Returns:
+            The names of the stacks that are already running with their current configuration,
+            and need not be brought up. Empty if force is True.
+        """
+        fingerprints = [ get_compose_stack_fingerprint(stack, settings=self.get_settings()) for stack in stacks ]
+        for stack, fingerprint in zip(stacks, fingerprints):
+            stack.env[CONFIG_FINGERPRINT_ENV_VAR] = fingerprint.fingerprint
+        if force:
+            return []
+        stale = get_stale_compose_stacks(fingerprints)
+        result: List[str] = []
+        for stack in stacks:
+            reason = stale[stack.project_name]
+            if reason is None:
+                print(f"Stack '{stack.name}' is up to date; skipped docker compose up (use --force to run it anyway)")
+                result.append(stack.name)
+            else:
+                logger.info(f"Stack '{stack.name}' needs docker compose up: {reason}")
+        return result
+
+    def traefik_up(self, force: bool=False, rolling: bool=False, probe_rate: float=20.0, **kwargs) -> None:
+        stack = self.get_traefik_stack(**kwargs)
+        if len(self.prepare_stacks_up([stack], force=force)) > 0:
+            return
+        if not rolling or not stack.has_running_containers():
+            stack.up()
+            return
+        self.traefik_rolling_up(stack, probe_rate=probe_rate)
+
+    def traefik_rolling_up(self, stack: DockerComposeStack, probe_rate: float=20.0) -> None:
+        """
+        Replace a running Traefik with the stack's current image and configuration, keeping
+        the old instance serving until a canary of the new one is healthy, and report the
+        requests that failed during the switch.
+        """
+        results = asyncio.run(ImageManager().ensure_images(get_compose_stack_images(stack), ttl=float('inf')))
+        failed = [ r for r in results if r.action == "failed" ]
+        if len(failed) > 0:
+            raise CmdExitError(1, f"Unable to pull image {failed[0].image}: {failed[0].error}")
+        with LoadProbe(get_traefik_probe_urls(), rate=probe_rate) as probe:
+            try:
+                canary_seconds = run_traefik_canary(stack)
+            except HubError as e:
+                raise CmdExitError(1, str(e)) from e
+            try:
+                print(f"Traefik canary healthy after {canary_seconds:.1f}s; switching", file=sys.stderr)
+                switch_start = time.monotonic()
+                stack.up()
+                ready = asyncio.run(wait_ready(get_traefik_readiness_checks(stack.project_name)))
+                switch_seconds = time.monotonic() - switch_start
+            finally:
+                remove_traefik_canary()
+        print(format_load_probe_results(probe.get_results()))
+        if not all(r.ready for r in ready):
+            print(format_readiness_report(ready), file=sys.stderr)
+            raise CmdExitError(1, "Replaced Traefik did not become ready")
+        print(f"Traefik replaced; switch took {switch_seconds:.1f}s")
 
     def traefik_down(self, **kwargs) -> None:
         self.get_traefik_stack(**kwargs).down()
@@ -136,8 +240,10 @@ class CommandHandler:
         ps_options: Optional[List[str]] = kwargs.pop('ps_options', None)
         self.get_traefik_stack(**kwargs).ps(ps_options)
 
-    def portainer_up(self, **kwargs) -> None:
-        self.get_portainer_stack(**kwargs).up()
+    def portainer_up(self, force: bool=False, **kwargs) -> None:
+        stack = self.get_portainer_stack(**kwargs)
+        if len(self.prepare_stacks_up([stack], force=force)) == 0:
+            stack.up()
 
     def portainer_down(self, **kwargs) -> None:
         self.get_portainer_stack(**kwargs).down()
@@ -153,20 +259,47 @@ class CommandHandler:
     def portainer_has_running_conainers(self, **kwargs) -> bool:
         return self.get_portainer_stack(**kwargs).has_running_containers()
 
-    def hub_up(self, **kwargs) -> None:
-        self.traefik_up(**kwargs)
-        self.portainer_up(**kwargs)
+    def get_hub_stack_group(self, **kwargs) -> DockerComposeStackGroup:
+        # Portainer only needs the external "traefik" network, not a running Traefik, so both
+        # stacks are operated on concurrently once the network exists.
+        group = DockerComposeStackGroup(required_networks=["traefik"])
+        group.add(AsyncDockerComposeStack.from_stack(self.get_traefik_stack(**kwargs), output_prefix="traefik   | "))
+        group.add(AsyncDockerComposeStack.from_stack(self.get_portainer_stack(**kwargs), output_prefix="portainer | "))
+        return group
+
+    def get_hub_images(self, **kwargs) -> List[str]:
+        """The images used by the hub stacks and by hub commands"""
+        result: List[str] = []
+        for stack in (self.get_traefik_stack(**kwargs), self.get_portainer_stack(**kwargs)):
+            result.extend(get_compose_stack_images(stack))
+        result.extend(HUB_HELPER_IMAGES)
+        return result
+
+    def hub_up(self, force: bool=False, **kwargs) -> None:
+        group = self.get_hub_stack_group(**kwargs)
+        stacks = [ stack.stack for stack in group.stacks.values() ]
+        skip = self.prepare_stacks_up(stacks, force=force)
+        images = [ image for stack in stacks if stack.name not in skip for image in get_compose_stack_images(stack) ]
+        if len(images) > 0:
+            # Pull any missing images of all stacks in parallel, rather than letting each
+            # docker compose up pull its own one at a time. Present images are not checked
+            # against the registry here; use "hub images prefetch" for that.
+            results = asyncio.run(ImageManager().ensure_images(images, ttl=float('inf')))
+            failed = [ r for r in results if r.action == "failed" ]
+            if len(failed) > 0:
+                raise CmdExitError(1, f"Unable to pull image {failed[0].image}: {failed[0].error}")
+        asyncio.run(group.up(skip=skip))
 
     def hub_down(self, **kwargs) -> None:
-        self.portainer_down(**kwargs)
-        self.traefik_down(**kwargs)
+        asyncio.run(self.get_hub_stack_group(**kwargs).down())
 
     def hub_ps(self, **kwargs) -> None:
-        self.traefik_ps(**kwargs)
-        self.portainer_ps(**kwargs)
+        ps_options: Optional[List[str]] = kwargs.pop('ps_options', None)
+        for text in asyncio.run(self.get_hub_stack_group(**kwargs).ps(ps_options)).values():
+            print(text, end='')
 
     def cmd_traefik_up(self) -> int:
-        self.traefik_up()
+        self.traefik_up(force=self._args.force, rolling=self._args.rolling, probe_rate=self._args.probe_rate)
         return 0
 
     def cmd_traefik_down(self) -> int:
@@ -186,7 +319,7 @@ class CommandHandler:
         return 0
 
     def cmd_portainer_up(self) -> int:
-        self.portainer_up()
+        self.portainer_up(force=self._args.force)
         return 0
 
     def cmd_portainer_down(self) -> int:
@@ -207,24 +340,62 @@ class CommandHandler:
     
     _portainer_password_reset_re = re.compile(r'^.*Use the following password to login: (.*)$')
 
+    def get_portainer_server_container(self) -> Optional[JsonableDict]:
+        """The Portainer server container of the Portainer stack (not the agent), if it exists"""
+        project_name = self.get_portainer_stack().project_name
+        containers = get_docker_containers(
+            all=True,
+            filters={ "label": [ f"com.docker.compose.project={project_name}", "com.docker.compose.service=portainer" ] },
+          )
+        return containers[0] if len(containers) > 0 else None
+
     def cmd_portainer_reset_admin_password(self) -> int:
         format_as_json = self._args.json
-        is_up = self.portainer_has_running_conainers()
-        if is_up:
-            self.portainer_down()
-
-        docker_call_output(["pull", "portainer/helper-reset-password"])
-
-        cmd: List[str] = ["docker", "run", "--rm", "-v", "portainer_data:/data", "portainer/helper-reset-password"]
-        with sudo_Popen(             # type: ignore [misc]
-                cmd,
-                use_sudo=False,
-                run_with_group="docker",
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            ) as proc:
-            (stdout_bytes, stderr_bytes) = cast(Tuple[bytes, bytes], proc.communicate())
-            exit_code = proc.returncode
+
+        # Get the helper image before anything is stopped, so a pull is never part of the outage
+        result = ImageManager().ensure_image(PORTAINER_RESET_PASSWORD_HELPER_IMAGE)
+        if result.action == "failed":
+            raise CmdExitError(1, f"Unable to pull image {result.image}: {result.error}")
+
+        # The helper rewrites the Portainer database (portainer.db in portainer_data), which only
+        # the server opens, and holds an exclusive lock on while it runs. The agent also mounts
+        # portainer_data, but does not open the database, so it, and the stacks it manages,
+        # keep running.
+        container = self.get_portainer_server_container()
+        container_id: Optional[str] = None
+        if container is not None and container.get('State') == 'running':
+            container_id = container['Id']
+        stop_time = time.monotonic()
+        if container_id is not None:
+            docker_call_output(["stop", "--time", "10", container_id])
+
+        cmd: List[str] = [
+            "docker", "run", "--rm", "--network", "none", "-v", "portainer_data:/data", PORTAINER_RESET_PASSWORD_HELPER_IMAGE
+          ]
+        try:
+            with sudo_Popen(             # type: ignore [misc]
+                    cmd,
+                    use_sudo=False,
+                    run_with_group="docker",
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                ) as proc:
+                (stdout_bytes, stderr_bytes) = cast(Tuple[bytes, bytes], proc.communicate())
+                exit_code = proc.returncode
+        finally:
+            if container_id is not None:
+                docker_call_output(["start", container_id])
+        if container_id is not None:
+            ready = asyncio.run(wait_ready(get_portainer_readiness_checks(
+                self.get_portainer_stack().project_name,
+                include_agent=False,
+              )))
+            if all(r.ready for r in ready):
+                print(f"Portainer was unavailable for {time.monotonic() - stop_time:.1f} seconds", file=sys.stderr)
+            else:
+                print(format_readiness_report(ready), file=sys.stderr)
+                print("Warning: Portainer did not become ready after the password reset", file=sys.stderr)
+
         if exit_code != 0:
             stderr_s = stderr_bytes.decode('utf-8').rstrip()
             raise CalledProcessErrorWithStderrMessage(exit_code, cmd, stderr=stderr_s, output=stdout_bytes)
@@ -239,9 +410,6 @@ class CommandHandler:
         else:
             print(text, file=sys.stderr)
             raise HubError("Failed to reset Portainer admin password")
-        
-        if is_up:
-            self.portainer_up()
 
         if format_as_json:
             print(json.dumps(password))
@@ -250,15 +418,160 @@ class CommandHandler:
         return 0
 
     def cmd_up(self) -> int:
-        self.hub_up()
+        wait_ready_timeout: Optional[float] = self._args.wait_ready
+        self.hub_up(force=self._args.force)
+        if wait_ready_timeout is not None:
+            checks = get_hub_readiness_checks(
+                self.get_traefik_stack().project_name,
+                self.get_portainer_stack().project_name,
+              )
+            results = asyncio.run(wait_ready(checks, timeout=wait_ready_timeout))
+            print(format_readiness_report(results))
+            if not all(r.ready for r in results):
+                raise CmdExitError(1, f"Hub not ready within {wait_ready_timeout:g} seconds")
         return 0
 
     def cmd_down(self) -> int:
         self.hub_down()
         return 0
 
+    def cmd_images_prefetch(self) -> int:
+        ttl: Optional[float] = 0.0 if self._args.force else self._args.ttl
+        manager = ImageManager(max_parallel=self._args.parallel)
+        results = asyncio.run(manager.ensure_images(self.get_hub_images(), ttl=ttl))
+        print(format_image_results(results))
+        failed = [ r for r in results if r.action == "failed" ]
+        if len(failed) > 0:
+            raise CmdExitError(1, f"Unable to prefetch {len(failed)} of {len(results)} images")
+        return 0
+
+    def cmd_gc(self) -> int:
+        dry_run: bool = self._args.dry_run
+        format_as_json: bool = self._args.json
+        current_images = [
+            image for stack in (self.get_traefik_stack(), self.get_portainer_stack()) for image in get_compose_stack_images(stack)
+          ]
+        try:
+            report = get_gc_report(current_images, keep_versions=self._args.keep)
+        except HubError as e:
+            raise CmdExitError(1, str(e)) from e
+        results = [] if dry_run else prune_gc_report(report, include_build_cache=self._args.build_cache)
+        removed = [ r for r in results if r.removed ]
+        failed = [ r for r in results if not r.removed ]
+        if format_as_json:
+            data = report.to_jsonable()
+            if not dry_run:
+                data['removed'] = [ r.item.to_jsonable() for r in removed ]
+                data['failed'] = [ dict(r.item.to_jsonable(), error=r.error) for r in failed ]
+            print(json.dumps(data, indent=2))
+        else:
+            print(format_gc_report(report, show_all=self._args.all))
+            if not dry_run:
+                reclaimed = sum(r.item.size for r in removed)
+                print(f"\nRemoved {len(removed)} resources, reclaiming {format_bytes(reclaimed)}")
+                for r in failed:
+                    print(f"Unable to remove {r.item.kind} {r.item.name}: {r.error}", file=sys.stderr)
+        return 1 if len(failed) > 0 else 0
+
+    async def watch_hub_ps(self, interval: float, format_as_json: bool) -> None:
+        async for statuses, changes in watch_stack_statuses(interval=interval):
+            timestamp = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+            if format_as_json:
+                if len(changes) == 0:
+                    print(json.dumps(dict(time=timestamp, snapshot=[ s.to_jsonable() for s in statuses ])), flush=True)
+                for change in changes:
+                    print(json.dumps(dict(time=timestamp, **change)), flush=True)
+            elif len(changes) == 0:
+                print(format_stack_statuses(statuses), flush=True)
+            else:
+                for change in changes:
+                    print(f"[{timestamp}] {format_stack_status_change(change)}", flush=True)
+
+    def cmd_logs(self) -> int:
+        services: Optional[List[str]] = self._args.services
+        show_timestamps: bool = self._args.timestamps
+        since: Optional[float] = None if self._args.since is None else parse_log_since(self._args.since)
+        line_filter = LogFilter(min_level=self._args.level, pattern=self._args.grep)
+        sources = get_stack_log_sources(HUB_STACK_NAMES, services=services)
+        if len(sources) == 0:
+            raise CmdExitError(1, "No matching hub containers found")
+        width = max(len(source.name) for source in sources)
+        follower = MultiplexedLogFollower(
+            sources,
+            follow=self._args.follow,
+            tail=self._args.tail,
+            since=since,
+            line_filter=line_filter,
+            max_buffered_lines=self._args.buffer_lines,
+          )
+        try:
+            with follower:
+                for line in follower:
+                    prefix = f"{line.source:<{width}} | "
+                    if show_timestamps:
+                        prefix += line.timestamp + " "
+                    sys.stdout.write(prefix + line.text + "\n")
+                    if follower.num_buffered == 0:
+                        sys.stdout.flush()
+        except KeyboardInterrupt:
+            return 130
+        sys.stdout.flush()
+        return 0
+
     def cmd_ps(self) -> int:
-        self.hub_ps()
+        format_as_json: bool = self._args.json
+        watch: bool = self._args.watch
+        if watch:
+            try:
+                asyncio.run(self.watch_hub_ps(self._args.interval, format_as_json))
+            except KeyboardInterrupt:
+                return 130
+        elif format_as_json:
+            statuses = asyncio.run(get_stack_statuses())
+            print(json.dumps([ s.to_jsonable() for s in statuses ], indent=2))
+        else:
+            self.hub_ps()
+        return 0
+
+    def cmd_stats(self) -> int:
+        format_as_json: bool = self._args.json
+        no_stream: bool = self._args.no_stream
+        interval: float = self._args.interval
+        services: Optional[List[str]] = self._args.services
+        is_tty = sys.stdout.isatty()
+        monitor = ContainerStatsMonitor(max_history=self._args.history, cli_interval=interval)
+        try:
+            with monitor:
+                tick = 0
+                while True:
+                    if tick % 5 == 0:
+                        # Pick up containers that have started or stopped
+                        monitor.sync(get_stats_containers(services=services))
+                    if tick == 0:
+                        if len(monitor.get_containers()) == 0:
+                            raise CmdExitError(1, "No running hub containers found")
+                        # Rates need two samples
+                        deadline = time.monotonic() + max(interval, 2.5)
+                        while (time.monotonic() < deadline and
+                               any(len(c.history) < 2 for c in monitor.get_containers())):
+                            time.sleep(0.1)
+                    else:
+                        time.sleep(interval)
+                    tick += 1
+                    containers = monitor.get_containers()
+                    if format_as_json:
+                        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+                        for c in containers:
+                            print(json.dumps(dict(time=timestamp, **c.to_jsonable())))
+                    elif is_tty and not no_stream:
+                        print("\x1b[H\x1b[2J" + format_container_stats(containers))
+                    else:
+                        print(format_container_stats(containers) + ("" if no_stream else "\n"))
+                    sys.stdout.flush()
+                    if no_stream:
+                        break
+        except KeyboardInterrupt:
+            return 130
         return 0
 
     def rebuild_traefik_env(self) -> None:
@@ -456,16 +769,32 @@ class CommandHandler:
 
     def cmd_build(self) -> int:
         target: str = self._args.target or "hub"
+        show_diff: bool = self._args.diff
+        dry_run: bool = self._args.dry_run or show_diff
+        show_secrets: bool = self._args.show_secrets
+
+        fs = MemoryBuildFs() if dry_run else None
 
         if target == 'hub':
-            build_hub()
+            build_hub(fs=fs)
         elif target == 'traefik':
-            build_traefik()
+            build_traefik(fs=fs)
         elif target == 'portainer':
-            build_portainer()
+            build_portainer(fs=fs)
         else:
             raise ValueError(f"Invalid build target {target}")
 
+        if fs is not None:
+            changed, diff_text = diff_memory_build_fs(fs, mask_secrets=not show_secrets)
+            if show_diff:
+                print(diff_text, end='')
+            else:
+                for rel_path in changed:
+                    action = "remove" if rel_path in fs.removed else "update"
+                    print(f"would {action}: {rel_path}")
+            # Like diff(1): 0 if the build is up to date, 1 if it would change anything
+            return 1 if len(changed) > 0 else 0
+
         return 0
 
     def cmd_install_prereqs(self) -> int:
@@ -473,26 +802,17 @@ class CommandHandler:
 
         username = os.environ["USER"]
 
-        # Install docker
-        if not docker_is_installed() or force:
-            install_docker(force=force)
-
-        # Install docker-compose
-        if not docker_compose_is_installed() or force:
-            install_docker_compose(force=force)
-
-        # Install aws-cli
-        if not aws_cli_is_installed() or force:
-            install_aws_cli(force=force)
-
-        # Create the "traefik" network if it doesn't exist:
-        create_docker_network("traefik")
-
-        # Create The "traefik_acme" volume if it doesn't exist:
-        create_docker_volume("traefik_acme")
-
-        # Create the "portainer_data" volume if it doesn't exist:
-        create_docker_volume("portainer_data")
+        # The network probes are independent of provisioning, so they run alongside it
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            probes: List[concurrent.futures.Future[Any]] = [ executor.submit(get_public_ipv4_egress_address), executor.submit(get_internet_ipv4_route_info) ]
+            results = Provisioner(get_hub_prereq_steps(include_cloudflared=False)).run(force=force)
+            logger.info(f"Provisioning results:\n{format_provisioning_results(results)}")
+            failed = [ r for r in results if r.action == "failed" ]
+            if len(failed) > 0:
+                print(format_provisioning_results(results), file=sys.stderr)
+                raise CmdExitError(1, f"Failed to provision {failed[0].name}: {failed[0].error}")
+            for probe in probes:
+                probe.result()
 
         public_ip_addr = get_public_ipv4_egress_address()
         gateway_lan_ip_addr = get_gateway_lan_ip4_address()
@@ -521,6 +841,11 @@ class CommandHandler:
         self._args.subparser.print_help(sys.stderr)
         return 1
 
+    def cmd_images_bare(self) -> int:
+        print("Error: A command is required\n", file=sys.stderr)
+        self._args.subparser.print_help(sys.stderr)
+        return 1
+
     def cmd_portainer_bare(self) -> int:
         print("Error: A command is required\n", file=sys.stderr)
         self._args.subparser.print_help(sys.stderr)
@@ -553,6 +878,11 @@ class CommandHandler:
         parser.add_argument('--log-level', '-l', type=str.lower, dest='log_level', default='warning',
                             choices=['debug', 'infos', 'warning', 'error', 'critical'],
                             help='''The logging level to use. Default: warning''')
+        parser.add_argument('--trace-subprocess', action='store_true', default=False,
+                            help='Log each subprocess (docker, docker compose, ip, ...) to stderr as it finishes, with its'
+                                 ' duration, exit code and bytes transferred, and display a summary table at the end')
+        parser.add_argument('--trace-subprocess-file', default=None, metavar='PATH',
+                            help='Append a JSON line for each subprocess to PATH, for later analysis')
         parser.set_defaults(func=self.cmd_bare, subparser=parser)
 
         subparsers = parser.add_subparsers(
@@ -566,6 +896,13 @@ class CommandHandler:
                                 description='''Build artifacts required to run the hub stacks.''')
         sp.add_argument("--force", "-f", action="store_true",
                             help="Force clean build")
+        sp.add_argument("--dry-run", "-n", action="store_true",
+                            help="Render the build in memory and list the artifacts that would change, without writing"
+                                 " anything. Exits with 1 if anything would change, 0 otherwise.")
+        sp.add_argument("--diff", action="store_true",
+                            help="Like --dry-run, but display unified diffs against the current build artifacts.")
+        sp.add_argument("--show-secrets", action="store_true",
+                            help="With --diff, do not mask the values in .env files.")
         sp.add_argument("target", nargs='?', default="hub", choices=["hub", "traefik", "portainer"],
                             help="The build target to build. Default: hub")
         sp.set_defaults(func=self.cmd_build, subparser=sp)
@@ -687,6 +1024,13 @@ class CommandHandler:
 
         sp = traefik_subparsers.add_parser('up',
                                 description='''Start the Traefik stack.''')
+        sp.add_argument("--force", "-f", action="store_true",
+                            help="Run docker compose up even if the stack is already running with its current configuration")
+        sp.add_argument("--rolling", action="store_true",
+                            help="If Traefik is running, keep it serving until a canary of the new configuration is healthy, "
+                                 "then switch, and report requests that failed during the switch")
+        sp.add_argument("--probe-rate", type=float, default=20.0,
+                            help="With --rolling, requests per second sent to each entrypoint during the switch. Default: 20")
         sp.set_defaults(func=self.cmd_traefik_up, subparser=sp)
 
         # ======================= traefik down
@@ -723,6 +1067,8 @@ class CommandHandler:
 
         sp = portainer_subparsers.add_parser('up',
                                 description='''Start the Portainer stack.''')
+        sp.add_argument("--force", "-f", action="store_true",
+                            help="Run docker compose up even if the stack is already running with its current configuration")
         sp.set_defaults(func=self.cmd_portainer_up, subparser=sp)
 
         # ======================= portainer down
@@ -748,7 +1094,8 @@ class CommandHandler:
         # ======================= portainer reset-admin-password
 
         sp = portainer_subparsers.add_parser('reset-admin-password',
-                                description='''Reset the admin password for an already-initialized Portainer service to a random value, and write the value to stdout.''')
+                                description='''Reset the admin password for an already-initialized Portainer service to a random value, and write the value to stdout. '''
+                                            '''Only the Portainer server container is stopped while the password is reset; the agent keeps running.''')
         sp.add_argument('--json', "-j", action='store_true', default=False,
                             help='Output the password encoded as a JSON string.')
         sp.set_defaults(func=self.cmd_portainer_reset_admin_password, subparser=sp)
@@ -757,6 +1104,13 @@ class CommandHandler:
 
         sp = subparsers.add_parser('up',
                                 description='''Start the hub.''')
+        sp.add_argument("--force", "-f", action="store_true",
+                            help="Run docker compose up even if the stacks are already running with its current configuration")
+        sp.add_argument("--wait-ready", nargs='?', type=float, const=DEFAULT_READY_TIMEOUT, default=None,
+                            metavar="TIMEOUT",
+                            help="Wait until Traefik and Portainer are healthy and serving, and report the time each"
+                                 " took to become ready. Fails with diagnostics if not ready in TIMEOUT seconds."
+                                 f" Default TIMEOUT: {DEFAULT_READY_TIMEOUT:g}")
         sp.set_defaults(func=self.cmd_up, subparser=sp)
 
         # ======================= down
@@ -765,12 +1119,104 @@ class CommandHandler:
                                 description='''Stop the hub.''')
         sp.set_defaults(func=self.cmd_down, subparser=sp)
 
+        # ======================= logs
+
+        sp = subparsers.add_parser('logs',
+                                description='''Display the logs of all hub containers, merged in timestamp order.''')
+        sp.add_argument("--follow", "-f", action="store_true",
+                            help="Continue monitoring and follow new log messages")
+        sp.add_argument("--since", default=None,
+                            help="Only show lines since a time: a duration (e.g., 10m, 2h), a UNIX time, or an ISO 8601 date/time")
+        sp.add_argument("--tail", "-n", type=int, default=None,
+                            help="Start with only the last TAIL lines of each container")
+        sp.add_argument("--service", "-s", dest="services", action="append", default=None,
+                            help="Only show logs of this service or container name. May be repeated.")
+        sp.add_argument("--level", type=str.lower, default=None, choices=LOG_LEVELS,
+                            help="Only show lines at or above this level. Lines with no recognized level are always shown.")
+        sp.add_argument("--grep", "-g", default=None, metavar="REGEX",
+                            help="Only show lines matching a regular expression")
+        sp.add_argument("--timestamps", "-t", action="store_true",
+                            help="Show the timestamp docker recorded for each line")
+        sp.add_argument("--buffer-lines", type=int, default=10000,
+                            help="The maximum number of lines buffered if output falls behind. When following, new lines"
+                                 " are dropped (oldest first) if output stays behind; otherwise no lines are dropped."
+                                 " Default: 10000")
+        sp.set_defaults(func=self.cmd_logs, subparser=sp)
+
         # ======================= ps
 
         sp = subparsers.add_parser('ps',
                                 description='''Display lists of Traefik and Portainer docker containers.''')
+        sp.add_argument('--json', "-j", action='store_true', default=False,
+                            help='Output structured status of the hub and Portainer-managed stack containers as JSON.'
+                                 ' With --watch, output JSON lines.')
+        sp.add_argument('--watch', "-w", action='store_true', default=False,
+                            help='Display the status, then poll and display only changes until interrupted.')
+        sp.add_argument('--interval', type=float, default=2.0,
+                            help='With --watch, the number of seconds between polls. Default: 2')
         sp.set_defaults(func=self.cmd_ps, subparser=sp)
 
+        # ======================= stats
+
+        sp = subparsers.add_parser('stats',
+                                description='''Display live CPU, memory, network and block IO usage of the hub and
+                                               Portainer-managed stack containers, from the docker stats streams.''')
+        sp.add_argument('--json', "-j", action='store_true', default=False,
+                            help='Output a JSON line per container at each interval')
+        sp.add_argument('--no-stream', action='store_true', default=False,
+                            help='Display one sample of each container and exit')
+        sp.add_argument('--interval', type=float, default=2.0,
+                            help='Seconds between displays. Default: 2')
+        sp.add_argument("--service", "-s", dest="services", action="append", default=None,
+                            help="Only show this service or container name. May be repeated.")
+        sp.add_argument('--history', type=int, default=DEFAULT_STATS_HISTORY,
+                            help=f'The number of samples kept in memory per container. Default: {DEFAULT_STATS_HISTORY}')
+        sp.set_defaults(func=self.cmd_stats, subparser=sp)
+
+        # ======================= images
+
+        sp = subparsers.add_parser('images',
+                                description='''Manage the docker images used by the hub.''')
+        sp.set_defaults(func=self.cmd_images_bare, subparser=sp)
+        images_subparsers = sp.add_subparsers(
+                            title='Subcommands',
+                            description='Valid subcommands',
+                            help=f'Additional help available with "{PROGNAME} images <subcommand-name> -h"')
+
+        # ======================= images prefetch
+
+        sp = images_subparsers.add_parser('prefetch',
+                                description='''Pull the images used by the hub stacks and hub commands, in parallel.
+                                               Images confirmed current within TTL seconds are not checked against the registry;
+                                               older ones are pulled only if their tag has moved. Resolved digests are recorded
+                                               in build/image-digests.json.''')
+        sp.add_argument("--ttl", type=float, default=None,
+                            help="Seconds for which a confirmed image digest is trusted without asking the registry. Default: 86400")
+        sp.add_argument("--force", "-f", action="store_true",
+                            help="Check every image against the registry, regardless of the TTL")
+        sp.add_argument("--parallel", type=int, default=4,
+                            help="The maximum number of images pulled at once. Default: 4")
+        sp.set_defaults(func=self.cmd_images_prefetch, subparser=sp)
+
+        # ======================= gc
+
+        sp = subparsers.add_parser('gc',
+                                description='''Show the disk used by docker resources related to the hub, and remove what is reclaimable:
+                                               old versions of the hub stack images, stopped containers left by hub helper runs,
+                                               and dangling volumes of the hub stacks. The traefik_acme and portainer_data volumes
+                                               are never removed.''')
+        sp.add_argument("--keep", type=int, default=DEFAULT_KEEP_VERSIONS,
+                            help=f"The number of versions older than the current one to keep of each hub image. Default: {DEFAULT_KEEP_VERSIONS}")
+        sp.add_argument("--dry-run", "-n", action="store_true",
+                            help="Only show what is reclaimable; remove nothing")
+        sp.add_argument("--build-cache", action="store_true",
+                            help="Also prune unused docker build cache")
+        sp.add_argument("--all", "-a", action="store_true",
+                            help="List every hub-related resource, not just the reclaimable ones")
+        sp.add_argument('--json', "-j", action='store_true', default=False,
+                            help='Output the report as JSON')
+        sp.set_defaults(func=self.cmd_gc, subparser=sp)
+
         # ======================= version
 
         sp = subparsers.add_parser('version',
@@ -791,6 +1237,11 @@ class CommandHandler:
                 level=logging.getLevelName(args.log_level.upper()),
             )
             self._args = args
+            if args.trace_subprocess or args.trace_subprocess_file is not None:
+                get_subprocess_tracer().enable(
+                    live_out=sys.stderr if args.trace_subprocess else None,
+                    jsonl_pathname=args.trace_subprocess_file,
+                  )
             func: Callable[[], int] = args.func
             logging.debug(f"Running command {func.__name__}, tb = {traceback}")
             rc = func()
@@ -812,6 +1263,12 @@ class CommandHandler:
         except BaseException as ex:
             print(f"{PROGNAME}: Unhandled exception {ex.__class__.__name__}: {ex}", file=sys.stderr)
             raise
+        finally:
+            tracer = get_subprocess_tracer()
+            if tracer.enabled:
+                if args.trace_subprocess:
+                    print(tracer.format_summary(), file=sys.stderr)
+                tracer.close()
 
         return rc
 
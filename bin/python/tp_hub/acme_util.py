@@ -16,21 +16,42 @@ import subprocess
 import json
 
 from .pkg_logging import logger
-from .docker_util import read_docker_volume_text_file, write_docker_volume_text_file, list_files_in_docker_volume
+from .docker_util import read_docker_volume_text_file, write_docker_volume_text_file, get_volume_session
 
 from .internal_types import *
 from .internal_types import _CMD, _FILE, _ENV
 
+TRAEFIK_ACME_FILE_PATTERNS = ('acme_*.json', 'acme.*json')
+"""fnmatch patterns for the acme files in the traefik_acme docker volume"""
+
+def _is_traefik_acme_file(name: str) -> bool:
+    return name.endswith('.json') and (name.startswith('acme_') or name.startswith('acme.'))
+
 def list_traefik_acme_files() -> List[str]:
     """
     List the acme files in the traefik_acme docker volume.
     """
     acme_files = [
-        x for x in list_files_in_docker_volume('traefik_acme')
-           if x.endswith('.json') and (x.startswith('acme_') or x.startswith('acme.'))
+        x for x in get_volume_session('traefik_acme').glob(TRAEFIK_ACME_FILE_PATTERNS)
+           if _is_traefik_acme_file(x)
       ]
     return acme_files
 
+def load_all_traefik_acme_data() -> Dict[str, JsonableDict]:
+    """
+    Get the acme data from all of the acme files in the traefik_acme docker volume,
+    reading them together in a single exchange with the volume.
+
+    Returns:
+        A dict mapping each acme filename to its acme data.
+    """
+    acme_contents = get_volume_session('traefik_acme').read_glob(TRAEFIK_ACME_FILE_PATTERNS)
+    return {
+        name: json.loads(content.decode('utf-8'))
+          for name, content in sorted(acme_contents.items())
+            if _is_traefik_acme_file(name)
+      }
+
 
 def load_traefik_acme_data(acme_file: str="acme_prod.json") -> JsonableDict:
     """
@@ -68,6 +89,19 @@ def save_traefik_acme_data(acme_data: JsonableDict, acme_file: str="acme_prod.js
         acme_content,
       )
 
+def save_all_traefik_acme_data(acme_files_data: Mapping[str, JsonableDict]) -> None:
+    """
+    Save the acme data for several acme files to the traefik_acme docker volume together.
+    All files are staged before any is replaced, so a failure while staging leaves every file unchanged.
+
+    Args:
+        acme_files_data: A dict mapping acme filename to the acme data to save.
+    """
+    get_volume_session('traefik_acme').write_many(
+        { name: (json.dumps(acme_data, indent=2, sort_keys=True) + '\n').encode('utf-8')
+            for name, acme_data in acme_files_data.items() },
+      )
+
 def get_acme_domain_data(acme_data: JsonableDict, domain: Optional[str]) -> List[Tuple[str, JsonableDict]]:
     """
     Get the acme certificate data records that correspond to a given domain.
@@ -0,0 +1,363 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+asyncio interfaces to docker-compose stacks, and an orchestrator that operates on a
+group of stacks concurrently while respecting their declared ordering.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import time
+import asyncio
+import subprocess
+from collections import deque
+from typing import Awaitable, Deque
+
+from project_init_tools.util import CalledProcessErrorWithStderrMessage
+
+from .internal_types import *
+from .pkg_logging import logger
+from .util import get_docker_command, create_docker_network
+from .subprocess_runner import trace_subprocess
+from .docker_compose_stack import DockerComposeStack
+
+class AsyncDockerComposeStack:
+    """
+    An asyncio counterpart of DockerComposeStack. It accepts the same constructor arguments,
+    and provides coroutine versions of its operations, so that several stacks can be operated
+    on at once from one thread.
+    """
+    stack: DockerComposeStack
+    """The synchronous stack, which holds the configuration"""
+
+    output_prefix: Optional[str]
+    """If not None, each line of docker-compose output is prefixed with this string, so that
+       output of stacks running concurrently can be told apart. If None, docker-compose writes
+       directly to this process's stdout and stderr."""
+
+    max_stderr_lines: int = 100
+    """The number of trailing stderr lines kept for exception messages"""
+
+    def __init__(
+            self,
+            compose_file: Optional[Union[str, List[str]]]=None,
+            *,
+            output_prefix: Optional[str]=None,
+            **kwargs: Any,
+          ):
+        """
+        Create an AsyncDockerComposeStack.
+
+        Args:
+            compose_file: The docker-compose file(s) to use, as for DockerComposeStack.
+            output_prefix: A prefix for each line of docker-compose output, or None to
+                let docker-compose write directly to stdout and stderr.
+            kwargs: Additional arguments for DockerComposeStack.
+        """
+        self.stack = DockerComposeStack(compose_file, **kwargs)
+        self.output_prefix = output_prefix
+
+    @classmethod
+    def from_stack(cls, stack: DockerComposeStack, output_prefix: Optional[str]=None) -> AsyncDockerComposeStack:
+        """Create an AsyncDockerComposeStack that shares the configuration of a DockerComposeStack"""
+        result = cls.__new__(cls)
+        result.stack = stack
+        result.output_prefix = output_prefix
+        return result
+
+    @property
+    def name(self) -> str:
+        """A friendly name of the stack, for logging purposes"""
+        return self.stack.name
+
+    async def _relay(
+            self,
+            reader: asyncio.StreamReader,
+            out: IO[str],
+            tail: Optional[Deque[str]]=None,
+          ) -> int:
+        n = 0
+        while True:
+            line_bytes = await reader.readline()
+            if line_bytes == b'':
+                return n
+            n += len(line_bytes)
+            line = line_bytes.decode('utf-8', errors='replace').rstrip('\n')
+            if tail is not None:
+                tail.append(line)
+            out.write(f"{self.output_prefix}{line}\n")
+            out.flush()
+
+    async def call(
+            self,
+            args: List[str],
+            *,
+            stderr_exception: bool=False,
+          ) -> None:
+        """
+        Call docker-compose with the stack options and the given arguments.
+        Automatically uses `sg docker` if login session is not yet in the "docker" group.
+        If an error occurs, an exception is raised; if stderr_exception is True, it includes
+        the tail of stderr output.
+        """
+        cmd = get_docker_command(["compose"] + self.stack.options + args)
+        logger.debug(f"AsyncDockerComposeStack: Running {cmd}, cwd={self.stack.cwd!r}")
+        piped = self.output_prefix is not None
+        with trace_subprocess(cmd, "async") as record:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=subprocess.PIPE if piped else None,
+                stderr=subprocess.PIPE if piped or stderr_exception else None,
+                env=self.stack.env,
+                cwd=self.stack.cwd,
+              )
+            tail: Deque[str] = deque(maxlen=self.max_stderr_lines)
+            relays: List[Awaitable[int]] = []
+            if piped:
+                assert proc.stdout is not None and proc.stderr is not None
+                relays.append(self._relay(proc.stdout, sys.stdout))
+                relays.append(self._relay(proc.stderr, sys.stderr, tail))
+            elif stderr_exception:
+                assert proc.stderr is not None
+                relays.append(self._collect(proc.stderr, tail))
+            try:
+                relayed = await asyncio.gather(*relays)
+                exit_code = await proc.wait()
+            except BaseException:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+            if record is not None:
+                record.exit_code = exit_code
+                record.bytes_out = sum(relayed) if len(relays) > 0 else None
+        if exit_code != 0:
+            if stderr_exception:
+                raise CalledProcessErrorWithStderrMessage(exit_code, cmd, stderr="\n".join(tail))
+            raise subprocess.CalledProcessError(exit_code, cmd)
+
+    @staticmethod
+    async def _collect(reader: asyncio.StreamReader, tail: Deque[str]) -> int:
+        n = 0
+        while True:
+            line_bytes = await reader.readline()
+            if line_bytes == b'':
+                return n
+            n += len(line_bytes)
+            tail.append(line_bytes.decode('utf-8', errors='replace').rstrip('\n'))
+
+    async def call_output(
+            self,
+            args: List[str],
+            *,
+            stderr_exception: bool=True,
+          ) -> str:
+        """
+        Call docker-compose with the stack options and the given arguments and return the stdout text.
+        Automatically uses `sg docker` if login session is not yet in the "docker" group.
+        If an error occurs, an exception is raised.
+        """
+        cmd = get_docker_command(["compose"] + self.stack.options + args)
+        logger.debug(f"AsyncDockerComposeStack: Running {cmd}, cwd={self.stack.cwd!r}")
+        with trace_subprocess(cmd, "async") as record:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE if stderr_exception else None,
+                env=self.stack.env,
+                cwd=self.stack.cwd,
+              )
+            stdout_bytes, stderr_bytes = await proc.communicate()
+            assert proc.returncode is not None
+            if record is not None:
+                record.exit_code = proc.returncode
+                record.bytes_out = len(stdout_bytes) + len(stderr_bytes or b'')
+        if proc.returncode != 0:
+            if stderr_exception:
+                raise CalledProcessErrorWithStderrMessage(
+                    proc.returncode, cmd, stderr=stderr_bytes.decode('utf-8', errors='replace').rstrip())
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        return stdout_bytes.decode('utf-8')
+
+    async def up(self, stderr_exception: bool=False) -> None:
+        """
+        Start the stack
+        """
+        await self.call(["up"] + self.stack.up_options, stderr_exception=stderr_exception)
+
+    async def down(self) -> None:
+        """
+        Stop the stack
+        """
+        await self.call(["down"] + self.stack.down_options)
+
+    async def logs(self, options: Optional[List[str]]=None) -> None:
+        """
+        Display the logs for the stack
+        """
+        options = [] if options is None else options
+        await self.call(["logs"] + options)
+
+    async def ps(self, options: Optional[List[str]]=None) -> str:
+        """
+        Get the `docker compose ps` table of the docker containers associated with the stack
+        """
+        options = [] if options is None else options
+        return await self.call_output(["ps"] + options)
+
+    async def has_running_containers(self) -> bool:
+        """
+        Return True if the stack has any running containers
+        """
+        text = await self.call_output(["ps", "-q"])
+        return text.rstrip() != ""
+
+    async def __aenter__(self) -> AsyncDockerComposeStack:
+        """Enters a context for the stack, bringing it down if auto_down_on_enter is True,
+           then bringing it up if auto_up is True.
+        """
+        try:
+            if self.stack.auto_down_on_enter:
+                await self.down()
+            if self.stack.auto_up:
+                await self.up(stderr_exception=self.stack.up_stderr_exception)
+        except BaseException:
+            if self.stack.auto_up:
+                logger.debug("Failed to start docker-compose stack; tearing down")
+                await self.down()
+            raise
+        return self
+
+    async def __aexit__(
+            self,
+            exc_type: Optional[type[BaseException]],
+            exc_val: Optional[BaseException],
+            exc_tb: Optional[TracebackType],
+          ) -> None:
+        """Exits a context for the stack, bringing it down if auto_down is True"""
+        if self.stack.auto_down:
+            await self.down()
+
+class DockerComposeStackGroup:
+    """
+    A group of docker-compose stacks that are brought up and down together. Stacks with no
+    declared ordering between them are operated on concurrently, so bringing up the group
+    takes about as long as its slowest chain of ordered stacks rather than the sum.
+    """
+    stacks: Dict[str, AsyncDockerComposeStack]
+    """The stacks in the group, by name, in the order they were added"""
+
+    after: Dict[str, List[str]]
+    """For each stack, the names of the stacks that must be up before it is brought up (and
+       that are brought down only after it is down)"""
+
+    required_networks: List[str]
+    """External docker networks that are created, if necessary, before any stack is brought up"""
+
+    durations: Dict[str, float]
+    """Wall-clock seconds taken by each stack in the most recent operation"""
+
+    def __init__(self, required_networks: Optional[List[str]]=None):
+        self.stacks = {}
+        self.after = {}
+        self.required_networks = [] if required_networks is None else list(required_networks)
+        self.durations = {}
+
+    def add(self, stack: AsyncDockerComposeStack, after: Optional[List[str]]=None) -> None:
+        """
+        Add a stack to the group.
+
+        Args:
+            stack: The stack to add. Its name must be unique in the group.
+            after: The names of stacks already in the group that must be up before this
+                stack is brought up.
+        """
+        if stack.name in self.stacks:
+            raise HubError(f"Duplicate stack name '{stack.name}' in stack group")
+        after = [] if after is None else list(after)
+        for name in after:
+            if name not in self.stacks:
+                raise HubError(f"Stack '{stack.name}' is ordered after unknown stack '{name}'")
+        self.stacks[stack.name] = stack
+        self.after[stack.name] = after
+
+    async def _run_ordered(
+            self,
+            op_name: str,
+            op: Callable[[AsyncDockerComposeStack], Awaitable[None]],
+            reverse: bool=False,
+          ) -> None:
+        # Because dependencies can only name stacks added earlier, the ordering is acyclic.
+        if reverse:
+            deps: Dict[str, List[str]] = { name: [] for name in self.stacks }
+            for name, after in self.after.items():
+                for dep in after:
+                    deps[dep].append(name)
+        else:
+            deps = self.after
+        tasks: Dict[str, asyncio.Task[None]] = {}
+        self.durations = {}
+
+        async def run_one(name: str) -> None:
+            for dep in deps[name]:
+                try:
+                    await asyncio.shield(tasks[dep])
+                except Exception as e:
+                    raise HubError(f"Stack '{name}' not brought {op_name} because stack '{dep}' failed") from e
+            start_time = time.monotonic()
+            logger.debug(f"Bringing stack '{name}' {op_name}")
+            await op(self.stacks[name])
+            self.durations[name] = time.monotonic() - start_time
+            logger.info(f"Stack '{name}' {op_name} in {self.durations[name]:.1f} seconds")
+
+        for name in self.stacks:
+            tasks[name] = asyncio.create_task(run_one(name), name=f"{op_name}-{name}")
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        errors = [ (name, result) for name, result in zip(tasks.keys(), results) if isinstance(result, BaseException) ]
+        if len(errors) > 0:
+            for name, error in errors[1:]:
+                logger.error(f"Stack '{name}': {error}")
+            raise errors[0][1]
+
+    async def up(self, stderr_exception: bool=False, skip: Optional[Iterable[str]]=None) -> None:
+        """
+        Create the required networks, then bring up all stacks, respecting their ordering.
+
+        Args:
+            stderr_exception: If True, exceptions include the tail of docker-compose stderr.
+            skip: The names of stacks that are known to be up to date. They are treated as
+                already up, so stacks ordered after them do not wait.
+        """
+        skip_names = set() if skip is None else set(skip)
+
+        async def up_one(stack: AsyncDockerComposeStack) -> None:
+            if stack.name in skip_names:
+                logger.debug(f"Stack '{stack.name}' is up to date; not running docker-compose")
+            else:
+                await stack.up(stderr_exception=stderr_exception)
+
+        for network_name in self.required_networks:
+            await asyncio.to_thread(create_docker_network, network_name)
+        await self._run_ordered("up", up_one)
+
+    async def down(self) -> None:
+        """Bring down all stacks, in the reverse of their ordering"""
+        await self._run_ordered("down", lambda stack: stack.down(), reverse=True)
+
+    async def ps(self, options: Optional[List[str]]=None) -> Dict[str, str]:
+        """Get the `docker compose ps` table of each stack, queried concurrently"""
+        names = list(self.stacks.keys())
+        results = await asyncio.gather(*(self.stacks[name].ps(options) for name in names))
+        return dict(zip(names, results))
+
+    async def has_running_containers(self) -> Dict[str, bool]:
+        """Determine, concurrently, whether each stack has any running containers"""
+        names = list(self.stacks.keys())
+        results = await asyncio.gather(*(self.stacks[name].has_running_containers() for name in names))
+        return dict(zip(names, results))
@@ -11,3 +11,14 @@ Builder tools for this project
 from .traefik_builder import build_traefik
 from .portainer_builder import build_portainer
 from .hub_builder import build_hub
+from .router_index_builder import build_router_index, find_project_compose_files
+from .route_catalog_builder import build_route_catalog, find_route_catalog_files
+from .static_asset_builder import build_static_site, build_static_sites
+from .build_fs import (
+    BuildFs,
+    DiskBuildFs,
+    MemoryBuildFs,
+    MemoryBuildFile,
+    diff_memory_build_fs,
+    mask_env_file_text,
+  )
@@ -0,0 +1,415 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+Output filesystems for builders.
+
+Builders never write build artifacts directly; they write through a BuildFs. A DiskBuildFs
+writes into the project build directory (the normal `hub build`), while a MemoryBuildFs
+captures the artifacts in memory so they can be compared against the current build
+(`hub build --dry-run --diff`) or inspected by tests without touching the filesystem.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import hmac
+import difflib
+import hashlib
+
+from ..internal_types import *
+from ..pkg_logging import logger
+from ..util import rel_symlink, atomic_mv
+from ..proj_dirs import get_project_dir, get_project_build_dir
+
+class BuildFs:
+    """
+    Abstract destination for build artifacts. All paths are relative to the build directory.
+    """
+    build_dir: str
+    """The absolute path of the build directory that artifacts are (or would be) written into"""
+
+    persist_caches: bool = True
+    """True if builders may persist caches outside the BuildFs (e.g., compiled YAML templates);
+       False for a build that must not write anything"""
+
+    def __init__(self, build_dir: Optional[str]=None):
+        if build_dir is None:
+            build_dir = get_project_build_dir()
+        self.build_dir = os.path.abspath(build_dir)
+
+    def get_abs_path(self, rel_path: str) -> str:
+        """Get the absolute path of an artifact in the build directory"""
+        return os.path.join(self.build_dir, rel_path)
+
+    def makedirs(self, rel_dir: str, mode: int=0o700) -> None:
+        """Create a directory (and parents) in the build directory if it does not exist"""
+        raise NotImplementedError()
+
+    def write_text_file(self, rel_path: str, content: str, mode: int=0o600) -> None:
+        """Atomically create or replace a text file in the build directory"""
+        raise NotImplementedError()
+
+    def write_binary_file(self, rel_path: str, data: bytes, mode: int=0o600) -> None:
+        """Atomically create or replace a binary file in the build directory"""
+        raise NotImplementedError()
+
+    def remove_file(self, rel_path: str) -> None:
+        """Remove a file from the build directory if it exists"""
+        raise NotImplementedError()
+
+    def symlink(self, rel_path: str, target: str) -> None:
+        """Create or replace a relative symlink in the build directory that points at absolute path target"""
+        raise NotImplementedError()
+
+    def project_symlink(self, project_path: str, rel_path: str) -> None:
+        """Create a relative symlink at absolute path project_path, outside the build directory, that
+           points at an artifact in the build directory. An existing symlink is left alone."""
+        raise NotImplementedError()
+
+    def exists(self, rel_path: str) -> bool:
+        """Return True if an artifact exists (or would exist) in the build directory"""
+        return os.path.exists(self.get_abs_path(rel_path))
+
+    def read_text_file(self, rel_path: str) -> str:
+        """Get the content of an artifact in the build directory, as written (or as would be written)"""
+        with open(self.get_abs_path(rel_path), encoding='utf-8') as f:
+            return f.read()
+
+    def read_binary_file(self, rel_path: str) -> bytes:
+        """Get the content of an artifact in the build directory as bytes, as written (or as would be written)"""
+        with open(self.get_abs_path(rel_path), 'rb') as f:
+            return f.read()
+
+    def list_files(self, rel_dir: str) -> List[str]:
+        """Get the sorted names of the regular files in a build directory subdirectory"""
+        dirname = self.get_abs_path(rel_dir)
+        if not os.path.isdir(dirname):
+            return []
+        return sorted(x for x in os.listdir(dirname) if os.path.isfile(os.path.join(dirname, x)))
+
+    def walk_files(self, rel_dir: str) -> List[str]:
+        """Get the sorted paths, relative to rel_dir, of all regular files in a build directory subtree"""
+        dirname = self.get_abs_path(rel_dir)
+        result: List[str] = []
+        for dirpath, _, filenames in os.walk(dirname):
+            for filename in filenames:
+                pathname = os.path.join(dirpath, filename)
+                if os.path.isfile(pathname) and not os.path.islink(pathname):
+                    result.append(os.path.relpath(pathname, dirname))
+        return sorted(result)
+
+def _file_is_unchanged(pathname: str, data: bytes, mode: int) -> bool:
+    if os.path.islink(pathname) or not os.path.isfile(pathname):
+        return False
+    st = os.stat(pathname)
+    if st.st_mode & 0o777 != mode or st.st_size != len(data):
+        return False
+    try:
+        with open(pathname, 'rb') as f:
+            return f.read() == data
+    except OSError:
+        return False
+
+class DiskBuildFs(BuildFs):
+    """
+    A BuildFs that writes artifacts into the build directory on disk.
+    """
+    def makedirs(self, rel_dir: str, mode: int=0o700) -> None:
+        os.makedirs(self.build_dir, exist_ok=True)
+        os.makedirs(self.get_abs_path(rel_dir), mode=mode, exist_ok=True)
+
+    def write_text_file(self, rel_path: str, content: str, mode: int=0o600) -> None:
+        self.write_binary_file(rel_path, content.encode('utf-8'), mode=mode)
+
+    def write_binary_file(self, rel_path: str, data: bytes, mode: int=0o600) -> None:
+        pathname = self.get_abs_path(rel_path)
+        if _file_is_unchanged(pathname, data, mode):
+            # Leave the file (and its mtime) alone, so that watchers such as the Traefik
+            # file provider do not see a spurious change.
+            return
+        tmp_pathname = pathname + ".tmp"
+        if os.path.exists(tmp_pathname):
+            os.unlink(tmp_pathname)
+        try:
+            with open(os.open(tmp_pathname, os.O_CREAT | os.O_WRONLY, mode), 'wb') as f:
+                f.write(data)
+            atomic_mv(tmp_pathname, pathname, force=True)
+        finally:
+            if os.path.exists(tmp_pathname):
+                os.unlink(tmp_pathname)
+
+    def remove_file(self, rel_path: str) -> None:
+        pathname = self.get_abs_path(rel_path)
+        if os.path.exists(pathname) or os.path.islink(pathname):
+            os.unlink(pathname)
+
+    def symlink(self, rel_path: str, target: str) -> None:
+        pathname = self.get_abs_path(rel_path)
+        if os.path.exists(pathname) or os.path.islink(pathname):
+            os.unlink(pathname)
+        rel_symlink(target, pathname)
+
+    def project_symlink(self, project_path: str, rel_path: str) -> None:
+        if not os.path.islink(project_path):
+            rel_symlink(self.get_abs_path(rel_path), project_path)
+
+class MemoryBuildFile:
+    """
+    A build artifact captured by a MemoryBuildFs. Exactly one of content, data or link_target is set.
+    """
+    content: Optional[str]
+    """The text content of a regular file"""
+
+    data: Optional[bytes]
+    """The content of a binary regular file"""
+
+    mode: int
+    """The file mode of a regular file"""
+
+    link_target: Optional[str]
+    """The relative target of a symlink, as it would be written by rel_symlink"""
+
+    def __init__(
+            self,
+            content: Optional[str]=None,
+            mode: int=0o600,
+            link_target: Optional[str]=None,
+            data: Optional[bytes]=None,
+          ):
+        self.content = content
+        self.data = data
+        self.mode = mode
+        self.link_target = link_target
+
+class MemoryBuildFs(BuildFs):
+    """
+    A BuildFs that captures artifacts in memory. Nothing is written to disk.
+    """
+    persist_caches = False
+
+    files: Dict[str, MemoryBuildFile]
+    """The captured artifacts, keyed by path relative to the build directory"""
+
+    removed: Set[str]
+    """Paths, relative to the build directory, of artifacts that the build would remove"""
+
+    def __init__(self, build_dir: Optional[str]=None):
+        super().__init__(build_dir)
+        self.files = {}
+        self.removed = set()
+
+    def makedirs(self, rel_dir: str, mode: int=0o700) -> None:
+        pass
+
+    def write_text_file(self, rel_path: str, content: str, mode: int=0o600) -> None:
+        rel_path = os.path.normpath(rel_path)
+        self.removed.discard(rel_path)
+        self.files[rel_path] = MemoryBuildFile(content=content, mode=mode)
+
+    def write_binary_file(self, rel_path: str, data: bytes, mode: int=0o600) -> None:
+        rel_path = os.path.normpath(rel_path)
+        self.removed.discard(rel_path)
+        self.files[rel_path] = MemoryBuildFile(data=data, mode=mode)
+
+    def remove_file(self, rel_path: str) -> None:
+        rel_path = os.path.normpath(rel_path)
+        self.files.pop(rel_path, None)
+        if super().exists(rel_path):
+            self.removed.add(rel_path)
+
+    def symlink(self, rel_path: str, target: str) -> None:
+        rel_path = os.path.normpath(rel_path)
+        pathname = self.get_abs_path(rel_path)
+        link_target = os.path.relpath(os.path.abspath(target), os.path.dirname(pathname))
+        self.removed.discard(rel_path)
+        self.files[rel_path] = MemoryBuildFile(link_target=link_target)
+
+    def project_symlink(self, project_path: str, rel_path: str) -> None:
+        # Links from the project tree into the build directory are created once and never
+        # change content, so they do not participate in a dry run.
+        pass
+
+    def exists(self, rel_path: str) -> bool:
+        rel_path = os.path.normpath(rel_path)
+        return rel_path in self.files or (rel_path not in self.removed and super().exists(rel_path))
+
+    def list_files(self, rel_dir: str) -> List[str]:
+        rel_dir = os.path.normpath(rel_dir)
+        result = set(x for x in super().list_files(rel_dir) if os.path.join(rel_dir, x) not in self.removed)
+        for rel_path, file in self.files.items():
+            if os.path.dirname(rel_path) == rel_dir and file.link_target is None:
+                result.add(os.path.basename(rel_path))
+        return sorted(result)
+
+    def walk_files(self, rel_dir: str) -> List[str]:
+        rel_dir = os.path.normpath(rel_dir)
+        result = set(x for x in super().walk_files(rel_dir) if os.path.join(rel_dir, x) not in self.removed)
+        prefix = rel_dir + os.sep
+        for rel_path, file in self.files.items():
+            if rel_path.startswith(prefix) and file.link_target is None:
+                result.add(rel_path[len(prefix):])
+        return sorted(result)
+
+    def read_text_file(self, rel_path: str) -> str:
+        """Get the content of a captured regular file. Artifacts that were not captured
+           are read from the current build directory."""
+        rel_path = os.path.normpath(rel_path)
+        file = self.files.get(rel_path)
+        if file is None:
+            if rel_path in self.removed:
+                raise FileNotFoundError(f"Build artifact {rel_path} has been removed")
+            return super().read_text_file(rel_path)
+        if file.data is not None:
+            return file.data.decode('utf-8')
+        if file.content is None:
+            raise HubError(f"Build artifact {rel_path} is a symlink, not a file")
+        return file.content
+
+    def read_binary_file(self, rel_path: str) -> bytes:
+        rel_path = os.path.normpath(rel_path)
+        file = self.files.get(rel_path)
+        if file is None:
+            if rel_path in self.removed:
+                raise FileNotFoundError(f"Build artifact {rel_path} has been removed")
+            return super().read_binary_file(rel_path)
+        if file.data is not None:
+            return file.data
+        if file.content is None:
+            raise HubError(f"Build artifact {rel_path} is a symlink, not a file")
+        return file.content.encode('utf-8')
+
+_env_line_re = re.compile(r'^(?P<name>[A-Za-z_][A-Za-z0-9_]*)=(?P<value>.*)$')
+
+def mask_env_file_text(content: str, key: bytes) -> str:
+    """
+    Mask the values in .env file content. Each value is replaced with a keyed digest, so that
+    two masked files can be diffed to see which variables changed without revealing any value.
+    """
+    result_lines: List[str] = []
+    for line in content.splitlines(keepends=True):
+        m = _env_line_re.match(line.rstrip('\n'))
+        masked_text = line.rstrip('\n') if m is None else m.group('value')
+        digest = hmac.new(key, masked_text.encode('utf-8'), hashlib.sha256).hexdigest()[:12]
+        if m is None:
+            # Possibly a continuation of a multi-line quoted value
+            result_lines.append(f"<masked:{digest}>\n")
+        else:
+            result_lines.append(f"{m.group('name')}=<masked:{digest}>\n")
+    return ''.join(result_lines)
+
+def _decode_text(data: Optional[bytes]) -> Optional[str]:
+    """Decode file content as UTF-8 text; None if there is no content or it is binary"""
+    if data is None or b'\0' in data:
+        return None
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+def _is_secret_file(rel_path: str) -> bool:
+    return os.path.basename(rel_path) == '.env'
+
+def diff_memory_build_fs(
+        fs: MemoryBuildFs,
+        mask_secrets: bool=True,
+        context_lines: int=3,
+      ) -> Tuple[List[str], str]:
+    """
+    Compare the artifacts captured in a MemoryBuildFs with the current contents of its build directory.
+
+    Args:
+        fs: The in-memory build output.
+        mask_secrets: If True, the values in .env files are masked in the diff output.
+        context_lines: The number of context lines in unified diffs.
+
+    Returns:
+        A tuple (changed_rel_paths, unified_diff_text). changed_rel_paths lists changed
+        artifacts and then removed artifacts, and is empty if the build would not change anything.
+    """
+    mask_key = os.urandom(32)
+    changed: List[str] = []
+    diff_chunks: List[str] = []
+    build_dir_name = os.path.relpath(fs.build_dir, get_project_dir())
+    for rel_path in sorted(fs.files.keys()):
+        new_file = fs.files[rel_path]
+        pathname = fs.get_abs_path(rel_path)
+        display_path = os.path.join(build_dir_name, rel_path)
+        old_link_target: Optional[str] = None
+        old_data: Optional[bytes] = None
+        old_mode: Optional[int] = None
+        if os.path.islink(pathname):
+            old_link_target = os.readlink(pathname)
+        elif os.path.isfile(pathname):
+            with open(pathname, 'rb') as f:
+                old_data = f.read()
+            old_mode = os.stat(pathname).st_mode & 0o777
+        exists = old_link_target is not None or old_data is not None
+
+        if new_file.link_target is not None:
+            if old_link_target == new_file.link_target:
+                continue
+            changed.append(rel_path)
+            old_desc = "(does not exist)" if not exists else (
+                f"symlink -> {old_link_target}" if old_link_target is not None else "regular file")
+            diff_chunks.append(
+                f"--- a/{display_path}\n+++ b/{display_path}\n"
+                f"-{old_desc}\n+symlink -> {new_file.link_target}\n"
+              )
+            continue
+
+        new_data = new_file.data if new_file.data is not None else cast(str, new_file.content).encode('utf-8')
+        if old_data == new_data and old_mode == new_file.mode:
+            continue
+        changed.append(rel_path)
+        old_content = _decode_text(old_data)
+        new_content = _decode_text(new_data)
+        if old_data != new_data and (new_content is None or (old_data is not None and old_content is None)):
+            diff_chunks.append(
+                f"Binary files {'/dev/null' if not exists else 'a/' + display_path} and b/{display_path} differ\n"
+              )
+        elif old_data != new_data:
+            assert new_content is not None
+            old_text = old_content or ''
+            new_text = new_content
+            if mask_secrets and _is_secret_file(rel_path):
+                old_text = mask_env_file_text(old_text, mask_key)
+                new_text = mask_env_file_text(new_text, mask_key)
+            diff_lines = list(difflib.unified_diff(
+                old_text.splitlines(keepends=True),
+                new_text.splitlines(keepends=True),
+                fromfile="/dev/null" if not exists else f"a/{display_path}",
+                tofile=f"b/{display_path}",
+                n=context_lines,
+              ))
+            if old_link_target is not None:
+                diff_chunks.append(f"# {display_path}: symlink -> {old_link_target} replaced by regular file\n")
+            for line in diff_lines:
+                diff_chunks.append(line if line.endswith('\n') else line + "\n\\ No newline at end of file\n")
+        if old_mode is not None and old_mode != new_file.mode:
+            diff_chunks.append(f"# {display_path}: mode {old_mode:o} -> {new_file.mode:o}\n")
+
+    for rel_path in sorted(fs.removed):
+        pathname = fs.get_abs_path(rel_path)
+        display_path = os.path.join(build_dir_name, rel_path)
+        changed.append(rel_path)
+        old_text_or_none: Optional[str] = None
+        if not os.path.islink(pathname) and os.path.isfile(pathname):
+            with open(pathname, 'rb') as f:
+                old_text_or_none = _decode_text(f.read())
+        if old_text_or_none is None:
+            diff_chunks.append(f"--- a/{display_path}\n+++ /dev/null\n")
+            continue
+        old_text = old_text_or_none
+        if mask_secrets and _is_secret_file(rel_path):
+            old_text = mask_env_file_text(old_text, mask_key)
+        for line in difflib.unified_diff(
+                old_text.splitlines(keepends=True), [], fromfile=f"a/{display_path}", tofile="/dev/null", n=context_lines):
+            diff_chunks.append(line if line.endswith('\n') else line + "\n\\ No newline at end of file\n")
+
+    logger.debug(f"diff_memory_build_fs: {len(changed)} changed artifacts")
+    return changed, ''.join(diff_chunks)
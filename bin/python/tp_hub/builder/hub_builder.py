@@ -16,10 +16,13 @@ from ..pkg_logging import logger
 from ..config import HubSettings, current_hub_settings
 from .traefik_builder import build_traefik
 from .portainer_builder import build_portainer
+from .router_index_builder import build_router_index
+from .build_fs import BuildFs
 
-def build_hub(settings: Optional[HubSettings]=None):
+def build_hub(settings: Optional[HubSettings]=None, fs: Optional[BuildFs]=None):
     logger.info("Building Hub")
-    build_traefik(settings=settings)
-    build_portainer(settings=settings)
+    build_traefik(settings=settings, fs=fs)
+    build_portainer(settings=settings, fs=fs)
+    build_router_index(settings=settings, fs=fs)
 
     logger.info("Hub build complete")
\ No newline at end of file
@@ -9,43 +9,39 @@ Builder tools for portainer
 """
 
 import os
+from io import StringIO
 from ruamel.yaml import YAML
 from ruamel.yaml.comments import CommentedMap
 
 from ..internal_types import *
 from ..pkg_logging import logger
-from ..util import rel_symlink, unindent_string_literal as usl, atomic_mv
+from ..util import unindent_string_literal as usl
 from ..config import HubSettings, current_hub_settings
-from ..proj_dirs import get_project_dir, get_project_build_dir
-from ..x_dotenv import x_dotenv_save_file
+from ..proj_dirs import get_project_dir
+from ..x_dotenv import x_dotenv_dumps
+from .build_fs import BuildFs, DiskBuildFs
 
-def build_portainer(settings: Optional[HubSettings]=None):
+def build_portainer(settings: Optional[HubSettings]=None, fs: Optional[BuildFs]=None):
     if settings is None:
         settings = current_hub_settings()
+    if fs is None:
+        fs = DiskBuildFs()
 
     logger.info("Building Portainer")
 
     project_dir = get_project_dir()
     src_dir = os.path.join(project_dir, "stacks", "portainer")
-    build_dir = get_project_build_dir()
-    os.makedirs(build_dir, exist_ok=True)
-    dst_dir = os.path.join(build_dir, "stacks", "portainer")
-    os.makedirs(dst_dir, mode=0o700, exist_ok=True)
+    dst_rel_dir = os.path.join("stacks", "portainer")
+    fs.makedirs(dst_rel_dir, mode=0o700)
     src_compose_pathname = os.path.join(src_dir, "docker-compose.yml")
-    dst_compose_pathname = os.path.join(dst_dir, "docker-compose.yml")
+    dst_compose_rel_pathname = os.path.join(dst_rel_dir, "docker-compose.yml")
     src_injected_vars_pathname = os.path.join(src_dir, "injected-env-vars.yml")
-    dst_injected_vars_pathname = os.path.join(dst_dir, "injected-env-vars.yml")
-    dst_injected_vars_tmp_pathname = dst_injected_vars_pathname + '.tmp'
-    dst_compose_pathname = os.path.join(dst_dir, "docker-compose.yml")
+    dst_injected_vars_rel_pathname = os.path.join(dst_rel_dir, "injected-env-vars.yml")
     src_env_pathname = os.path.join(src_dir, ".env")
-    dst_env_pathname = os.path.join(dst_dir, ".env")
-    if not os.path.islink(src_env_pathname):
-        rel_symlink(dst_env_pathname, src_env_pathname)
-    if not os.path.islink(src_injected_vars_pathname):
-        rel_symlink(dst_injected_vars_pathname, src_injected_vars_pathname)
-    if os.path.exists(dst_compose_pathname) or os.path.islink(dst_compose_pathname):
-        os.unlink(dst_compose_pathname)
-    rel_symlink(src_compose_pathname, dst_compose_pathname)
+    dst_env_rel_pathname = os.path.join(dst_rel_dir, ".env")
+    fs.project_symlink(src_env_pathname, dst_env_rel_pathname)
+    fs.project_symlink(src_injected_vars_pathname, dst_injected_vars_rel_pathname)
+    fs.symlink(dst_compose_rel_pathname, src_compose_pathname)
     env = dict(settings.portainer_stack_env)
     injected_vars = dict(settings.portainer_runtime_env)
     # Since the injected vars are going directly into a YAML file that will be expanded by docker-compose,
@@ -55,7 +51,7 @@ def build_portainer(settings: Optional[HubSettings]=None):
         assert isinstance(v, str)
         if '$' in v:
             injected_vars[k] = v.replace('$ ', '$$ ')
-    x_dotenv_save_file(dst_env_pathname, env, mode=0o400)
+    fs.write_text_file(dst_env_rel_pathname, x_dotenv_dumps(env) + "\n", mode=0o400)
     ryaml = YAML()
     injected_vars_data= CommentedMap()
     injected_vars_data.yaml_set_start_comment(usl(
@@ -71,18 +67,9 @@ def build_portainer(settings: Optional[HubSettings]=None):
     for k in sorted(injected_vars.keys()):
         v = injected_vars[k]
         environment[k] = v
-    if os.path.exists(dst_injected_vars_tmp_pathname):
-        os.unlink(dst_injected_vars_tmp_pathname)
-    try:
-        with open(
-                os.open(dst_injected_vars_tmp_pathname, os.O_CREAT | os.O_WRONLY, 0o400),
-                'w',
-                encoding='utf-8',
-            ) as fd:
-            ryaml.dump(injected_vars_data, fd)
-        atomic_mv(dst_injected_vars_tmp_pathname, dst_injected_vars_pathname, force=True)
-    finally:
-        if os.path.exists(dst_injected_vars_tmp_pathname):
-            os.unlink(dst_injected_vars_tmp_pathname)
+    with StringIO() as fd:
+        ryaml.dump(injected_vars_data, fd)
+        injected_vars_content = fd.getvalue()
+    fs.write_text_file(dst_injected_vars_rel_pathname, injected_vars_content, mode=0o400)
 
     logger.info("Portainer build complete")
@@ -0,0 +1,116 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+Builder tools for the Traefik route catalog
+"""
+
+import os
+import re
+import yaml
+
+from ..internal_types import *
+from ..pkg_logging import logger
+from ..proj_dirs import get_project_dir
+from ..compose_interpolation import compose_interpolate_data
+from ..traefik_router_index import normalize_compose_labels
+from ..route_catalog import RouteCatalogError, compile_route_catalog_shard
+from .build_fs import BuildFs
+
+ROUTE_CATALOG_SHARD_PREFIX = "routes-"
+"""The filename prefix of compiled route catalog shards in the Traefik file provider directory"""
+
+def get_route_catalog_dir() -> str:
+    """Get the directory containing route catalog files"""
+    return os.path.join(get_project_dir(), "stacks", "routes")
+
+def find_route_catalog_files() -> List[str]:
+    """Get the sorted absolute pathnames of all route catalog files"""
+    catalog_dir = get_route_catalog_dir()
+    if not os.path.isdir(catalog_dir):
+        return []
+    return sorted(
+        os.path.join(catalog_dir, x) for x in os.listdir(catalog_dir)
+            if x.endswith(('.yml', '.yaml')) and os.path.isfile(os.path.join(catalog_dir, x))
+      )
+
+_label_middleware_re = re.compile(r'^traefik\.http\.middlewares\.([^.]+)\.')
+
+def get_compose_label_middlewares(compose_data: JsonableDict) -> Set[str]:
+    """Get the names of the Traefik middlewares defined by service labels in parsed compose data"""
+    result: Set[str] = set()
+    for service_data in (compose_data.get('services') or {}).values():
+        labels = normalize_compose_labels((service_data or {}).get('labels'))
+        for label in labels.keys():
+            m = _label_middleware_re.match(label)
+            if m is not None:
+                result.add(m.group(1))
+    return result
+
+def build_route_catalog(
+        fs: BuildFs,
+        dynamic_config_rel_dir: str,
+        env: Mapping[str, str],
+        file_middlewares: Iterable[str],
+        traefik_compose_pathname: str,
+      ) -> List[str]:
+    """
+    Compile each route catalog file into a shard in the Traefik file provider directory, and
+    remove shards whose catalog file no longer exists. Unchanged shards are not rewritten, so
+    Traefik only reloads when the catalog actually changes.
+
+    Args:
+        fs: The build filesystem.
+        dynamic_config_rel_dir: The Traefik file provider directory, relative to the build directory.
+        env: The Traefik stack environment, used to interpolate catalog files.
+        file_middlewares: Names of middlewares defined by other files in the file provider directory.
+        traefik_compose_pathname: The Traefik stack's docker-compose.yml, whose labels define
+                middlewares that routes may refer to.
+
+    Returns:
+        The names of the shards that were written, relative to dynamic_config_rel_dir.
+    """
+    catalog_pathnames = find_route_catalog_files()
+    with open(traefik_compose_pathname, encoding='utf-8') as f:
+        traefik_compose_data = compose_interpolate_data(yaml.safe_load(f) or {}, env)
+    docker_middlewares = get_compose_label_middlewares(traefik_compose_data)
+
+    catalogs: List[Tuple[str, JsonableDict]] = []
+    all_middlewares: Set[str] = set(file_middlewares)
+    for pathname in catalog_pathnames:
+        shard_name = os.path.splitext(os.path.basename(pathname))[0]
+        with open(pathname, encoding='utf-8') as f:
+            catalog = yaml.safe_load(f)
+        missing: Set[str] = set()
+        catalog = compose_interpolate_data(catalog, env, missing=missing)
+        if len(missing) > 0:
+            logger.warning(f"Route catalog {shard_name}: unset variables interpolated as empty strings: {sorted(missing)}")
+        if isinstance(catalog, dict):
+            all_middlewares.update((catalog.get('middlewares') or {}).keys())
+        catalogs.append((shard_name, catalog))
+
+    written: List[str] = []
+    for shard_name, catalog in catalogs:
+        dynamic_config = compile_route_catalog_shard(shard_name, catalog, all_middlewares, docker_middlewares)
+        filename = f"{ROUTE_CATALOG_SHARD_PREFIX}{shard_name}.yml"
+        fs.write_text_file(
+            os.path.join(dynamic_config_rel_dir, filename),
+            "# Traefik dynamic configuration file\n"
+            "#\n"
+            f"# Auto-generated from stacks/routes/{shard_name} by `hub build`. DO NOT EDIT!\n"
+            "#\n" +
+            yaml.dump(dynamic_config, indent=2, sort_keys=True),
+            mode=0o400,
+          )
+        written.append(filename)
+
+    for filename in fs.list_files(dynamic_config_rel_dir):
+        if filename.startswith(ROUTE_CATALOG_SHARD_PREFIX) and filename not in written:
+            logger.info(f"Removing stale route catalog shard {filename}")
+            fs.remove_file(os.path.join(dynamic_config_rel_dir, filename))
+
+    logger.debug(f"Route catalog: {len(written)} shards")
+    return written
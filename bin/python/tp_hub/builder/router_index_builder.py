@@ -0,0 +1,171 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+Builder tools for the Traefik router index
+"""
+
+import os
+import json
+import yaml
+
+from ..internal_types import *
+from ..pkg_logging import logger
+from ..config import HubSettings, current_hub_settings
+from ..proj_dirs import get_project_dir
+from ..x_dotenv import x_dotenv_loads
+from ..compose_interpolation import compose_interpolate_data, ComposeInterpolationError
+from ..traefik_router_index import (
+    TraefikRouter,
+    TraefikRouterIndex,
+    normalize_compose_labels,
+    extract_label_routers,
+    extract_file_provider_routers,
+  )
+from .build_fs import BuildFs, DiskBuildFs
+from .traefik_builder import TRAEFIK_DYNAMIC_CONFIG_REL_DIR
+
+ROUTER_INDEX_REL_PATHNAME = "traefik-router-index.json"
+"""The path of the generated router index, relative to the build directory"""
+
+COMPOSE_FILE_NAMES = ("compose.yaml", "compose.yml", "docker-compose.yaml", "docker-compose.yml")
+
+def find_project_compose_files(project_dir: Optional[str]=None) -> List[str]:
+    """
+    Find all docker-compose files in the project, excluding the build directory and hidden directories.
+    Returns sorted absolute pathnames.
+    """
+    if project_dir is None:
+        project_dir = get_project_dir()
+    result: List[str] = []
+    for dirpath, dirnames, filenames in os.walk(project_dir):
+        if dirpath == project_dir:
+            dirnames[:] = [ d for d in dirnames if d != 'build' ]
+        dirnames[:] = [ d for d in dirnames if not d.startswith('.') ]
+        for filename in filenames:
+            if filename in COMPOSE_FILE_NAMES:
+                result.append(os.path.join(dirpath, filename))
+    return sorted(result)
+
+def get_compose_file_env(
+        compose_pathname: str,
+        fs: BuildFs,
+        settings: HubSettings,
+      ) -> Dict[str, str]:
+    """
+    Get the environment that a compose file is interpolated with. Stacks built by `hub build`
+    use their built .env (as written into fs); other stacks with a .env file use it, and
+    everything else is assumed to be an app stack run by Portainer, which sees Portainer's
+    runtime environment.
+    """
+    project_dir = get_project_dir()
+    compose_dir = os.path.dirname(compose_pathname)
+    build_rel_env_pathname = os.path.join(os.path.relpath(compose_dir, project_dir), ".env")
+    if fs.exists(build_rel_env_pathname):
+        return dict(x_dotenv_loads(fs.read_text_file(build_rel_env_pathname)))
+    env_pathname = os.path.join(compose_dir, ".env")
+    if os.path.isfile(env_pathname):
+        with open(env_pathname, encoding='utf-8') as f:
+            return dict(x_dotenv_loads(f.read()))
+    return dict(settings.portainer_runtime_env)
+
+def load_compose_file_data(
+        compose_pathname: str,
+        env: Mapping[str, str],
+      ) -> JsonableDict:
+    """
+    Parse a compose file and interpolate it with env.
+    """
+    project_dir = get_project_dir()
+    rel_pathname = os.path.relpath(compose_pathname, project_dir)
+    with open(compose_pathname, encoding='utf-8') as f:
+        data = yaml.safe_load(f)
+    missing: Set[str] = set()
+    data = compose_interpolate_data(data, env, missing=missing)
+    if len(missing) > 0:
+        logger.debug(f"{rel_pathname}: unset variables interpolated as empty strings: {sorted(missing)}")
+    return data or {}
+
+def load_compose_file_routers(
+        compose_pathname: str,
+        env: Mapping[str, str],
+      ) -> List[TraefikRouter]:
+    """
+    Parse a compose file, interpolate it with env, and extract the Traefik routers defined
+    by its service labels.
+    """
+    rel_pathname = os.path.relpath(compose_pathname, get_project_dir())
+    data = load_compose_file_data(compose_pathname, env)
+    result: List[TraefikRouter] = []
+    services = data.get('services') or {}
+    for service_name, service_data in services.items():
+        labels = normalize_compose_labels((service_data or {}).get('labels'))
+        result.extend(extract_label_routers(labels, f"{rel_pathname}#{service_name}"))
+    return result
+
+def build_router_index(settings: Optional[HubSettings]=None, fs: Optional[BuildFs]=None) -> TraefikRouterIndex:
+    if settings is None:
+        settings = current_hub_settings()
+    if fs is None:
+        fs = DiskBuildFs()
+
+    logger.info("Building Traefik router index")
+
+    project_dir = get_project_dir()
+    hub_stacks_dir = os.path.join(project_dir, "stacks")
+    routers: List[TraefikRouter] = []
+    for compose_pathname in find_project_compose_files():
+        try:
+            env = get_compose_file_env(compose_pathname, fs, settings)
+            routers.extend(load_compose_file_routers(compose_pathname, env))
+        except (OSError, yaml.YAMLError, ComposeInterpolationError) as e:
+            if os.path.commonpath([ hub_stacks_dir, compose_pathname ]) == hub_stacks_dir:
+                raise
+            # An app or example compose file that cannot be parsed should not fail the hub build
+            logger.warning(f"Skipping {os.path.relpath(compose_pathname, project_dir)} in the Traefik router index: {e}")
+
+    # Everything in the Traefik file provider directory, including compiled route catalog shards
+    for filename in fs.list_files(TRAEFIK_DYNAMIC_CONFIG_REL_DIR):
+        if not filename.endswith(('.yml', '.yaml')):
+            continue
+        rel_pathname = os.path.join(TRAEFIK_DYNAMIC_CONFIG_REL_DIR, filename)
+        dynamic_config = yaml.safe_load(fs.read_text_file(rel_pathname))
+        routers.extend(extract_file_provider_routers(dynamic_config, rel_pathname))
+
+    entrypoints: List[str] = []
+    traefik_config_rel_file = os.path.join("stacks", "traefik", "traefik-config.yml")
+    if fs.exists(traefik_config_rel_file):
+        traefik_config = yaml.safe_load(fs.read_text_file(traefik_config_rel_file)) or {}
+        entrypoints = sorted((traefik_config.get('entryPoints') or {}).keys())
+
+    router_index = TraefikRouterIndex(routers, entrypoints=entrypoints)
+
+    for router in routers:
+        if router.error is not None:
+            logger.warning(f"Traefik router {router.qualified_name} ({router.source}): {router.error}")
+    for duplicate in router_index.duplicates:
+        logger.warning(f"Traefik router {duplicate['router']} is defined more than once: {', '.join(duplicate['sources'])}")
+    for collision in router_index.collisions:
+        msg = (
+            f"Traefik routers {' and '.join(collision['routers'])} overlap on entrypoint {collision['entrypoint']}, "
+            f"host {collision['host']} ({', '.join(collision['sources'])})"
+          )
+        if collision['ambiguous']:
+            logger.warning(f"{msg} with equal priority {collision['priorities'][0]}")
+        else:
+            logger.debug(f"{msg}; resolved by priority {collision['priorities']}")
+
+    fs.write_text_file(
+        ROUTER_INDEX_REL_PATHNAME,
+        json.dumps(router_index.to_jsonable(), indent=2, sort_keys=True) + "\n",
+        mode=0o600,
+      )
+
+    logger.info(
+        f"Traefik router index complete: {len(routers)} routers, {len(router_index.duplicates)} duplicates, "
+        f"{len(router_index.ambiguous_collisions)} ambiguous collisions"
+      )
+    return router_index
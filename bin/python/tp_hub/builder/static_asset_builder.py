@@ -0,0 +1,204 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+Builder tools for the static sites served by the Traefik stack
+"""
+
+import os
+import json
+import hashlib
+
+from ..internal_types import *
+from ..pkg_logging import logger
+from ..proj_dirs import get_project_dir
+from ..static_assets import (
+    HTML_EXTENSIONS,
+    get_asset_ext,
+    is_fingerprintable,
+    get_fingerprinted_path,
+    minify_asset,
+    rewrite_asset_refs,
+    compress_asset,
+    is_brotli_available,
+    make_static_web_server_config,
+  )
+from .build_fs import BuildFs
+
+STATIC_SITE_NAMES = ("shared_app_static", "shared_lan_app_static")
+"""The static site directories in stacks/traefik"""
+
+STATIC_SITE_CONTAINER_DIR = "/static"
+"""Where a built static site is mounted in its static-web-server container"""
+
+ASSET_MANIFEST_NAME = "asset-manifest.json"
+"""The name of the manifest, in the site root, mapping logical asset paths to fingerprinted paths"""
+
+_PIPELINE_VERSION = 1
+"""Bump when processing changes, to invalidate the incremental build state"""
+
+def find_static_site_files(src_dir: str) -> List[str]:
+    """Get the sorted site-relative paths ("/"-separated) of the files in a static site, excluding hidden files"""
+    result: List[str] = []
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        dirnames[:] = [ d for d in dirnames if not d.startswith('.') or d == '.well-known' ]
+        for filename in filenames:
+            if filename.startswith('.') or filename == ASSET_MANIFEST_NAME:
+                continue
+            rel_path = os.path.relpath(os.path.join(dirpath, filename), src_dir)
+            result.append(rel_path.replace(os.sep, '/'))
+    return sorted(result)
+
+def _asset_phase(rel_path: str) -> int:
+    # Assets are processed in dependency order: CSS may refer to anything but HTML and CSS,
+    # and HTML may refer to anything but HTML.
+    ext = get_asset_ext(rel_path)
+    if ext in HTML_EXTENSIONS:
+        return 2
+    if ext == '.css':
+        return 1
+    return 0
+
+def build_static_site(
+        fs: BuildFs,
+        src_dir: str,
+        dst_rel_dir: str,
+        state_rel_pathname: str,
+      ) -> JsonableDict:
+    """
+    Build one static site: minify, fingerprint, rewrite references, and precompress each
+    asset, and generate the asset manifest and static-web-server config.
+
+    Only assets whose source (or whose fingerprinted dependencies) changed since the
+    last build are reprocessed; everything else is carried over from the previous build
+    state. Outputs of deleted assets are removed.
+
+    Args:
+        fs: The build filesystem.
+        src_dir: The absolute path of the site's source directory.
+        dst_rel_dir: The built site directory, relative to the build directory. The site
+                root is in the "public" subdirectory.
+        state_rel_pathname: The incremental build state file, relative to the build directory.
+
+    Returns:
+        A summary with counts of processed, reused and removed assets.
+    """
+    public_rel_dir = os.path.join(dst_rel_dir, "public")
+    fs.makedirs(public_rel_dir, mode=0o755)
+    fs.makedirs(os.path.dirname(state_rel_pathname), mode=0o700)
+
+    old_state: JsonableDict = {}
+    if fs.exists(state_rel_pathname):
+        try:
+            old_state = json.loads(fs.read_text_file(state_rel_pathname))
+        except ValueError:
+            logger.warning(f"Ignoring corrupt static asset build state {state_rel_pathname}")
+    brotli_available = is_brotli_available()
+    if (old_state.get('version') != _PIPELINE_VERSION or
+            old_state.get('brotli', False) != brotli_available):
+        old_state = {}
+    old_files: JsonableDict = old_state.get('files', {})
+    if not brotli_available:
+        logger.warning("Python package 'brotli' is not installed; static assets will only be precompressed with gzip")
+
+    manifest: Dict[str, str] = {}
+    new_files: JsonableDict = {}
+    num_processed = 0
+    num_reused = 0
+
+    for rel_path in sorted(find_static_site_files(src_dir), key=lambda x: (_asset_phase(x), x)):
+        src_pathname = os.path.join(src_dir, rel_path)
+        st = os.stat(src_pathname)
+        old = old_files.get(rel_path)
+        source_data: Optional[bytes] = None
+        if old is not None and (old.get('size') != st.st_size or old.get('mtime_ns') != st.st_mtime_ns):
+            # Touched but possibly unchanged; compare content
+            with open(src_pathname, 'rb') as f:
+                source_data = f.read()
+            if hashlib.sha256(source_data).hexdigest() != old.get('sha256'):
+                old = None
+        if (old is not None and
+                all(manifest.get(dep) == hashed for dep, hashed in old['deps'].items()) and
+                all(fs.exists(os.path.join(public_rel_dir, x)) for x in old['outputs'])):
+            entry = dict(old, size=st.st_size, mtime_ns=st.st_mtime_ns)
+            num_reused += 1
+        else:
+            if source_data is None:
+                with open(src_pathname, 'rb') as f:
+                    source_data = f.read()
+            data = minify_asset(rel_path, source_data)
+            data, deps = rewrite_asset_refs(rel_path, data, manifest)
+            output_names = [ rel_path ]
+            fingerprinted: Optional[str] = None
+            if is_fingerprintable(rel_path):
+                fingerprinted = get_fingerprinted_path(rel_path, data)
+                output_names.append(fingerprinted)
+            compressed = compress_asset(rel_path, data)
+            outputs: List[str] = []
+            fs.makedirs(os.path.dirname(os.path.join(public_rel_dir, rel_path)), mode=0o755)
+            for name in output_names:
+                fs.write_binary_file(os.path.join(public_rel_dir, name), data, mode=0o644)
+                outputs.append(name)
+                for suffix, compressed_data in compressed.items():
+                    fs.write_binary_file(os.path.join(public_rel_dir, name + suffix), compressed_data, mode=0o644)
+                    outputs.append(name + suffix)
+            entry = dict(
+                size=st.st_size,
+                mtime_ns=st.st_mtime_ns,
+                sha256=hashlib.sha256(source_data).hexdigest(),
+                fingerprinted=fingerprinted,
+                deps=deps,
+                outputs=outputs,
+              )
+            logger.debug(f"Static asset {rel_path}: {len(source_data)} -> {len(data)} bytes, outputs {outputs}")
+            num_processed += 1
+        if entry['fingerprinted'] is not None:
+            manifest[rel_path] = entry['fingerprinted']
+        new_files[rel_path] = entry
+
+    fs.write_text_file(
+        os.path.join(public_rel_dir, ASSET_MANIFEST_NAME),
+        json.dumps(manifest, indent=2, sort_keys=True) + "\n",
+        mode=0o644,
+      )
+    fs.write_text_file(
+        os.path.join(dst_rel_dir, "sws.toml"),
+        make_static_web_server_config(f"{STATIC_SITE_CONTAINER_DIR}/public", manifest.values()),
+        mode=0o644,
+      )
+
+    expected_outputs: Set[str] = { ASSET_MANIFEST_NAME }
+    for entry in new_files.values():
+        expected_outputs.update(entry['outputs'])
+    num_removed = 0
+    for rel_path in fs.walk_files(public_rel_dir):
+        if rel_path.replace(os.sep, '/') not in expected_outputs:
+            fs.remove_file(os.path.join(public_rel_dir, rel_path))
+            num_removed += 1
+
+    fs.write_text_file(
+        state_rel_pathname,
+        json.dumps(dict(version=_PIPELINE_VERSION, brotli=brotli_available, files=new_files), indent=2, sort_keys=True) + "\n",
+        mode=0o600,
+      )
+    return dict(processed=num_processed, reused=num_reused, removed=num_removed, fingerprinted=len(manifest))
+
+def build_static_sites(fs: BuildFs, dst_rel_dir: str) -> None:
+    """
+    Build all of the static sites in stacks/traefik into subdirectories of dst_rel_dir.
+    """
+    src_dir = os.path.join(get_project_dir(), "stacks", "traefik")
+    for site_name in STATIC_SITE_NAMES:
+        summary = build_static_site(
+            fs,
+            os.path.join(src_dir, site_name),
+            os.path.join(dst_rel_dir, site_name),
+            os.path.join("cache", "static-assets", f"{site_name}.json"),
+          )
+        logger.info(
+            f"Static site {site_name}: {summary['processed']} assets processed, {summary['reused']} unchanged, "
+            f"{summary['removed']} stale outputs removed"
+          )
@@ -11,20 +11,19 @@ Builder tools
 import os
 import json
 import hashlib
-from datetime import datetime
-from functools import cache
+from datetime import datetime, timezone
 
 from ..internal_types import *
 from ..pkg_logging import logger
 from ..config import HubSettings, current_hub_settings
 
-very_old = datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+very_old = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
-def timestamp_now() -> datetime.datetime:
-    return datetime.utcnow()
+def timestamp_now() -> datetime:
+    return datetime.now(timezone.utc)
 
 def timestamp_to_str(ts: datetime) -> str:
-    ts = ts.astimezone(datetime.timezone.utc)
+    ts = ts.astimezone(timezone.utc)
     result = ts.isoformat()
     if result.endswith("+00:00"):
         result = result[:-6] + "Z"
@@ -33,17 +32,25 @@ def timestamp_to_str(ts: datetime) -> str:
 def str_to_timestamp(s: str) -> datetime:
     if s.endswith("Z"):
         s = s[:-1] + "+00:00"
-    return datetime.fromisoformat(s).astimezone(datetime.timezone.utc)
+    return datetime.fromisoformat(s).astimezone(timezone.utc)
 
-@cache
-def get_config_hash(settings: Optional[HubSettings]=None) -> str:
+def get_config_hash(settings: Optional[HubSettings]=None, extra: Optional[Jsonable]=None) -> str:
     """
     Returns a hash of the current configuration settings. Will
     be used to determine if a rebuild is necessary.
+
+    Args:
+        settings: The settings to hash. Defaults to the current hub settings.
+        extra: If not None, additional JSON-able data that is hashed along with the
+            settings (e.g., the resolved inputs of a docker-compose stack), so that the
+            result fingerprints both.
     """
     if settings is None:
         settings = current_hub_settings()
     settings_data = json.loads(settings.model_dump_json())
     settings_str = json.dumps(settings_data, separators=(',', ':'), sort_keys=True)
-    settings_hash = hashlib.sha256(settings_str.encode('utf-8')).hexdigest()
-    return settings_hash
+    hasher = hashlib.sha256(settings_str.encode('utf-8'))
+    if extra is not None:
+        hasher.update(b'\n')
+        hasher.update(json.dumps(extra, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+    return hasher.hexdigest()
@@ -0,0 +1,176 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+Configuration fingerprints for docker-compose stacks, used to skip `docker compose up`
+when a stack is already running with its current configuration.
+
+Each hub compose service carries a label whose value is interpolated from an environment
+variable that is set to the stack's fingerprint when the stack is brought up. The
+fingerprint covers the hub configuration settings and everything docker-compose reads to
+create the stack's containers, so if every service has a running container stamped with
+the current fingerprint, running the local image of its service's image reference,
+`docker compose up` would have nothing to do.
+"""
+
+from __future__ import annotations
+
+import os
+import copy
+
+from .internal_types import *
+from .pkg_logging import logger
+from .config import HubSettings
+from .docker_compose_stack import DockerComposeStack
+from .compose_model import get_compose_model
+from .util import get_docker_containers, get_docker_images, normalize_image_reference
+from .builder.util import get_config_hash
+
+CONFIG_FINGERPRINT_LABEL = "tp-hub.config-fingerprint"
+"""The container label that holds the configuration fingerprint of its stack"""
+
+CONFIG_FINGERPRINT_ENV_VAR = "TP_HUB_CONFIG_FINGERPRINT"
+"""The environment variable that compose files interpolate into CONFIG_FINGERPRINT_LABEL"""
+
+class ComposeStackFingerprint:
+    """The configuration fingerprint of a docker-compose stack"""
+    project_name: str
+    """The docker-compose project name"""
+
+    fingerprint: str
+    """A hash of the hub configuration settings and the resolved inputs of the stack"""
+
+    services: List[str]
+    """The names of the services that `docker compose up` starts (i.e., without profiles)"""
+
+    images: Dict[str, str]
+    """The image reference of each service that has one, by service name"""
+
+    def __init__(self, project_name: str, fingerprint: str, services: List[str], images: Optional[Dict[str, str]]=None):
+        self.project_name = project_name
+        self.fingerprint = fingerprint
+        self.services = services
+        self.images = {} if images is None else images
+
+def _read_file_for_hash(pathname: str) -> str:
+    try:
+        with open(pathname, 'rb') as f:
+            return f.read().decode('utf-8', errors='replace')
+    except OSError:
+        # Unreadable (e.g., root-owned): changes are still detected by size and mtime
+        st = os.stat(pathname)
+        return f"size={st.st_size} mtime_ns={st.st_mtime_ns}"
+
+def get_compose_stack_fingerprint(
+        stack: DockerComposeStack,
+        settings: Optional[HubSettings]=None,
+      ) -> ComposeStackFingerprint:
+    """
+    Compute the configuration fingerprint of a docker-compose stack.
+
+    The fingerprint hashes the hub configuration settings (see get_config_hash) together with:
+
+        * The stack's effective configuration (see get_compose_model), so the files its services
+          extend and their env_file files are covered, and environment variables the stack does
+          not use do not matter. The CONFIG_FINGERPRINT_LABEL labels are excluded.
+        * Regular files bind-mounted from the stack's project directory (e.g., traefik-config.yml,
+          which Traefik only reads at startup).
+        * Files inside directories bind-mounted from the stack's project directory that the
+          service's environment names by their container path (e.g., SERVER_CONFIG_FILE=/static/sws.toml,
+          which static-web-server only reads at startup). The rest of a mounted directory is
+          content the service reads as it runs (e.g., the static site), and is not covered.
+
+    Image updates are not part of the fingerprint; get_stale_compose_stacks compares the image
+    of each container with the local image of its service's image reference.
+
+    Args:
+        stack: The stack.
+        settings: The hub settings. Defaults to the current hub settings.
+    """
+    model = get_compose_model(stack)
+    config = copy.deepcopy(model.data)
+    for service_data in (config.get('services') or {}).values():
+        labels = service_data.get('labels')
+        if isinstance(labels, dict):
+            labels.pop(CONFIG_FINGERPRINT_LABEL, None)
+    inputs: JsonableDict = dict(config=config)
+
+    project_directory = os.path.abspath(model.project_directory)
+    for service in model.services.values():
+        for volume in service.volumes:
+            if volume.type != "bind" or volume.source is None:
+                continue
+            if os.path.commonpath([ project_directory, volume.source ]) != project_directory:
+                continue
+            if os.path.isfile(volume.source):
+                inputs[volume.source] = _read_file_for_hash(volume.source)
+            elif os.path.isdir(volume.source) and volume.target.startswith('/'):
+                prefix = volume.target.rstrip('/') + '/'
+                for value in service.environment.values():
+                    if value is not None and value.startswith(prefix):
+                        pathname = os.path.normpath(os.path.join(volume.source, os.path.relpath(value, volume.target)))
+                        if os.path.isfile(pathname):
+                            inputs[pathname] = _read_file_for_hash(pathname)
+
+    fingerprint = get_config_hash(settings, extra=inputs)
+    active_services = sorted(service.name for service in model.get_active_services())
+    images = { name: service.image for name, service in model.services.items() if service.image is not None }
+    logger.debug(f"Stack '{stack.project_name}' configuration fingerprint: {fingerprint}")
+    return ComposeStackFingerprint(stack.project_name, fingerprint, active_services, images=images)
+
+def get_stale_compose_stacks(fingerprints: Iterable[ComposeStackFingerprint]) -> Dict[str, Optional[str]]:
+    """
+    Determine which stacks need `docker compose up`, with a single query of container labels
+    and a single query of local images.
+
+    Args:
+        fingerprints: The current fingerprints of the stacks.
+
+    Returns:
+        A dictionary mapping each project name to the reason that `docker compose up` is
+        needed, or None if every service has a running container stamped with the current
+        fingerprint, running the current local image of its service's image reference (so,
+        e.g., a newer ":latest" pulled by `hub images prefetch` is picked up), and there are
+        no orphaned containers to remove.
+    """
+    fingerprints = list(fingerprints)
+    image_ids: Dict[str, str] = {}
+    if any(len(fp.images) > 0 for fp in fingerprints):
+        for image in get_docker_images():
+            for ref in (image.get('RepoTags') or []) + (image.get('RepoDigests') or []):
+                image_ids[ref] = image['Id']
+    containers_by_project: Dict[str, List[JsonableDict]] = { fp.project_name: [] for fp in fingerprints }
+    for container in get_docker_containers(all=True, filters={ "label": [ "com.docker.compose.project" ] }):
+        labels = container.get('Labels') or {}
+        project_containers = containers_by_project.get(labels.get('com.docker.compose.project', ''))
+        if project_containers is not None:
+            project_containers.append(container)
+
+    result: Dict[str, Optional[str]] = {}
+    for fp in fingerprints:
+        reason: Optional[str] = None
+        remaining = set(fp.services)
+        for container in containers_by_project[fp.project_name]:
+            labels = container.get('Labels') or {}
+            service = labels.get('com.docker.compose.service', '')
+            if service not in fp.services:
+                reason = f"orphaned container for service '{service}'"
+            elif container.get('State') != 'running':
+                reason = f"service '{service}' container is {container.get('State')}"
+            elif labels.get(CONFIG_FINGERPRINT_LABEL) != fp.fingerprint:
+                reason = f"service '{service}' configuration changed"
+            elif service in fp.images and image_ids.get(normalize_image_reference(fp.images[service])) is None:
+                reason = f"service '{service}' image {fp.images[service]} is not present locally"
+            elif service in fp.images and image_ids[normalize_image_reference(fp.images[service])] != container.get('ImageID'):
+                reason = f"service '{service}' image {fp.images[service]} has been updated"
+            else:
+                remaining.discard(service)
+                continue
+            break
+        if reason is None and len(remaining) > 0:
+            reason = f"service '{sorted(remaining)[0]}' has no container"
+        result[fp.project_name] = reason
+    return result
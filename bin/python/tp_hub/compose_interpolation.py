@@ -0,0 +1,176 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+In-process implementation of docker-compose variable interpolation.
+
+Follows the compose specification:
+
+    $$                  A literal "$"
+    $VAR, ${VAR}        The value of VAR; an empty string if VAR is unset
+    ${VAR:-default}     default if VAR is unset or empty
+    ${VAR-default}      default if VAR is unset
+    ${VAR:?message}     Error with message if VAR is unset or empty
+    ${VAR?message}      Error with message if VAR is unset
+    ${VAR:+replacement} replacement if VAR is set and non-empty, otherwise empty
+    ${VAR+replacement}  replacement if VAR is set, otherwise empty
+
+Defaults, messages and replacements may themselves contain interpolations, which
+are only evaluated if they are used.
+"""
+
+from __future__ import annotations
+
+from .internal_types import *
+from .pkg_logging import logger
+
+class ComposeInterpolationError(HubError):
+    """An invalid interpolation expression, or a required variable that is unset"""
+    pass
+
+def _is_name_start(ch: str) -> bool:
+    return ch == '_' or ('a' <= ch <= 'z') or ('A' <= ch <= 'Z')
+
+def _is_name_char(ch: str) -> bool:
+    return _is_name_start(ch) or ('0' <= ch <= '9')
+
+_operators = (':-', ':?', ':+', '-', '?', '+')
+
+def _find_closing_brace(s: str, i: int) -> int:
+    """
+    Find the index of the "}" that closes a "${" expression whose body starts at s[i],
+    skipping over nested "${...}" expressions and "$$" escapes.
+    """
+    depth = 0
+    n = len(s)
+    while i < n:
+        ch = s[i]
+        if ch == '$' and i + 1 < n:
+            if s[i+1] == '$':
+                i += 2
+                continue
+            if s[i+1] == '{':
+                depth += 1
+                i += 2
+                continue
+        elif ch == '}':
+            if depth == 0:
+                return i
+            depth -= 1
+        i += 1
+    raise ComposeInterpolationError(f"Unterminated '${{' in interpolated string {s!r}")
+
+def compose_interpolate(
+        s: str,
+        env: Mapping[str, str],
+        missing: Optional[Set[str]]=None,
+      ) -> str:
+    """
+    Interpolate environment variables into a string exactly as docker-compose does.
+
+    Args:
+        s: The string to interpolate.
+        env: The variables available for interpolation.
+        missing: If provided, the names of referenced variables that are unset (and
+                 were not covered by a default) are added to this set. docker-compose
+                 warns about these and substitutes an empty string.
+
+    Raises:
+        ComposeInterpolationError: The string is malformed, or a required (":?"/"?") variable is unset.
+    """
+    if '$' not in s:
+        return s
+    result: List[str] = []
+    n = len(s)
+    i = 0
+    while i < n:
+        j = s.find('$', i)
+        if j < 0:
+            result.append(s[i:])
+            break
+        result.append(s[i:j])
+        i = j + 1
+        if i >= n:
+            raise ComposeInterpolationError(f"Invalid interpolation format: trailing '$' in {s!r}")
+        ch = s[i]
+        if ch == '$':
+            result.append('$')
+            i += 1
+        elif ch == '{':
+            end = _find_closing_brace(s, i + 1)
+            result.append(_interpolate_braced(s[i+1:end], env, missing, s))
+            i = end + 1
+        elif _is_name_start(ch):
+            k = i + 1
+            while k < n and _is_name_char(s[k]):
+                k += 1
+            name = s[i:k]
+            value = env.get(name)
+            if value is None:
+                if missing is not None:
+                    missing.add(name)
+                value = ''
+            result.append(value)
+            i = k
+        else:
+            raise ComposeInterpolationError(f"Invalid interpolation format: '${ch}' in {s!r}")
+    return ''.join(result)
+
+def _interpolate_braced(
+        body: str,
+        env: Mapping[str, str],
+        missing: Optional[Set[str]],
+        whole: str,
+      ) -> str:
+    if len(body) == 0 or not _is_name_start(body[0]):
+        raise ComposeInterpolationError(f"Invalid interpolation format: '${{{body}}}' in {whole!r}")
+    k = 1
+    while k < len(body) and _is_name_char(body[k]):
+        k += 1
+    name = body[:k]
+    rest = body[k:]
+    value = env.get(name)
+    if rest == '':
+        if value is None:
+            if missing is not None:
+                missing.add(name)
+            return ''
+        return value
+    for op in _operators:
+        if rest.startswith(op):
+            arg = rest[len(op):]
+            break
+    else:
+        raise ComposeInterpolationError(f"Invalid interpolation format: '${{{body}}}' in {whole!r}")
+    is_set = value is not None
+    is_set_nonempty = is_set and value != ''
+    present = is_set_nonempty if op.startswith(':') else is_set
+    if op in (':-', '-'):
+        return cast(str, value) if present else compose_interpolate(arg, env, missing=missing)
+    if op in (':?', '?'):
+        if not present:
+            message = compose_interpolate(arg, env, missing=missing)
+            raise ComposeInterpolationError(f"Required variable {name} is missing a value: {message}")
+        return cast(str, value)
+    # ':+' or '+'
+    return compose_interpolate(arg, env, missing=missing) if present else ''
+
+def compose_interpolate_data(
+        data: Any,
+        env: Mapping[str, str],
+        missing: Optional[Set[str]]=None,
+      ) -> Any:
+    """
+    Interpolate environment variables into every string value of parsed compose YAML data.
+    As with docker-compose, mapping keys are not interpolated.
+    """
+    if isinstance(data, str):
+        return compose_interpolate(data, env, missing=missing)
+    if isinstance(data, dict):
+        return { k: compose_interpolate_data(v, env, missing=missing) for k, v in data.items() }
+    if isinstance(data, list):
+        return [ compose_interpolate_data(v, env, missing=missing) for v in data ]
+    return data
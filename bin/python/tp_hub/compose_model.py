@@ -0,0 +1,538 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+An in-process model of the effective configuration of a docker-compose stack, as
+`docker compose config` would produce it, without running docker compose.
+
+The stack's compose files are each interpolated with the variables docker-compose would use
+(see get_compose_stack_env), service extends are resolved, service env_file files are folded
+into the service environment, and the files are merged in order following the compose
+specification:
+
+    * Mappings are merged recursively, with later values winning.
+    * labels, environment, annotations and extra_hosts are merged as mappings, whichever of
+      the list ("KEY=VALUE") or mapping forms each file uses.
+    * ports, expose, dns and dns_search are concatenated, without duplicates.
+    * volumes are merged by their mount target.
+    * networks are merged as mappings, whichever form each file uses.
+    * Any other list (e.g., command, entrypoint) is replaced.
+
+Models are cached by a hash of their inputs (the compose file contents, the interpolation
+variables, the project name and directory), with the files pulled in by extends and env_file
+validated by size and modification time, so repeated queries cost one read of each compose file.
+"""
+
+from __future__ import annotations
+
+import os
+import copy
+import yaml
+import hashlib
+import threading
+
+from .internal_types import *
+from .pkg_logging import logger
+from .docker_compose_stack import DockerComposeStack
+from .compose_interpolation import compose_interpolate_data
+from .x_dotenv import x_dotenv_loads
+
+COMPOSE_MODEL_CACHE_SIZE = 32
+"""The maximum number of compose models kept in the cache"""
+
+_MAPPING_KEYS = ("labels", "environment", "annotations", "extra_hosts")
+_CONCATENATED_KEYS = ("ports", "expose", "dns", "dns_search")
+
+class ComposeModelError(HubError):
+    """A compose file that cannot be modeled, e.g., an unresolvable extends"""
+    pass
+
+class ComposePort:
+    """A port published (or exposed) by a service"""
+    target: int
+    """The container port"""
+
+    published: Optional[str]
+    """The host port or port range, or None if docker picks an ephemeral port"""
+
+    host_ip: Optional[str]
+    """The host address the port is bound to, or None for all addresses"""
+
+    protocol: str
+    """"tcp" or "udp" """
+
+    def __init__(self, target: int, published: Optional[str]=None, host_ip: Optional[str]=None, protocol: str="tcp"):
+        self.target = target
+        self.published = published
+        self.host_ip = host_ip
+        self.protocol = protocol
+
+    def __repr__(self) -> str:
+        host = f"{self.host_ip}:" if self.host_ip else ""
+        published = f"{self.published}:" if self.published else ""
+        return f"ComposePort({host}{published}{self.target}/{self.protocol})"
+
+    def to_jsonable(self) -> JsonableDict:
+        return dict(target=self.target, published=self.published, host_ip=self.host_ip, protocol=self.protocol)
+
+class ComposeVolumeMount:
+    """A volume, bind mount or tmpfs mounted into a service"""
+    type: str
+    """"volume", "bind" or "tmpfs" """
+
+    source: Optional[str]
+    """The volume name or absolute host path, or None for an anonymous volume or tmpfs"""
+
+    target: str
+    """The mount path in the container"""
+
+    read_only: bool
+    """True if mounted read-only"""
+
+    def __init__(self, type: str, source: Optional[str], target: str, read_only: bool=False):
+        self.type = type
+        self.source = source
+        self.target = target
+        self.read_only = read_only
+
+    def __repr__(self) -> str:
+        return f"ComposeVolumeMount({self.type} {self.source or '-'}:{self.target}{':ro' if self.read_only else ''})"
+
+    def to_jsonable(self) -> JsonableDict:
+        return dict(type=self.type, source=self.source, target=self.target, read_only=self.read_only)
+
+class ComposeService:
+    """The effective configuration of one service"""
+    name: str
+    """The service name"""
+
+    data: JsonableDict
+    """The merged, interpolated service configuration, in compose file form"""
+
+    image: Optional[str]
+    """The image, or None if the service is only built"""
+
+    container_name: Optional[str]
+    """The explicit container name, if any"""
+
+    labels: Dict[str, str]
+    """The container labels"""
+
+    environment: Dict[str, Optional[str]]
+    """The container environment; None values are taken from the environment of docker compose"""
+
+    ports: List[ComposePort]
+    """The published ports"""
+
+    volumes: List[ComposeVolumeMount]
+    """The mounts, with relative bind sources resolved against the project directory"""
+
+    networks: List[str]
+    """The names of the networks the service is attached to"""
+
+    profiles: List[str]
+    """The profiles that enable the service; empty if it is always enabled"""
+
+    def __init__(self, name: str, data: JsonableDict, project_directory: str):
+        self.name = name
+        self.data = data
+        self.image = data.get('image')
+        self.container_name = data.get('container_name')
+        self.labels = { k: ('' if v is None else str(v)) for k, v in _to_mapping(data.get('labels')).items() }
+        self.environment = { k: (None if v is None else str(v)) for k, v in _to_mapping(data.get('environment')).items() }
+        self.ports = [ port for spec in data.get('ports') or [] for port in _parse_port(spec) ]
+        self.volumes = [ _parse_volume(spec, project_directory) for spec in data.get('volumes') or [] ]
+        networks = data.get('networks')
+        self.networks = list(_to_network_mapping(networks)) if networks else [ "default" ]
+        self.profiles = list(data.get('profiles') or [])
+
+    def __repr__(self) -> str:
+        return f"ComposeService({self.name!r}, image={self.image!r})"
+
+    def to_jsonable(self) -> JsonableDict:
+        return dict(
+            name=self.name,
+            image=self.image,
+            container_name=self.container_name,
+            labels=self.labels,
+            environment=self.environment,
+            ports=[ x.to_jsonable() for x in self.ports ],
+            volumes=[ x.to_jsonable() for x in self.volumes ],
+            networks=self.networks,
+            profiles=self.profiles,
+          )
+
+class ComposeModel:
+    """The effective configuration of a docker-compose stack"""
+    project_name: str
+    """The docker-compose project name"""
+
+    project_directory: str
+    """The absolute project directory"""
+
+    data: JsonableDict
+    """The merged, interpolated configuration, in compose file form"""
+
+    services: Dict[str, ComposeService]
+    """The services, by name"""
+
+    missing_variables: Set[str]
+    """Variables referenced without a default that are unset; docker compose warns about these
+       and substitutes an empty string"""
+
+    input_hash: str
+    """The hash of the inputs the model was built from"""
+
+    def __init__(
+            self,
+            project_name: str,
+            project_directory: str,
+            data: JsonableDict,
+            missing_variables: Set[str],
+            input_hash: str,
+          ):
+        self.project_name = project_name
+        self.project_directory = project_directory
+        self.data = data
+        self.missing_variables = missing_variables
+        self.input_hash = input_hash
+        self.services = {
+            name: ComposeService(name, service or {}, project_directory)
+            for name, service in (data.get('services') or {}).items()
+          }
+
+    @property
+    def networks(self) -> Dict[str, JsonableDict]:
+        """The top-level network definitions, by name"""
+        return { k: (v or {}) for k, v in (self.data.get('networks') or {}).items() }
+
+    @property
+    def volumes(self) -> Dict[str, JsonableDict]:
+        """The top-level volume definitions, by name"""
+        return { k: (v or {}) for k, v in (self.data.get('volumes') or {}).items() }
+
+    def get_active_services(self, profiles: Iterable[str]=()) -> List[ComposeService]:
+        """Get the services that `docker compose up` starts with the given profiles enabled"""
+        enabled = set(profiles)
+        return [
+            service for service in self.services.values()
+            if len(service.profiles) == 0 or not enabled.isdisjoint(service.profiles)
+          ]
+
+    def get_images(self) -> List[str]:
+        """Get the images of the services, in service order, without duplicates"""
+        result: List[str] = []
+        for service in self.services.values():
+            if service.image is not None and service.image not in result:
+                result.append(service.image)
+        return result
+
+    def get_published_ports(self) -> List[Tuple[str, ComposePort]]:
+        """Get (service name, port) for every port published on the host"""
+        return [
+            (service.name, port)
+            for service in self.services.values()
+            for port in service.ports
+            if port.published is not None
+          ]
+
+def _get_stack_env_files(stack: DockerComposeStack) -> List[str]:
+    result: List[str] = []
+    options = stack.options
+    for i, option in enumerate(options):
+        if option == "--env-file" and i + 1 < len(options):
+            result.append(options[i+1])
+        elif option.startswith("--env-file="):
+            result.append(option.split('=', 1)[1])
+    base_dir = os.getcwd() if stack.cwd is None else stack.cwd
+    if len(result) == 0:
+        default_env_file = os.path.join(stack.project_directory, ".env")
+        return [ default_env_file ] if os.path.isfile(default_env_file) else []
+    return [ os.path.join(base_dir, x) for x in result ]
+
+def get_compose_stack_env(stack: DockerComposeStack) -> Dict[str, str]:
+    """
+    Get the variables that docker-compose interpolates a stack's compose files with: the
+    stack's env files (or its .env), overridden by the stack's process environment.
+    """
+    env: Dict[str, str] = {}
+    for env_file in _get_stack_env_files(stack):
+        with open(env_file, encoding='utf-8') as f:
+            env.update(x_dotenv_loads(f.read()))
+    env.update(stack.env)
+    return env
+
+def _to_mapping(value: Any) -> Dict[str, Any]:
+    """Normalize a compose "KEY=VALUE" list or mapping to a mapping"""
+    if value is None:
+        return {}
+    if isinstance(value, dict):
+        return dict(value)
+    result: Dict[str, Any] = {}
+    for item in value:
+        key, sep, v = str(item).partition('=')
+        result[key] = v if sep else None
+    return result
+
+def _to_network_mapping(value: Any) -> Dict[str, Any]:
+    if value is None:
+        return {}
+    if isinstance(value, dict):
+        return dict(value)
+    return { str(name): None for name in value }
+
+def _expand_port_range(s: str) -> List[int]:
+    start, sep, end = s.partition('-')
+    return list(range(int(start), int(end) + 1)) if sep else [ int(start) ]
+
+def _parse_port(spec: Any) -> List[ComposePort]:
+    if isinstance(spec, dict):
+        published = spec.get('published')
+        return [ ComposePort(
+            int(spec['target']),
+            None if published is None else str(published),
+            spec.get('host_ip'),
+            spec.get('protocol') or "tcp",
+          ) ]
+    s = str(spec)
+    protocol = "tcp"
+    if '/' in s:
+        s, protocol = s.rsplit('/', 1)
+    host_ip: Optional[str] = None
+    if s.startswith('['):
+        end = s.index(']')
+        host_ip = s[1:end]
+        s = s[end+2:]
+    parts = s.split(':')
+    if len(parts) == 3:
+        host_ip, published, target = parts
+    elif len(parts) == 2:
+        published, target = parts
+    else:
+        published, target = '', parts[0]
+    targets = _expand_port_range(target)
+    if published != '' and '-' in published and len(_expand_port_range(published)) == len(targets):
+        return [ ComposePort(t, str(p), host_ip or None, protocol) for t, p in zip(targets, _expand_port_range(published)) ]
+    return [ ComposePort(t, published or None, host_ip or None, protocol) for t in targets ]
+
+def _resolve_bind_source(source: str, project_directory: str) -> str:
+    return os.path.normpath(os.path.join(project_directory, os.path.expanduser(source)))
+
+def _parse_volume(spec: Any, project_directory: str) -> ComposeVolumeMount:
+    if isinstance(spec, dict):
+        type = spec.get('type') or "volume"
+        source = spec.get('source')
+        if type == "bind" and source:
+            source = _resolve_bind_source(source, project_directory)
+        return ComposeVolumeMount(type, source or None, spec['target'], bool(spec.get('read_only', False)))
+    parts = str(spec).split(':')
+    if len(parts) == 1:
+        return ComposeVolumeMount("volume", None, parts[0])
+    source, target = parts[0], parts[1]
+    read_only = len(parts) > 2 and 'ro' in parts[2].split(',')
+    if source.startswith(('/', '.', '~')):
+        return ComposeVolumeMount("bind", _resolve_bind_source(source, project_directory), target, read_only)
+    return ComposeVolumeMount("volume", source, target, read_only)
+
+def _volume_target(spec: Any) -> str:
+    if isinstance(spec, dict):
+        return str(spec.get('target', ''))
+    parts = str(spec).split(':')
+    return parts[1] if len(parts) > 1 else parts[0]
+
+def merge_compose_services(base: JsonableDict, override: JsonableDict) -> JsonableDict:
+    """Merge one service configuration over another, following the compose specification"""
+    result = copy.deepcopy(base)
+    for key, value in override.items():
+        if key in _MAPPING_KEYS:
+            merged = _to_mapping(result.get(key))
+            merged.update(_to_mapping(value))
+            result[key] = merged
+        elif key in _CONCATENATED_KEYS:
+            merged_list = list(result.get(key) or [])
+            for item in value or []:
+                if item not in merged_list:
+                    merged_list.append(item)
+            result[key] = merged_list
+        elif key == 'volumes':
+            by_target: Dict[str, Any] = { _volume_target(v): v for v in result.get(key) or [] }
+            for v in value or []:
+                by_target[_volume_target(v)] = v
+            result[key] = list(by_target.values())
+        elif key == 'networks':
+            merged = _to_network_mapping(result.get(key))
+            merged.update(_to_network_mapping(value))
+            result[key] = merged
+        elif isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = _merge_mappings(result[key], value)
+        else:
+            result[key] = copy.deepcopy(value)
+    return result
+
+def _merge_mappings(base: JsonableDict, override: JsonableDict) -> JsonableDict:
+    result = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = _merge_mappings(result[key], value)
+        else:
+            result[key] = copy.deepcopy(value)
+    return result
+
+def merge_compose_data(base: JsonableDict, override: JsonableDict) -> JsonableDict:
+    """Merge one compose file's (interpolated) data over another's"""
+    result = dict(base)
+    for key, value in override.items():
+        if key == 'services':
+            services = dict(result.get('services') or {})
+            for name, service in (value or {}).items():
+                services[name] = merge_compose_services(services.get(name) or {}, service or {})
+            result['services'] = services
+        elif isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = _merge_mappings(result[key], value)
+        else:
+            result[key] = copy.deepcopy(value)
+    return result
+
+class _ComposeLoader:
+    """Loads and interpolates compose files, recording every file read"""
+    env: Mapping[str, str]
+    missing: Set[str]
+    files_read: Dict[str, Tuple[int, int]]
+    _cache: Dict[str, JsonableDict]
+
+    def __init__(self, env: Mapping[str, str]):
+        self.env = env
+        self.missing = set()
+        self.files_read = {}
+        self._cache = {}
+
+    def load(self, pathname: str) -> JsonableDict:
+        pathname = os.path.abspath(pathname)
+        if pathname not in self._cache:
+            st = os.stat(pathname)
+            self.files_read[pathname] = (st.st_size, st.st_mtime_ns)
+            with open(pathname, encoding='utf-8') as f:
+                data = yaml.safe_load(f) or {}
+            self._cache[pathname] = compose_interpolate_data(data, self.env, missing=self.missing)
+        return self._cache[pathname]
+
+    def load_env_file(self, pathname: str) -> Dict[str, str]:
+        pathname = os.path.abspath(pathname)
+        st = os.stat(pathname)
+        self.files_read[pathname] = (st.st_size, st.st_mtime_ns)
+        with open(pathname, encoding='utf-8') as f:
+            return x_dotenv_loads(f.read())
+
+    def resolve_env_files(self, pathname: str, service: JsonableDict) -> JsonableDict:
+        """As `docker compose config` does, fold a service's env_file files into its environment"""
+        env_files = service.get('env_file')
+        if env_files is None:
+            return service
+        service = dict(service)
+        del service['env_file']
+        environment: Dict[str, Any] = {}
+        for env_file in [ env_files ] if isinstance(env_files, str) else env_files:
+            required = True
+            if isinstance(env_file, dict):
+                required = env_file.get('required', True)
+                env_file = env_file['path']
+            env_pathname = os.path.join(os.path.dirname(os.path.abspath(pathname)), env_file)
+            if not required and not os.path.exists(env_pathname):
+                continue
+            environment.update(self.load_env_file(env_pathname))
+        environment.update(_to_mapping(service.get('environment')))
+        service['environment'] = environment
+        return service
+
+    def resolve_service(self, pathname: str, name: str, chain: Tuple[Tuple[str, str], ...]=()) -> JsonableDict:
+        """Get a service from a compose file, with its extends resolved"""
+        key = (os.path.abspath(pathname), name)
+        if key in chain:
+            raise ComposeModelError(f"Circular extends of service '{name}' in {pathname}")
+        services = self.load(pathname).get('services') or {}
+        if name not in services:
+            raise ComposeModelError(f"Service '{name}' not found in {pathname}")
+        service = dict(services[name] or {})
+        extends = service.pop('extends', None)
+        if extends is None:
+            return service
+        if isinstance(extends, str):
+            extends = dict(service=extends)
+        base_pathname = pathname
+        if 'file' in extends:
+            base_pathname = os.path.join(os.path.dirname(os.path.abspath(pathname)), extends['file'])
+            if not os.path.isfile(base_pathname):
+                # e.g., a file generated by "hub build" that has not been built yet
+                raise ComposeModelError(f"Service '{name}' in {pathname} extends missing file {base_pathname}")
+        base = self.resolve_service(base_pathname, extends['service'], chain + (key,))
+        # Dependencies of the base service are not inherited
+        for k in ('depends_on', 'links', 'volumes_from'):
+            base.pop(k, None)
+        return merge_compose_services(base, service)
+
+def _get_input_hash(stack: DockerComposeStack, compose_files: List[str], env: Mapping[str, str]) -> str:
+    h = hashlib.sha256()
+    h.update(repr((stack.project_name, stack.project_directory, sorted(env.items()))).encode('utf-8'))
+    for pathname in compose_files:
+        h.update(pathname.encode('utf-8') + b'\0')
+        with open(pathname, 'rb') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+_cache_lock = threading.Lock()
+_model_cache: Dict[str, Tuple[ComposeModel, Dict[str, Tuple[int, int]]]] = {}
+
+def _cached_model_is_valid(files_read: Dict[str, Tuple[int, int]]) -> bool:
+    for pathname, signature in files_read.items():
+        try:
+            st = os.stat(pathname)
+        except OSError:
+            return False
+        if (st.st_size, st.st_mtime_ns) != signature:
+            return False
+    return True
+
+def get_compose_model(stack: DockerComposeStack) -> ComposeModel:
+    """
+    Get the effective configuration of a docker-compose stack. The result is cached by the
+    hash of its inputs, and must not be modified.
+
+    Raises:
+        ComposeInterpolationError: A compose file has an invalid interpolation, or a required
+            variable is unset.
+        ComposeModelError: A service extends a service that cannot be found, or itself.
+        OSError: A compose file cannot be read.
+    """
+    env = get_compose_stack_env(stack)
+    base_dir = os.getcwd() if stack.cwd is None else stack.cwd
+    compose_files = [ os.path.abspath(os.path.join(base_dir, x)) for x in stack.docker_compose_files ]
+    input_hash = _get_input_hash(stack, compose_files, env)
+    with _cache_lock:
+        entry = _model_cache.get(input_hash)
+    if entry is not None and _cached_model_is_valid(entry[1]):
+        return entry[0]
+
+    loader = _ComposeLoader(env)
+    data: JsonableDict = {}
+    for pathname in compose_files:
+        file_data = dict(loader.load(pathname))
+        file_data['services'] = {
+            name: loader.resolve_env_files(pathname, loader.resolve_service(pathname, name))
+            for name in (file_data.get('services') or {})
+          }
+        data = merge_compose_data(data, file_data)
+    model = ComposeModel(stack.project_name, stack.project_directory, data, loader.missing, input_hash)
+    logger.debug(f"Built compose model of stack '{stack.name}' ({len(model.services)} services) from {len(loader.files_read)} files")
+    with _cache_lock:
+        while len(_model_cache) >= COMPOSE_MODEL_CACHE_SIZE:
+            del _model_cache[next(iter(_model_cache))]
+        _model_cache[input_hash] = (model, loader.files_read)
+    return model
+
+def clear_compose_model_cache() -> None:
+    """Forget all cached compose models"""
+    with _cache_lock:
+        _model_cache.clear()
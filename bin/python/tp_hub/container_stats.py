@@ -0,0 +1,462 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+A streaming resource monitor for the containers of the hub stacks.
+
+Each container's Engine API stats stream is read on its own thread. The daemon pushes one
+sample per second per container, so there is no polling; each sample is reduced to CPU%,
+memory, and network and block IO rates by differencing it with the previous sample, and
+appended to a fixed-size ring buffer of history for the container. If the Engine API is not
+directly accessible, one `docker stats --no-stream` subprocess per interval samples all the
+containers instead.
+"""
+
+from __future__ import annotations
+
+import re
+import json
+import time
+import threading
+import subprocess
+from collections import deque
+from typing import Deque
+
+from .internal_types import *
+from .pkg_logging import logger
+from .docker_api import DockerStream, get_docker_engine_client
+from .util import docker_call_output, format_bytes, format_table
+from .stack_status import HUB_STACK_NAMES, find_stack_containers
+
+DEFAULT_STATS_HISTORY = 300
+"""The default number of samples kept per container (5 minutes at one sample per second)"""
+
+class StatsSample:
+    """One resource usage sample of a container. Rates are None for the first sample."""
+    time: float
+    """When the sample was taken, as a UNIX time"""
+
+    cpu_percent: Optional[float]
+    """CPU usage since the previous sample, as a percentage of one CPU (so up to 100 * ncpus)"""
+
+    memory_usage: int
+    """Memory in use, in bytes, excluding reclaimable page cache"""
+
+    memory_limit: int
+    """The memory limit, in bytes (the host's memory if the container has no limit)"""
+
+    net_rx_rate: Optional[float]
+    """Network bytes received per second, over all interfaces"""
+
+    net_tx_rate: Optional[float]
+    """Network bytes sent per second, over all interfaces"""
+
+    block_read_rate: Optional[float]
+    """Block device bytes read per second"""
+
+    block_write_rate: Optional[float]
+    """Block device bytes written per second"""
+
+    pids: Optional[int]
+    """The number of processes and threads"""
+
+    def __init__(
+            self,
+            time: float,
+            cpu_percent: Optional[float],
+            memory_usage: int,
+            memory_limit: int,
+            net_rx_rate: Optional[float],
+            net_tx_rate: Optional[float],
+            block_read_rate: Optional[float],
+            block_write_rate: Optional[float],
+            pids: Optional[int],
+          ):
+        self.time = time
+        self.cpu_percent = cpu_percent
+        self.memory_usage = memory_usage
+        self.memory_limit = memory_limit
+        self.net_rx_rate = net_rx_rate
+        self.net_tx_rate = net_tx_rate
+        self.block_read_rate = block_read_rate
+        self.block_write_rate = block_write_rate
+        self.pids = pids
+
+    @property
+    def memory_percent(self) -> Optional[float]:
+        """Memory in use as a percentage of the limit"""
+        return None if self.memory_limit <= 0 else 100.0 * self.memory_usage / self.memory_limit
+
+    def to_jsonable(self) -> JsonableDict:
+        return dict(
+            time=self.time,
+            cpu_percent=self.cpu_percent,
+            memory_usage=self.memory_usage,
+            memory_limit=self.memory_limit,
+            memory_percent=self.memory_percent,
+            net_rx_rate=self.net_rx_rate,
+            net_tx_rate=self.net_tx_rate,
+            block_read_rate=self.block_read_rate,
+            block_write_rate=self.block_write_rate,
+            pids=self.pids,
+          )
+
+class _Counters:
+    """Cumulative counters from one raw sample, used to compute rates from the next"""
+    monotonic_time: float
+    cpu_total: Optional[int]
+    system_cpu: Optional[int]
+    net_rx: int
+    net_tx: int
+    block_read: int
+    block_write: int
+
+    def __init__(
+            self,
+            monotonic_time: float,
+            cpu_total: Optional[int],
+            system_cpu: Optional[int],
+            net_rx: int,
+            net_tx: int,
+            block_read: int,
+            block_write: int,
+          ):
+        self.monotonic_time = monotonic_time
+        self.cpu_total = cpu_total
+        self.system_cpu = system_cpu
+        self.net_rx = net_rx
+        self.net_tx = net_tx
+        self.block_read = block_read
+        self.block_write = block_write
+
+def _rate(new: int, old: int, seconds: float) -> Optional[float]:
+    # Counters reset if the container restarts
+    return None if seconds <= 0 or new < old else (new - old) / seconds
+
+class ContainerStats:
+    """A monitored container and its sample history"""
+    stack: str
+    """The docker-compose project name"""
+
+    service: str
+    """The docker-compose service name"""
+
+    name: str
+    """The container name"""
+
+    container_id: str
+    """The container ID"""
+
+    history: Deque[StatsSample]
+    """Recent samples, oldest first; a ring buffer that discards the oldest sample when full"""
+
+    _prev: Optional[_Counters]
+    _ncpus: int
+
+    def __init__(self, stack: str, service: str, name: str, container_id: str, max_history: int=DEFAULT_STATS_HISTORY):
+        self.stack = stack
+        self.service = service
+        self.name = name
+        self.container_id = container_id
+        self.history = deque(maxlen=max_history)
+        self._prev = None
+        self._ncpus = 1
+
+    @property
+    def latest(self) -> Optional[StatsSample]:
+        """The most recent sample, or None if there is none yet"""
+        return self.history[-1] if len(self.history) > 0 else None
+
+    def _add(self, sample_time: float, counters: _Counters, cpu_percent: Optional[float],
+             memory_usage: int, memory_limit: int, pids: Optional[int]) -> StatsSample:
+        prev = self._prev
+        rates: List[Optional[float]] = [ None, None, None, None ]
+        if prev is not None:
+            seconds = counters.monotonic_time - prev.monotonic_time
+            rates = [
+                _rate(counters.net_rx, prev.net_rx, seconds),
+                _rate(counters.net_tx, prev.net_tx, seconds),
+                _rate(counters.block_read, prev.block_read, seconds),
+                _rate(counters.block_write, prev.block_write, seconds),
+              ]
+            if (cpu_percent is None and counters.cpu_total is not None and prev.cpu_total is not None and
+                    counters.system_cpu is not None and prev.system_cpu is not None and
+                    counters.system_cpu > prev.system_cpu and counters.cpu_total >= prev.cpu_total):
+                # system_cpu_usage sums over all CPUs, so scale to a percentage of one CPU
+                cpu_percent = 100.0 * self._ncpus * (counters.cpu_total - prev.cpu_total) / (counters.system_cpu - prev.system_cpu)
+        self._prev = counters
+        sample = StatsSample(
+            sample_time,
+            cpu_percent,
+            memory_usage,
+            memory_limit,
+            net_rx_rate=rates[0],
+            net_tx_rate=rates[1],
+            block_read_rate=rates[2],
+            block_write_rate=rates[3],
+            pids=pids,
+          )
+        self.history.append(sample)
+        return sample
+
+    def add_engine_sample(self, raw: JsonableDict) -> StatsSample:
+        """Add a sample from the Engine API stats stream"""
+        cpu_stats = raw.get('cpu_stats') or {}
+        self._ncpus = cpu_stats.get('online_cpus') or len((cpu_stats.get('cpu_usage') or {}).get('percpu_usage') or []) or 1
+        memory_stats = raw.get('memory_stats') or {}
+        mem_detail = memory_stats.get('stats') or {}
+        # As docker stats does: cgroup v1 excludes total_inactive_file, v2 inactive_file
+        reclaimable = mem_detail.get('total_inactive_file', mem_detail.get('inactive_file', 0))
+        memory_usage = max(0, (memory_stats.get('usage') or 0) - (reclaimable or 0))
+        networks = (raw.get('networks') or {}).values()
+        block_read = block_write = 0
+        for entry in (raw.get('blkio_stats') or {}).get('io_service_bytes_recursive') or []:
+            op = (entry.get('op') or '').lower()
+            if op == 'read':
+                block_read += entry.get('value') or 0
+            elif op == 'write':
+                block_write += entry.get('value') or 0
+        counters = _Counters(
+            time.monotonic(),
+            (cpu_stats.get('cpu_usage') or {}).get('total_usage'),
+            cpu_stats.get('system_cpu_usage'),
+            sum(n.get('rx_bytes') or 0 for n in networks),
+            sum(n.get('tx_bytes') or 0 for n in networks),
+            block_read,
+            block_write,
+          )
+        return self._add(
+            time.time(), counters, None, memory_usage, memory_stats.get('limit') or 0,
+            (raw.get('pids_stats') or {}).get('current'))
+
+    def add_cli_sample(self, raw: Mapping[str, str]) -> StatsSample:
+        """Add a sample from `docker stats --format '{{json .}}'`"""
+        mem_usage, _, mem_limit = (raw.get('MemUsage') or '').partition('/')
+        net_rx, _, net_tx = (raw.get('NetIO') or '').partition('/')
+        block_read, _, block_write = (raw.get('BlockIO') or '').partition('/')
+        cpu = (raw.get('CPUPerc') or '').rstrip('%').strip()
+        pids = (raw.get('PIDs') or '').strip()
+        counters = _Counters(
+            time.monotonic(), None, None,
+            parse_size(net_rx), parse_size(net_tx), parse_size(block_read), parse_size(block_write))
+        return self._add(
+            time.time(),
+            counters,
+            float(cpu) if re.match(r'^[0-9.]+$', cpu) else None,
+            parse_size(mem_usage),
+            parse_size(mem_limit),
+            int(pids) if pids.isdigit() else None,
+          )
+
+    def to_jsonable(self, history: bool=False) -> JsonableDict:
+        latest = self.latest
+        result: JsonableDict = dict(
+            stack=self.stack,
+            service=self.service,
+            name=self.name,
+            container_id=self.container_id,
+            sample=None if latest is None else latest.to_jsonable(),
+          )
+        if history:
+            result['history'] = [ s.to_jsonable() for s in self.history ]
+        return result
+
+_size_re = re.compile(r'^\s*([0-9.]+)\s*([kKMGTP]?i?B)?\s*$')
+_size_units = {
+    '': 1, 'B': 1,
+    'kB': 1000, 'KB': 1000, 'MB': 1000**2, 'GB': 1000**3, 'TB': 1000**4, 'PB': 1000**5,
+    'KiB': 1024, 'kiB': 1024, 'MiB': 1024**2, 'GiB': 1024**3, 'TiB': 1024**4, 'PiB': 1024**5,
+  }
+
+def parse_size(s: str) -> int:
+    """Parse a size as formatted by the docker CLI (e.g., "1.5MiB", "648B", "2.1kB"); 0 if unparseable"""
+    m = _size_re.match(s)
+    if m is None:
+        return 0
+    return int(float(m.group(1)) * _size_units.get(m.group(2) or '', 1))
+
+def get_stats_containers(
+        stacks: Iterable[str]=HUB_STACK_NAMES,
+        include_portainer_stacks: bool=True,
+        services: Optional[Iterable[str]]=None,
+      ) -> List[Tuple[str, str, str, str]]:
+    """
+    Find the running containers to monitor, with a single container listing.
+
+    Returns:
+        (stack, service, name, container_id) tuples, sorted by stack, service and name.
+    """
+    return find_stack_containers(stacks, include_portainer_stacks=include_portainer_stacks, services=services, all=False)
+
+class ContainerStatsMonitor:
+    """
+    Monitors the resource usage of a changing set of containers. Call sync() periodically to
+    pick up containers that start or stop.
+    """
+    max_history: int
+    """The number of samples kept per container"""
+
+    cli_interval: float
+    """Seconds between samples when the docker CLI must be used"""
+
+    on_sample: Optional[Callable[[ContainerStats, StatsSample], None]]
+    """If not None, called (on a monitor thread) with each new sample"""
+
+    _containers: Dict[str, ContainerStats]
+    _streams: Dict[str, DockerStream]
+    _lock: threading.Lock
+    _stopping: bool
+    _threads: List[threading.Thread]
+    _use_cli: bool
+
+    def __init__(
+            self,
+            max_history: int=DEFAULT_STATS_HISTORY,
+            cli_interval: float=2.0,
+            on_sample: Optional[Callable[[ContainerStats, StatsSample], None]]=None,
+          ):
+        self.max_history = max_history
+        self.cli_interval = cli_interval
+        self.on_sample = on_sample
+        self._containers = {}
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._threads = []
+        self._use_cli = get_docker_engine_client() is None
+        if self._use_cli:
+            thread = threading.Thread(target=self._poll_cli, name="stats-cli", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def get_containers(self) -> List[ContainerStats]:
+        """The monitored containers, sorted by stack, service and name"""
+        with self._lock:
+            return sorted(self._containers.values(), key=lambda x: (x.stack, x.service, x.name))
+
+    def sync(self, containers: Iterable[Tuple[str, str, str, str]]) -> None:
+        """
+        Set the containers to monitor, starting streams for new ones, and stopping and
+        forgetting the ones that are no longer included.
+
+        Args:
+            containers: (stack, service, name, container_id) tuples, as returned by
+                get_stats_containers().
+        """
+        wanted = { container_id: (stack, service, name) for stack, service, name, container_id in containers }
+        with self._lock:
+            removed = [ cid for cid in self._containers if cid not in wanted ]
+            for cid in removed:
+                del self._containers[cid]
+            streams = [ self._streams.pop(cid) for cid in removed if cid in self._streams ]
+            added: List[ContainerStats] = []
+            for cid, (stack, service, name) in wanted.items():
+                if cid not in self._containers:
+                    stats = ContainerStats(stack, service, name, cid, max_history=self.max_history)
+                    self._containers[cid] = stats
+                    added.append(stats)
+        for stream in streams:
+            stream.close()
+        if not self._use_cli:
+            for stats in added:
+                thread = threading.Thread(target=self._follow_engine, args=(stats,), name=f"stats-{stats.name}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def _sampled(self, stats: ContainerStats, sample: StatsSample) -> None:
+        if self.on_sample is not None:
+            self.on_sample(stats, sample)
+
+    def _follow_engine(self, stats: ContainerStats) -> None:
+        client = get_docker_engine_client()
+        assert client is not None
+        try:
+            stream = client.open_container_stats(stats.container_id)
+            with self._lock:
+                if self._stopping or stats.container_id not in self._containers:
+                    stream.close()
+                    return
+                self._streams[stats.container_id] = stream
+            with stream:
+                while True:
+                    line = stream.readline()
+                    if line == b'':
+                        break
+                    line = line.strip()
+                    if line == b'':
+                        continue
+                    raw = json.loads(line)
+                    if not raw.get('read', '').startswith('0001-'):
+                        self._sampled(stats, stats.add_engine_sample(raw))
+        except Exception as e:
+            if not self._stopping and stats.container_id in self._containers:
+                logger.warning(f"Stats stream for {stats.name} failed: {e}")
+
+    def _poll_cli(self) -> None:
+        while not self._stopping:
+            start_time = time.monotonic()
+            with self._lock:
+                by_id = dict(self._containers)
+            if len(by_id) > 0:
+                try:
+                    text = docker_call_output(["stats", "--no-stream", "--no-trunc", "--format", "{{json .}}"] + list(by_id))
+                except subprocess.CalledProcessError as e:
+                    # A container that stopped makes the whole call fail; sync() will drop it
+                    logger.debug(f"docker stats failed: {e}")
+                    text = ''
+                for line in text.splitlines():
+                    if line.strip() == '':
+                        continue
+                    raw = json.loads(line)
+                    stats = by_id.get(raw.get('ID', ''))
+                    if stats is not None:
+                        self._sampled(stats, stats.add_cli_sample(raw))
+            time.sleep(max(0.1, start_time + self.cli_interval - time.monotonic()))
+
+    def stop(self) -> None:
+        """Stop monitoring; blocked reads are interrupted"""
+        with self._lock:
+            self._stopping = True
+            streams = list(self._streams.values())
+            self._streams.clear()
+        for stream in streams:
+            stream.close()
+        for thread in self._threads:
+            thread.join(timeout=5.0)
+
+    def __enter__(self) -> ContainerStatsMonitor:
+        return self
+
+    def __exit__(
+            self,
+            exc_type: Optional[type[BaseException]],
+            exc_val: Optional[BaseException],
+            exc_tb: Optional[TracebackType],
+          ) -> None:
+        self.stop()
+
+def format_container_stats(containers: List[ContainerStats]) -> str:
+    """Format the latest sample of each container as a table"""
+    rows = [ ("STACK", "SERVICE", "CPU%", "MEM", "MEM%", "NET RX", "NET TX", "BLK RD", "BLK WR", "PIDS") ]
+    for c in containers:
+        s = c.latest
+        if s is None:
+            rows.append((c.stack, c.service) + ("-",) * 8)
+            continue
+        memory_percent = s.memory_percent
+        rows.append((
+            c.stack,
+            c.service,
+            "-" if s.cpu_percent is None else f"{s.cpu_percent:.1f}",
+            format_bytes(s.memory_usage),
+            "-" if memory_percent is None else f"{memory_percent:.1f}",
+            format_bytes(s.net_rx_rate, "/s"),
+            format_bytes(s.net_tx_rate, "/s"),
+            format_bytes(s.block_read_rate, "/s"),
+            format_bytes(s.block_write_rate, "/s"),
+            "-" if s.pids is None else str(s.pids),
+          ))
+    return format_table(rows, left_columns=2)
@@ -0,0 +1,758 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+A minimal in-process Docker Engine API client.
+
+Talks HTTP/1.1 directly to the docker daemon's unix socket over a persistent keep-alive
+connection, so that queries do not pay for forking the docker CLI (and possibly an
+`sg docker` re-exec) on every call. If the socket is not accessible to this process
+(e.g., the login session is not yet in the "docker" group), get_docker_engine_client()
+returns None and callers fall back to the docker CLI.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import time
+import socket
+import threading
+import http.client
+from urllib.parse import urlencode, quote
+
+from .internal_types import *
+from .pkg_logging import logger
+
+DEFAULT_DOCKER_SOCKET = "/var/run/docker.sock"
+
+_RETRYABLE_METHODS = ("GET", "HEAD")
+
+class DockerApiError(HubError):
+    """An error response from the Docker Engine API"""
+    status: int
+    """The HTTP status code"""
+
+    def __init__(self, status: int, message: str, method: str='', path: str=''):
+        super().__init__(f"Docker Engine API {method} {path} failed with HTTP {status}: {message}")
+        self.status = status
+
+class DockerApiNotFoundError(DockerApiError):
+    """The requested docker object does not exist (HTTP 404)"""
+    pass
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """An HTTPConnection to a server on a unix domain socket"""
+
+    socket_path: str
+
+    def __init__(self, socket_path: str, timeout: Optional[float]=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if self.timeout is not None:
+                sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+        except BaseException:
+            sock.close()
+            raise
+        self.sock = sock
+
+class DockerStream:
+    """
+    A streaming Docker Engine API response on its own connection. Closing the stream
+    closes the connection.
+    """
+    response: http.client.HTTPResponse
+    """The underlying HTTP response"""
+
+    _conn: UnixHTTPConnection
+    _sock: Optional[socket.socket]
+
+    def __init__(self, conn: UnixHTTPConnection, response: http.client.HTTPResponse, sock: Optional[socket.socket]=None):
+        self._conn = conn
+        self.response = response
+        self._sock = sock
+
+    @property
+    def status(self) -> int:
+        return self.response.status
+
+    def getheader(self, name: str, default: Optional[str]=None) -> Optional[str]:
+        return self.response.getheader(name, default)
+
+    def read(self, size: Optional[int]=None) -> bytes:
+        """Read up to size bytes (all remaining bytes if size is None). Returns b'' at end of stream."""
+        return self.response.read(size) if size is not None else self.response.read()
+
+    def read1(self, size: int=-1) -> bytes:
+        """Read whatever is available, up to size bytes, blocking only if nothing is available"""
+        return self.response.read1(size)
+
+    def readline(self) -> bytes:
+        return self.response.readline()
+
+    def set_timeout(self, timeout: Optional[float]) -> None:
+        """Set the timeout for subsequent reads"""
+        if self._conn.sock is not None:
+            self._conn.sock.settimeout(timeout)
+
+    def close(self) -> None:
+        """Close the stream. May be called from another thread to interrupt a blocked read."""
+        if self._sock is not None:
+            # Unblocks a reader in another thread, which holds the response's buffer lock
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.response.close()
+        self._conn.close()
+        if self._sock is not None:
+            self._sock.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+            self,
+            exc_type: Optional[type[BaseException]],
+            exc_val: Optional[BaseException],
+            exc_tb: Optional[TracebackType],
+          ) -> None:
+        self.close()
+
+class DockerExecSocket:
+    """
+    An exec started with its stdin attached, on its own hijacked (upgraded) connection.
+    Data written is delivered to the command's stdin with socket backpressure;
+    close_stdin() signals end of input.
+    """
+    exec_id: str
+    """The ID of the exec instance"""
+
+    _client: DockerEngineClient
+    _conn: UnixHTTPConnection
+    _sock: socket.socket
+    _response: http.client.HTTPResponse
+    _stdin_closed: bool = False
+
+    def __init__(
+            self,
+            client: DockerEngineClient,
+            exec_id: str,
+            conn: UnixHTTPConnection,
+            sock: socket.socket,
+            response: http.client.HTTPResponse,
+          ):
+        self._client = client
+        self.exec_id = exec_id
+        self._conn = conn
+        self._sock = sock
+        self._response = response
+
+    def write(self, data: bytes) -> int:
+        """Write all of data to the command's stdin, blocking until the daemon accepts it"""
+        self._sock.sendall(data)
+        return len(data)
+
+    def close_stdin(self) -> None:
+        if not self._stdin_closed:
+            self._stdin_closed = True
+            self._sock.shutdown(socket.SHUT_WR)
+
+    def wait(self) -> Tuple[int, bytes, bytes]:
+        """
+        Close stdin, collect the command's output, and wait for it to exit.
+
+        Returns:
+            A tuple (exit_code, stdout, stderr).
+        """
+        self.close_stdin()
+        # The upgraded connection carries the raw multiplexed stream until the command exits
+        assert self._response.fp is not None
+        data = self._response.fp.read()
+        self.close()
+        stdout, stderr = demux_docker_stream(data)
+        return self._client.wait_exec(self.exec_id), stdout, stderr
+
+    def close(self) -> None:
+        """Abandon the exec's connection. The command sees end of input (or a broken pipe)."""
+        self._response.close()
+        self._conn.close()
+        self._sock.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+            self,
+            exc_type: Optional[type[BaseException]],
+            exc_val: Optional[BaseException],
+            exc_tb: Optional[TracebackType],
+          ) -> None:
+        self.close()
+
+def demux_docker_stream(data: bytes) -> Tuple[bytes, bytes]:
+    """
+    Split a multiplexed (non-TTY) attach/exec/logs stream into (stdout, stderr). Each frame is an
+    8-byte header (stream type, 3 zero bytes, big-endian 32-bit length) followed by the payload.
+    """
+    out: List[bytes] = []
+    err: List[bytes] = []
+    i = 0
+    n = len(data)
+    while i + 8 <= n:
+        stream_type = data[i]
+        size = int.from_bytes(data[i+4:i+8], 'big')
+        payload = data[i+8:i+8+size]
+        (err if stream_type == 2 else out).append(payload)
+        i += 8 + size
+    return b''.join(out), b''.join(err)
+
+def iter_docker_stream_frames(stream: DockerStream) -> Iterator[Tuple[int, bytes]]:
+    """
+    Iterate over the frames of a multiplexed (non-TTY) attach/exec/logs stream as it arrives,
+    yielding (stream_type, payload) tuples, where stream_type is 1 for stdout and 2 for stderr.
+    """
+    while True:
+        header = stream.read(8)
+        if len(header) < 8:
+            return
+        size = int.from_bytes(header[4:8], 'big')
+        payload = stream.read(size) if size > 0 else b''
+        if len(payload) < size:
+            return
+        yield header[0], payload
+
+def get_docker_socket_path() -> Optional[str]:
+    """
+    Get the path of the docker daemon's unix socket, honoring DOCKER_HOST. Returns None if
+    DOCKER_HOST names a non-unix endpoint, which only the docker CLI can reach.
+    """
+    docker_host = os.environ.get("DOCKER_HOST", "")
+    if docker_host == "":
+        return DEFAULT_DOCKER_SOCKET
+    if docker_host.startswith("unix://"):
+        return docker_host[len("unix://"):]
+    return None
+
+class DockerEngineClient:
+    """
+    A thread-safe Docker Engine API client over a unix socket. Requests share one
+    keep-alive connection, which is transparently re-established if the daemon closes it.
+    Streaming requests each use a dedicated connection.
+    """
+    socket_path: str
+    """The path of the docker daemon's unix socket"""
+
+    timeout: Optional[float]
+    """Socket timeout in seconds for non-streaming requests"""
+
+    num_requests: int
+    """The number of requests made on the shared connection"""
+
+    num_connects: int
+    """The number of times the shared connection has been (re)established"""
+
+    _conn: Optional[UnixHTTPConnection] = None
+    _lock: threading.Lock
+
+    def __init__(self, socket_path: Optional[str]=None, timeout: Optional[float]=60.0):
+        if socket_path is None:
+            socket_path = get_docker_socket_path() or DEFAULT_DOCKER_SOCKET
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.num_requests = 0
+        self.num_connects = 0
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+            self,
+            exc_type: Optional[type[BaseException]],
+            exc_val: Optional[BaseException],
+            exc_tb: Optional[TracebackType],
+          ) -> None:
+        self.close()
+
+    @staticmethod
+    def make_path(path: str, query: Optional[Mapping[str, Any]]=None) -> str:
+        """
+        Build a request path with a query string. Boolean values are encoded as "1"/"0",
+        dict and list values (e.g., filters) as JSON, and None values are omitted.
+        """
+        if query is None:
+            return path
+        params: List[Tuple[str, str]] = []
+        for k, v in query.items():
+            if v is None:
+                continue
+            if isinstance(v, bool):
+                v = "1" if v else "0"
+            elif isinstance(v, (dict, list)):
+                v = json.dumps(v)
+            params.append((k, str(v)))
+        return path if len(params) == 0 else f"{path}?{urlencode(params)}"
+
+    def _get_conn(self) -> UnixHTTPConnection:
+        if self._conn is None:
+            self._conn = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+            self.num_connects += 1
+        return self._conn
+
+    def request(
+            self,
+            method: str,
+            path: str,
+            query: Optional[Mapping[str, Any]]=None,
+            body: Optional[Union[bytes, Jsonable]]=None,
+            headers: Optional[Mapping[str, str]]=None,
+            ok_statuses: Iterable[int]=(200, 201, 204, 304),
+          ) -> Tuple[int, bytes]:
+        """
+        Make a request on the shared keep-alive connection and return (status, response_body).
+
+        Args:
+            method: The HTTP method.
+            path: The API path, e.g., "/volumes". Unversioned paths use the daemon's current API version.
+            query: Query parameters; see make_path().
+            body: A request body; bytes are sent as-is, anything else as JSON.
+            headers: Additional request headers.
+            ok_statuses: Statuses that are returned rather than raised.
+
+        Raises:
+            DockerApiNotFoundError: The daemon returned 404.
+            DockerApiError: The daemon returned some other status not in ok_statuses.
+            OSError: The daemon could not be reached.
+        """
+        full_path = self.make_path(path, query)
+        req_headers: Dict[str, str] = dict(headers or {})
+        body_bytes: Optional[bytes] = None
+        if body is not None:
+            if isinstance(body, bytes):
+                body_bytes = body
+            else:
+                body_bytes = json.dumps(body).encode('utf-8')
+                req_headers.setdefault("Content-Type", "application/json")
+        with self._lock:
+            for attempt in range(2):
+                conn = self._get_conn()
+                sent = False
+                try:
+                    conn.request(method, full_path, body=body_bytes, headers=req_headers)
+                    sent = True
+                    response = conn.getresponse()
+                    data = response.read()
+                    break
+                except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError, http.client.CannotSendRequest):
+                    # The daemon may have closed an idle keep-alive connection; reconnect once. Once
+                    # the request has been sent, the daemon may have acted on it, so only requests
+                    # that are safe to repeat are retried.
+                    conn.close()
+                    self._conn = None
+                    if attempt > 0 or (sent and method not in _RETRYABLE_METHODS):
+                        raise
+                except BaseException:
+                    conn.close()
+                    self._conn = None
+                    raise
+            self.num_requests += 1
+            if response.will_close:
+                conn.close()
+                self._conn = None
+        status = response.status
+        if status not in ok_statuses:
+            message = data.decode('utf-8', errors='replace').strip()
+            try:
+                message = json.loads(message).get('message', message)
+            except (ValueError, AttributeError):
+                pass
+            if status == 404:
+                raise DockerApiNotFoundError(status, message, method, full_path)
+            raise DockerApiError(status, message, method, full_path)
+        return status, data
+
+    def get_json(self, path: str, query: Optional[Mapping[str, Any]]=None) -> Any:
+        """GET a JSON resource"""
+        _, data = self.request("GET", path, query=query)
+        return json.loads(data)
+
+    def post_json(
+            self,
+            path: str,
+            body: Optional[Jsonable]=None,
+            query: Optional[Mapping[str, Any]]=None,
+          ) -> Any:
+        """POST to a resource and return the JSON response, or None if there is no response body"""
+        _, data = self.request("POST", path, query=query, body=body)
+        return json.loads(data) if len(data) > 0 else None
+
+    def delete(self, path: str, query: Optional[Mapping[str, Any]]=None) -> None:
+        """DELETE a resource"""
+        self.request("DELETE", path, query=query)
+
+    def open_stream(
+            self,
+            method: str,
+            path: str,
+            query: Optional[Mapping[str, Any]]=None,
+            body: Optional[Union[bytes, Jsonable]]=None,
+            headers: Optional[Mapping[str, str]]=None,
+            timeout: Optional[float]=None,
+          ) -> DockerStream:
+        """
+        Make a request on a new dedicated connection and return the open response, for
+        long-lived or large responses (events, logs, stats, archives). The caller must
+        close the returned stream.
+        """
+        full_path = self.make_path(path, query)
+        req_headers: Dict[str, str] = dict(headers or {})
+        body_bytes: Optional[bytes] = None
+        if body is not None:
+            if isinstance(body, bytes):
+                body_bytes = body
+            else:
+                body_bytes = json.dumps(body).encode('utf-8')
+                req_headers.setdefault("Content-Type", "application/json")
+        conn = UnixHTTPConnection(self.socket_path, timeout=timeout)
+        try:
+            conn.request(method, full_path, body=body_bytes, headers=req_headers)
+            sock = conn.sock
+            assert sock is not None
+            response = conn.getresponse()
+        except BaseException:
+            conn.close()
+            raise
+        if response.status >= 300:
+            message = response.read().decode('utf-8', errors='replace').strip()
+            conn.close()
+            try:
+                message = json.loads(message).get('message', message)
+            except (ValueError, AttributeError):
+                pass
+            if response.status == 404:
+                raise DockerApiNotFoundError(response.status, message, method, full_path)
+            raise DockerApiError(response.status, message, method, full_path)
+        return DockerStream(conn, response, sock)
+
+    def ping(self) -> bool:
+        """Return True if the daemon responds"""
+        try:
+            _, data = self.request("GET", "/_ping")
+            return data.strip() == b"OK"
+        except (OSError, DockerApiError):
+            return False
+
+    # ---- Networks
+
+    def list_networks(self, filters: Optional[Mapping[str, List[str]]]=None) -> List[JsonableDict]:
+        return self.get_json("/networks", query=dict(filters=filters) if filters else None)
+
+    def inspect_network(self, name: str) -> JsonableDict:
+        return self.get_json(f"/networks/{quote(name, safe='')}")
+
+    def create_network(self, name: str, driver: str="bridge") -> JsonableDict:
+        return self.post_json("/networks/create", body=dict(Name=name, Driver=driver, CheckDuplicate=True))
+
+    # ---- Volumes
+
+    def list_volumes(self, filters: Optional[Mapping[str, List[str]]]=None) -> List[JsonableDict]:
+        data = self.get_json("/volumes", query=dict(filters=filters) if filters else None)
+        return data.get('Volumes') or []
+
+    def inspect_volume(self, name: str) -> JsonableDict:
+        return self.get_json(f"/volumes/{quote(name, safe='')}")
+
+    def create_volume(self, name: str) -> JsonableDict:
+        return self.post_json("/volumes/create", body=dict(Name=name))
+
+    def remove_volume(self, name: str) -> None:
+        self.delete(f"/volumes/{quote(name, safe='')}")
+
+    # ---- Containers
+
+    def list_containers(self, all: bool=False, filters: Optional[Mapping[str, List[str]]]=None) -> List[JsonableDict]:
+        return self.get_json("/containers/json", query=dict(all=all, filters=filters if filters else None))
+
+    def inspect_container(self, name: str) -> JsonableDict:
+        return self.get_json(f"/containers/{quote(name, safe='')}/json")
+
+    def remove_container(self, name: str, force: bool=False, volumes: bool=False) -> None:
+        self.delete(f"/containers/{quote(name, safe='')}", query=dict(force=force, v=volumes))
+
+    def container_logs(
+            self,
+            name: str,
+            tail: Optional[int]=None,
+            since: Optional[float]=None,
+            timestamps: bool=False,
+          ) -> Tuple[bytes, bytes]:
+        """
+        Get the logs of a container (which must not use a TTY) as (stdout, stderr).
+
+        Args:
+            name: The container name or ID.
+            tail: If not None, only the last tail lines of each stream.
+            since: If not None, only lines logged at or after this UNIX time.
+            timestamps: Prefix each line with its RFC3339Nano timestamp.
+        """
+        _, data = self.request(
+            "GET",
+            f"/containers/{quote(name, safe='')}/logs",
+            query=dict(
+                stdout=True,
+                stderr=True,
+                tail=tail,
+                since=None if since is None else f"{since:.9f}",  # seconds.nanoseconds
+                timestamps=timestamps,
+              ),
+          )
+        return demux_docker_stream(data)
+
+    def open_container_logs(
+            self,
+            name: str,
+            follow: bool=False,
+            tail: Optional[int]=None,
+            since: Optional[float]=None,
+            timestamps: bool=False,
+          ) -> DockerStream:
+        """
+        Open a stream of the logs of a container (which must not use a TTY), on a dedicated
+        connection. Use iter_docker_stream_frames() to read it. The caller must close the stream.
+
+        Args:
+            name: The container name or ID.
+            follow: If True, the stream stays open and delivers new log lines as they are written.
+            tail: If not None, start with only the last tail lines of each stream.
+            since: If not None, only lines logged at or after this UNIX time.
+            timestamps: Prefix each line with its RFC3339Nano timestamp.
+        """
+        return self.open_stream(
+            "GET",
+            f"/containers/{quote(name, safe='')}/logs",
+            query=dict(
+                stdout=True,
+                stderr=True,
+                follow=follow,
+                tail=tail,
+                since=None if since is None else f"{since:.9f}",  # seconds.nanoseconds
+                timestamps=timestamps,
+              ),
+          )
+
+    def open_container_stats(self, name: str) -> DockerStream:
+        """
+        Open a stream of resource usage samples of a running container, on a dedicated
+        connection. The daemon writes one JSON object per line, about once per second, until
+        the container stops or the stream is closed. The caller must close the stream.
+        """
+        return self.open_stream(
+            "GET",
+            f"/containers/{quote(name, safe='')}/stats",
+            query=dict(stream=True),
+          )
+
+    def create_container(self, config: JsonableDict, name: Optional[str]=None) -> str:
+        """Create a container from an Engine API container config and return its ID"""
+        data = self.post_json("/containers/create", body=config, query=dict(name=name))
+        return data['Id']
+
+    def start_container(self, name: str) -> None:
+        self.request("POST", f"/containers/{quote(name, safe='')}/start")
+
+    def exec_run(self, container: str, cmd: List[str]) -> Tuple[int, bytes, bytes]:
+        """
+        Run a command in a running container and wait for it to finish.
+
+        Returns:
+            A tuple (exit_code, stdout, stderr).
+        """
+        exec_id = self.post_json(
+            f"/containers/{quote(container, safe='')}/exec",
+            body=dict(AttachStdout=True, AttachStderr=True, Tty=False, Cmd=cmd),
+          )['Id']
+        _, data = self.request("POST", f"/exec/{exec_id}/start", body=dict(Detach=False, Tty=False))
+        stdout, stderr = demux_docker_stream(data)
+        return self.wait_exec(exec_id), stdout, stderr
+
+    def wait_exec(self, exec_id: str, timeout: float=10.0) -> int:
+        """
+        Get the exit code of an exec whose output stream has ended, allowing briefly for
+        the daemon to record the exit.
+        """
+        end_time = time.monotonic() + timeout
+        while True:
+            data = self.get_json(f"/exec/{exec_id}/json")
+            if not data.get('Running', False) or time.monotonic() >= end_time:
+                return data['ExitCode'] if data.get('ExitCode') is not None else -1
+            time.sleep(0.01)
+
+    def open_exec(self, container: str, cmd: List[str]) -> DockerExecSocket:
+        """
+        Start a command in a running container with its stdin attached, for streaming input.
+        The caller must wait() for or close() the returned exec socket.
+        """
+        exec_id = self.post_json(
+            f"/containers/{quote(container, safe='')}/exec",
+            body=dict(AttachStdin=True, AttachStdout=True, AttachStderr=True, Tty=False, Cmd=cmd),
+          )['Id']
+        path = f"/exec/{exec_id}/start"
+        conn = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        try:
+            conn.request(
+                "POST",
+                path,
+                body=json.dumps(dict(Detach=False, Tty=False)).encode('utf-8'),
+                headers={ "Content-Type": "application/json", "Connection": "Upgrade", "Upgrade": "tcp" },
+              )
+            sock = conn.sock
+            assert sock is not None
+            response = conn.getresponse()
+            if response.status not in (101, 200):
+                message = response.read().decode('utf-8', errors='replace').strip()
+                raise DockerApiError(response.status, message, "POST", path)
+        except BaseException:
+            conn.close()
+            raise
+        return DockerExecSocket(self, exec_id, conn, sock, response)
+
+    def get_archive(self, container: str, path: str) -> bytes:
+        """Get a tar archive of a file or directory in a container"""
+        _, data = self.request("GET", f"/containers/{quote(container, safe='')}/archive", query=dict(path=path))
+        return data
+
+    def put_archive(self, container: str, path: str, data: bytes) -> None:
+        """Extract a tar archive into an existing directory in a container"""
+        self.request(
+            "PUT",
+            f"/containers/{quote(container, safe='')}/archive",
+            query=dict(path=path),
+            body=data,
+            headers={ "Content-Type": "application/x-tar" },
+          )
+
+    # ---- Images
+
+    def pull_image(self, image: str, progress: Optional[Callable[[JsonableDict], None]]=None) -> None:
+        """
+        Pull an image (e.g., "alpine:3.12" or "alpine@sha256:...") and wait for the pull to finish.
+
+        Args:
+            image: The image reference.
+            progress: If not None, called with each progress message (with "id", "status"
+                and, while downloading, "progressDetail" { "current", "total" }).
+        """
+        query: Dict[str, str]
+        if '@' in image:
+            # A digest reference; the daemon pulls by the digest in fromImage, and would misread
+            # a split at the last ':' (within the digest) as a tag
+            query = dict(fromImage=image)
+        else:
+            from_image, _, tag = image.rpartition(':')
+            if from_image == '' or '/' in tag:
+                from_image, tag = image, 'latest'
+            query = dict(fromImage=from_image, tag=tag)
+        with self.open_stream("POST", "/images/create", query=query) as stream:
+            for line in iter(stream.readline, b''):
+                line = line.strip()
+                if line == b'':
+                    continue
+                message = json.loads(line)
+                if 'error' in message:
+                    raise DockerApiError(500, message['error'], "POST", "/images/create")
+                if progress is not None:
+                    progress(message)
+
+    def inspect_distribution(self, image: str) -> JsonableDict:
+        """
+        Get the registry descriptor of an image (its manifest digest is in ["Descriptor"]["digest"])
+        without pulling it. This is one registry round trip.
+        """
+        return self.get_json(f"/distribution/{quote(image, safe='/:@')}/json")
+
+    def list_images(self, filters: Optional[Mapping[str, List[str]]]=None) -> List[JsonableDict]:
+        return self.get_json("/images/json", query=dict(filters=filters) if filters else None)
+
+    def inspect_image(self, name: str) -> JsonableDict:
+        return self.get_json(f"/images/{quote(name, safe='')}/json")
+
+    def remove_image(self, name: str, force: bool=False) -> List[JsonableDict]:
+        """
+        Remove an image, or one of its tags. Returns the daemon's list of { "Untagged": ... }
+        and { "Deleted": ... } actions.
+        """
+        _, data = self.request("DELETE", f"/images/{quote(name, safe='')}", query=dict(force=force))
+        return json.loads(data) if len(data) > 0 else []
+
+    # ---- Disk usage
+
+    def system_df(self, kind: Optional[str]=None) -> JsonableDict:
+        """
+        Get disk usage ("Images", "Containers", "Volumes" and "BuildCache"). Daemons with API
+        1.42 or later compute only the given kind ("image", "container", "volume" or
+        "build-cache") if one is provided; older ones ignore it and compute everything.
+        """
+        return self.get_json("/system/df", query=dict(type=kind))
+
+    def prune_build_cache(self) -> JsonableDict:
+        """Remove unused build cache. Returns { "CachesDeleted": [...], "SpaceReclaimed": n }."""
+        return self.post_json("/build/prune") or {}
+
+_client_lock = threading.Lock()
+_client: Optional[DockerEngineClient] = None
+_client_probed: bool = False
+
+def get_docker_engine_client() -> Optional[DockerEngineClient]:
+    """
+    Get the shared Docker Engine API client, or None if the docker socket cannot be used
+    directly by this process, in which case the docker CLI must be used. The socket is
+    probed once per process.
+    """
+    global _client, _client_probed
+    with _client_lock:
+        if not _client_probed:
+            _client_probed = True
+            socket_path = get_docker_socket_path()
+            if socket_path is None:
+                logger.debug("DOCKER_HOST is not a unix socket; using the docker CLI")
+            elif not os.access(socket_path, os.R_OK | os.W_OK):
+                # Not yet in the docker group; relay through a broker that is, if possible
+                from .docker_group_broker import get_docker_group_broker
+                broker = get_docker_group_broker()
+                if broker is None:
+                    logger.debug(f"Docker socket {socket_path} is not accessible; using the docker CLI")
+                else:
+                    socket_path = broker.socket_path
+            if socket_path is not None and os.access(socket_path, os.R_OK | os.W_OK):
+                client = DockerEngineClient(socket_path)
+                if client.ping():
+                    _client = client
+                    logger.debug(f"Using the Docker Engine API at {socket_path}")
+                else:
+                    client.close()
+                    logger.debug(f"Docker daemon at {socket_path} did not respond to ping; using the docker CLI")
+        return _client
+
+def reset_docker_engine_client() -> None:
+    """Close the shared client and probe again on next use (e.g., after joining the docker group)"""
+    global _client, _client_probed
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        _client_probed = False
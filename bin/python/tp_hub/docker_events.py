@@ -0,0 +1,258 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+A cache of docker networks and volumes kept fresh by the docker /events stream.
+
+A background thread subscribes to network and volume create/destroy events. Each time
+it (re)connects, it relists everything, so events missed while disconnected cannot leave
+the cache stale. Lookups return the current snapshot without contacting the daemon.
+While the subscription is down, lookups fall back to listing directly.
+"""
+
+from __future__ import annotations
+
+import json
+import random
+import threading
+
+from .internal_types import *
+from .pkg_logging import logger
+from .docker_api import DockerEngineClient, DockerApiNotFoundError, DockerStream, get_docker_engine_client
+
+DOCKER_RESOURCE_KINDS = ("network", "volume")
+"""The kinds of docker objects kept by DockerResourceCache"""
+
+class DockerResourceCache:
+    """
+    Event-driven cache of docker networks and volumes, keyed by name, in Engine API format.
+
+    Snapshots are copy-on-write: every change replaces the dict for its kind, so a dict
+    returned by get() is never modified and must not be modified by the caller.
+    """
+    client: DockerEngineClient
+    """The Engine API client"""
+
+    reconnect_min_delay: float
+    """Seconds to wait before the first reconnect attempt after the event stream drops"""
+
+    reconnect_max_delay: float
+    """Maximum seconds between reconnect attempts"""
+
+    num_events: int
+    """The number of create/destroy events applied"""
+
+    num_resyncs: int
+    """The number of full relistings made on (re)connect"""
+
+    _snapshots: Dict[str, Dict[str, JsonableDict]]
+    _generations: Dict[str, int]
+    """Per kind, bumped by each event so that listings and inspections that overlap an event can be redone"""
+    _lock: threading.Lock
+    _connected: threading.Event
+    _attempted: threading.Event
+    _stopping: threading.Event
+    _thread: Optional[threading.Thread] = None
+    _stream: Optional[DockerStream] = None
+
+    def __init__(
+            self,
+            client: DockerEngineClient,
+            reconnect_min_delay: float=0.5,
+            reconnect_max_delay: float=30.0,
+          ):
+        self.client = client
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.num_events = 0
+        self.num_resyncs = 0
+        self._snapshots = { kind: {} for kind in DOCKER_RESOURCE_KINDS }
+        self._generations = { kind: 0 for kind in DOCKER_RESOURCE_KINDS }
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._attempted = threading.Event()
+        self._stopping = threading.Event()
+
+    @property
+    def connected(self) -> bool:
+        """True if the event subscription is live and the snapshots are current"""
+        return self._connected.is_set()
+
+    def start(self) -> None:
+        """Start the background subscription, if it is not already running"""
+        with self._lock:
+            if self._thread is None:
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name="docker-events", daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background subscription"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+            self._stopping.set()
+            stream = self._stream
+        self._connected.clear()
+        if stream is not None:
+            stream.close()
+        if thread is not None:
+            thread.join(timeout=5.0)
+
+    def get(self, kind: str, wait_timeout: float=10.0) -> Dict[str, JsonableDict]:
+        """
+        Get all docker objects of a kind ("network" or "volume"), keyed by name.
+
+        Args:
+            kind: The kind of object.
+            wait_timeout: Seconds to wait for the first connection attempt to finish
+                before falling back to listing directly.
+        """
+        self._attempted.wait(wait_timeout)
+        if self._connected.is_set():
+            return self._snapshots[kind]
+        logger.debug(f"Docker event subscription is not connected; listing {kind}s directly")
+        return self._list(kind)
+
+    def refresh(self, kind: str, name: Optional[str]=None) -> None:
+        """
+        Bring the cache up to date for one object (e.g., just after this process created it,
+        so the change is visible before its event arrives), or relist all objects of a kind.
+        """
+        if name is None:
+            while True:
+                with self._lock:
+                    generation = self._generations[kind]
+                objects = self._list(kind)
+                with self._lock:
+                    if self._generations[kind] == generation:
+                        self._snapshots[kind] = objects
+                        return
+                logger.debug(f"Docker {kind} event arrived while listing {kind}s; relisting")
+        else:
+            self._update(kind, name)
+
+    def _list(self, kind: str) -> Dict[str, JsonableDict]:
+        if kind == "network":
+            objects = self.client.list_networks()
+        elif kind == "volume":
+            objects = self.client.list_volumes()
+        else:
+            raise ValueError(f"Unsupported docker resource kind '{kind}'")
+        return { x['Name']: x for x in objects }
+
+    def _update(self, kind: str, name: str) -> None:
+        # A result that overlaps an event may predate it (e.g., an inspection that raced a
+        # destroy), so it is discarded and the object is inspected again.
+        data: Optional[JsonableDict]
+        while True:
+            with self._lock:
+                generation = self._generations[kind]
+            try:
+                data = self.client.inspect_network(name) if kind == "network" else self.client.inspect_volume(name)
+            except DockerApiNotFoundError:
+                data = None
+            with self._lock:
+                if self._generations[kind] == generation:
+                    snapshot = dict(self._snapshots[kind])
+                    if data is None:
+                        snapshot.pop(name, None)
+                    else:
+                        snapshot[data['Name']] = data
+                    self._snapshots[kind] = snapshot
+                    return
+            logger.debug(f"Docker {kind} event arrived while inspecting {kind} {name}; inspecting again")
+
+    def _apply_event(self, event: JsonableDict) -> None:
+        kind = event.get('Type')
+        action = event.get('Action')
+        actor = event.get('Actor') or {}
+        if kind not in DOCKER_RESOURCE_KINDS:
+            return
+        if kind == "network":
+            name = (actor.get('Attributes') or {}).get('name')
+        else:
+            name = actor.get('ID')
+        if not name:
+            return
+        self.num_events += 1
+        logger.debug(f"Docker event: {kind} {action} {name}")
+        with self._lock:
+            self._generations[kind] += 1
+        if action == "destroy":
+            with self._lock:
+                snapshot = dict(self._snapshots[kind])
+                snapshot.pop(name, None)
+                self._snapshots[kind] = snapshot
+        else:
+            self._update(kind, name)
+
+    def _run(self) -> None:
+        delay = self.reconnect_min_delay
+        while not self._stopping.is_set():
+            try:
+                stream = self.client.open_stream(
+                    "GET",
+                    "/events",
+                    query=dict(filters={ "type": list(DOCKER_RESOURCE_KINDS), "event": [ "create", "destroy" ] }),
+                  )
+                with self._lock:
+                    self._stream = stream
+                    if self._stopping.is_set():
+                        stream.close()
+                        break
+                with stream:
+                    # The subscription is live before relisting, so nothing created or destroyed
+                    # in between is missed; applying an event twice is harmless.
+                    for kind in DOCKER_RESOURCE_KINDS:
+                        self.refresh(kind)
+                    self.num_resyncs += 1
+                    self._connected.set()
+                    self._attempted.set()
+                    delay = self.reconnect_min_delay
+                    for line in iter(stream.readline, b''):
+                        line = line.strip()
+                        if line != b'':
+                            self._apply_event(json.loads(line))
+            except Exception as e:
+                if not self._stopping.is_set():
+                    logger.debug(f"Docker event subscription failed: {e}")
+            finally:
+                self._connected.clear()
+                self._attempted.set()
+                with self._lock:
+                    self._stream = None
+            if not self._stopping.is_set():
+                logger.debug(f"Docker event stream disconnected; reconnecting in {delay:.1f} seconds")
+                self._stopping.wait(delay * random.uniform(0.8, 1.2))
+                delay = min(delay * 2.0, self.reconnect_max_delay)
+
+_docker_resource_cache_lock = threading.Lock()
+_docker_resource_cache: Optional[DockerResourceCache] = None
+
+def get_docker_resource_cache() -> Optional[DockerResourceCache]:
+    """
+    Get the process-wide event-driven cache of docker networks and volumes, starting its
+    subscription on first use. Returns None if the Docker Engine API is not directly accessible.
+    """
+    global _docker_resource_cache
+    with _docker_resource_cache_lock:
+        if _docker_resource_cache is None:
+            client = get_docker_engine_client()
+            if client is None:
+                return None
+            _docker_resource_cache = DockerResourceCache(client)
+            _docker_resource_cache.start()
+        return _docker_resource_cache
+
+def reset_docker_resource_cache() -> None:
+    """Stop and discard the process-wide docker resource cache"""
+    global _docker_resource_cache
+    with _docker_resource_cache_lock:
+        resource_cache = _docker_resource_cache
+        _docker_resource_cache = None
+    if resource_cache is not None:
+        resource_cache.stop()
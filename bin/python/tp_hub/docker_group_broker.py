@@ -0,0 +1,150 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+A persistent docker group elevation broker.
+
+Right after install-prereqs adds the user to the "docker" group, the login session is not yet
+in the group, so every docker invocation has to be wrapped in `sg docker -c ...`, which costs
+a group switch and an extra shell on each of the dozens of calls made by a command like
+`hub up`. Instead, the first such call starts one coprocess under `sg docker` (see
+docker_group_broker_server.py) that relays connections from a private unix socket to the
+docker daemon socket. For the rest of the hub process:
+
+    * The Docker Engine API client connects to the broker socket, so most operations need
+      no subprocess at all.
+    * docker CLI invocations run docker directly with DOCKER_HOST pointing at the broker
+      socket, rather than under `sg`.
+
+The broker exits when its stdin pipe is closed, which happens when the hub process exits.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import shlex
+import select
+import atexit
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from project_init_tools.util import should_run_with_group
+
+from .internal_types import *
+from .pkg_logging import logger
+from .docker_api import get_docker_socket_path
+
+DOCKER_GROUP_BROKER_DISABLE_ENV_VAR = "TP_HUB_NO_DOCKER_GROUP_BROKER"
+"""If this environment variable is set to a nonempty value, the broker is not used and
+   docker calls are wrapped in `sg docker` individually"""
+
+BROKER_START_TIMEOUT = 10.0
+"""Seconds to wait for the broker to report that it is ready"""
+
+class DockerGroupBroker:
+    """A running broker coprocess"""
+    socket_path: str
+    """The path of the broker's private unix socket, which relays to the docker daemon"""
+
+    _proc: subprocess.Popen
+    _dir: str
+
+    def __init__(self, docker_socket_path: str, timeout: float=BROKER_START_TIMEOUT):
+        """
+        Start the broker under `sg docker` and wait until it is ready.
+
+        Raises:
+            HubError: The broker did not start or could not reach the docker socket.
+        """
+        self._dir = tempfile.mkdtemp(prefix="tp-hub-docker-")
+        self.socket_path = os.path.join(self._dir, "docker.sock")
+        server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "docker_group_broker_server.py")
+        cmd = shlex.join([ sys.executable, "-I", server_script, self.socket_path, docker_socket_path ])
+        logger.debug(f"Starting docker group broker: sg docker -c {cmd!r}")
+        self._proc = subprocess.Popen(
+            [ "sg", "docker", "-c", f"exec {cmd}" ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+          )
+        assert self._proc.stdout is not None
+        ready, _, _ = select.select([ self._proc.stdout ], [], [], timeout)
+        line = self._proc.stdout.readline().decode('utf-8', errors='replace').strip() if ready else ''
+        if line != "ready":
+            self.close()
+            raise HubError(f"Docker group broker did not start: {line or 'timed out'}")
+        logger.debug(f"Docker group broker is relaying {self.socket_path} to {docker_socket_path}")
+
+    @property
+    def docker_host(self) -> str:
+        """The DOCKER_HOST value that directs the docker CLI to the broker"""
+        return f"unix://{self.socket_path}"
+
+    def get_env(self, env: Optional[Mapping[str, str]]=None) -> Dict[str, str]:
+        """
+        Get an environment for a docker CLI subprocess that uses the broker.
+
+        Args:
+            env: The environment to extend. Defaults to this process's environment.
+        """
+        result = dict(os.environ if env is None else env)
+        result["DOCKER_HOST"] = self.docker_host
+        return result
+
+    def close(self) -> None:
+        """Stop the broker, and remove its socket"""
+        if self._proc.stdin is not None and not self._proc.stdin.closed:
+            self._proc.stdin.close()
+        try:
+            self._proc.wait(timeout=5.0)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+        if self._proc.stdout is not None:
+            self._proc.stdout.close()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+_broker_lock = threading.Lock()
+_broker: Optional[DockerGroupBroker] = None
+_broker_probed: bool = False
+
+def get_docker_group_broker() -> Optional[DockerGroupBroker]:
+    """
+    Get the process-wide docker group broker, starting it on first use, or None if it is not
+    needed (this process can already use docker, or DOCKER_HOST is not a local unix socket),
+    is disabled, or could not be started, in which case docker calls fall back to `sg docker`.
+    """
+    global _broker, _broker_probed
+    with _broker_lock:
+        if not _broker_probed:
+            _broker_probed = True
+            docker_socket_path = get_docker_socket_path()
+            if os.environ.get(DOCKER_GROUP_BROKER_DISABLE_ENV_VAR, "") != "":
+                logger.debug("Docker group broker is disabled")
+            elif docker_socket_path is None or not os.path.exists(docker_socket_path):
+                pass
+            elif os.access(docker_socket_path, os.R_OK | os.W_OK) or not should_run_with_group("docker"):
+                pass
+            else:
+                try:
+                    _broker = DockerGroupBroker(docker_socket_path)
+                except (HubError, OSError) as e:
+                    logger.warning(f"{e}; falling back to running each docker command under sg")
+        return _broker
+
+def close_docker_group_broker() -> None:
+    """Stop the docker group broker, if it is running. It is restarted on next use if needed."""
+    global _broker, _broker_probed
+    with _broker_lock:
+        if _broker is not None:
+            _broker.close()
+        _broker = None
+        _broker_probed = False
+
+atexit.register(close_docker_group_broker)
@@ -0,0 +1,96 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+The elevated side of the docker group broker (see docker_group_broker.py).
+
+This file is run as a standalone script, under `sg docker`, so it imports only the standard
+library. It listens on a private unix socket and relays each connection to the docker
+daemon's socket, which it can open because it runs with the docker group. It writes "ready"
+to stdout once listening, and exits, removing its socket, when stdin is closed (i.e., when
+the hub process that started it exits).
+
+Usage: python3 docker_group_broker_server.py <listen-socket-path> <docker-socket-path>
+"""
+
+import os
+import sys
+import socket
+import threading
+
+def _pump(src: socket.socket, dst: socket.socket) -> None:
+    try:
+        while True:
+            data = src.recv(65536)
+            if not data:
+                break
+            dst.sendall(data)
+    except OSError:
+        pass
+    try:
+        dst.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+def _relay(client: socket.socket, docker_socket_path: str) -> None:
+    try:
+        upstream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            upstream.connect(docker_socket_path)
+        except OSError:
+            upstream.close()
+            client.close()
+            return
+        t = threading.Thread(target=_pump, args=(upstream, client), daemon=True)
+        t.start()
+        _pump(client, upstream)
+        t.join()
+        upstream.close()
+    finally:
+        client.close()
+
+def _serve(listener: socket.socket, docker_socket_path: str) -> None:
+    while True:
+        try:
+            client, _ = listener.accept()
+        except OSError:
+            return
+        threading.Thread(target=_relay, args=(client, docker_socket_path), daemon=True).start()
+
+def main() -> int:
+    listen_path, docker_socket_path = sys.argv[1], sys.argv[2]
+    # Fail early, before reporting ready, if the group switch did not grant access
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(docker_socket_path)
+    except OSError as e:
+        print(f"error: cannot connect to {docker_socket_path}: {e}", flush=True)
+        return 1
+    finally:
+        probe.close()
+    old_umask = os.umask(0o177)
+    try:
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(listen_path)
+    finally:
+        os.umask(old_umask)
+    try:
+        listener.listen(64)
+        threading.Thread(target=_serve, args=(listener, docker_socket_path), daemon=True).start()
+        print("ready", flush=True)
+        # Block until the hub process closes our stdin (or exits)
+        while sys.stdin.buffer.read(4096):
+            pass
+    finally:
+        listener.close()
+        try:
+            os.unlink(listen_path)
+        except OSError:
+            pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,25 +6,142 @@
 
 """
 Handy Python utilities for docker
+
+Files in docker volumes are accessed through a VolumeSession. If the volume's mountpoint
+on this host is accessible, files are read and written there directly. Otherwise, when
+the Docker Engine API is directly accessible, a session keeps one lightweight helper
+container per volume alive for the life of the process, and moves files with the Engine
+archive API (tar streams over GET/PUT /containers/{id}/archive) and short exec commands.
+As a last resort, every operation runs a throwaway container with the docker CLI.
 """
 
 from __future__ import annotations
 
 import os
+import io
+import time
+import shlex
+import socket
+import atexit
+import fnmatch
+import tarfile
+import threading
 import subprocess
 
-from project_init_tools.util import (
+from project_init_tools.util import CalledProcessErrorWithStderrMessage
+
+from .subprocess_runner import (
     sudo_Popen,
     sudo_check_output_stderr_exception,
     sudo_check_call_stderr_exception,
-    CalledProcessErrorWithStderrMessage,
 )
 
 from .pkg_logging import logger
+from .util import inspect_docker_volume
+from .docker_api import DockerEngineClient, DockerApiError, DockerApiNotFoundError, get_docker_engine_client
 
 from .internal_types import *
 from .internal_types import _CMD, _FILE, _ENV
 
+VOLUME_HELPER_IMAGE = "alpine:3.12"
+"""The image used for containers that access docker volumes"""
+
+VOLUME_HELPER_LABEL = "tp-hub.volume-helper"
+"""Label on helper containers; the value is the name of the volume"""
+
+DEFAULT_VOLUME_CHUNK_SIZE = 64 * 1024
+"""The default chunk size, in bytes, for streaming volume file reads and writes"""
+
+class DockerVolumeFileNotFoundError(HubError, FileNotFoundError):
+    """A file in a docker volume does not exist"""
+    pass
+
+class _VolumeFileRawReader(io.RawIOBase):
+    """Unbuffered reader over a chunk source; closing it releases the source"""
+    _readinto_fn: Callable[[memoryview], int]
+    _close_fn: Callable[[], None]
+
+    def __init__(self, readinto_fn: Callable[[memoryview], int], close_fn: Callable[[], None]):
+        super().__init__()
+        self._readinto_fn = readinto_fn
+        self._close_fn = close_fn
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        return self._readinto_fn(memoryview(b).cast('B'))
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                self._close_fn()
+            finally:
+                super().close()
+
+class _VolumeFileRawWriter(io.RawIOBase):
+    """Unbuffered writer over a chunk sink; closing it commits the file, abort() discards it"""
+    _write_fn: Callable[[bytes], None]
+    _finish_fn: Callable[[], None]
+    _abort_fn: Callable[[], None]
+
+    def __init__(
+            self,
+            write_fn: Callable[[bytes], None],
+            finish_fn: Callable[[], None],
+            abort_fn: Callable[[], None],
+          ):
+        super().__init__()
+        self._write_fn = write_fn
+        self._finish_fn = finish_fn
+        self._abort_fn = abort_fn
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b: Any) -> int:
+        data = bytes(b)
+        self._write_fn(data)
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                self._finish_fn()
+            finally:
+                super().close()
+
+    def abort(self) -> None:
+        if not self.closed:
+            try:
+                self._abort_fn()
+            finally:
+                super().close()
+
+class VolumeFileWriter(io.BufferedWriter):
+    """
+    A buffered writer for a file in a docker volume. The new content is streamed into a
+    temporary file, which atomically replaces the target file when the writer is closed.
+    If the writer is aborted, or its context exits with an exception, the target file is
+    left unchanged.
+    """
+    raw: _VolumeFileRawWriter
+
+    def abort(self) -> None:
+        """Discard everything written, leaving the target file unchanged"""
+        self.raw.abort()
+
+    def __exit__(
+            self,
+            exc_type: Optional[type[BaseException]],
+            exc_val: Optional[BaseException],
+            exc_tb: Optional[TracebackType],
+          ) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
 def docker_volume_exists(volume_name: str) -> bool:
     """
     Check if a docker volume exists.
@@ -32,21 +149,7 @@ def docker_volume_exists(volume_name: str) -> bool:
     Args:
         volume_name: The name of the docker volume.
     """
-    args = [
-        "docker",
-        "volume",
-        "inspect",
-        volume_name,
-      ]
-    try:
-        sudo_check_output_stderr_exception(
-            args,
-            use_sudo=False,
-            run_with_group='docker',
-          )
-        return True
-    except subprocess.CalledProcessError:
-        return False
+    return inspect_docker_volume(volume_name) is not None
 
 def verify_docker_volume_exists(volume_name: str) -> None:
     """
@@ -57,7 +160,842 @@ def verify_docker_volume_exists(volume_name: str) -> None:
     """
     if not docker_volume_exists(volume_name):
         raise RuntimeError(f"Docker volume '{volume_name}' does not exist")
-        
+
+def normalize_volume_path(filename: str) -> str:
+    """
+    Normalize a path relative to the root of a docker volume. Any leading slash is removed;
+    the root itself is returned as '.'.
+    """
+    result = os.path.normpath(os.path.join('/', filename))[1:]
+    return '.' if result == '' else result
+
+class VolumeSession:
+    """
+    Access to the files in one docker volume. Paths are relative to the root of the volume;
+    any leading slash is removed. Sessions are obtained with get_volume_session().
+    """
+    volume_name: str
+    """The name of the docker volume"""
+
+    strategy: str
+    """A short description of how this session accesses the volume"""
+
+    def __init__(self, volume_name: str):
+        self.volume_name = volume_name
+
+    def list_files(self, dir_name: str='/', include_dirs: bool=False) -> List[str]:
+        """Get the sorted names of the entries in a directory of the volume"""
+        raise NotImplementedError()
+
+    def read_file(self, filename: str) -> bytes:
+        """
+        Get the content of a file in the volume.
+
+        Raises:
+            DockerVolumeFileNotFoundError: The file does not exist.
+        """
+        raise NotImplementedError()
+
+    def write_file(self, filename: str, data: bytes, mode: int=0o640) -> None:
+        """Atomically create or replace a file in the volume, with the given mode, owned by root"""
+        raise NotImplementedError()
+
+    def remove_file(self, filename: str) -> None:
+        """Remove a file from the volume. If the file does not exist, no error is raised."""
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        """Release any resources held by the session"""
+        pass
+
+    def open_reader(self, filename: str, chunk_size: int=DEFAULT_VOLUME_CHUNK_SIZE) -> io.BufferedReader:
+        """
+        Open a file in the volume for streaming binary reads. Content is moved in chunks
+        as it is read, so memory use does not depend on the size of the file.
+
+        Raises:
+            DockerVolumeFileNotFoundError: The file does not exist.
+        """
+        reader: io.BufferedReader = io.BufferedReader(self._open_raw_reader(normalize_volume_path(filename)), chunk_size)
+        try:
+            # Surface a missing file at open time rather than at the first read
+            reader.peek(1)
+        except BaseException:
+            reader.close()
+            raise
+        return reader
+
+    def open_writer(self, filename: str, mode: int=0o640, chunk_size: int=DEFAULT_VOLUME_CHUNK_SIZE) -> VolumeFileWriter:
+        """
+        Open a file in the volume for streaming binary writes. Content is moved in chunks
+        as it is written, with backpressure from the docker daemon, so memory use does not
+        depend on the size of the file. The file is atomically created or replaced, with the
+        given mode, when the writer is closed.
+        """
+        return VolumeFileWriter(self._open_raw_writer(normalize_volume_path(filename), mode), chunk_size)
+
+    def _open_raw_reader(self, filename: str) -> _VolumeFileRawReader:
+        raise NotImplementedError()
+
+    def _open_raw_writer(self, filename: str, mode: int) -> _VolumeFileRawWriter:
+        raise NotImplementedError()
+
+    def _commit_and_abort_fns(self, filename: str) -> Tuple[Callable[[], None], Callable[[], None]]:
+        # Replacing the target with the fully written temporary file is a rename within the volume,
+        # so readers never see a partial file.
+        q_tmp = shlex.quote(f"/volume/{filename}.tmp")
+        q_filename = shlex.quote(f"/volume/{filename}")
+        def commit() -> None:
+            self._run_script(f"mv -f {q_tmp} {q_filename}", f"replace {filename}")
+        def abort() -> None:
+            try:
+                self._run_script(f"rm -f {q_tmp}", f"remove {filename}.tmp")
+            except Exception as e:
+                logger.debug(f"Unable to remove {filename}.tmp from docker volume {self.volume_name}: {e}")
+        return commit, abort
+
+    def _run_script(self, script: str, error_desc: str) -> bytes:
+        """Run a shell script with the volume mounted at /volume, and return its stdout"""
+        raise NotImplementedError()
+
+    def _extract_and_run_script(self, tar_data: bytes, script: str, error_desc: str) -> None:
+        """Extract a tar archive into the root of the volume, then run a shell script"""
+        raise NotImplementedError()
+
+    def glob(self, patterns: Union[str, Iterable[str]], dir_name: str='/') -> List[str]:
+        """
+        Get the sorted names of the files in a directory of the volume that match any
+        of one or more fnmatch-style patterns.
+        """
+        if isinstance(patterns, str):
+            patterns = [ patterns ]
+        patterns = list(patterns)
+        return [ x for x in self.list_files(dir_name) if any(fnmatch.fnmatchcase(x, p) for p in patterns) ]
+
+    def read_many(self, filenames: Iterable[str], missing_ok: bool=False) -> Dict[str, bytes]:
+        """
+        Get the content of several files in the volume in a single exchange.
+
+        Args:
+            filenames: The names of the files relative to the root of the volume.
+            missing_ok: If True, missing files are omitted from the result rather than
+                        raising DockerVolumeFileNotFoundError.
+
+        Returns:
+            A dict mapping each normalized filename to its content.
+        """
+        names = sorted(set(normalize_volume_path(x) for x in filenames))
+        if len(names) == 0:
+            return {}
+        script = (
+            'cd /volume || exit 1; set --; '
+            f'for f in {" ".join(shlex.quote(x) for x in names)}; do [ -f "$f" ] && set -- "$@" "./$f"; done; '
+            '[ $# -eq 0 ] || exec tar -cf - "$@"'
+          )
+        result = _parse_tar_files(self._run_script(script, "read files"))
+        if not missing_ok:
+            for name in names:
+                if name not in result:
+                    raise DockerVolumeFileNotFoundError(f"File {name} does not exist in docker volume {self.volume_name}")
+        return result
+
+    def read_glob(self, patterns: Union[str, Iterable[str]], dir_name: str='/') -> Dict[str, bytes]:
+        """
+        Get the content of all files in a directory of the volume that match any of one or
+        more fnmatch-style patterns, in a single exchange.
+
+        Returns:
+            A dict mapping the name of each matching file (relative to dir_name) to its content.
+        """
+        if isinstance(patterns, str):
+            patterns = [ patterns ]
+        dir_name = normalize_volume_path(dir_name)
+        abs_dir_name = '/volume' if dir_name == '.' else f'/volume/{dir_name}'
+        script = (
+            f'cd {shlex.quote(abs_dir_name)} || exit 0; set --; '
+            'for f in * .[!.]* ..?*; do [ -f "$f" ] || continue; '
+            f'for p in {" ".join(shlex.quote(x) for x in patterns)}; do case "$f" in $p) set -- "$@" "./$f"; break;; esac; done; '
+            'done; '
+            '[ $# -eq 0 ] || exec tar -cf - "$@"'
+          )
+        return _parse_tar_files(self._run_script(script, f"read files in {dir_name}"))
+
+    def write_many(self, files: Mapping[str, bytes], mode: int=0o640) -> None:
+        """
+        Create or replace several files in the volume in a single exchange. All new content
+        is staged in temporary files before any file is replaced, and the replacements are
+        then made back-to-back with atomic renames; if staging fails, no file is changed.
+
+        Args:
+            files: A mapping from filename, relative to the root of the volume, to content.
+            mode: The mode to use for all of the files.
+        """
+        staged = sorted((normalize_volume_path(k), v) for k, v in files.items())
+        if len(staged) == 0:
+            return
+        tar_data = _make_tar([ (f"{name}.tmp", data) for name, data in staged ], mode)
+        tmp_names = " ".join(shlex.quote(f"{name}.tmp") for name, _ in staged)
+        renames = " && ".join(f"mv -f {shlex.quote(name + '.tmp')} {shlex.quote(name)}" for name, _ in staged)
+        script = (
+            f'cd /volume && chmod {mode:o} {tmp_names} && {renames} || {{ rm -f {tmp_names}; exit 1; }}'
+          )
+        self._extract_and_run_script(tar_data, script, "replace files")
+
+    def remove_many(self, filenames: Iterable[str]) -> None:
+        """Remove several files from the volume in a single exchange. Missing files are ignored."""
+        names = sorted(set(normalize_volume_path(x) for x in filenames))
+        if len(names) > 0:
+            self._run_script(f'cd /volume && rm -f {" ".join(shlex.quote(x) for x in names)}', "remove files")
+
+class DockerRunVolumeSession(VolumeSession):
+    """
+    A VolumeSession that runs a throwaway container with the docker CLI for every operation.
+    Used when the Docker Engine API is not directly accessible.
+    """
+    strategy = "per-call docker run"
+
+    def _run_args(self, interactive: bool=False) -> List[str]:
+        return [
+            "docker",
+            "run",
+          ] + (["-i"] if interactive else []) + [
+            "--rm",
+            "--volume",
+            f"{self.volume_name}:/volume",
+            VOLUME_HELPER_IMAGE,
+          ]
+
+    def list_files(self, dir_name: str='/', include_dirs: bool=False) -> List[str]:
+        verify_docker_volume_exists(self.volume_name)
+        dir_name = normalize_volume_path(dir_name)
+        abs_dir_name = '/volume' if dir_name == '.' else f'/volume/{dir_name}'
+        args = self._run_args() + [
+            "find",
+            abs_dir_name,
+            "-maxdepth",
+            "1",
+          ]
+        if not include_dirs:
+            args += [
+                "-not",
+                "-type",
+                "d",
+              ]
+        result_txt = sudo_check_output_stderr_exception(
+            args,
+            use_sudo=False,
+            run_with_group='docker',
+          ).decode('utf-8').rstrip()
+        return _parse_find_output(result_txt, abs_dir_name)
+
+    def read_file(self, filename: str) -> bytes:
+        verify_docker_volume_exists(self.volume_name)
+        filename = normalize_volume_path(filename)
+        q_filename = shlex.quote(f"/volume/{filename}")
+        args = self._run_args() + [
+            "sh",
+            "-c",
+            f"test -f {q_filename} || exit 66; cat {q_filename}",
+          ]
+        try:
+            return cast(bytes, sudo_check_output_stderr_exception(
+                args,
+                use_sudo=False,
+                run_with_group='docker',
+              ))
+        except subprocess.CalledProcessError as e:
+            if e.returncode == 66:
+                raise DockerVolumeFileNotFoundError(f"File {filename} does not exist in docker volume {self.volume_name}") from e
+            raise
+
+    def _run_with_input(self, script: str, data: bytes) -> None:
+        args = self._run_args(interactive=True) + [
+            "sh",
+            "-c",
+            script,
+          ]
+        with sudo_Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            use_sudo=False,
+            run_with_group='docker',
+          ) as proc:
+            _, stderr_data = proc.communicate(data)
+            exit_code = proc.returncode
+        if exit_code != 0:
+            stderr_s = stderr_data if isinstance(stderr_data, str) else stderr_data.decode('utf-8')
+            stderr_s = stderr_s.rstrip()
+            raise CalledProcessErrorWithStderrMessage(exit_code, args, stderr=stderr_s)
+
+    def write_file(self, filename: str, data: bytes, mode: int=0o640) -> None:
+        verify_docker_volume_exists(self.volume_name)
+        filename = normalize_volume_path(filename)
+        q_tmp = shlex.quote(f"/volume/{filename}.tmp")
+        q_filename = shlex.quote(f"/volume/{filename}")
+        self._run_with_input(
+            f"rm -f {q_tmp} && touch {q_tmp} && chmod {mode:o} {q_tmp} && cat >> {q_tmp} && mv {q_tmp} {q_filename} && rm -f {q_tmp}",
+            data,
+          )
+
+    def _run_script(self, script: str, error_desc: str) -> bytes:
+        verify_docker_volume_exists(self.volume_name)
+        return cast(bytes, sudo_check_output_stderr_exception(
+            self._run_args() + [ "sh", "-c", script ],
+            use_sudo=False,
+            run_with_group='docker',
+          ))
+
+    def _extract_and_run_script(self, tar_data: bytes, script: str, error_desc: str) -> None:
+        verify_docker_volume_exists(self.volume_name)
+        self._run_with_input(f"tar -xf - -C /volume && {{ {script}; }}", tar_data)
+
+    def _open_raw_reader(self, filename: str) -> _VolumeFileRawReader:
+        verify_docker_volume_exists(self.volume_name)
+        q_filename = shlex.quote(f"/volume/{filename}")
+        args = self._run_args() + [
+            "sh",
+            "-c",
+            f"test -f {q_filename} || exit 66; exec cat {q_filename}",
+          ]
+        proc = sudo_Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            use_sudo=False,
+            run_with_group='docker',
+          )
+        assert proc.stdout is not None and proc.stderr is not None
+        # With the default buffering, Popen's pipes are buffered binary files
+        stdout, stderr = cast(io.BufferedReader, proc.stdout), proc.stderr
+        def readinto(b: memoryview) -> int:
+            n = stdout.readinto(b)
+            if n == 0:
+                exit_code = proc.wait()
+                if exit_code == 66:
+                    raise DockerVolumeFileNotFoundError(f"File {filename} does not exist in docker volume {self.volume_name}")
+                if exit_code != 0:
+                    raise CalledProcessErrorWithStderrMessage(
+                        exit_code, args, stderr=stderr.read().decode('utf-8', errors='replace').rstrip())
+            return n
+        def close() -> None:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            stdout.close()
+            stderr.close()
+        return _VolumeFileRawReader(readinto, close)
+
+    def _open_raw_writer(self, filename: str, mode: int) -> _VolumeFileRawWriter:
+        verify_docker_volume_exists(self.volume_name)
+        q_tmp = shlex.quote(f"/volume/{filename}.tmp")
+        args = self._run_args(interactive=True) + [
+            "sh",
+            "-c",
+            f"rm -f {q_tmp} && touch {q_tmp} && chmod {mode:o} {q_tmp} && exec cat > {q_tmp}",
+          ]
+        proc = sudo_Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            use_sudo=False,
+            run_with_group='docker',
+          )
+        assert proc.stdin is not None and proc.stderr is not None
+        stdin, stderr = proc.stdin, proc.stderr
+        commit, abort = self._commit_and_abort_fns(filename)
+        def finish() -> None:
+            stdin.close()
+            stderr_s = stderr.read().decode('utf-8', errors='replace').rstrip()
+            stderr.close()
+            exit_code = proc.wait()
+            if exit_code != 0:
+                abort()
+                raise CalledProcessErrorWithStderrMessage(exit_code, args, stderr=stderr_s)
+            commit()
+        def write(data: bytes) -> None:
+            stdin.write(data)
+        def kill() -> None:
+            proc.kill()
+            proc.wait()
+            stdin.close()
+            stderr.close()
+            abort()
+        return _VolumeFileRawWriter(write, finish, kill)
+
+    def remove_file(self, filename: str) -> None:
+        verify_docker_volume_exists(self.volume_name)
+        filename = normalize_volume_path(filename)
+        sudo_check_call_stderr_exception(
+            self._run_args() + [
+                "rm",
+                "-f",
+                f"/volume/{filename}",
+              ],
+            use_sudo=False,
+            run_with_group='docker',
+          )
+
+def _parse_find_output(result_txt: str, abs_dir_name: str) -> List[str]:
+    result: List[str] = []
+    for v in result_txt.split('\n'):
+        if v != abs_dir_name and v != '' and not v.endswith('/'):
+            result.append(os.path.basename(v))
+    return sorted(result)
+
+def _make_tar(members: Iterable[Tuple[str, bytes]], mode: int) -> bytes:
+    tar_buffer = io.BytesIO()
+    mtime = int(time.time())
+    with tarfile.open(fileobj=tar_buffer, mode='w:', format=tarfile.PAX_FORMAT) as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = mode
+            info.mtime = mtime
+            info.uid = 0
+            info.gid = 0
+            tar.addfile(info, io.BytesIO(data))
+    return tar_buffer.getvalue()
+
+def _parse_tar_files(tar_data: bytes) -> Dict[str, bytes]:
+    result: Dict[str, bytes] = {}
+    if len(tar_data) == 0:
+        return result
+    with tarfile.open(fileobj=io.BytesIO(tar_data), mode='r:') as tar:
+        for member in tar:
+            if member.isfile():
+                f = tar.extractfile(member)
+                assert f is not None
+                result[normalize_volume_path(member.name)] = f.read()
+    return result
+
+def _pid_is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class HelperContainerVolumeSession(VolumeSession):
+    """
+    A VolumeSession that keeps one idle helper container, with the volume mounted at /volume,
+    running for the life of the session. File content moves through the Engine archive API;
+    listing, renaming and removal are single exec commands in the helper.
+    """
+    strategy = "helper container"
+
+    client: DockerEngineClient
+    """The Engine API client"""
+
+    container_id: Optional[str] = None
+    """The ID of the helper container, once started"""
+
+    _lock: threading.Lock
+
+    def __init__(self, volume_name: str, client: DockerEngineClient):
+        super().__init__(volume_name)
+        self.client = client
+        self._lock = threading.Lock()
+
+    def _remove_stale_helpers(self) -> None:
+        # Helpers left behind by processes on this host that exited without cleaning up
+        hostname = socket.gethostname()
+        for container in self.client.list_containers(all=True, filters={ "label": [ f"{VOLUME_HELPER_LABEL}={self.volume_name}" ] }):
+            labels = container.get('Labels') or {}
+            try:
+                pid = int(labels.get(f"{VOLUME_HELPER_LABEL}.pid", ""))
+            except ValueError:
+                continue
+            if labels.get(f"{VOLUME_HELPER_LABEL}.host") == hostname and not _pid_is_alive(pid):
+                logger.debug(f"Removing stale volume helper container {container['Id'][:12]}")
+                try:
+                    self.client.remove_container(container['Id'], force=True)
+                except DockerApiNotFoundError:
+                    pass
+
+    def _get_container(self) -> str:
+        if self.container_id is None:
+            if inspect_docker_volume(self.volume_name) is None:
+                raise RuntimeError(f"Docker volume '{self.volume_name}' does not exist")
+            self._remove_stale_helpers()
+            start_time = time.monotonic()
+            config: JsonableDict = dict(
+                Image=VOLUME_HELPER_IMAGE,
+                Cmd=[ "sleep", "2147483647" ],
+                Labels={
+                    VOLUME_HELPER_LABEL: self.volume_name,
+                    f"{VOLUME_HELPER_LABEL}.pid": str(os.getpid()),
+                    f"{VOLUME_HELPER_LABEL}.host": socket.gethostname(),
+                  },
+                HostConfig=dict(
+                    Binds=[ f"{self.volume_name}:/volume" ],
+                    AutoRemove=True,
+                    NetworkMode="none",
+                  ),
+              )
+            try:
+                container_id = self.client.create_container(config)
+            except DockerApiNotFoundError:
+                logger.info(f"Pulling docker image {VOLUME_HELPER_IMAGE}")
+                self.client.pull_image(VOLUME_HELPER_IMAGE)
+                container_id = self.client.create_container(config)
+            try:
+                self.client.start_container(container_id)
+            except BaseException:
+                self.client.remove_container(container_id, force=True)
+                raise
+            self.container_id = container_id
+            logger.debug(
+                f"Started volume helper container {container_id[:12]} for {self.volume_name} "
+                f"in {time.monotonic() - start_time:.3f} seconds"
+              )
+        return self.container_id
+
+    def _exec(self, script: str, error_desc: str) -> bytes:
+        exit_code, stdout, stderr = self.client.exec_run(self._get_container(), [ "sh", "-c", script ])
+        if exit_code != 0:
+            raise HubError(
+                f"Failed to {error_desc} in docker volume {self.volume_name} (exit code {exit_code}): "
+                f"{stderr.decode('utf-8', errors='replace').rstrip()}"
+              )
+        return stdout
+
+    def list_files(self, dir_name: str='/', include_dirs: bool=False) -> List[str]:
+        dir_name = normalize_volume_path(dir_name)
+        abs_dir_name = '/volume' if dir_name == '.' else f'/volume/{dir_name}'
+        with self._lock:
+            result_txt = self._exec(
+                f"find {shlex.quote(abs_dir_name)} -maxdepth 1" + ('' if include_dirs else ' -not -type d'),
+                f"list directory {dir_name}",
+              ).decode('utf-8').rstrip()
+        return _parse_find_output(result_txt, abs_dir_name)
+
+    def read_file(self, filename: str) -> bytes:
+        filename = normalize_volume_path(filename)
+        with self._lock:
+            try:
+                tar_data = self.client.get_archive(self._get_container(), f"/volume/{filename}")
+            except DockerApiNotFoundError as e:
+                raise DockerVolumeFileNotFoundError(f"File {filename} does not exist in docker volume {self.volume_name}") from e
+        with tarfile.open(fileobj=io.BytesIO(tar_data), mode='r:') as tar:
+            member = tar.next()
+            if member is None or not member.isfile():
+                raise HubError(f"{filename} in docker volume {self.volume_name} is not a regular file")
+            f = tar.extractfile(member)
+            assert f is not None
+            return f.read()
+
+    def write_file(self, filename: str, data: bytes, mode: int=0o640) -> None:
+        filename = normalize_volume_path(filename)
+        dir_name, base_name = os.path.split(filename)
+        tmp_name = f"{base_name}.tmp"
+        tar_data = _make_tar([ (tmp_name, data) ], mode)
+        abs_dir_name = '/volume' if dir_name == '' else f'/volume/{dir_name}'
+        with self._lock:
+            self.client.put_archive(self._get_container(), abs_dir_name, tar_data)
+            # Renaming within the volume is atomic, so readers never see a partial file
+            self._exec(
+                f"mv -f {shlex.quote(f'{abs_dir_name}/{tmp_name}')} {shlex.quote(f'{abs_dir_name}/{base_name}')}",
+                f"replace {filename}",
+              )
+
+    def remove_file(self, filename: str) -> None:
+        filename = normalize_volume_path(filename)
+        with self._lock:
+            self._exec(f"rm -f {shlex.quote(f'/volume/{filename}')}", f"remove {filename}")
+
+    def _run_script(self, script: str, error_desc: str) -> bytes:
+        with self._lock:
+            return self._exec(script, error_desc)
+
+    def _open_raw_reader(self, filename: str) -> _VolumeFileRawReader:
+        with self._lock:
+            container_id = self._get_container()
+        try:
+            stream = self.client.open_stream(
+                "GET",
+                f"/containers/{container_id}/archive",
+                query=dict(path=f"/volume/{filename}"),
+                timeout=self.client.timeout,
+              )
+        except DockerApiNotFoundError as e:
+            raise DockerVolumeFileNotFoundError(f"File {filename} does not exist in docker volume {self.volume_name}") from e
+        try:
+            # Stream mode reads the tar sequentially, one block buffer at a time, and only
+            # calls read(), so the stream need not be seekable or writable
+            tar = tarfile.open(fileobj=cast(IO[bytes], stream), mode='r|')
+            member = tar.next()
+            if member is None or not member.isfile():
+                raise HubError(f"{filename} in docker volume {self.volume_name} is not a regular file")
+            f = tar.extractfile(member)
+            # A regular file member is extracted as a tarfile.ExFileObject, a BufferedReader
+            assert isinstance(f, io.BufferedReader)
+        except BaseException:
+            stream.close()
+            raise
+        def close() -> None:
+            f.close()
+            tar.close()
+            stream.close()
+        return _VolumeFileRawReader(f.readinto, close)
+
+    def _open_raw_writer(self, filename: str, mode: int) -> _VolumeFileRawWriter:
+        with self._lock:
+            container_id = self._get_container()
+        q_tmp = shlex.quote(f"/volume/{filename}.tmp")
+        exec_socket = self.client.open_exec(
+            container_id,
+            [ "sh", "-c", f"rm -f {q_tmp} && touch {q_tmp} && chmod {mode:o} {q_tmp} && exec cat > {q_tmp}" ],
+          )
+        commit, abort = self._commit_and_abort_fns(filename)
+        def write(data: bytes) -> None:
+            exec_socket.write(data)
+        def finish() -> None:
+            exit_code, _, stderr = exec_socket.wait()
+            if exit_code != 0:
+                abort()
+                raise HubError(
+                    f"Failed to write {filename} in docker volume {self.volume_name} (exit code {exit_code}): "
+                    f"{stderr.decode('utf-8', errors='replace').rstrip()}"
+                  )
+            commit()
+        def discard() -> None:
+            exec_socket.close()
+            abort()
+        return _VolumeFileRawWriter(write, finish, discard)
+
+    def _extract_and_run_script(self, tar_data: bytes, script: str, error_desc: str) -> None:
+        with self._lock:
+            self.client.put_archive(self._get_container(), "/volume", tar_data)
+            self._exec(script, error_desc)
+
+    def close(self) -> None:
+        with self._lock:
+            if self.container_id is not None:
+                container_id = self.container_id
+                self.container_id = None
+                try:
+                    self.client.remove_container(container_id, force=True)
+                except (DockerApiError, OSError) as e:
+                    logger.debug(f"Unable to remove volume helper container {container_id[:12]}: {e}")
+
+class HostPathVolumeSession(VolumeSession):
+    """
+    A VolumeSession that accesses the volume's files directly through its Mountpoint on
+    this host, with no container at all. Used for local volumes whose mountpoint this
+    process can read.
+
+    Files written through a container are owned by root, so direct writes are only made
+    when running as root. Otherwise, reads go directly to the host path and writes and
+    removals are delegated to write_session.
+    """
+    mountpoint: str
+    """The real path of the volume's mountpoint on this host"""
+
+    write_session: Optional[VolumeSession]
+    """The session that handles writes and removals, or None if they are made directly"""
+
+    def __init__(self, volume_name: str, mountpoint: str, write_session: Optional[VolumeSession]=None):
+        super().__init__(volume_name)
+        self.mountpoint = os.path.realpath(mountpoint)
+        self.write_session = write_session
+        self.strategy = "host path" if write_session is None else f"host path (reads), {write_session.strategy} (writes)"
+
+    def _host_path(self, filename: str, follow_symlinks: bool=True) -> str:
+        # A symlink inside the volume is resolved inside a container's namespace; on the
+        # host it must not be allowed to escape the volume.
+        filename = normalize_volume_path(filename)
+        pathname = self.mountpoint if filename == '.' else os.path.join(self.mountpoint, filename)
+        if follow_symlinks:
+            real_pathname = os.path.realpath(pathname)
+        else:
+            real_pathname = os.path.join(os.path.realpath(os.path.dirname(pathname)), os.path.basename(pathname))
+        if real_pathname != self.mountpoint and not real_pathname.startswith(self.mountpoint + os.sep):
+            raise HubError(f"{filename} in docker volume {self.volume_name} resolves outside of the volume")
+        return real_pathname
+
+    def list_files(self, dir_name: str='/', include_dirs: bool=False) -> List[str]:
+        with os.scandir(self._host_path(dir_name)) as it:
+            return sorted(
+                entry.name for entry in it
+                  if include_dirs or not entry.is_dir(follow_symlinks=False)
+              )
+
+    def read_file(self, filename: str) -> bytes:
+        pathname = self._host_path(filename)
+        if not os.path.isfile(pathname):
+            raise DockerVolumeFileNotFoundError(f"File {normalize_volume_path(filename)} does not exist in docker volume {self.volume_name}")
+        with open(pathname, 'rb') as f:
+            return f.read()
+
+    def _open_tmp_file(self, pathname: str, mode: int) -> int:
+        tmp_pathname = f"{pathname}.tmp"
+        if os.path.lexists(tmp_pathname):
+            os.remove(tmp_pathname)
+        fd = os.open(tmp_pathname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            # Match a container's root-owned file with exactly the requested mode, regardless of umask
+            os.fchmod(fd, mode)
+            os.fchown(fd, 0, 0)
+        except BaseException:
+            os.close(fd)
+            os.remove(tmp_pathname)
+            raise
+        return fd
+
+    def write_file(self, filename: str, data: bytes, mode: int=0o640) -> None:
+        if self.write_session is not None:
+            self.write_session.write_file(filename, data, mode=mode)
+            return
+        self.write_many({ filename: data }, mode=mode)
+
+    def write_many(self, files: Mapping[str, bytes], mode: int=0o640) -> None:
+        if self.write_session is not None:
+            self.write_session.write_many(files, mode=mode)
+            return
+        staged: List[str] = []
+        try:
+            for filename, data in sorted(files.items()):
+                pathname = self._host_path(filename, follow_symlinks=False)
+                fd = self._open_tmp_file(pathname, mode)
+                staged.append(pathname)
+                with open(fd, 'wb') as f:
+                    f.write(data)
+        except BaseException:
+            for pathname in staged:
+                os.remove(f"{pathname}.tmp")
+            raise
+        for pathname in staged:
+            os.replace(f"{pathname}.tmp", pathname)
+
+    def remove_file(self, filename: str) -> None:
+        self.remove_many([ filename ])
+
+    def remove_many(self, filenames: Iterable[str]) -> None:
+        if self.write_session is not None:
+            self.write_session.remove_many(filenames)
+            return
+        for filename in filenames:
+            try:
+                os.remove(self._host_path(filename, follow_symlinks=False))
+            except FileNotFoundError:
+                pass
+
+    def read_many(self, filenames: Iterable[str], missing_ok: bool=False) -> Dict[str, bytes]:
+        result: Dict[str, bytes] = {}
+        for filename in sorted(set(normalize_volume_path(x) for x in filenames)):
+            try:
+                result[filename] = self.read_file(filename)
+            except DockerVolumeFileNotFoundError:
+                if not missing_ok:
+                    raise
+        return result
+
+    def read_glob(self, patterns: Union[str, Iterable[str]], dir_name: str='/') -> Dict[str, bytes]:
+        dir_pathname = self._host_path(dir_name)
+        if not os.path.isdir(dir_pathname):
+            return {}
+        result: Dict[str, bytes] = {}
+        for name in self.glob(patterns, dir_name):
+            pathname = os.path.join(dir_pathname, name)
+            if os.path.isfile(pathname):
+                result[name] = self.read_file(os.path.relpath(pathname, self.mountpoint))
+        return result
+
+    def _open_raw_reader(self, filename: str) -> _VolumeFileRawReader:
+        pathname = self._host_path(filename)
+        if not os.path.isfile(pathname):
+            raise DockerVolumeFileNotFoundError(f"File {filename} does not exist in docker volume {self.volume_name}")
+        f = io.FileIO(pathname, 'r')
+        return _VolumeFileRawReader(f.readinto, f.close)
+
+    def _open_raw_writer(self, filename: str, mode: int) -> _VolumeFileRawWriter:
+        if self.write_session is not None:
+            return self.write_session._open_raw_writer(filename, mode)
+        pathname = self._host_path(filename, follow_symlinks=False)
+        f = io.FileIO(self._open_tmp_file(pathname, mode), 'w')
+        def write(data: bytes) -> None:
+            view = memoryview(data)
+            while len(view) > 0:
+                n = f.write(view)
+                view = view[n or 0:]
+        def finish() -> None:
+            f.close()
+            os.replace(f"{pathname}.tmp", pathname)
+        def abort() -> None:
+            f.close()
+            os.remove(f"{pathname}.tmp")
+        return _VolumeFileRawWriter(write, finish, abort)
+
+    def close(self) -> None:
+        if self.write_session is not None:
+            self.write_session.close()
+
+def get_docker_volume_host_path(volume_name: str) -> Optional[str]:
+    """
+    Get the host path of a docker volume's files, if this process can access them directly.
+    Returns None if the volume does not exist, is not a plain local volume (e.g., it is
+    NFS-backed and only mounted while in use), or its mountpoint is not readable here
+    (e.g., docker runs in a VM or as a rootless daemon, or /var/lib/docker is not accessible).
+    """
+    volume_data = inspect_docker_volume(volume_name)
+    if volume_data is None or volume_data.get('Driver') != 'local' or volume_data.get('Options'):
+        return None
+    mountpoint = volume_data.get('Mountpoint')
+    if not mountpoint or not os.path.isdir(mountpoint) or not os.access(mountpoint, os.R_OK | os.X_OK):
+        return None
+    return cast(str, mountpoint)
+
+_volume_sessions_lock = threading.Lock()
+_volume_sessions: Dict[str, VolumeSession] = {}
+
+def get_volume_session(volume_name: str) -> VolumeSession:
+    """
+    Get the process-wide session for a docker volume. Sessions are closed automatically
+    when the process exits.
+
+    The cheapest working access strategy is probed once per volume per process, in order:
+    the volume's host path (HostPathVolumeSession), a helper container through the Engine
+    API (HelperContainerVolumeSession), and a docker CLI run per operation
+    (DockerRunVolumeSession). All strategies write files atomically with the same mode
+    and root ownership.
+    """
+    with _volume_sessions_lock:
+        session = _volume_sessions.get(volume_name)
+        if session is None:
+            client = get_docker_engine_client()
+            container_session: VolumeSession
+            if client is not None:
+                container_session = HelperContainerVolumeSession(volume_name, client)
+            else:
+                container_session = DockerRunVolumeSession(volume_name)
+            host_path = get_docker_volume_host_path(volume_name)
+            if host_path is None:
+                session = container_session
+            elif os.geteuid() == 0:
+                session = HostPathVolumeSession(volume_name, host_path)
+            else:
+                session = HostPathVolumeSession(volume_name, host_path, write_session=container_session)
+            logger.info(f"Accessing docker volume {volume_name} with strategy: {session.strategy}")
+            _volume_sessions[volume_name] = session
+        return session
+
+def get_volume_access_strategy(volume_name: str) -> str:
+    """Get a short description of how files in a docker volume are accessed by this process"""
+    return get_volume_session(volume_name).strategy
+
+def close_volume_sessions() -> None:
+    """Close all volume sessions, removing their helper containers"""
+    with _volume_sessions_lock:
+        sessions = list(_volume_sessions.values())
+        _volume_sessions.clear()
+    for session in sessions:
+        session.close()
+
+atexit.register(close_volume_sessions)
+
 def list_files_in_docker_volume(volume_name: str, dir_name: str='/', include_dirs:bool=False) -> List[str]:
     """
     List the files in a directory of a docker volume.
@@ -69,47 +1007,7 @@ def list_files_in_docker_volume(volume_name: str, dir_name: str='/', include_dir
                   is used.
 
     """
-    verify_docker_volume_exists(volume_name)
-    dir_name = os.path.join('/', dir_name)
-    assert dir_name.startswith('/')
-    if dir_name == '/':
-        dir_name = '.'
-        abs_dir_name = '/volume'
-    else:
-        dir_name = dir_name[1:]
-        abs_dir_name = f'/volume/{dir_name}'
-
-    args = [
-        "docker",
-        "run",
-        "--rm",
-        "--volume",
-        f"{volume_name}:/volume",
-        "alpine:3.12",
-        "find",
-        abs_dir_name,
-        "-maxdepth",
-        "1",
-      ]
-    if not include_dirs:
-        args += [
-            "-not",
-            "-type",
-            "d",
-          ]
-    result_txt = sudo_check_output_stderr_exception(
-        args,
-        use_sudo=False,
-        run_with_group='docker',
-      ).decode('utf-8').rstrip()
-    prefixed_result = result_txt.split('\n')
-    result: List[str] = []
-    for v in prefixed_result:
-        if v != abs_dir_name and v != '' and not v.endswith('/'):
-            tail = os.path.basename(v)
-            result.append(tail)
-
-    return sorted(result)
+    return get_volume_session(volume_name).list_files(dir_name, include_dirs=include_dirs)
 
 def remove_docker_volume_file(
         volume_name: str,
@@ -125,25 +1023,90 @@ def remove_docker_volume_file(
         filename: The name of the file relative to the root of the docker volume.
                   any leading slash will be removed.
     """
-    verify_docker_volume_exists(volume_name)
-    filename = os.path.join('/', filename)
-    assert filename.startswith('/')
-    filename = filename[1:]
-    sudo_check_call_stderr_exception(
-        [
-            "docker",
-            "run",
-            "--rm",
-            "--volume",
-            f"{volume_name}:/volume",
-            "alpine:3.12",
-            "rm",
-            "-f",
-            f"/volume/{filename}",
-          ],
-        use_sudo=False,
-        run_with_group='docker',
-      )
+    get_volume_session(volume_name).remove_file(filename)
+
+@overload
+def open_volume_file(
+        volume_name: str,
+        filename: str,
+        mode: Literal['rb']='rb',
+        file_mode: int=0o640,
+        chunk_size: int=DEFAULT_VOLUME_CHUNK_SIZE,
+      ) -> io.BufferedReader: ...
+@overload
+def open_volume_file(
+        volume_name: str,
+        filename: str,
+        mode: Literal['wb'],
+        file_mode: int=0o640,
+        chunk_size: int=DEFAULT_VOLUME_CHUNK_SIZE,
+      ) -> VolumeFileWriter: ...
+def open_volume_file(
+        volume_name: str,
+        filename: str,
+        mode: str='rb',
+        file_mode: int=0o640,
+        chunk_size: int=DEFAULT_VOLUME_CHUNK_SIZE,
+      ) -> Union[io.BufferedReader, VolumeFileWriter]:
+    """
+    Open a file in a docker volume as a binary stream, with memory use bounded by
+    chunk_size regardless of the size of the file.
+
+    Args:
+        volume_name: The name of the docker volume.
+
+        filename: The name of the file relative to the root of the docker volume.
+                  any leading slash will be removed.
+
+        mode: 'rb' to read the file, or 'wb' to atomically create or replace it when
+              the returned writer is closed.
+
+        file_mode: The mode to use when creating the file ('wb' only).
+
+        chunk_size: The size of the chunks moved to or from the docker daemon.
+
+    Raises:
+        DockerVolumeFileNotFoundError: mode is 'rb' and the file does not exist.
+    """
+    session = get_volume_session(volume_name)
+    if mode == 'rb':
+        return session.open_reader(filename, chunk_size=chunk_size)
+    if mode == 'wb':
+        return session.open_writer(filename, mode=file_mode, chunk_size=chunk_size)
+    raise ValueError(f"Unsupported docker volume file mode '{mode}'; must be 'rb' or 'wb'")
+
+def read_volume_file_chunks(
+        volume_name: str,
+        filename: str,
+        chunk_size: int=DEFAULT_VOLUME_CHUNK_SIZE,
+      ) -> Generator[bytes, None, None]:
+    """
+    Iterate over the content of a file in a docker volume in chunks of up to chunk_size bytes.
+
+    Raises:
+        DockerVolumeFileNotFoundError: The file does not exist.
+    """
+    with open_volume_file(volume_name, filename, 'rb', chunk_size=chunk_size) as f:
+        while True:
+            chunk = f.read1(chunk_size)
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+def write_volume_file_chunks(
+        volume_name: str,
+        filename: str,
+        chunks: Iterable[bytes],
+        file_mode: int=0o640,
+        chunk_size: int=DEFAULT_VOLUME_CHUNK_SIZE,
+      ) -> None:
+    """
+    Atomically create or replace a file in a docker volume with content from an iterable of
+    chunks. If iterating the chunks raises an exception, the file is left unchanged.
+    """
+    with open_volume_file(volume_name, filename, 'wb', file_mode=file_mode, chunk_size=chunk_size) as f:
+        for chunk in chunks:
+            f.write(chunk)
 
 def read_docker_volume_text_file(
         volume_name: str,
@@ -158,26 +1121,11 @@ def read_docker_volume_text_file(
 
         filename: The name of the file relative to the root of the docker volume.
                   any leading slash will be removed.
+
+    Raises:
+        DockerVolumeFileNotFoundError: The file does not exist.
     """
-    verify_docker_volume_exists(volume_name)
-    filename = os.path.join('/', filename)
-    assert filename.startswith('/')
-    filename = filename[1:]
-    result = sudo_check_output_stderr_exception(
-        [
-            "docker",
-            "run",
-            "--rm",
-            "--volume",
-            f"{volume_name}:/volume",
-            "alpine:3.12",
-            "cat",
-            f"/volume/{filename}",
-          ],
-        use_sudo=False,
-        run_with_group='docker',
-      ).decode(encoding)
-    return result
+    return get_volume_session(volume_name).read_file(filename).decode(encoding)
 
 def write_docker_volume_text_file(
         volume_name: str,
@@ -199,36 +1147,4 @@ def write_docker_volume_text_file(
 
         mode: The mode to use when creating the file.
     """
-    verify_docker_volume_exists(volume_name)
-    filename = os.path.join('/', filename)
-    assert filename.startswith('/')
-
-    args = [
-        "docker",
-        "run",
-        "-i",
-        "--rm",
-        "--volume",
-        f"{volume_name}:/volume",
-        "alpine:3.12",
-        "sh",
-        "-c",
-        f"rm -f /volume/{filename}.tmp && touch /volume/{filename}.tmp && chmod {mode:o} /volume/{filename}.tmp && cat >> /volume/{filename}.tmp && mv /volume/{filename}.tmp /volume/{filename} && rm -f /volume/{filename}.tmp",
-      ]
-
-    with sudo_Popen(
-        args,
-        stdin=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        use_sudo=False,
-        run_with_group='docker',
-      ) as proc:
-        _, stderr_data = proc.communicate(content.encode(encoding))
-        exit_code = proc.returncode
-    if exit_code != 0:
-        if encoding is None:
-            encoding = 'utf-8'
-        stderr_s = stderr_data if isinstance(stderr_data, str) else stderr_data.decode(encoding)
-        stderr_s = stderr_s.rstrip()
-        raise CalledProcessErrorWithStderrMessage(exit_code, args, stderr=stderr_s)
-
+    get_volume_session(volume_name).write_file(filename, content.encode(encoding), mode=mode)
@@ -0,0 +1,378 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+Disk usage accounting and garbage collection for docker resources related to the hub.
+
+Disk usage of images, containers, volumes and build cache is gathered with one Engine API
+request per kind, issued concurrently on separate connections, since the daemon computes
+each kind (volume sizes in particular) independently. What is reclaimable:
+
+    * Old versions of the images of the hub stacks. For each repository of a current hub
+      image (e.g., "traefik" at "v${TRAEFIK_VERSION}"), the current tag, any newer tags (e.g.,
+      prefetched for an upgrade), and the newest keep_versions older tags are kept; older
+      version tags, and untagged images from the same repositories, are reclaimable. Tags that
+      are not versions (e.g., "latest") are never touched.
+    * Stopped containers left by hub helper runs: Traefik canaries, volume helpers, and
+      containers of the hub helper images.
+    * Dangling volumes that belong to a hub stack. Volumes of other projects, including
+      anonymous volumes and those of stacks managed by Portainer, are not considered.
+    * Unused build cache, which is only pruned on request, since the hub does not build images.
+
+Images used by any container that is not itself reclaimable are kept, and the volumes in
+PROTECTED_VOLUMES are never removed, whatever their state.
+"""
+
+from __future__ import annotations
+
+import re
+import concurrent.futures
+
+from .internal_types import *
+from .pkg_logging import logger
+from .docker_api import DockerEngineClient, DockerApiError, DockerApiNotFoundError, get_docker_engine_client
+from .docker_util import VOLUME_HELPER_LABEL
+from .image_manager import HUB_HELPER_IMAGES
+from .util import normalize_image_reference, format_bytes, format_table
+from .stack_status import HUB_STACK_NAMES
+from .traefik_rollout import TRAEFIK_CANARY_CONTAINER_NAME
+
+PROTECTED_VOLUMES = frozenset([ "traefik_acme", "portainer_data" ])
+"""Volumes that hold irreplaceable hub state, and are never removed"""
+
+DEFAULT_KEEP_VERSIONS = 1
+"""The default number of previous versions kept of each hub image"""
+
+GC_KINDS = ("container", "image", "volume", "build-cache")
+"""The kinds of resources accounted for, in the order they are pruned"""
+
+_version_re = re.compile(r'^v?(\d+(?:\.\d+)*)$')
+
+def parse_image_version(tag: str) -> Optional[Tuple[int, ...]]:
+    """Parse an image tag such as "v2.10.4" or "2.19.0" as a version; None if it is not one"""
+    m = _version_re.match(tag)
+    if m is None:
+        return None
+    return tuple(int(x) for x in m.group(1).split('.'))
+
+def _split_image_reference(image: str) -> Tuple[str, str]:
+    repository, _, tag = normalize_image_reference(image).rpartition(':')
+    return repository, tag
+
+class GcItem:
+    """A docker resource related to the hub, with its disk usage"""
+    kind: str
+    """One of GC_KINDS"""
+
+    name: str
+    """A display name: an image reference, container name, volume name or cache record ID"""
+
+    id: str
+    """The ID used to remove the resource"""
+
+    size: int
+    """Bytes of disk freed by removing the resource (for images, not counting layers shared
+       with other images); 0 if unknown"""
+
+    reclaimable: bool
+    """True if the retention policy allows removing the resource"""
+
+    reason: str
+    """Why the resource is kept or reclaimable"""
+
+    def __init__(self, kind: str, name: str, id: str, size: int, reclaimable: bool, reason: str):
+        self.kind = kind
+        self.name = name
+        self.id = id
+        self.size = size
+        self.reclaimable = reclaimable
+        self.reason = reason
+
+    def to_jsonable(self) -> JsonableDict:
+        return dict(
+            kind=self.kind,
+            name=self.name,
+            id=self.id,
+            size=self.size,
+            reclaimable=self.reclaimable,
+            reason=self.reason,
+          )
+
+class GcResult:
+    """The outcome of removing one resource"""
+    item: GcItem
+    """The resource"""
+
+    removed: bool
+    """True if the resource was removed"""
+
+    error: Optional[str]
+    """The error message, if not removed"""
+
+    def __init__(self, item: GcItem, removed: bool, error: Optional[str]=None):
+        self.item = item
+        self.removed = removed
+        self.error = error
+
+def _get_df(socket_path: str, kind: str) -> JsonableDict:
+    # Each kind on its own connection, so the daemon computes them concurrently
+    with DockerEngineClient(socket_path, timeout=None) as client:
+        return client.system_df(kind)
+
+def get_docker_disk_usage(client: Optional[DockerEngineClient]=None) -> JsonableDict:
+    """
+    Get docker disk usage, as returned by the Engine API's GET /system/df, with the kinds
+    computed concurrently.
+
+    Raises:
+        HubError: The Docker Engine API is not accessible.
+    """
+    if client is None:
+        client = get_docker_engine_client()
+        if client is None:
+            raise HubError("Docker disk usage requires access to the Docker Engine API socket")
+    keys = { "image": "Images", "container": "Containers", "volume": "Volumes", "build-cache": "BuildCache" }
+    result: JsonableDict = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(keys), thread_name_prefix="df") as executor:
+        futures = { kind: executor.submit(_get_df, client.socket_path, kind) for kind in keys }
+        for kind, key in keys.items():
+            result[key] = futures[kind].result().get(key) or []
+    return result
+
+def _classify_containers(containers: List[JsonableDict]) -> List[GcItem]:
+    helper_images = set(normalize_image_reference(x) for x in HUB_HELPER_IMAGES)
+    result: List[GcItem] = []
+    for c in containers:
+        labels = c.get('Labels') or {}
+        name = ((c.get('Names') or [ c['Id'][:12] ])[0]).lstrip('/')
+        reason: Optional[str] = None
+        if 'tp-hub.canary' in labels or name == TRAEFIK_CANARY_CONTAINER_NAME:
+            reason = "traefik canary"
+        elif VOLUME_HELPER_LABEL in labels:
+            reason = "volume helper"
+        elif normalize_image_reference(c.get('Image') or '') in helper_images:
+            reason = "hub helper run"
+        if reason is None:
+            continue
+        running = c.get('State') in ('running', 'restarting', 'paused')
+        result.append(GcItem(
+            "container",
+            name,
+            c['Id'],
+            c.get('SizeRw') or 0,
+            not running,
+            f"{reason}, {c.get('State')}",
+          ))
+    return result
+
+def _classify_images(
+        images: List[JsonableDict],
+        containers: List[JsonableDict],
+        reclaimable_container_ids: Set[str],
+        current_images: Iterable[str],
+        keep_versions: int,
+      ) -> List[GcItem]:
+    current: Dict[str, str] = {}
+    for current_image in current_images:
+        repository, tag = _split_image_reference(current_image)
+        current[repository] = tag
+    used_image_ids = set(
+        c.get('ImageID') for c in containers if c['Id'] not in reclaimable_container_ids
+      )
+
+    # Every local version tag of each hub repository
+    versions: Dict[str, List[Tuple[Tuple[int, ...], str]]] = { repository: [] for repository in current }
+    for image_data in images:
+        for ref in image_data.get('RepoTags') or []:
+            repository, tag = _split_image_reference(ref)
+            version = parse_image_version(tag)
+            if repository in versions and version is not None:
+                versions[repository].append((version, tag))
+    kept_tags: Dict[str, Set[str]] = {}
+    for repository, version_tags in versions.items():
+        current_version = parse_image_version(current[repository])
+        kept = { current[repository] }
+        if current_version is None:
+            # Versions cannot be ordered relative to, e.g., "latest"
+            kept.update(tag for _, tag in version_tags)
+        else:
+            older = sorted(set(t for t in version_tags if t[0] < current_version), reverse=True)
+            kept.update(tag for version, tag in version_tags if version > current_version)
+            kept.update(tag for _, tag in older[:keep_versions])
+        kept_tags[repository] = kept
+
+    result: List[GcItem] = []
+    for image_data in images:
+        ref_tags = [ _split_image_reference(ref) for ref in image_data.get('RepoTags') or [] if ref != '<none>:<none>' ]
+        digest_repositories = set(ref.partition('@')[0] for ref in image_data.get('RepoDigests') or [])
+        hub_tags = [ (r, t) for r, t in ref_tags if r in current ]
+        shared_size = image_data.get('SharedSize') or 0
+        size = max(0, (image_data.get('Size') or 0) - max(0, shared_size))
+        if len(ref_tags) == 0:
+            repositories = sorted(r for r in digest_repositories if r in current)
+            if len(repositories) == 0:
+                continue
+            name = f"{repositories[0]}@<none>"
+            candidate_reason = "untagged old pull"
+        elif len(hub_tags) == 0:
+            continue
+        else:
+            name = ", ".join(f"{r}:{t}" for r, t in hub_tags)
+            kept_refs = [ f"{r}:{t}" for r, t in ref_tags if r not in current or t in kept_tags[r] ]
+            if len(kept_refs) > 0:
+                result.append(GcItem("image", name, image_data['Id'], size, False, f"retained ({kept_refs[0]})"))
+                continue
+            candidate_reason = "old version"
+        if image_data['Id'] in used_image_ids:
+            result.append(GcItem("image", name, image_data['Id'], size, False, "in use by a container"))
+        else:
+            result.append(GcItem("image", name, image_data['Id'], size, True, candidate_reason))
+    return result
+
+def _classify_volumes(volumes: List[JsonableDict]) -> List[GcItem]:
+    result: List[GcItem] = []
+    for v in volumes:
+        name = v['Name']
+        labels = v.get('Labels') or {}
+        usage = v.get('UsageData') or {}
+        project = labels.get('com.docker.compose.project')
+        if name in PROTECTED_VOLUMES:
+            result.append(GcItem("volume", name, name, max(0, usage.get('Size', 0)), False, "protected"))
+        elif project in HUB_STACK_NAMES:
+            in_use = usage.get('RefCount', 0) != 0
+            result.append(GcItem(
+                "volume",
+                name,
+                name,
+                max(0, usage.get('Size', 0)),
+                not in_use,
+                f"{'in use' if in_use else 'dangling'}, stack {project}",
+              ))
+    return result
+
+def _classify_build_cache(records: List[JsonableDict]) -> List[GcItem]:
+    return [
+        GcItem(
+            "build-cache",
+            f"{r.get('Type', 'cache')} {r['ID'][:12]}",
+            r['ID'],
+            r.get('Size') or 0,
+            not r.get('InUse', False),
+            "in use" if r.get('InUse', False) else "unused",
+          )
+        for r in records
+      ]
+
+class GcReport:
+    """The hub-related docker resources, with their disk usage and what is reclaimable"""
+    items: List[GcItem]
+    """The resources, in pruning order"""
+
+    def __init__(self, items: List[GcItem]):
+        self.items = items
+
+    def get_totals(self) -> Dict[str, Tuple[int, int, int]]:
+        """Get (count, total bytes, reclaimable bytes) for each kind"""
+        result: Dict[str, Tuple[int, int, int]] = {}
+        for kind in GC_KINDS:
+            items = [ x for x in self.items if x.kind == kind ]
+            result[kind] = (len(items), sum(x.size for x in items), sum(x.size for x in items if x.reclaimable))
+        return result
+
+    def to_jsonable(self) -> JsonableDict:
+        return dict(
+            totals={ kind: dict(count=c, size=s, reclaimable=r) for kind, (c, s, r) in self.get_totals().items() },
+            items=[ x.to_jsonable() for x in self.items ],
+          )
+
+def get_gc_report(
+        current_images: Iterable[str],
+        keep_versions: int=DEFAULT_KEEP_VERSIONS,
+        client: Optional[DockerEngineClient]=None,
+      ) -> GcReport:
+    """
+    Account for the disk usage of hub-related docker resources, and apply the retention policy.
+
+    Args:
+        current_images: The images currently used by the hub stacks, e.g., "traefik:v2.10.4".
+        keep_versions: The number of versions older than the current one to keep, per repository.
+        client: The Engine API client. Defaults to the shared client.
+    """
+    df = get_docker_disk_usage(client)
+    containers = _classify_containers(df['Containers'])
+    reclaimable_container_ids = set(x.id for x in containers if x.reclaimable)
+    images = _classify_images(df['Images'], df['Containers'], reclaimable_container_ids, current_images, keep_versions)
+    volumes = _classify_volumes(df['Volumes'])
+    build_cache = _classify_build_cache(df['BuildCache'])
+    return GcReport(containers + images + volumes + build_cache)
+
+def prune_gc_report(
+        report: GcReport,
+        include_build_cache: bool=False,
+        client: Optional[DockerEngineClient]=None,
+      ) -> List[GcResult]:
+    """
+    Remove the reclaimable resources in a report: containers first, so that the images they
+    used can then be removed. Protected volumes are never removed, whatever the report says.
+
+    Args:
+        report: The report from get_gc_report().
+        include_build_cache: Also prune unused build cache.
+        client: The Engine API client. Defaults to the shared client.
+    """
+    if client is None:
+        client = get_docker_engine_client()
+        if client is None:
+            raise HubError("hub gc requires access to the Docker Engine API socket")
+    result: List[GcResult] = []
+    build_cache_items: List[GcItem] = []
+    for item in report.items:
+        if not item.reclaimable:
+            continue
+        if item.kind == "build-cache":
+            build_cache_items.append(item)
+            continue
+        if item.kind == "volume" and item.id in PROTECTED_VOLUMES:
+            continue
+        try:
+            if item.kind == "container":
+                client.remove_container(item.id, volumes=True)
+            elif item.kind == "image":
+                client.remove_image(item.id, force=True)
+            elif item.kind == "volume":
+                client.remove_volume(item.id)
+        except DockerApiNotFoundError:
+            pass
+        except DockerApiError as e:
+            logger.debug(f"Unable to remove {item.kind} {item.name}: {e}")
+            result.append(GcResult(item, False, str(e)))
+            continue
+        result.append(GcResult(item, True))
+    if include_build_cache and len(build_cache_items) > 0:
+        try:
+            client.prune_build_cache()
+            result += [ GcResult(item, True) for item in build_cache_items ]
+        except DockerApiError as e:
+            result += [ GcResult(item, False, str(e)) for item in build_cache_items ]
+    return result
+
+def format_gc_report(report: GcReport, show_all: bool=False) -> str:
+    """
+    Format a report as a summary table per kind, followed by the reclaimable resources (or all
+    resources, if show_all).
+    """
+    rows = [ ("KIND", "COUNT", "SIZE", "RECLAIMABLE") ]
+    for kind, (count, size, reclaimable) in report.get_totals().items():
+        rows.append((kind, str(count), format_bytes(size), format_bytes(reclaimable)))
+    lines = [ format_table(rows) ]
+    items = [ x for x in report.items if show_all or x.reclaimable ]
+    if len(items) > 0:
+        rows = [ ("KIND", "NAME", "SIZE", "STATUS") ]
+        for x in items:
+            rows.append((x.kind, x.name, format_bytes(x.size), ("reclaimable: " if x.reclaimable else "kept: ") + x.reason))
+        lines.append("")
+        lines.append(format_table(rows))
+    return "\n".join(lines)
@@ -0,0 +1,295 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+Pre-pulling of the docker images used by the hub, with a digest cache.
+
+The cache, in the build directory, records for each image reference the registry digest
+it resolved to and when that was last confirmed. An image that is present locally and was
+confirmed within the TTL needs no registry round trip at all. An image that is present
+but stale is checked against the registry (a manifest lookup, not a pull) and pulled only
+if the tag has moved. Missing images are pulled concurrently, with progress.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+
+from .internal_types import *
+from .pkg_logging import logger
+from .proj_dirs import get_project_build_dir
+from .docker_api import DockerApiError, get_docker_engine_client
+from .docker_util import VOLUME_HELPER_IMAGE
+from .docker_compose_stack import DockerComposeStack
+from .compose_model import get_compose_model
+from .util import inspect_docker_image, docker_call_output, normalize_image_reference, format_table
+
+IMAGE_DIGEST_CACHE_FILENAME = "image-digests.json"
+"""The name of the digest cache file in the build directory"""
+
+DEFAULT_IMAGE_TTL = 24 * 3600.0
+"""Default seconds for which a confirmed digest is trusted without asking the registry"""
+
+PORTAINER_RESET_PASSWORD_HELPER_IMAGE = "portainer/helper-reset-password"
+"""The image used to reset the Portainer admin password"""
+
+HUB_HELPER_IMAGES = (VOLUME_HELPER_IMAGE, PORTAINER_RESET_PASSWORD_HELPER_IMAGE)
+"""Images that hub commands run directly, outside of any stack"""
+
+def get_compose_stack_images(stack: DockerComposeStack) -> List[str]:
+    """Get the image references used by the services of a docker-compose stack"""
+    result: List[str] = []
+    for image in get_compose_model(stack).get_images():
+        if normalize_image_reference(image) not in result:
+            result.append(normalize_image_reference(image))
+    return result
+
+def _digest_of(repo_digests: Iterable[str]) -> Optional[str]:
+    for repo_digest in repo_digests:
+        _, _, digest = repo_digest.partition('@')
+        if digest != '':
+            return digest
+    return None
+
+class ImageResult:
+    """The outcome of ensuring that one image is present and current"""
+    image: str
+    """The image reference"""
+
+    action: str
+    """What was done: "cached" (fresh within the TTL; no registry access), "verified" (the
+       registry confirmed the local image is current), "pulled" (was missing), "updated"
+       (the tag had moved), or "failed" """
+
+    digest: Optional[str]
+    """The registry digest of the local image"""
+
+    seconds: float
+    """Seconds taken"""
+
+    error: Optional[str]
+    """The error message, if failed"""
+
+    def __init__(self, image: str, action: str, digest: Optional[str], seconds: float, error: Optional[str]=None):
+        self.image = image
+        self.action = action
+        self.digest = digest
+        self.seconds = seconds
+        self.error = error
+
+class ImageManager:
+    """
+    Ensures that images are present locally and current, using a persistent digest cache to
+    avoid registry round trips.
+    """
+    cache_pathname: str
+    """The pathname of the digest cache file"""
+
+    ttl: float
+    """Seconds for which a confirmed digest is trusted without asking the registry"""
+
+    max_parallel: int
+    """The maximum number of images pulled or checked at once"""
+
+    progress_out: Optional[IO[str]]
+    """Where progress messages are written, or None for no progress"""
+
+    progress_interval: float
+    """Minimum seconds between progress messages for each image"""
+
+    _cache: Dict[str, JsonableDict]
+    _lock: threading.Lock
+
+    def __init__(
+            self,
+            cache_pathname: Optional[str]=None,
+            ttl: float=DEFAULT_IMAGE_TTL,
+            max_parallel: int=4,
+            progress_out: Optional[IO[str]]=sys.stderr,
+            progress_interval: float=2.0,
+          ):
+        if cache_pathname is None:
+            cache_pathname = os.path.join(get_project_build_dir(), IMAGE_DIGEST_CACHE_FILENAME)
+        self.cache_pathname = cache_pathname
+        self.ttl = ttl
+        self.max_parallel = max_parallel
+        self.progress_out = progress_out
+        self.progress_interval = progress_interval
+        self._lock = threading.Lock()
+        self._cache = self._load_cache()
+
+    def _load_cache(self) -> Dict[str, JsonableDict]:
+        try:
+            with open(self.cache_pathname, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable image digest cache {self.cache_pathname}: {e}")
+            return {}
+        return dict(data.get('images') or {})
+
+    def save_cache(self) -> None:
+        """Write the digest cache, atomically"""
+        with self._lock:
+            data = dict(version=1, images=self._cache)
+        os.makedirs(os.path.dirname(self.cache_pathname), exist_ok=True)
+        tmp_pathname = self.cache_pathname + ".tmp"
+        with open(tmp_pathname, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write("\n")
+        os.replace(tmp_pathname, self.cache_pathname)
+
+    def _progress(self, message: str) -> None:
+        if self.progress_out is not None:
+            with self._lock:
+                self.progress_out.write(message + "\n")
+                self.progress_out.flush()
+
+    def _record(self, image: str, digest: Optional[str], image_id: str) -> None:
+        with self._lock:
+            self._cache[image] = dict(digest=digest, image_id=image_id, checked_at=time.time())
+
+    def _local(self, image: str) -> Optional[Tuple[str, Optional[str]]]:
+        data = inspect_docker_image(image)
+        if data is None:
+            return None
+        return data['Id'], _digest_of(data.get('RepoDigests') or [])
+
+    def _pull(self, image: str) -> None:
+        client = get_docker_engine_client()
+        if client is None:
+            docker_call_output(["pull", "--quiet", image])
+            return
+        layers: Dict[str, Tuple[int, int]] = {}
+        last_report = time.monotonic()
+
+        def on_progress(message: JsonableDict) -> None:
+            nonlocal last_report
+            detail = message.get('progressDetail') or {}
+            layer_id = message.get('id')
+            if layer_id and detail.get('total'):
+                layers[layer_id] = (detail.get('current', 0), detail['total'])
+            elif layer_id and message.get('status') in ("Download complete", "Pull complete", "Already exists"):
+                current, total = layers.get(layer_id, (0, 0))
+                layers[layer_id] = (total, total)
+            now = time.monotonic()
+            if now - last_report >= self.progress_interval and len(layers) > 0:
+                last_report = now
+                current = sum(x[0] for x in layers.values())
+                total = sum(x[1] for x in layers.values())
+                if total > 0:
+                    self._progress(f"{image}: {current / 1e6:.1f} of {total / 1e6:.1f} MB ({100 * current // total}%)")
+
+        client.pull_image(image, progress=on_progress)
+
+    def _remote_digest(self, image: str) -> Optional[str]:
+        client = get_docker_engine_client()
+        if client is None:
+            return None
+        try:
+            return (client.inspect_distribution(image).get('Descriptor') or {}).get('digest')
+        except DockerApiError as e:
+            logger.debug(f"Unable to get registry digest of {image}: {e}")
+            return None
+
+    def ensure_image_sync(self, image: str, ttl: Optional[float]=None) -> ImageResult:
+        """
+        Make sure one image is present and, unless it was confirmed within the TTL, current.
+
+        Args:
+            image: The image reference.
+            ttl: Overrides the manager's TTL. 0 always checks the registry; float('inf') only
+                pulls missing images.
+        """
+        image = normalize_image_reference(image)
+        ttl = self.ttl if ttl is None else ttl
+        start_time = time.monotonic()
+        try:
+            local = self._local(image)
+            if local is not None:
+                image_id, digest = local
+                with self._lock:
+                    entry = self._cache.get(image)
+                if (entry is not None and entry.get('image_id') == image_id and
+                        time.time() - entry.get('checked_at', 0) < ttl):
+                    return ImageResult(image, "cached", digest, time.monotonic() - start_time)
+                if '@' in image:
+                    # Pinned by digest; the content cannot change
+                    self._record(image, digest, image_id)
+                    return ImageResult(image, "verified", digest, time.monotonic() - start_time)
+                if ttl == float('inf'):
+                    return ImageResult(image, "cached", digest, time.monotonic() - start_time)
+                remote_digest = self._remote_digest(image)
+                if remote_digest is not None and remote_digest == digest:
+                    self._record(image, digest, image_id)
+                    return ImageResult(image, "verified", digest, time.monotonic() - start_time)
+            self._progress(f"Pulling {image}")
+            self._pull(image)
+            pulled = self._local(image)
+            if pulled is None:
+                raise HubError(f"Image {image} is not present after pulling")
+            image_id, digest = pulled
+            self._record(image, digest, image_id)
+            action = "pulled" if local is None else ("updated" if image_id != local[0] else "verified")
+            seconds = time.monotonic() - start_time
+            self._progress(f"{image}: {action} in {seconds:.1f} seconds")
+            return ImageResult(image, action, digest, seconds)
+        except Exception as e:
+            self._progress(f"{image}: failed: {e}")
+            return ImageResult(image, "failed", None, time.monotonic() - start_time, error=str(e))
+
+    async def ensure_images(self, images: Iterable[str], ttl: Optional[float]=None) -> List[ImageResult]:
+        """
+        Make sure images are present and current, working on up to max_parallel at once, then
+        save the digest cache.
+
+        Returns:
+            A result for each distinct image, in order.
+        """
+        distinct: List[str] = []
+        for image in images:
+            image = normalize_image_reference(image)
+            if image not in distinct:
+                distinct.append(image)
+        semaphore = asyncio.Semaphore(self.max_parallel)
+
+        async def ensure_one(image: str) -> ImageResult:
+            async with semaphore:
+                return await asyncio.to_thread(self.ensure_image_sync, image, ttl)
+
+        results = await asyncio.gather(*(ensure_one(image) for image in distinct))
+        try:
+            self.save_cache()
+        except OSError as e:
+            logger.warning(f"Unable to save image digest cache {self.cache_pathname}: {e}")
+        return list(results)
+
+    def ensure_image(self, image: str, ttl: Optional[float]=None) -> ImageResult:
+        """Make sure one image is present and current, and save the digest cache"""
+        result = self.ensure_image_sync(image, ttl=ttl)
+        try:
+            self.save_cache()
+        except OSError as e:
+            logger.warning(f"Unable to save image digest cache {self.cache_pathname}: {e}")
+        return result
+
+def format_image_results(results: List[ImageResult]) -> str:
+    """Format image results as a table"""
+    rows = [ ("IMAGE", "ACTION", "DIGEST", "TIME") ]
+    for r in results:
+        rows.append((
+            r.image,
+            r.action,
+            (r.digest or "-")[:19] if r.error is None else r.error,
+            f"{r.seconds:.1f}s",
+          ))
+    return format_table(rows)
@@ -0,0 +1,436 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+An in-process log follower that merges the logs of many containers by timestamp.
+
+Each container's log is read on its own thread (from an Engine API log stream, or a
+`docker logs` subprocess if the Engine API is not directly accessible), with docker
+timestamps enabled. Lines are filtered as they arrive, so filtered-out lines cost no
+buffer space, and then held in a bounded buffer ordered by timestamp. A line is released
+once it has been buffered for a short reorder window, so that lines from containers that
+arrive slightly out of order are still emitted in timestamp order. While the buffer is full,
+reader threads block, so backpressure reaches the log stream and no line is lost. Only when
+following, and the consumer stays behind on lines logged after following started, are the
+oldest of those lines dropped, and the drop is reported.
+"""
+
+from __future__ import annotations
+
+import re
+import time
+import heapq
+import threading
+import subprocess
+from datetime import datetime, timezone
+
+from .internal_types import *
+from .pkg_logging import logger
+from .docker_api import DockerStream, get_docker_engine_client, iter_docker_stream_frames
+from .util import get_docker_command
+from .stack_status import find_stack_containers
+from .subprocess_runner import Popen
+
+LOG_LEVELS = ("trace", "debug", "info", "warn", "error", "fatal")
+"""Normalized log levels, from least to most severe"""
+
+_level_aliases: Dict[str, str] = {
+    "trace": "trace", "trc": "trace",
+    "debug": "debug", "dbg": "debug",
+    "info": "info", "inf": "info", "information": "info",
+    "warn": "warn", "warning": "warn", "wrn": "warn",
+    "error": "error", "err": "error",
+    "fatal": "fatal", "ftl": "fatal", "panic": "fatal", "critical": "fatal", "crit": "fatal",
+  }
+
+# Traefik (logrus text or JSON) and zerolog console output (Portainer), e.g.:
+#    time="2023-10-22T10:00:00Z" level=debug msg="..."
+#    {"level":"info","msg":"...","time":"..."}
+#    2023/10/22 10:00AM INF ...
+_level_re = re.compile(
+    r'(?:\blevel=|"level"\s*:\s*")(\w+)|^\S+ \S+ (TRC|DBG|INF|WRN|ERR|FTL)\b',
+    re.IGNORECASE,
+  )
+
+def parse_log_level(text: str) -> Optional[str]:
+    """
+    Get the normalized level (one of LOG_LEVELS) of a log line, or None if it has none
+    that is recognized.
+    """
+    m = _level_re.search(text)
+    if m is None:
+        return None
+    return _level_aliases.get((m.group(1) or m.group(2)).lower())
+
+_relative_time_re = re.compile(r'^(\d+(?:\.\d+)?)([smhd])$')
+_time_units = { 's': 1, 'm': 60, 'h': 3600, 'd': 86400 }
+
+def parse_log_since(value: str, now: Optional[float]=None) -> float:
+    """
+    Parse a --since value, as accepted by `docker logs`: a relative duration (e.g., "30s", "10m",
+    "2h", "1d"), a UNIX timestamp, or an ISO 8601 date/time (UTC if no zone is given).
+
+    Returns:
+        The UNIX time.
+    """
+    value = value.strip()
+    m = _relative_time_re.match(value)
+    if m is not None:
+        return (time.time() if now is None else now) - float(m.group(1)) * _time_units[m.group(2)]
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        dt = datetime.fromisoformat(value[:-1] + "+00:00" if value.endswith("Z") else value)
+    except ValueError:
+        raise HubError(f"Invalid --since value {value!r}; expected e.g. 10m, 2h, a UNIX time or an ISO 8601 date/time")
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+def _unix_time_sort_key(t: float) -> str:
+    # The same form as _timestamp_sort_key, for a UNIX time
+    seconds = int(t)
+    nanoseconds = int(round((t - seconds) * 1e9))
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S') + f".{nanoseconds:09d}"
+
+def _timestamp_sort_key(timestamp: str) -> str:
+    # RFC3339Nano timestamps omit trailing zeros of the fraction, so pad it to compare as strings
+    base, dot, rest = timestamp.partition('.')
+    if dot == '':
+        return timestamp.rstrip('Z') + ".000000000"
+    return base + "." + rest.rstrip('Z').ljust(9, '0')
+
+class LogLine:
+    """A log line from a container"""
+    source: str
+    """The name of the source (the service name, or the container name if a service has several)"""
+
+    stream: str
+    """ "stdout" or "stderr" ("stdout" if the streams were not distinguished) """
+
+    timestamp: str
+    """The RFC3339Nano timestamp docker recorded for the line"""
+
+    text: str
+    """The text of the line, without its line ending"""
+
+    level: Optional[str]
+    """The normalized level of the line (see LOG_LEVELS), or None if not recognized"""
+
+    def __init__(self, source: str, stream: str, timestamp: str, text: str):
+        self.source = source
+        self.stream = stream
+        self.timestamp = timestamp
+        self.text = text
+        self.level = parse_log_level(text)
+
+class LogFilter:
+    """Selects log lines by minimum level and regular expression"""
+    min_level: Optional[str]
+    """If not None, lines with a recognized level below this are excluded. Lines with no
+       recognized level (e.g., stack traces) are kept."""
+
+    pattern: Optional[re.Pattern[str]]
+    """If not None, only lines in which this matches are kept"""
+
+    def __init__(self, min_level: Optional[str]=None, pattern: Optional[str]=None):
+        if min_level is not None:
+            normalized_level = _level_aliases.get(min_level.lower())
+            if normalized_level is None:
+                raise HubError(f"Unknown log level {min_level!r}; expected one of {', '.join(LOG_LEVELS)}")
+            min_level = normalized_level
+        self.min_level = min_level
+        try:
+            self.pattern = None if pattern is None else re.compile(pattern)
+        except re.error as e:
+            raise HubError(f"Invalid log filter regular expression {pattern!r}: {e}") from e
+
+    def matches(self, line: LogLine) -> bool:
+        if self.min_level is not None and line.level is not None:
+            if LOG_LEVELS.index(line.level) < LOG_LEVELS.index(self.min_level):
+                return False
+        if self.pattern is not None and self.pattern.search(line.text) is None:
+            return False
+        return True
+
+class LogSource:
+    """A container whose log is followed"""
+    name: str
+    """The name shown for lines from this source"""
+
+    container_id: str
+    """The container ID"""
+
+    def __init__(self, name: str, container_id: str):
+        self.name = name
+        self.container_id = container_id
+
+def get_stack_log_sources(stacks: Iterable[str], services: Optional[Iterable[str]]=None) -> List[LogSource]:
+    """
+    Find the containers of docker-compose stacks, with a single container listing.
+
+    Args:
+        stacks: The docker-compose project names.
+        services: If not None, only containers of these services (or with these container names).
+    """
+    selected = find_stack_containers(stacks, include_portainer_stacks=False, services=services)
+    service_counts: Dict[str, int] = {}
+    for _, service, _, _ in selected:
+        service_counts[service] = service_counts.get(service, 0) + 1
+    return sorted(
+        (LogSource(service if service_counts[service] == 1 else name, container_id) for _, service, name, container_id in selected),
+        key=lambda x: x.name,
+      )
+
+class MultiplexedLogFollower:
+    """
+    Follows the logs of several containers concurrently, and iterates over their lines
+    merged in timestamp order.
+    """
+    sources: List[LogSource]
+    """The containers whose logs are followed"""
+
+    follow: bool
+    """If True, keep following until stopped; otherwise, stop at the end of the existing logs"""
+
+    tail: Optional[int]
+    """If not None, start with the last tail lines of each container"""
+
+    since: Optional[float]
+    """If not None, start with lines logged at or after this UNIX time"""
+
+    line_filter: LogFilter
+    """The filter applied to each line as it arrives"""
+
+    max_buffered_lines: int
+    """The maximum number of lines buffered; readers block while the buffer is full"""
+
+    max_lag: float
+    """When following and the buffer is full, the oldest buffered line is dropped if it was logged
+       after following started and more than this many seconds ago. Earlier lines are never dropped."""
+
+    reorder_window: float
+    """Seconds a line is held, so lines from other containers that arrive slightly later
+       but have earlier timestamps are emitted first"""
+
+    num_dropped: int
+    """The number of lines dropped because the consumer fell behind"""
+
+    _heap: List[Tuple[str, int, float, LogLine]]
+    _live_key: str
+    """The sort key of the time following started; lines at or after it are live"""
+    _cond: threading.Condition
+    _seq: int
+    _active: int
+    _stopping: bool
+    _streams: List[DockerStream]
+    _procs: List[subprocess.Popen[bytes]]
+    _threads: List[threading.Thread]
+
+    def __init__(
+            self,
+            sources: Iterable[LogSource],
+            follow: bool=False,
+            tail: Optional[int]=None,
+            since: Optional[float]=None,
+            line_filter: Optional[LogFilter]=None,
+            max_buffered_lines: int=10000,
+            reorder_window: float=0.25,
+            max_lag: float=2.0,
+          ):
+        self.sources = list(sources)
+        self.follow = follow
+        self.tail = tail
+        self.since = since
+        self.line_filter = LogFilter() if line_filter is None else line_filter
+        self.max_buffered_lines = max_buffered_lines
+        self.reorder_window = reorder_window
+        self.max_lag = max_lag
+        self.num_dropped = 0
+        self._heap = []
+        self._live_key = _unix_time_sort_key(time.time())
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._active = 0
+        self._stopping = False
+        self._streams = []
+        self._procs = []
+        self._threads = []
+
+    @property
+    def num_buffered(self) -> int:
+        """The number of lines currently buffered"""
+        with self._cond:
+            return len(self._heap)
+
+    def start(self) -> None:
+        """Start following all sources"""
+        client = get_docker_engine_client()
+        with self._cond:
+            self._active = len(self.sources)
+            self._live_key = _unix_time_sort_key(time.time())
+        for source in self.sources:
+            target = self._follow_engine if client is not None else self._follow_cli
+            thread = threading.Thread(target=target, args=(source,), name=f"logs-{source.name}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def stop(self) -> None:
+        """Stop following; blocked reads are interrupted"""
+        with self._cond:
+            self._stopping = True
+            streams = list(self._streams)
+            procs = list(self._procs)
+            self._cond.notify_all()
+        for stream in streams:
+            stream.close()
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+        for thread in self._threads:
+            thread.join(timeout=5.0)
+
+    def __enter__(self) -> MultiplexedLogFollower:
+        self.start()
+        return self
+
+    def __exit__(
+            self,
+            exc_type: Optional[type[BaseException]],
+            exc_val: Optional[BaseException],
+            exc_tb: Optional[TracebackType],
+          ) -> None:
+        self.stop()
+
+    def _add_line(self, source: LogSource, stream: str, raw: bytes) -> None:
+        text = raw.decode('utf-8', errors='replace').rstrip('\r\n')
+        timestamp, _, text = text.partition(' ')
+        line = LogLine(source.name, stream, timestamp, text)
+        if not self.line_filter.matches(line):
+            return
+        sort_key = _timestamp_sort_key(timestamp)
+        with self._cond:
+            while len(self._heap) >= self.max_buffered_lines and not self._stopping:
+                if self.follow and self._heap[0][0] >= self._live_key and sort_key >= self._live_key:
+                    # Only live lines are buffered; if output lags too far behind them, drop the oldest
+                    if self._heap[0][0] < _unix_time_sort_key(time.time() - self.max_lag):
+                        heapq.heappop(self._heap)
+                        self.num_dropped += 1
+                        break
+                    self._cond.wait(self.max_lag)
+                else:
+                    # Block this reader until the consumer makes room
+                    self._cond.wait()
+            if self._stopping:
+                return
+            self._seq += 1
+            heapq.heappush(self._heap, (sort_key, self._seq, time.monotonic(), line))
+            self._cond.notify_all()
+
+    def _source_done(self, source: LogSource, error: Optional[Exception]=None) -> None:
+        with self._cond:
+            if error is not None and not self._stopping:
+                logger.warning(f"Log stream for {source.name} failed: {error}")
+            self._active -= 1
+            self._cond.notify_all()
+
+    def _follow_engine(self, source: LogSource) -> None:
+        client = get_docker_engine_client()
+        assert client is not None
+        error: Optional[Exception] = None
+        try:
+            stream = client.open_container_logs(
+                source.container_id, follow=self.follow, tail=self.tail, since=self.since, timestamps=True)
+            with self._cond:
+                self._streams.append(stream)
+                if self._stopping:
+                    stream.close()
+                    return
+            with stream:
+                # A frame normally holds one line, but long lines are split across frames
+                partial: Dict[int, bytes] = { 1: b'', 2: b'' }
+                for stream_type, payload in iter_docker_stream_frames(stream):
+                    data = partial.get(stream_type, b'') + payload
+                    lines = data.split(b'\n')
+                    partial[stream_type] = lines.pop()
+                    for raw in lines:
+                        self._add_line(source, "stderr" if stream_type == 2 else "stdout", raw)
+                for stream_type, raw in partial.items():
+                    if raw != b'':
+                        self._add_line(source, "stderr" if stream_type == 2 else "stdout", raw)
+        except Exception as e:
+            error = e
+        finally:
+            self._source_done(source, error)
+
+    def _follow_cli(self, source: LogSource) -> None:
+        args = [ "logs", "--timestamps" ]
+        if self.follow:
+            args.append("--follow")
+        if self.tail is not None:
+            args += [ "--tail", str(self.tail) ]
+        if self.since is not None:
+            args += [ "--since", f"{self.since:.9f}" ]
+        error: Optional[Exception] = None
+        try:
+            # Interleaving stdout and stderr in one pipe keeps their relative order
+            proc = Popen(
+                get_docker_command(args + [ source.container_id ]),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+              )
+            with self._cond:
+                self._procs.append(proc)
+                if self._stopping:
+                    proc.terminate()
+            assert proc.stdout is not None
+            with proc.stdout:
+                for raw in proc.stdout:
+                    self._add_line(source, "stdout", raw)
+            exit_code = proc.wait()
+            if exit_code != 0 and not self._stopping:
+                error = HubError(f"docker logs exited with code {exit_code}")
+        except Exception as e:
+            error = e
+        finally:
+            self._source_done(source, error)
+
+    def __iter__(self) -> Iterator[LogLine]:
+        """
+        Iterate over lines in timestamp order, until every source has ended (or forever, if
+        following). If lines were dropped, a line from source "hub" reports how many.
+        """
+        reported_dropped = 0
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    if len(self._heap) > 0:
+                        wait_time = self._heap[0][2] + self.reorder_window - time.monotonic()
+                        if wait_time <= 0 or self._active == 0 or len(self._heap) >= self.max_buffered_lines:
+                            # Readers blocked on a full buffer cannot deliver anything earlier
+                            _, _, _, line = heapq.heappop(self._heap)
+                            self._cond.notify_all()
+                            break
+                        self._cond.wait(wait_time)
+                    elif self._active == 0:
+                        return
+                    else:
+                        self._cond.wait()
+                num_dropped = self.num_dropped
+            if num_dropped > reported_dropped:
+                yield LogLine(
+                    "hub",
+                    "stderr",
+                    line.timestamp,
+                    f"... {num_dropped - reported_dropped} log lines dropped because output fell behind",
+                  )
+                reported_dropped = num_dropped
+            yield line
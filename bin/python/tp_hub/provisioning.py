@@ -0,0 +1,347 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+A desired-state provisioning engine for the hub's system prerequisites.
+
+Each ProvisioningStep knows how to tell whether it is already satisfied and how to satisfy
+it. Satisfaction checks are cheap: installed commands are found on the PATH (or, for the
+docker compose plugin, in the CLI plugin directories) without running them, and docker
+networks and volumes are each listed once, in a shared ProvisioningState snapshot, rather
+than queried per resource. The slower authoritative checks of project_init_tools only run
+for a step that looks unsatisfied, just before installing.
+
+Steps run concurrently once the steps they depend on have succeeded, so that, e.g., the AWS
+CLI download proceeds while apt installs docker. Steps that share a lock (e.g., everything that
+runs apt, which holds the dpkg lock) run one at a time.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+import shutil
+import threading
+import concurrent.futures
+
+from project_init_tools.os_packages import update_gpg_keyring, update_apt_sources_list, update_and_install_os_packages
+from project_init_tools.util import command_exists, get_linux_distro_name
+
+from .internal_types import *
+from .pkg_logging import logger
+from .util import (
+    install_docker,
+    docker_is_installed,
+    install_docker_compose,
+    docker_compose_is_installed,
+    install_aws_cli,
+    aws_cli_is_installed,
+    get_docker_networks,
+    get_docker_volumes,
+    refresh_docker_networks,
+    refresh_docker_volumes,
+    create_docker_network,
+    create_docker_volume,
+    format_table,
+  )
+
+APT_LOCK = "apt"
+"""The lock shared by steps that run apt, which cannot run concurrently"""
+
+DOCKER_CLI_PLUGIN_DIRS = [
+    "~/.docker/cli-plugins",
+    "/usr/local/lib/docker/cli-plugins",
+    "/usr/local/libexec/docker/cli-plugins",
+    "/usr/lib/docker/cli-plugins",
+    "/usr/libexec/docker/cli-plugins",
+  ]
+"""The directories in which the docker CLI looks for plugins, such as docker compose"""
+
+def install_cloudflared(force: bool=False) -> None:
+    if force or not command_exists("cloudflared"):
+        print("Installing cloudflared")
+
+        cloudflare_keyring_file = "/usr/share/keyrings/cloudflare-main.gpg"
+
+        update_gpg_keyring(
+            "https://pkg.cloudflare.com/cloudflare-main.gpg",
+            cloudflare_keyring_file,
+        )
+
+        update_apt_sources_list(
+            "/etc/apt/sources.list.d/cloudflared.list",
+            cloudflare_keyring_file,
+            "https://pkg.cloudflare.com/cloudflared",
+            get_linux_distro_name(),
+            "main")
+
+        update_and_install_os_packages( [ "cloudflared" ] )
+
+        if not command_exists("cloudflared"):
+            raise RuntimeError("cloudflared command still not available after installation!")
+
+        print("cloudflared package installed successfully")
+
+class ProvisioningState:
+    """
+    A snapshot of the current state of the host, gathered with as few queries as possible
+    and shared by all steps. Each query runs at most once, on first use, until invalidated.
+    """
+    _lock: threading.Lock
+    _docker_networks: Optional[Set[str]] = None
+    _docker_volumes: Optional[Set[str]] = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def command_exists(self, name: str) -> bool:
+        """True if a command is on the PATH. Does not run it."""
+        return shutil.which(name) is not None
+
+    def docker_cli_plugin_exists(self, name: str) -> bool:
+        """True if a docker CLI plugin (e.g., "compose") is installed. Does not run it."""
+        return any(
+            os.path.isfile(os.path.join(os.path.expanduser(dir_name), f"docker-{name}"))
+            for dir_name in DOCKER_CLI_PLUGIN_DIRS
+          )
+
+    @property
+    def docker_networks(self) -> Set[str]:
+        """The names of all docker networks"""
+        with self._lock:
+            if self._docker_networks is None:
+                self._docker_networks = set(get_docker_networks())
+            return self._docker_networks
+
+    @property
+    def docker_volumes(self) -> Set[str]:
+        """The names of all docker volumes"""
+        with self._lock:
+            if self._docker_volumes is None:
+                self._docker_volumes = set(get_docker_volumes())
+            return self._docker_volumes
+
+    def invalidate_docker(self) -> None:
+        """Forget the docker snapshot; e.g., after docker has been installed"""
+        with self._lock:
+            self._docker_networks = None
+            self._docker_volumes = None
+        refresh_docker_networks()
+        refresh_docker_volumes()
+
+class ProvisioningStep:
+    """One piece of desired state, with a check for it and an action that establishes it"""
+    name: str
+    """A short name for the step, e.g., "docker" or "volume portainer_data" """
+
+    depends_on: List[str]
+    """The names of steps that must succeed before this step is checked"""
+
+    lock: Optional[str]
+    """If not None, steps with the same lock run one at a time"""
+
+    _check: Callable[[ProvisioningState], bool]
+    _apply: Callable[[ProvisioningState, bool], None]
+
+    def __init__(
+            self,
+            name: str,
+            check: Callable[[ProvisioningState], bool],
+            apply: Callable[[ProvisioningState, bool], None],
+            depends_on: Iterable[str]=(),
+            lock: Optional[str]=None,
+          ):
+        """
+        Args:
+            name: A short name for the step.
+            check: Returns True if the desired state already holds. Should be cheap.
+            apply: Establishes the desired state. Called with (state, force).
+            depends_on: The names of steps that must succeed first.
+            lock: Steps with the same lock run one at a time.
+        """
+        self.name = name
+        self._check = check
+        self._apply = apply
+        self.depends_on = list(depends_on)
+        self.lock = lock
+
+    def check(self, state: ProvisioningState) -> bool:
+        return self._check(state)
+
+    def apply(self, state: ProvisioningState, force: bool=False) -> None:
+        self._apply(state, force)
+
+class ProvisioningResult:
+    """The outcome of one provisioning step"""
+    name: str
+    """The step name"""
+
+    action: str
+    """What was done: "satisfied" (nothing to do), "applied", "failed", or "skipped" (a step
+       it depends on failed)"""
+
+    seconds: float
+    """Seconds taken, including the check"""
+
+    error: Optional[str]
+    """The error message, if failed or skipped"""
+
+    def __init__(self, name: str, action: str, seconds: float, error: Optional[str]=None):
+        self.name = name
+        self.action = action
+        self.seconds = seconds
+        self.error = error
+
+class Provisioner:
+    """Brings the host to a desired state, running independent steps concurrently"""
+    steps: Dict[str, ProvisioningStep]
+    """The steps, by name"""
+
+    max_parallel: int
+    """The maximum number of steps run at once"""
+
+    state: ProvisioningState
+    """The shared state snapshot"""
+
+    _locks: Dict[str, threading.Lock]
+
+    def __init__(self, steps: Iterable[ProvisioningStep], max_parallel: int=4, state: Optional[ProvisioningState]=None):
+        self.steps = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise HubError(f"Duplicate provisioning step '{step.name}'")
+            self.steps[step.name] = step
+        for step in self.steps.values():
+            for dep in step.depends_on:
+                if dep not in self.steps:
+                    raise HubError(f"Provisioning step '{step.name}' depends on unknown step '{dep}'")
+        self.max_parallel = max_parallel
+        self.state = ProvisioningState() if state is None else state
+        self._locks = { step.lock: threading.Lock() for step in self.steps.values() if step.lock is not None }
+
+    def _run_step(self, step: ProvisioningStep, force: bool) -> ProvisioningResult:
+        start_time = time.monotonic()
+        try:
+            if not force and step.check(self.state):
+                return ProvisioningResult(step.name, "satisfied", time.monotonic() - start_time)
+            lock = self._locks.get(step.lock) if step.lock is not None else None
+            if lock is not None:
+                with lock:
+                    step.apply(self.state, force)
+            else:
+                step.apply(self.state, force)
+        except Exception as e:
+            logger.debug(f"Provisioning step '{step.name}' failed", exc_info=True)
+            return ProvisioningResult(step.name, "failed", time.monotonic() - start_time, error=str(e) or type(e).__name__)
+        return ProvisioningResult(step.name, "applied", time.monotonic() - start_time)
+
+    def run(self, force: bool=False) -> List[ProvisioningResult]:
+        """
+        Check every step, and apply those that are not satisfied, in dependency order.
+
+        Args:
+            force: Apply every step, even if it appears satisfied.
+
+        Returns:
+            A result for every step, in the order the steps were given.
+        """
+        results: Dict[str, ProvisioningResult] = {}
+        pending = list(self.steps.values())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_parallel, thread_name_prefix="provision") as executor:
+            running: Dict[concurrent.futures.Future[ProvisioningResult], str] = {}
+            while len(pending) > 0 or len(running) > 0:
+                still_pending: List[ProvisioningStep] = []
+                for step in pending:
+                    dep_results = [ results.get(dep) for dep in step.depends_on ]
+                    if any(r is None for r in dep_results):
+                        still_pending.append(step)
+                        continue
+                    failed = [ r for r in dep_results if r is not None and r.action in ("failed", "skipped") ]
+                    if len(failed) > 0:
+                        results[step.name] = ProvisioningResult(step.name, "skipped", 0.0, error=f"{failed[0].name} {failed[0].action}")
+                    else:
+                        running[executor.submit(self._run_step, step, force)] = step.name
+                pending = still_pending
+                if len(running) == 0:
+                    if len(pending) > 0:
+                        raise HubError(f"Provisioning steps have circular dependencies: {', '.join(s.name for s in pending)}")
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        return [ results[name] for name in self.steps ]
+
+def format_provisioning_results(results: List[ProvisioningResult]) -> str:
+    """Format provisioning results as a table"""
+    rows = [ ("STEP", "ACTION", "TIME", "ERROR") ]
+    for r in results:
+        rows.append((r.name, r.action, f"{r.seconds:.2f}s", r.error or ""))
+    return format_table(rows)
+
+def _apply_docker(state: ProvisioningState, force: bool) -> None:
+    if force or not docker_is_installed():
+        install_docker(force=force)
+    state.invalidate_docker()
+
+def _apply_docker_compose(state: ProvisioningState, force: bool) -> None:
+    if force or not docker_compose_is_installed():
+        install_docker_compose(force=force)
+
+def _apply_aws_cli(state: ProvisioningState, force: bool) -> None:
+    if force or not aws_cli_is_installed():
+        install_aws_cli(force=force)
+
+def _apply_cloudflared(state: ProvisioningState, force: bool) -> None:
+    install_cloudflared(force=force)
+
+def _docker_network_step(name: str) -> ProvisioningStep:
+    def apply(state: ProvisioningState, force: bool) -> None:
+        create_docker_network(name)
+    return ProvisioningStep(
+        f"network {name}",
+        lambda state: name in state.docker_networks,
+        apply,
+        depends_on=["docker"],
+      )
+
+def _docker_volume_step(name: str) -> ProvisioningStep:
+    def apply(state: ProvisioningState, force: bool) -> None:
+        # Never recreated, even with force; the volumes hold certificates and Portainer's data
+        create_docker_volume(name)
+    return ProvisioningStep(
+        f"volume {name}",
+        lambda state: name in state.docker_volumes,
+        apply,
+        depends_on=["docker"],
+      )
+
+def get_hub_prereq_steps(include_cloudflared: bool=True) -> List[ProvisioningStep]:
+    """
+    Get the provisioning steps for the hub's system prerequisites: docker, the docker compose
+    plugin, the AWS CLI, optionally cloudflared, the "traefik" network, and the "traefik_acme"
+    and "portainer_data" volumes.
+    """
+    result = [
+        ProvisioningStep("docker", lambda state: state.command_exists("docker"), _apply_docker, lock=APT_LOCK),
+        ProvisioningStep(
+            "docker-compose",
+            lambda state: state.docker_cli_plugin_exists("compose"),
+            _apply_docker_compose,
+            depends_on=["docker"],
+            lock=APT_LOCK,
+          ),
+        ProvisioningStep("aws-cli", lambda state: state.command_exists("aws"), _apply_aws_cli),
+      ]
+    if include_cloudflared:
+        result.append(
+            ProvisioningStep("cloudflared", lambda state: state.command_exists("cloudflared"), _apply_cloudflared, lock=APT_LOCK)
+          )
+    result += [
+        _docker_network_step("traefik"),
+        _docker_volume_step("traefik_acme"),
+        _docker_volume_step("portainer_data"),
+      ]
+    return result
@@ -0,0 +1,362 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+Readiness checking for hub services after their stacks are brought up.
+
+`docker compose up -d` returns as soon as containers are started, not when they are
+serving. wait_ready() polls a set of readiness checks concurrently, each with exponential
+backoff and jitter, and records each service's time-to-ready. It gives up early if a
+check can never succeed, and gathers diagnostics for anything that is not ready.
+"""
+
+from __future__ import annotations
+
+import ssl
+import time
+import random
+import asyncio
+import http.client
+from urllib.parse import urlsplit
+
+from .internal_types import *
+from .pkg_logging import logger
+from .util import get_docker_containers, inspect_docker_container, get_docker_container_logs
+
+DEFAULT_READY_TIMEOUT = 120.0
+"""Default seconds to wait for the hub to become ready"""
+
+class ReadinessFatalError(HubError):
+    """A readiness check determined that its service cannot become ready without intervention"""
+    pass
+
+class ReadinessCheck:
+    """A check of whether one aspect of a service is ready"""
+    name: str
+    """A short description of what is checked, for reporting"""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    async def check(self) -> Tuple[bool, str]:
+        """
+        Make one attempt.
+
+        Returns:
+            A tuple (ready, detail), where detail briefly describes the observed state.
+
+        Raises:
+            ReadinessFatalError: The service can never become ready without intervention.
+        """
+        raise NotImplementedError()
+
+    async def diagnostics(self) -> List[str]:
+        """Get additional lines of diagnostic information, for a check that did not become ready"""
+        return []
+
+class ContainerReadinessCheck(ReadinessCheck):
+    """
+    Checks that the container for a docker-compose service is running and, if it has a
+    healthcheck, healthy.
+    """
+    project: str
+    """The docker-compose project name"""
+
+    service: str
+    """The docker-compose service name"""
+
+    _container_id: Optional[str] = None
+
+    def __init__(self, name: str, project: str, service: str):
+        super().__init__(name)
+        self.project = project
+        self.service = service
+
+    def _inspect(self) -> Optional[JsonableDict]:
+        if self._container_id is None:
+            containers = get_docker_containers(
+                all=True,
+                filters={ "label": [ f"com.docker.compose.project={self.project}", f"com.docker.compose.service={self.service}" ] },
+              )
+            if len(containers) == 0:
+                return None
+            self._container_id = containers[0]['Id']
+        assert self._container_id is not None
+        data = inspect_docker_container(self._container_id)
+        if data is None:
+            # Recreated since it was found
+            self._container_id = None
+        return data
+
+    async def check(self) -> Tuple[bool, str]:
+        data = await asyncio.to_thread(self._inspect)
+        if data is None:
+            raise ReadinessFatalError(f"No container exists for service {self.project}/{self.service}")
+        state = data.get('State') or {}
+        status = state.get('Status', 'unknown')
+        if status != 'running':
+            restart_policy = ((data.get('HostConfig') or {}).get('RestartPolicy') or {}).get('Name') or 'no'
+            if status in ('exited', 'dead') and restart_policy == 'no':
+                raise ReadinessFatalError(f"Container exited with code {state.get('ExitCode')} and will not be restarted")
+            return False, f"container {status}"
+        health = state.get('Health')
+        if health is None:
+            return True, "running (no healthcheck)"
+        health_status = health.get('Status', 'unknown')
+        return health_status == 'healthy', f"running, {health_status}"
+
+    async def diagnostics(self) -> List[str]:
+        data = await asyncio.to_thread(self._inspect)
+        if data is None:
+            return [ f"no container for service {self.project}/{self.service}" ]
+        state = data.get('State') or {}
+        result = [
+            f"container {data.get('Name', '').lstrip('/')}: status={state.get('Status')}, "
+            f"exit code={state.get('ExitCode')}, restarts={data.get('RestartCount', 0)}, "
+            f"error={state.get('Error') or 'none'}"
+          ]
+        health = state.get('Health')
+        if health is not None:
+            for entry in (health.get('Log') or [])[-3:]:
+                output = (entry.get('Output') or '').strip().replace('\n', ' ')
+                result.append(f"healthcheck exit code {entry.get('ExitCode')}: {output}")
+        try:
+            logs = await asyncio.to_thread(get_docker_container_logs, data['Id'], 20)
+            result.append("last log lines:")
+            result.extend(f"    {line}" for line in logs.rstrip().split('\n') if line != '')
+        except Exception as e:
+            result.append(f"unable to get container logs: {e}")
+        return result
+
+def http_get_status(url: str, timeout: float=2.0) -> int:
+    """
+    GET a URL on a new connection and return the HTTP status. Certificates are not verified,
+    since the hub's LAN entrypoints use a self-signed certificate.
+
+    Raises:
+        OSError, http.client.HTTPException: The request failed.
+    """
+    parts = urlsplit(url)
+    conn: http.client.HTTPConnection
+    if parts.scheme == 'https':
+        conn = http.client.HTTPSConnection(
+            parts.hostname or 'localhost', parts.port, timeout=timeout, context=ssl._create_unverified_context())
+    else:
+        conn = http.client.HTTPConnection(parts.hostname or 'localhost', parts.port, timeout=timeout)
+    try:
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+class HttpReadinessCheck(ReadinessCheck):
+    """
+    Checks that an HTTP(S) endpoint answers. By default, any HTTP response at all counts as
+    ready (e.g., a Traefik entrypoint that answers 404 or 401 is serving); ok_statuses can
+    require particular statuses. Redirects are not followed and TLS certificates are not
+    verified, since LAN entrypoints use self-signed certificates.
+    """
+    url: str
+    """The URL to GET"""
+
+    ok_statuses: Optional[Sequence[int]]
+    """The HTTP statuses that indicate readiness, or None to accept any response"""
+
+    timeout: float
+    """Seconds to wait for each attempt"""
+
+    def __init__(self, name: str, url: str, ok_statuses: Optional[Sequence[int]]=None, timeout: float=2.0):
+        super().__init__(name)
+        self.url = url
+        self.ok_statuses = ok_statuses
+        self.timeout = timeout
+
+    async def check(self) -> Tuple[bool, str]:
+        try:
+            status = await asyncio.to_thread(http_get_status, self.url, self.timeout)
+        except (OSError, http.client.HTTPException) as e:
+            return False, f"{type(e).__name__}: {e}"
+        ready = self.ok_statuses is None or status in self.ok_statuses
+        return ready, f"HTTP {status}"
+
+    async def diagnostics(self) -> List[str]:
+        return [ f"GET {self.url}" ]
+
+class ReadinessResult:
+    """The outcome of waiting for one readiness check"""
+    name: str
+    """The name of the check"""
+
+    ready: bool
+    """True if the check succeeded in time"""
+
+    seconds: float
+    """Seconds from the start of waiting until ready (or until giving up)"""
+
+    attempts: int
+    """The number of attempts made"""
+
+    detail: str
+    """The last observed state"""
+
+    diagnostics: List[str]
+    """Diagnostic lines, if not ready"""
+
+    def __init__(self, name: str, ready: bool, seconds: float, attempts: int, detail: str):
+        self.name = name
+        self.ready = ready
+        self.seconds = seconds
+        self.attempts = attempts
+        self.detail = detail
+        self.diagnostics = []
+
+async def wait_ready(
+        checks: Iterable[ReadinessCheck],
+        timeout: float=DEFAULT_READY_TIMEOUT,
+        initial_interval: float=0.1,
+        max_interval: float=2.0,
+      ) -> List[ReadinessResult]:
+    """
+    Poll readiness checks concurrently until all are ready, one can never become ready, or the
+    timeout expires. Each check is retried with exponential backoff and "equal jitter" (half
+    the interval fixed, half random), so that checks do not poll in lockstep.
+
+    Args:
+        checks: The checks to wait for.
+        timeout: Maximum seconds to wait.
+        initial_interval: Seconds between the first and second attempts of each check.
+        max_interval: Maximum seconds between attempts.
+
+    Returns:
+        A result for each check, in order. Checks that were not ready include diagnostics.
+    """
+    checks = list(checks)
+    start_time = time.monotonic()
+    deadline = start_time + timeout
+    results: Dict[int, ReadinessResult] = {}
+
+    async def poll(i: int, check: ReadinessCheck) -> None:
+        attempts = 0
+        interval = initial_interval
+        detail = "not checked"
+        try:
+            while True:
+                attempts += 1
+                ready, detail = await check.check()
+                now = time.monotonic()
+                if ready:
+                    results[i] = ReadinessResult(check.name, True, now - start_time, attempts, detail)
+                    logger.debug(f"{check.name} ready in {now - start_time:.2f} seconds ({detail})")
+                    return
+                if now >= deadline:
+                    break
+                delay = min(interval / 2 + random.uniform(0, interval / 2), deadline - now)
+                await asyncio.sleep(delay)
+                interval = min(interval * 2, max_interval)
+        except ReadinessFatalError as e:
+            results[i] = ReadinessResult(check.name, False, time.monotonic() - start_time, attempts, str(e))
+            raise
+        results[i] = ReadinessResult(check.name, False, time.monotonic() - start_time, attempts, f"timed out: {detail}")
+
+    tasks = [ asyncio.create_task(poll(i, check)) for i, check in enumerate(checks) ]
+    try:
+        # A fatal check makes waiting for the others pointless
+        await asyncio.gather(*tasks)
+    except ReadinessFatalError:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    result: List[ReadinessResult] = []
+    for i, check in enumerate(checks):
+        r = results.get(i)
+        if r is None:
+            r = ReadinessResult(check.name, False, time.monotonic() - start_time, 0, "abandoned after another check failed")
+        if not r.ready:
+            try:
+                r.diagnostics = await check.diagnostics()
+            except Exception as e:
+                r.diagnostics = [ f"unable to collect diagnostics: {e}" ]
+        result.append(r)
+    return result
+
+def format_readiness_report(results: List[ReadinessResult], diagnostics: bool=True) -> str:
+    """Format readiness results as a table of time-to-ready, followed by diagnostics for failures"""
+    width = max([ len(r.name) for r in results ] + [ len("Service") ])
+    lines = [ f"{'Service':<{width}}  {'Ready in':>9}  Status" ]
+    for r in results:
+        ready_in = f"{r.seconds:8.2f}s" if r.ready else "      ---"
+        lines.append(f"{r.name:<{width}}  {ready_in}  {r.detail}")
+    if diagnostics:
+        for r in results:
+            if not r.ready and len(r.diagnostics) > 0:
+                lines.append("")
+                lines.append(f"{r.name}:")
+                lines.extend(f"    {line}" for line in r.diagnostics)
+    return "\n".join(lines)
+
+def get_traefik_readiness_checks(project_name: str, host: str="127.0.0.1") -> List[ReadinessCheck]:
+    """
+    Get the readiness checks for the hub's Traefik stack: container health, and each Traefik
+    entrypoint published on this host.
+
+    Args:
+        project_name: The docker-compose project name of the Traefik stack.
+        host: The host that the Traefik entrypoints are published on.
+    """
+    return [
+        ContainerReadinessCheck("traefik container", project_name, "traefik"),
+        HttpReadinessCheck("traefik lanweb (:80)", f"http://{host}:80/"),
+        HttpReadinessCheck("traefik lanwebsecure (:443)", f"https://{host}:443/"),
+        HttpReadinessCheck("traefik websecure (:7082)", f"http://{host}:7082/"),
+        HttpReadinessCheck("traefik landashboard (:8080)", f"http://{host}:8080/"),
+      ]
+
+def get_hub_readiness_checks(
+        traefik_project_name: str,
+        portainer_project_name: str,
+        host: str="127.0.0.1",
+      ) -> List[ReadinessCheck]:
+    """
+    Get the readiness checks for the hub's Traefik and Portainer stacks: container health,
+    each Traefik entrypoint published on this host, and the Portainer UI through Traefik.
+    """
+    return (
+        get_traefik_readiness_checks(traefik_project_name, host) +
+        get_portainer_readiness_checks(portainer_project_name, host)
+      )
+
+def get_portainer_readiness_checks(
+        project_name: str,
+        host: str="127.0.0.1",
+        include_agent: bool=True,
+      ) -> List[ReadinessCheck]:
+    """
+    Get the readiness checks for the hub's Portainer stack: container health, and the Portainer
+    UI through Traefik.
+
+    Args:
+        project_name: The docker-compose project name of the Portainer stack.
+        host: The host that the Portainer UI is published on.
+        include_agent: True if the Portainer agent container should be checked.
+    """
+    result: List[ReadinessCheck] = []
+    if include_agent:
+        result.append(ContainerReadinessCheck("portainer_agent container", project_name, "portainer_agent"))
+    result += [
+        ContainerReadinessCheck("portainer container", project_name, "portainer"),
+        HttpReadinessCheck(
+            "portainer ui (:9000)",
+            f"http://{host}:9000/portainer/api/system/status",
+            ok_statuses=(200,),
+          ),
+      ]
+    return result
@@ -0,0 +1,191 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+A declarative catalog of Traefik routes, compiled into Traefik file-provider dynamic configuration.
+
+Routes expressed as docker labels must be re-read and re-parsed by Traefik's docker provider on
+every container event. Routes in the catalog are instead compiled by `hub build` into static
+file-provider shards that Traefik only re-reads when a shard actually changes.
+
+Each catalog file (stacks/routes/<shard>.yml) looks like:
+
+    routes:
+      whoami-lan:
+        entrypoints: [ lanwebsecure ]
+        hosts: [ "${SHARED_LAN_APP_DNS_NAME}" ]   # or "rule:" for an arbitrary Traefik rule
+        path_prefix: /whoami                       # optional; or "path:"
+        strip_prefix: true                         # optional; strips path_prefix before forwarding
+        url: http://whoami:80                      # or "urls:", or "service:" naming a service
+        middlewares: [ traefik-shared-lan-app-default-path ]
+        priority: 100                              # optional
+        tls: true                                  # optional
+    middlewares:                                   # optional; Traefik dynamic config format
+      ...
+    services:                                      # optional; Traefik dynamic config format
+      ...
+
+Catalog files are interpolated like docker-compose files (${VAR}, ${VAR:-default}, $$) against
+the Traefik stack environment. Middleware references that are not defined in the catalog or in the
+file provider are resolved against the middlewares defined by docker labels in the Traefik stack
+(e.g., the default-path redirect middlewares), and qualified with "@docker".
+"""
+
+from __future__ import annotations
+
+from .internal_types import *
+from .pkg_logging import logger
+
+class RouteCatalogError(HubError):
+    """An invalid route catalog entry"""
+    pass
+
+_route_keys = {
+    'entrypoints', 'rule', 'hosts', 'path', 'path_prefix', 'strip_prefix',
+    'service', 'url', 'urls', 'middlewares', 'priority', 'tls',
+  }
+
+def _as_str_list(value: Any, what: str) -> List[str]:
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [ x.strip() for x in value.split(',') if x.strip() != '' ]
+    if isinstance(value, list) and all(isinstance(x, str) for x in value):
+        return list(value)
+    raise RouteCatalogError(f"{what} must be a list of strings or a comma-delimited string: {value!r}")
+
+def _backquote(s: str) -> str:
+    if '`' in s:
+        raise RouteCatalogError(f"Value may not contain a backquote: {s!r}")
+    return f"`{s}`"
+
+def compile_route_rule(route_name: str, route: JsonableDict) -> str:
+    """
+    Get the Traefik rule for a catalog route, either given explicitly or built from hosts/path/path_prefix.
+    """
+    rule = route.get('rule')
+    hosts = _as_str_list(route.get('hosts'), f"Route {route_name}: hosts")
+    path = route.get('path')
+    path_prefix = route.get('path_prefix')
+    if rule is not None:
+        if len(hosts) > 0 or path is not None or path_prefix is not None:
+            raise RouteCatalogError(f"Route {route_name}: 'rule' cannot be combined with 'hosts', 'path' or 'path_prefix'")
+        if not isinstance(rule, str):
+            raise RouteCatalogError(f"Route {route_name}: 'rule' must be a string")
+        return rule
+    if path is not None and path_prefix is not None:
+        raise RouteCatalogError(f"Route {route_name}: only one of 'path' and 'path_prefix' may be given")
+    terms: List[str] = []
+    if len(hosts) > 0:
+        terms.append(f"Host({', '.join(_backquote(h) for h in hosts)})")
+    if path is not None:
+        terms.append(f"Path({_backquote(str(path))})")
+    if path_prefix is not None:
+        terms.append(f"PathPrefix({_backquote(str(path_prefix))})")
+    if len(terms) == 0:
+        raise RouteCatalogError(f"Route {route_name}: one of 'rule', 'hosts', 'path' or 'path_prefix' is required")
+    return ' && '.join(terms)
+
+def compile_route_catalog_shard(
+        shard_name: str,
+        catalog: JsonableDict,
+        file_middlewares: AbstractSet[str],
+        docker_middlewares: AbstractSet[str],
+      ) -> JsonableDict:
+    """
+    Compile one catalog file into Traefik file-provider dynamic configuration.
+
+    Args:
+        shard_name: The name of the catalog file, for error messages.
+        catalog: The parsed and interpolated catalog file.
+        file_middlewares: Names of middlewares defined by the file provider outside this shard
+                (including other catalog shards).
+        docker_middlewares: Names of middlewares defined by docker labels.
+
+    Returns:
+        Dynamic configuration, in the format of traefik-dynamic-config.yml.
+    """
+    if catalog is None:
+        catalog = {}
+    if not isinstance(catalog, dict):
+        raise RouteCatalogError(f"Route catalog {shard_name}: must be a mapping")
+    unknown_sections = set(catalog.keys()) - { 'routes', 'middlewares', 'services' }
+    if len(unknown_sections) > 0:
+        raise RouteCatalogError(f"Route catalog {shard_name}: unknown sections {sorted(unknown_sections)}")
+    routes: JsonableDict = catalog.get('routes') or {}
+    middlewares: JsonableDict = dict(catalog.get('middlewares') or {})
+    services: JsonableDict = dict(catalog.get('services') or {})
+    routers: JsonableDict = {}
+    local_middlewares = set(file_middlewares) | set(middlewares.keys())
+
+    for route_name, route in routes.items():
+        what = f"Route catalog {shard_name}: route {route_name}"
+        if not isinstance(route, dict):
+            raise RouteCatalogError(f"{what}: must be a mapping")
+        unknown_keys = set(route.keys()) - _route_keys
+        if len(unknown_keys) > 0:
+            raise RouteCatalogError(f"{what}: unknown properties {sorted(unknown_keys)}")
+        router: JsonableDict = {}
+        entrypoints = _as_str_list(route.get('entrypoints'), f"{what}: entrypoints")
+        if len(entrypoints) == 0:
+            raise RouteCatalogError(f"{what}: 'entrypoints' is required")
+        router['entryPoints'] = entrypoints
+        router['rule'] = compile_route_rule(route_name, route)
+
+        service = route.get('service')
+        urls = _as_str_list(route.get('urls'), f"{what}: urls")
+        if route.get('url') is not None:
+            urls.insert(0, str(route['url']))
+        if (service is None) == (len(urls) == 0):
+            raise RouteCatalogError(f"{what}: exactly one of 'service' or 'url'/'urls' is required")
+        if service is None:
+            service = route_name
+            if service in services:
+                raise RouteCatalogError(f"{what}: service {service} is already defined")
+            services[service] = dict(loadBalancer=dict(servers=[ dict(url=u) for u in urls ]))
+        router['service'] = str(service)
+
+        middleware_refs: List[str] = []
+        if route.get('strip_prefix'):
+            path_prefix = route.get('path_prefix')
+            if path_prefix is None:
+                raise RouteCatalogError(f"{what}: 'strip_prefix' requires 'path_prefix'")
+            strip_name = f"{route_name}-strip-prefix"
+            middlewares[strip_name] = dict(stripPrefix=dict(prefixes=[ str(path_prefix) ]))
+            local_middlewares.add(strip_name)
+            middleware_refs.append(strip_name)
+        for ref in _as_str_list(route.get('middlewares'), f"{what}: middlewares"):
+            if '@' in ref or ref in local_middlewares:
+                middleware_refs.append(ref)
+            elif ref in docker_middlewares:
+                middleware_refs.append(f"{ref}@docker")
+            else:
+                raise RouteCatalogError(f"{what}: unknown middleware {ref!r}")
+        if len(middleware_refs) > 0:
+            router['middlewares'] = middleware_refs
+
+        priority = route.get('priority')
+        if priority is not None:
+            if isinstance(priority, bool) or not isinstance(priority, (int, str)):
+                raise RouteCatalogError(f"{what}: priority must be an integer")
+            try:
+                router['priority'] = int(priority)
+            except ValueError:
+                raise RouteCatalogError(f"{what}: priority must be an integer") from None
+        tls = route.get('tls')
+        if tls is not None and tls is not False:
+            router['tls'] = {} if tls is True else tls
+        routers[route_name] = router
+
+    http: JsonableDict = {}
+    if len(routers) > 0:
+        http['routers'] = routers
+    if len(middlewares) > 0:
+        http['middlewares'] = middlewares
+    if len(services) > 0:
+        http['services'] = services
+    logger.debug(f"Route catalog {shard_name}: {len(routers)} routers, {len(middlewares)} middlewares, {len(services)} services")
+    return dict(http=http)
@@ -0,0 +1,351 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+Structured status of the containers of hub stacks and Portainer-managed stacks.
+
+Rather than parsing `docker compose ps` text per stack, one container listing finds the
+containers of every stack by their docker-compose labels, and the containers are then
+inspected concurrently to produce typed status records.
+"""
+
+from __future__ import annotations
+
+import re
+import time
+import asyncio
+from datetime import datetime, timezone
+from typing import AsyncIterator
+
+from .internal_types import *
+from .pkg_logging import logger
+from .util import get_docker_containers, inspect_docker_container, get_docker_images, format_table
+
+HUB_STACK_NAMES = ("traefik", "portainer")
+"""The docker-compose project names of the hub stacks"""
+
+PORTAINER_STACK_WORKING_DIR_PREFIX = "/data/compose/"
+"""The working directory prefix that Portainer uses for the stacks it deploys"""
+
+class ContainerStatus:
+    """The status of one docker-compose service container"""
+    stack: str
+    """The docker-compose project name"""
+
+    managed_by: str
+    """"hub" for the hub stacks, or "portainer" for stacks deployed by Portainer"""
+
+    service: str
+    """The docker-compose service name"""
+
+    name: str
+    """The container name"""
+
+    container_id: str
+    """The container ID"""
+
+    state: str
+    """The container state ("running", "exited", "restarting", etc.)"""
+
+    health: Optional[str]
+    """The healthcheck status ("healthy", "unhealthy", "starting"), or None if there is no healthcheck"""
+
+    started_at: Optional[str]
+    """When the container was last started, in ISO 8601 UTC, or None if never started"""
+
+    uptime: Optional[float]
+    """Seconds that the container has been running, or None if it is not running"""
+
+    ports: List[str]
+    """Published ports, e.g., "0.0.0.0:80->80/tcp" """
+
+    image: str
+    """The image name the container was created from"""
+
+    image_id: str
+    """The ID of the image the container is running"""
+
+    image_digest: Optional[str]
+    """The registry digest of the image (e.g., "traefik@sha256:..."), or None if it has none"""
+
+    def __init__(
+            self,
+            stack: str,
+            managed_by: str,
+            service: str,
+            name: str,
+            container_id: str,
+            state: str,
+            health: Optional[str],
+            started_at: Optional[str],
+            uptime: Optional[float],
+            ports: List[str],
+            image: str,
+            image_id: str,
+            image_digest: Optional[str],
+          ):
+        self.stack = stack
+        self.managed_by = managed_by
+        self.service = service
+        self.name = name
+        self.container_id = container_id
+        self.state = state
+        self.health = health
+        self.started_at = started_at
+        self.uptime = uptime
+        self.ports = ports
+        self.image = image
+        self.image_id = image_id
+        self.image_digest = image_digest
+
+    @property
+    def key(self) -> Tuple[str, str, str]:
+        """A key that identifies the container across snapshots"""
+        return (self.stack, self.service, self.name)
+
+    def to_jsonable(self) -> JsonableDict:
+        return dict(
+            stack=self.stack,
+            managed_by=self.managed_by,
+            service=self.service,
+            name=self.name,
+            container_id=self.container_id,
+            state=self.state,
+            health=self.health,
+            started_at=self.started_at,
+            uptime=self.uptime,
+            ports=list(self.ports),
+            image=self.image,
+            image_id=self.image_id,
+            image_digest=self.image_digest,
+          )
+
+_docker_timestamp_re = re.compile(r'^(.*T\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)$')
+
+def _parse_docker_timestamp(s: Optional[str]) -> Optional[datetime]:
+    # Docker timestamps have nanosecond precision, which datetime does not accept
+    if not s:
+        return None
+    m = _docker_timestamp_re.match(s)
+    if m is None:
+        return None
+    fraction = (m.group(2) or '')[:7]
+    tz = '+00:00' if m.group(3) == 'Z' else m.group(3)
+    result = datetime.fromisoformat(m.group(1) + fraction + tz)
+    # Docker reports "0001-01-01T00:00:00Z" for never
+    return None if result.year <= 1 else result.astimezone(timezone.utc)
+
+def _format_ports(port_bindings: Optional[Mapping[str, Any]]) -> List[str]:
+    result: List[str] = []
+    for container_port, bindings in (port_bindings or {}).items():
+        for binding in bindings or []:
+            host_ip = binding.get('HostIp') or '0.0.0.0'
+            if ':' in host_ip:
+                host_ip = f"[{host_ip}]"
+            result.append(f"{host_ip}:{binding.get('HostPort')}->{container_port}")
+    return sorted(result)
+
+def _container_status(data: JsonableDict, image_digests: Mapping[str, List[str]], now: datetime) -> ContainerStatus:
+    config = data.get('Config') or {}
+    labels = config.get('Labels') or {}
+    state = data.get('State') or {}
+    stack = labels.get('com.docker.compose.project', '')
+    working_dir = labels.get('com.docker.compose.project.working_dir', '')
+    health = (state.get('Health') or {}).get('Status')
+    started_at = _parse_docker_timestamp(state.get('StartedAt'))
+    status = state.get('Status', 'unknown')
+    uptime = (now - started_at).total_seconds() if status == 'running' and started_at is not None else None
+    image_id = data.get('Image', '')
+    repo_digests = image_digests.get(image_id) or []
+    return ContainerStatus(
+        stack=stack,
+        managed_by="portainer" if working_dir.startswith(PORTAINER_STACK_WORKING_DIR_PREFIX) else "hub",
+        service=labels.get('com.docker.compose.service', ''),
+        name=data.get('Name', '').lstrip('/'),
+        container_id=data.get('Id', ''),
+        state=status,
+        health=health,
+        started_at=None if started_at is None else started_at.isoformat().replace('+00:00', 'Z'),
+        uptime=uptime,
+        ports=_format_ports((data.get('NetworkSettings') or {}).get('Ports')),
+        image=config.get('Image', ''),
+        image_id=image_id,
+        image_digest=repo_digests[0] if len(repo_digests) > 0 else None,
+      )
+
+def find_stack_containers(
+        stacks: Iterable[str]=HUB_STACK_NAMES,
+        include_portainer_stacks: bool=True,
+        services: Optional[Iterable[str]]=None,
+        all: bool=True,
+      ) -> List[Tuple[str, str, str, str]]:
+    """
+    Find the containers of docker-compose stacks, by their labels, with a single container listing.
+
+    Args:
+        stacks: The docker-compose project names of the stacks. Defaults to the hub stacks.
+        include_portainer_stacks: If True, also include every stack deployed by Portainer.
+        services: If not None, only containers of these services (or with these container names).
+        all: If True, include containers that are not running.
+
+    Returns:
+        (stack, service, name, container_id) tuples, sorted by stack, service and name.
+    """
+    stack_names = set(stacks)
+    service_names = None if services is None else set(services)
+    result: List[Tuple[str, str, str, str]] = []
+    for container in get_docker_containers(all=all, filters={ "label": [ "com.docker.compose.project" ] }):
+        labels = container.get('Labels') or {}
+        project = labels.get('com.docker.compose.project', '')
+        working_dir = labels.get('com.docker.compose.project.working_dir', '')
+        if not (project in stack_names or (
+                include_portainer_stacks and working_dir.startswith(PORTAINER_STACK_WORKING_DIR_PREFIX))):
+            continue
+        service = labels.get('com.docker.compose.service', '')
+        name = (container.get('Names') or [ '' ])[0].lstrip('/')
+        if service_names is not None and service not in service_names and name not in service_names:
+            continue
+        result.append((project, service, name, container['Id']))
+    return sorted(result)
+
+def _inspect_containers(container_ids: List[str]) -> List[JsonableDict]:
+    result: List[JsonableDict] = []
+    for container_id in container_ids:
+        data = inspect_docker_container(container_id)
+        if data is not None:
+            result.append(data)
+    return result
+
+async def get_stack_statuses(
+        stacks: Iterable[str]=HUB_STACK_NAMES,
+        include_portainer_stacks: bool=True,
+      ) -> List[ContainerStatus]:
+    """
+    Get the status of every container of the given stacks, inspecting each stack's containers
+    concurrently.
+
+    Args:
+        stacks: The docker-compose project names of the stacks. Defaults to the hub stacks.
+        include_portainer_stacks: If True, also include every stack deployed by Portainer.
+
+    Returns:
+        Container status records, sorted by stack, service and container name.
+    """
+    containers, images = await asyncio.gather(
+        asyncio.to_thread(find_stack_containers, stacks, include_portainer_stacks=include_portainer_stacks),
+        asyncio.to_thread(get_docker_images),
+      )
+    ids_by_stack: Dict[str, List[str]] = {}
+    for project, _, _, container_id in containers:
+        ids_by_stack.setdefault(project, []).append(container_id)
+    image_digests: Dict[str, List[str]] = { image['Id']: image.get('RepoDigests') or [] for image in images }
+
+    inspected = await asyncio.gather(*(asyncio.to_thread(_inspect_containers, ids) for ids in ids_by_stack.values()))
+    now = datetime.now(timezone.utc)
+    result = [ _container_status(data, image_digests, now) for stack_data in inspected for data in stack_data ]
+    result.sort(key=lambda x: x.key)
+    logger.debug(f"Got status of {len(result)} containers in {len(ids_by_stack)} stacks")
+    return result
+
+def _format_uptime(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    if seconds < 86400:
+        return f"{seconds // 3600}h{(seconds % 3600) // 60:02d}m"
+    return f"{seconds // 86400}d{(seconds % 86400) // 3600:02d}h"
+
+def format_stack_statuses(statuses: List[ContainerStatus]) -> str:
+    """Format container status records as a table"""
+    rows = [ ("STACK", "SERVICE", "STATE", "HEALTH", "UPTIME", "PORTS") ]
+    for s in statuses:
+        rows.append((s.stack, s.service, s.state, s.health or "-", _format_uptime(s.uptime), ", ".join(s.ports)))
+    return format_table(rows)
+
+_DIFF_FIELDS = ("container_id", "state", "health", "ports", "image_id", "image_digest")
+
+def diff_stack_statuses(
+        old: List[ContainerStatus],
+        new: List[ContainerStatus],
+      ) -> List[JsonableDict]:
+    """
+    Compare two status snapshots. Uptime and start time are not compared, since they change
+    on every snapshot; a restart shows up as a state change or a new container ID.
+
+    Returns:
+        A list of changes, each with "change" ("added", "removed" or "changed"), the
+        container's stack, service and name, and for "changed", the old and new values of
+        each field that changed.
+    """
+    old_by_key = { s.key: s for s in old }
+    new_by_key = { s.key: s for s in new }
+    result: List[JsonableDict] = []
+    for key in sorted(set(old_by_key) | set(new_by_key)):
+        stack, service, name = key
+        o = old_by_key.get(key)
+        n = new_by_key.get(key)
+        if o is None:
+            assert n is not None
+            result.append(dict(change="added", stack=stack, service=service, name=name, status=n.to_jsonable()))
+        elif n is None:
+            result.append(dict(change="removed", stack=stack, service=service, name=name))
+        else:
+            o_data = o.to_jsonable()
+            n_data = n.to_jsonable()
+            fields = { field: dict(old=o_data[field], new=n_data[field])
+                       for field in _DIFF_FIELDS if o_data[field] != n_data[field] }
+            if len(fields) > 0:
+                result.append(dict(change="changed", stack=stack, service=service, name=name, fields=fields))
+    return result
+
+def format_stack_status_change(change: JsonableDict) -> str:
+    """Format one change returned by diff_stack_statuses as a line of text"""
+    what = f"{change['stack']}/{change['service']} ({change['name']})"
+    if change['change'] == "added":
+        status = change['status']
+        return f"{what}: added, {status['state']}" + (f" ({status['health']})" if status['health'] else "")
+    if change['change'] == "removed":
+        return f"{what}: removed"
+    parts: List[str] = []
+    for field, values in change['fields'].items():
+        old_value, new_value = values['old'], values['new']
+        if field in ("container_id", "image_id"):
+            old_value = (old_value or '')[:19]
+            new_value = (new_value or '')[:19]
+        parts.append(f"{field} {old_value} -> {new_value}")
+    return f"{what}: " + ", ".join(parts)
+
+async def watch_stack_statuses(
+        interval: float=2.0,
+        stacks: Iterable[str]=HUB_STACK_NAMES,
+        include_portainer_stacks: bool=True,
+      ) -> AsyncIterator[Tuple[List[ContainerStatus], List[JsonableDict]]]:
+    """
+    Poll stack status, yielding the first snapshot with no changes, and then each later
+    snapshot that differs from its predecessor along with the changes.
+
+    Args:
+        interval: Seconds between polls.
+        stacks: As for get_stack_statuses.
+        include_portainer_stacks: As for get_stack_statuses.
+    """
+    stacks = list(stacks)
+    poll_time = time.monotonic()
+    previous = await get_stack_statuses(stacks, include_portainer_stacks=include_portainer_stacks)
+    yield previous, []
+    while True:
+        # Poll at a steady rate, regardless of how long each poll takes
+        await asyncio.sleep(max(0.0, poll_time + interval - time.monotonic()))
+        poll_time = time.monotonic()
+        current = await get_stack_statuses(stacks, include_portainer_stacks=include_portainer_stacks)
+        changes = diff_stack_statuses(previous, current)
+        if len(changes) > 0:
+            yield current, changes
+        previous = current
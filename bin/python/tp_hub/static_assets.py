@@ -0,0 +1,326 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+Transformations for static web assets: minification, content-hash fingerprinting,
+reference rewriting, and precompression.
+
+Minification is deliberately conservative; every transformation preserves the rendered
+result. HTML and SVG lose comments and redundant whitespace in text nodes (except inside
+<pre>, <textarea>, <script> and <style>); CSS loses comments and redundant whitespace; JSON
+is re-serialized compactly. JavaScript is passed through unchanged, since it cannot be
+safely minified without a real parser.
+"""
+
+from __future__ import annotations
+
+import re
+import gzip
+import json
+import hashlib
+import posixpath
+
+from .internal_types import *
+from .pkg_logging import logger
+
+try:
+    import brotli  # type: ignore[import]
+except ImportError:
+    brotli = None
+
+FINGERPRINT_LENGTH = 10
+"""The number of hex digits of the content hash inserted into fingerprinted filenames"""
+
+MIN_COMPRESS_SIZE = 256
+"""Files smaller than this are not precompressed"""
+
+COMPRESSIBLE_EXTENSIONS = {
+    '.html', '.htm', '.css', '.js', '.mjs', '.json', '.map', '.svg', '.xml', '.txt',
+    '.webmanifest', '.ico', '.wasm', '.ttf', '.otf', '.eot',
+  }
+"""Extensions of files that are worth precompressing"""
+
+FIXED_URL_NAMES = { 'favicon.ico', 'robots.txt', 'humans.txt', 'sitemap.xml', 'asset-manifest.json' }
+"""Filenames that are fetched at well-known URLs and are never fingerprinted"""
+
+HTML_EXTENSIONS = ('.html', '.htm')
+
+def is_brotli_available() -> bool:
+    """Return True if the optional brotli package is installed"""
+    return brotli is not None
+
+def get_asset_ext(rel_path: str) -> str:
+    return posixpath.splitext(rel_path)[1].lower()
+
+def is_fingerprintable(rel_path: str) -> bool:
+    """
+    Return True if an asset should get a content-hashed name. HTML documents and files that
+    are fetched at well-known URLs keep only their original names.
+    """
+    return not (
+        get_asset_ext(rel_path) in HTML_EXTENSIONS or
+        posixpath.basename(rel_path) in FIXED_URL_NAMES or
+        rel_path.startswith('.well-known/')
+      )
+
+def get_fingerprinted_path(rel_path: str, data: bytes) -> str:
+    """Get the content-hashed name for an asset, e.g., "css/site.css" -> "css/site.0123456789.css"."""
+    stem, ext = posixpath.splitext(rel_path)
+    digest = hashlib.sha256(data).hexdigest()[:FINGERPRINT_LENGTH]
+    return f"{stem}.{digest}{ext}"
+
+_markup_token_re = re.compile(
+    r'(?P<comment><!--.*?-->)|'
+    r'(?P<cdata><!\[CDATA\[.*?\]\]>)|'
+    r'(?P<raw><(?P<raw_tag>pre|textarea|script|style)\b(?:[^>"\']|"[^"]*"|\'[^\']*\')*>.*?</(?P=raw_tag)\s*>)|'
+    r'(?P<tag><(?:[^>"\']|"[^"]*"|\'[^\']*\')*>)',
+    re.DOTALL | re.IGNORECASE,
+  )
+_whitespace_re = re.compile(r'\s+')
+_style_body_re = re.compile(r'^(<style\b[^>]*>)(.*)(</style\s*>)$', re.DOTALL | re.IGNORECASE)
+
+def _collapse_text_whitespace(text: str) -> str:
+    return _whitespace_re.sub(lambda m: '\n' if '\n' in m.group(0) else ' ', text)
+
+def minify_markup(text: str) -> str:
+    """
+    Minify HTML or SVG: remove comments (other than conditional comments) and collapse
+    whitespace runs in text nodes to a single character. Tags and the content of raw-text
+    elements are preserved, except that inline <style> content is minified as CSS.
+    """
+    result: List[str] = []
+    # Text on both sides of a removed comment is collapsed as one text node
+    pending_text: List[str] = []
+    pos = 0
+    for m in _markup_token_re.finditer(text):
+        pending_text.append(text[pos:m.start()])
+        pos = m.end()
+        token = m.group(0)
+        if m.group('comment') is not None and not (token.startswith('<!--[if') or token.startswith('<!--<!')):
+            continue
+        result.append(_collapse_text_whitespace(''.join(pending_text)))
+        pending_text.clear()
+        if m.group('raw') is not None and m.group('raw_tag').lower() == 'style':
+            sm = _style_body_re.match(token)
+            result.append(token if sm is None else sm.group(1) + minify_css(sm.group(2)) + sm.group(3))
+        else:
+            result.append(token)
+    pending_text.append(text[pos:])
+    result.append(_collapse_text_whitespace(''.join(pending_text)))
+    return ''.join(result).strip() + '\n'
+
+_css_token_re = re.compile(
+    r'(?P<string>"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|'
+    r'(?P<comment>/\*.*?\*/)|'
+    r'(?P<space>\s+)',
+    re.DOTALL,
+  )
+_css_punct_re = re.compile(r'\s*([{};,])\s*')
+_css_colon_re = re.compile(r':\s+')
+
+def minify_css(text: str) -> str:
+    """
+    Minify CSS: remove comments (other than "/*! ... */" license comments), collapse
+    whitespace, remove whitespace around "{", "}", ";" and "," and after ":", and drop the last ";" in
+    each block. String literals are preserved.
+    """
+    chunks: List[Tuple[bool, str]] = []
+    pos = 0
+    for m in _css_token_re.finditer(text):
+        chunks.append((False, text[pos:m.start()]))
+        if m.group('string') is not None:
+            chunks.append((True, m.group(0)))
+        elif m.group('comment') is not None:
+            if m.group(0).startswith('/*!'):
+                chunks.append((True, m.group(0)))
+            else:
+                chunks.append((False, ' '))
+        else:
+            chunks.append((False, ' '))
+        pos = m.end()
+    chunks.append((False, text[pos:]))
+
+    result: List[str] = []
+    pending: List[str] = []
+    def flush() -> None:
+        code = _whitespace_re.sub(' ', ''.join(pending))
+        code = _css_punct_re.sub(r'\1', code)
+        # Whitespace before ":" can be a descendant combinator in a selector, but whitespace after it never matters
+        code = _css_colon_re.sub(':', code)
+        code = code.replace(';}', '}')
+        result.append(code)
+        pending.clear()
+    for is_literal, chunk in chunks:
+        if is_literal:
+            flush()
+            result.append(chunk)
+        else:
+            pending.append(chunk)
+    flush()
+    return ''.join(result).strip()
+
+def minify_json(text: str) -> str:
+    """Re-serialize JSON compactly, preserving key order. Invalid JSON is returned unchanged."""
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return text
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+def minify_asset(rel_path: str, data: bytes) -> bytes:
+    """Minify an asset according to its extension. Unknown types and non-UTF-8 content are unchanged."""
+    ext = get_asset_ext(rel_path)
+    if ext in HTML_EXTENSIONS or ext == '.svg':
+        minify: Optional[Callable[[str], str]] = minify_markup
+    elif ext == '.css':
+        minify = minify_css
+    elif ext in ('.json', '.webmanifest', '.map'):
+        minify = minify_json
+    else:
+        minify = None
+    if minify is None:
+        return data
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data
+    result = minify(text).encode('utf-8')
+    return result if len(result) < len(data) else data
+
+_html_ref_re = re.compile(r'(?P<prefix>\b(?:src|href|poster)\s*=\s*)(?P<quote>["\'])(?P<ref>[^"\']*)(?P=quote)', re.IGNORECASE)
+_css_ref_re = re.compile(r'(?P<prefix>url\(\s*)(?P<quote>["\']?)(?P<ref>[^"\')]+)(?P=quote)(?P<suffix>\s*\))', re.IGNORECASE)
+_external_ref_re = re.compile(r'^(?:[A-Za-z][A-Za-z0-9+.-]*:|//|#)')
+
+def _resolve_ref(rel_path: str, ref: str) -> Optional[Tuple[str, str]]:
+    """Resolve a reference from an asset to (logical path, query-and-fragment suffix), or None if not local"""
+    ref = ref.strip()
+    if ref == '' or _external_ref_re.match(ref):
+        return None
+    cut = min((i for i in (ref.find('?'), ref.find('#')) if i >= 0), default=len(ref))
+    path, suffix = ref[:cut], ref[cut:]
+    if path == '':
+        return None
+    if path.startswith('/'):
+        logical = posixpath.normpath(path.lstrip('/'))
+    else:
+        logical = posixpath.normpath(posixpath.join(posixpath.dirname(rel_path), path))
+    if logical.startswith('../'):
+        return None
+    return logical, suffix
+
+def rewrite_asset_refs(
+        rel_path: str,
+        data: bytes,
+        manifest: Mapping[str, str],
+      ) -> Tuple[bytes, Dict[str, Optional[str]]]:
+    """
+    Rewrite references in an HTML or CSS asset to point at fingerprinted names.
+
+    Args:
+        rel_path: The asset's path relative to the site root, with "/" separators.
+        data: The asset content.
+        manifest: Map from logical asset path to fingerprinted path.
+
+    Returns:
+        A tuple (new_data, deps), where deps maps every local path referenced by the asset
+        to its fingerprinted path, or None if it is not fingerprinted. An asset must be
+        rewritten again if any of its dependencies change.
+    """
+    ext = get_asset_ext(rel_path)
+    if ext in HTML_EXTENSIONS:
+        ref_re = _html_ref_re
+    elif ext == '.css':
+        ref_re = _css_ref_re
+    else:
+        return data, {}
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data, {}
+    deps: Dict[str, Optional[str]] = {}
+
+    def replace(m: re.Match) -> str:
+        ref = m.group('ref')
+        resolved = _resolve_ref(rel_path, ref)
+        if resolved is None:
+            return m.group(0)
+        logical, suffix = resolved
+        hashed = manifest.get(logical)
+        deps[logical] = hashed
+        if hashed is None:
+            return m.group(0)
+        if ref.strip().startswith('/'):
+            new_ref = '/' + hashed
+        else:
+            new_ref = posixpath.relpath(hashed, posixpath.dirname(rel_path) or '.')
+        return m.group(0).replace(ref, new_ref + suffix, 1)
+
+    text = ref_re.sub(replace, text)
+    return text.encode('utf-8'), deps
+
+def compress_asset(rel_path: str, data: bytes) -> Dict[str, bytes]:
+    """
+    Precompress an asset. Returns a map from encoding suffix (".gz", ".br") to compressed
+    data, containing only encodings that save at least 10%. Compression is deterministic, so
+    unchanged inputs produce unchanged outputs.
+    """
+    result: Dict[str, bytes] = {}
+    if get_asset_ext(rel_path) not in COMPRESSIBLE_EXTENSIONS or len(data) < MIN_COMPRESS_SIZE:
+        return result
+    limit = len(data) * 0.9
+    gz_data = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz_data) <= limit:
+        result['.gz'] = gz_data
+    if brotli is not None:
+        br_data = brotli.compress(data, quality=11)
+        if len(br_data) <= limit:
+            result['.br'] = br_data
+    return result
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+"""Cache-Control for fingerprinted assets, whose content never changes"""
+
+REVALIDATE_CACHE_CONTROL = "public, no-cache"
+"""Cache-Control for assets with stable names, which browsers must revalidate before use"""
+
+def _toml_str(s: str) -> str:
+    return json.dumps(s)
+
+def make_static_web_server_config(root: str, fingerprinted_paths: Iterable[str]) -> str:
+    """
+    Generate a static-web-server TOML config that serves precompressed files and sets
+    long-lived cache headers on fingerprinted assets and revalidation on everything else.
+
+    Args:
+        root: The directory of the site inside the static-web-server container.
+        fingerprinted_paths: The fingerprinted asset paths, relative to the site root.
+    """
+    lines: List[str] = [
+        "# static-web-server configuration",
+        "#",
+        "# Auto-generated by `hub build`. DO NOT EDIT!",
+        "#",
+        "[general]",
+        f"root = {_toml_str(root)}",
+        "compression-static = true",
+        "cache-control-headers = false",
+        "",
+        "[advanced]",
+        "",
+        "[[advanced.headers]]",
+        'source = "**"',
+        "[advanced.headers.headers]",
+        f"Cache-Control = {_toml_str(REVALIDATE_CACHE_CONTROL)}",
+      ]
+    for rel_path in sorted(fingerprinted_paths):
+        lines += [
+            "",
+            "[[advanced.headers]]",
+            f"source = {_toml_str('**/' + rel_path)}",
+            "[advanced.headers.headers]",
+            f"Cache-Control = {_toml_str(IMMUTABLE_CACHE_CONTROL)}",
+          ]
+    return "\n".join(lines) + "\n"
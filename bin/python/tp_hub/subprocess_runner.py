@@ -0,0 +1,427 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+The central runner for the subprocesses the hub forks (docker, docker compose, ip, sudo, sg).
+
+The functions here are drop-in replacements for the project_init_tools.util sudo_* functions
+(and subprocess.check_call/Popen). Commands to be run with the "docker" group use the docker
+group broker when it is in use (see docker_group_broker.py), rather than `sg docker`.
+
+When subprocess tracing is enabled, each invocation is recorded with its argv (secrets
+redacted), wall time, exit code and the bytes sent to and received from it, and can be
+logged live, written to a JSONL trace file, and summarized in a table at the end of a
+command. When tracing is disabled, the only overhead is a flag test.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import json
+import time
+import shlex
+import threading
+import subprocess
+from contextlib import contextmanager
+
+from project_init_tools import util as _pit_util
+
+from .internal_types import *
+from .docker_group_broker import get_docker_group_broker
+
+REDACTED = "***"
+"""The replacement for redacted argv values"""
+
+_secret_name_re = re.compile(r'(pass(word|wd)?|secret|token|api[-_]?key|credential|auth)', re.IGNORECASE)
+_bcrypt_re = re.compile(r'\$2[abxy]?\$\d\d\$[./A-Za-z0-9]{53}')
+
+# Options whose value is the next argument, so it is not mistaken for a subcommand
+_OPTIONS_WITH_VALUES = {
+    "-f", "--file", "-p", "--project-name", "--project-directory", "--env-file", "--profile",
+    "--parallel", "--progress", "-H", "--host", "--context", "--config", "--log-level",
+  }
+
+def _redact_arg(arg: str) -> str:
+    name, sep, _ = arg.partition('=')
+    if sep != '' and _secret_name_re.search(name):
+        return f"{name}={REDACTED}"
+    return _bcrypt_re.sub(REDACTED, arg)
+
+def redact_argv(argv: Sequence[str]) -> List[str]:
+    """
+    Redact secrets from a command line: values of options and NAME=VALUE assignments whose
+    name looks secret (password, secret, token, ...), and password hashes. The command
+    string of `sg <group> -c <command>` and `sh -c <script>` is redacted recursively.
+    """
+    result: List[str] = []
+    redact_next = False
+    split_next = False
+    for arg in argv:
+        if redact_next:
+            result.append(REDACTED)
+            redact_next = False
+        elif split_next:
+            try:
+                result.append(shlex.join(redact_argv(shlex.split(arg))))
+            except ValueError:
+                result.append(_redact_arg(arg))
+            split_next = False
+        else:
+            result.append(_redact_arg(arg))
+            if arg.startswith('-') and '=' not in arg and _secret_name_re.search(arg) and not arg.endswith("-stdin"):
+                redact_next = True
+            elif arg == "-c" and len(result) > 1:
+                split_next = True
+    return result
+
+def get_subprocess_command_key(argv: Sequence[str]) -> str:
+    """
+    Get a short name that groups similar invocations for the summary; e.g., "docker inspect",
+    "docker compose up", "ip route". `sudo` and `sg <group> -c` wrappers are looked through.
+    """
+    tokens = list(argv)
+    while len(tokens) > 0:
+        if os.path.basename(tokens[0]) == "sudo":
+            tokens = [ x for x in tokens[1:] if not x.startswith('-') ] if len(tokens) > 1 else []
+        elif os.path.basename(tokens[0]) == "sg" and len(tokens) >= 4 and tokens[2] == "-c":
+            try:
+                tokens = shlex.split(tokens[3])
+            except ValueError:
+                break
+        else:
+            break
+    if len(tokens) == 0:
+        return "?"
+    words = [ os.path.basename(tokens[0]) ]
+    max_words = 3 if words[0] == "docker" and "compose" in tokens[1:3] else 2
+    skip_value = False
+    for token in tokens[1:]:
+        if len(words) >= max_words:
+            break
+        if skip_value:
+            skip_value = False
+        elif token.startswith('-'):
+            skip_value = token in _OPTIONS_WITH_VALUES
+        else:
+            words.append(token)
+    return " ".join(words)
+
+class SubprocessRecord:
+    """The trace record of one subprocess invocation"""
+    argv: List[str]
+    """The command line, with secrets redacted"""
+
+    key: str
+    """The command name used to group invocations in the summary; see get_subprocess_command_key"""
+
+    kind: str
+    """How it was run: "call", "output", "popen" or "async" """
+
+    start_time: float
+    """When it was started, as a UNIX time"""
+
+    duration: Optional[float]
+    """Seconds from start until it exited, or None if still running"""
+
+    exit_code: Optional[int]
+    """The exit code, or None if it could not be started or was not waited for"""
+
+    bytes_in: Optional[int]
+    """The number of bytes written to its stdin, or None if not known"""
+
+    bytes_out: Optional[int]
+    """The number of bytes read from its stdout and stderr, or None if not known (e.g., not captured)"""
+
+    error: Optional[str]
+    """An error that prevented it from running, if any"""
+
+    def __init__(self, argv: Sequence[str], kind: str):
+        self.argv = redact_argv(argv)
+        self.key = get_subprocess_command_key(self.argv)
+        self.kind = kind
+        self.start_time = time.time()
+        self.duration = None
+        self.exit_code = None
+        self.bytes_in = None
+        self.bytes_out = None
+        self.error = None
+
+    def to_jsonable(self) -> JsonableDict:
+        return dict(
+            argv=list(self.argv),
+            key=self.key,
+            kind=self.kind,
+            start_time=self.start_time,
+            duration=self.duration,
+            exit_code=self.exit_code,
+            bytes_in=self.bytes_in,
+            bytes_out=self.bytes_out,
+            error=self.error,
+          )
+
+def _len_of(data: Any) -> Optional[int]:
+    return len(data) if isinstance(data, (bytes, bytearray, str)) else None
+
+def _add_len(total: Optional[int], data: Any) -> Optional[int]:
+    n = _len_of(data)
+    if n is None:
+        return total
+    return n if total is None else total + n
+
+class SubprocessTracer:
+    """Collects subprocess trace records, and optionally logs them live and to a JSONL file"""
+    enabled: bool
+    """True if invocations are being recorded"""
+
+    live_out: Optional[IO[str]]
+    """Where each invocation is logged as it finishes, or None"""
+
+    jsonl_out: Optional[IO[str]]
+    """Where each record is written as a JSON line as it finishes, or None"""
+
+    records: List[SubprocessRecord]
+    """Records of finished invocations, in order of completion"""
+
+    start_time: float
+    """When tracing was enabled, as a UNIX time"""
+
+    _lock: threading.Lock
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.live_out = None
+        self.jsonl_out = None
+        self.records = []
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def enable(self, live_out: Optional[IO[str]]=None, jsonl_pathname: Optional[str]=None) -> None:
+        """
+        Start recording subprocess invocations.
+
+        Args:
+            live_out: If not None, each invocation is logged to this stream as it finishes.
+            jsonl_pathname: If not None, each record is appended to this file as a JSON line.
+        """
+        with self._lock:
+            self.enabled = True
+            self.start_time = time.time()
+            self.live_out = live_out
+            if jsonl_pathname is not None:
+                self.jsonl_out = open(jsonl_pathname, 'a', encoding='utf-8')
+
+    def close(self) -> None:
+        """Stop recording, and close the JSONL file"""
+        with self._lock:
+            self.enabled = False
+            if self.jsonl_out is not None:
+                self.jsonl_out.close()
+                self.jsonl_out = None
+
+    def finish(self, record: SubprocessRecord) -> None:
+        """Record a finished invocation"""
+        # util runs its subprocesses through this module, so import it late
+        from .util import format_bytes
+        if record.duration is None:
+            record.duration = time.time() - record.start_time
+        with self._lock:
+            self.records.append(record)
+            if self.live_out is not None:
+                status = "error" if record.error is not None else f"exit={record.exit_code}"
+                self.live_out.write(
+                    f"[subprocess +{record.start_time - self.start_time:.3f}s] {record.duration:.3f}s {status}"
+                    f" in={format_bytes(record.bytes_in)} out={format_bytes(record.bytes_out)}"
+                    f" {shlex.join(record.argv)}\n"
+                  )
+                self.live_out.flush()
+            if self.jsonl_out is not None:
+                self.jsonl_out.write(json.dumps(record.to_jsonable()) + "\n")
+                self.jsonl_out.flush()
+
+    def format_summary(self, wall_time: Optional[float]=None) -> str:
+        """
+        Format a table of invocations grouped by command, slowest total first.
+
+        Args:
+            wall_time: The wall time of the whole command, for comparison. Defaults to the
+                time since tracing was enabled.
+        """
+        from .util import format_bytes, format_table
+        if wall_time is None:
+            wall_time = time.time() - self.start_time
+        with self._lock:
+            records = list(self.records)
+        groups: Dict[str, List[SubprocessRecord]] = {}
+        for record in records:
+            groups.setdefault(record.key, []).append(record)
+
+        def total_bytes(rs: List[SubprocessRecord], attr: str) -> Optional[int]:
+            values = [ getattr(r, attr) for r in rs if getattr(r, attr) is not None ]
+            return sum(values) if len(values) > 0 else None
+
+        rows = [ ("COMMAND", "CALLS", "FAILED", "TOTAL", "MEAN", "MAX", "IN", "OUT") ]
+        for key, rs in sorted(groups.items(), key=lambda x: -sum(r.duration or 0.0 for r in x[1])):
+            durations = [ r.duration or 0.0 for r in rs ]
+            rows.append((
+                key,
+                str(len(rs)),
+                str(sum(1 for r in rs if r.exit_code != 0)),
+                f"{sum(durations):.3f}s",
+                f"{sum(durations) / len(durations):.3f}s",
+                f"{max(durations):.3f}s",
+                format_bytes(total_bytes(rs, 'bytes_in')),
+                format_bytes(total_bytes(rs, 'bytes_out')),
+              ))
+        total = sum(r.duration or 0.0 for r in records)
+        return (
+            format_table(rows, left_columns=1) +
+            f"\n{len(records)} subprocesses took {total:.3f}s in total, during {wall_time:.3f}s of wall time"
+          )
+
+_tracer = SubprocessTracer()
+
+def get_subprocess_tracer() -> SubprocessTracer:
+    """Get the process-wide subprocess tracer"""
+    return _tracer
+
+@contextmanager
+def trace_subprocess(argv: Sequence[str], kind: str) -> Generator[Optional[SubprocessRecord], None, None]:
+    """
+    A context manager that records one subprocess invocation that runs within it.
+
+    Yields the record, or None if tracing is disabled. The caller may set its exit_code,
+    bytes_in and bytes_out; a CalledProcessError raised from within supplies the exit code,
+    and any other exception is recorded as an error.
+    """
+    if not _tracer.enabled:
+        yield None
+        return
+    record = SubprocessRecord(argv, kind)
+    try:
+        yield record
+    except subprocess.CalledProcessError as e:
+        record.exit_code = e.returncode
+        record.bytes_out = _add_len(_add_len(record.bytes_out, e.output), e.stderr)
+        raise
+    except BaseException as e:
+        record.error = f"{e.__class__.__name__}: {e}"
+        raise
+    finally:
+        _tracer.finish(record)
+
+def _use_docker_group_broker(kwargs: Dict[str, Any]) -> None:
+    # Rather than wrapping each docker command in `sg docker`, point it at the broker
+    if kwargs.get('run_with_group') == "docker":
+        broker = get_docker_group_broker()
+        if broker is not None:
+            kwargs['run_with_group'] = None
+            kwargs['env'] = broker.get_env(kwargs.get('env'))
+
+def _traced_call(fn: Callable[..., Any], kind: str, args: Sequence[str], kwargs: Dict[str, Any]) -> Any:
+    _use_docker_group_broker(kwargs)
+    with trace_subprocess(args, kind) as record:
+        result = fn(args, **kwargs)
+        if record is not None:
+            record.exit_code = result if kind == "call" and isinstance(result, int) else 0
+            record.bytes_in = _len_of(kwargs.get('input'))
+            record.bytes_out = _len_of(result) if kind == "output" else None
+        return result
+
+def sudo_check_call(args: Sequence[str], **kwargs: Any) -> int:
+    """project_init_tools.util.sudo_check_call, traced"""
+    return _traced_call(_pit_util.sudo_check_call, "call", args, kwargs)
+
+def sudo_check_output(args: Sequence[str], **kwargs: Any) -> bytes:
+    """project_init_tools.util.sudo_check_output, traced. Returns bytes; no caller passes text=True."""
+    return _traced_call(_pit_util.sudo_check_output, "output", args, kwargs)
+
+def sudo_check_call_stderr_exception(args: Sequence[str], **kwargs: Any) -> int:
+    """project_init_tools.util.sudo_check_call_stderr_exception, traced"""
+    return _traced_call(_pit_util.sudo_check_call_stderr_exception, "call", args, kwargs)
+
+def sudo_check_output_stderr_exception(args: Sequence[str], **kwargs: Any) -> bytes:
+    """project_init_tools.util.sudo_check_output_stderr_exception, traced. Returns bytes; no caller passes text=True."""
+    return _traced_call(_pit_util.sudo_check_output_stderr_exception, "output", args, kwargs)
+
+def check_call(args: Sequence[str], **kwargs: Any) -> int:
+    """subprocess.check_call, traced"""
+    return _traced_call(subprocess.check_call, "call", args, kwargs)
+
+class TracedPopen:
+    """
+    A proxy for a subprocess.Popen that records the invocation when it is waited for.
+    Bytes are counted for data passed through communicate(); data read or written through
+    the pipe attributes directly is not counted.
+    """
+    proc: subprocess.Popen
+    """The underlying process"""
+
+    record: SubprocessRecord
+    """The trace record"""
+
+    def __init__(self, proc: subprocess.Popen, record: SubprocessRecord):
+        self.proc = proc
+        self.record = record
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.proc, name)
+
+    def _check_finished(self) -> None:
+        if self.proc.returncode is not None and self.record.exit_code is None:
+            self.record.exit_code = self.proc.returncode
+            _tracer.finish(self.record)
+
+    def poll(self) -> Optional[int]:
+        result = self.proc.poll()
+        self._check_finished()
+        return result
+
+    def wait(self, timeout: Optional[float]=None) -> int:
+        result = self.proc.wait(timeout=timeout)
+        self._check_finished()
+        return result
+
+    def communicate(self, input: Any=None, timeout: Optional[float]=None) -> Tuple[Any, Any]:
+        self.record.bytes_in = _add_len(self.record.bytes_in, input)
+        stdout_data, stderr_data = self.proc.communicate(input, timeout=timeout)
+        self.record.bytes_out = _add_len(_add_len(self.record.bytes_out, stdout_data), stderr_data)
+        self._check_finished()
+        return stdout_data, stderr_data
+
+    def __enter__(self) -> TracedPopen:
+        self.proc.__enter__()
+        return self
+
+    def __exit__(
+            self,
+            exc_type: Optional[Type[BaseException]],
+            exc_val: Optional[BaseException],
+            exc_tb: Optional[TracebackType],
+          ) -> None:
+        self.proc.__exit__(exc_type, exc_val, exc_tb)
+        self._check_finished()
+
+def _traced_popen(fn: Callable[..., subprocess.Popen], args: Sequence[str], kwargs: Dict[str, Any]) -> Any:
+    _use_docker_group_broker(kwargs)
+    if not _tracer.enabled:
+        return fn(args, **kwargs)
+    record = SubprocessRecord(args, "popen")
+    try:
+        proc = fn(args, **kwargs)
+    except BaseException as e:
+        record.error = f"{e.__class__.__name__}: {e}"
+        _tracer.finish(record)
+        raise
+    return TracedPopen(proc, record)
+
+def sudo_Popen(args: Sequence[str], **kwargs: Any) -> subprocess.Popen:
+    """project_init_tools.util.sudo_Popen, traced"""
+    return _traced_popen(_pit_util.sudo_Popen, args, kwargs)
+
+def Popen(args: Sequence[str], **kwargs: Any) -> subprocess.Popen:
+    """subprocess.Popen, traced"""
+    return _traced_popen(subprocess.Popen, args, kwargs)
@@ -0,0 +1,252 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+Rolling replacement of the Traefik container, with a load probe that measures the requests
+that fail during the switch.
+
+Docker cannot publish the same host ports from two containers at once, so the new instance
+cannot take over the ports while the old one still holds them. Instead, while the old
+instance keeps serving, a canary Traefik container is started from the new image with the new
+configuration, on the traefik network but with no published ports, and must pass its /ping
+healthcheck. This pulls the image, and validates the static configuration and the dynamic
+configuration it loads, before anything is disturbed; if the canary fails, the old instance
+is left running. Only then is the stack's Traefik container recreated, which, with the image
+local and the configuration known-good, leaves a gap of about one container restart.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+import shlex
+import threading
+import http.client
+
+from .internal_types import *
+from .pkg_logging import logger
+from .docker_compose_stack import DockerComposeStack
+from .compose_model import get_compose_model
+from .readiness import http_get_status
+from .util import docker_call_output, inspect_docker_container, get_docker_container_logs, format_table
+
+TRAEFIK_CANARY_CONTAINER_NAME = "traefik-canary"
+"""The name of the canary Traefik container"""
+
+DEFAULT_CANARY_TIMEOUT = 60.0
+"""Default seconds to wait for the canary to become healthy"""
+
+def get_traefik_probe_urls(host: str="127.0.0.1") -> List[str]:
+    """Get a URL for each Traefik entrypoint published on this host, for a LoadProbe"""
+    return [
+        f"http://{host}:80/",
+        f"https://{host}:443/",
+        f"http://{host}:7082/",
+        f"http://{host}:8080/",
+      ]
+
+class LoadProbeResult:
+    """The outcome of probing one URL"""
+    url: str
+    """The URL probed"""
+
+    requests: int
+    """The number of requests made"""
+
+    failed: int
+    """The number of requests that got no HTTP response (refused, reset or timed out)"""
+
+    longest_outage: float
+    """The longest time, in seconds, from a failed request until the next successful one"""
+
+    last_error: Optional[str]
+    """The last failure, if any"""
+
+    def __init__(self, url: str, requests: int, failed: int, longest_outage: float, last_error: Optional[str]):
+        self.url = url
+        self.requests = requests
+        self.failed = failed
+        self.longest_outage = longest_outage
+        self.last_error = last_error
+
+    def to_jsonable(self) -> JsonableDict:
+        return dict(
+            url=self.url,
+            requests=self.requests,
+            failed=self.failed,
+            longest_outage=self.longest_outage,
+            last_error=self.last_error,
+          )
+
+class LoadProbe:
+    """
+    Sends requests to URLs at a steady rate on background threads, counting those that get
+    no HTTP response. Any HTTP response, including an error status, counts as served.
+    """
+    urls: List[str]
+    """The URLs to probe, each on its own thread"""
+
+    rate: float
+    """Requests per second per URL"""
+
+    timeout: float
+    """Seconds before a request is counted as failed"""
+
+    _samples: Dict[str, List[Tuple[float, Optional[str]]]]
+    _stopping: threading.Event
+    _threads: List[threading.Thread]
+    _end_time: Optional[float]
+
+    def __init__(self, urls: Iterable[str], rate: float=20.0, timeout: float=1.0):
+        self.urls = list(urls)
+        self.rate = rate
+        self.timeout = timeout
+        self._samples = { url: [] for url in self.urls }
+        self._stopping = threading.Event()
+        self._threads = []
+        self._end_time = None
+
+    def _run(self, url: str) -> None:
+        samples = self._samples[url]
+        interval = 1.0 / self.rate
+        next_time = time.monotonic()
+        while not self._stopping.is_set():
+            start_time = time.monotonic()
+            error: Optional[str] = None
+            try:
+                http_get_status(url, timeout=self.timeout)
+            except (OSError, http.client.HTTPException) as e:
+                error = f"{type(e).__name__}: {e}"
+            samples.append((start_time, error))
+            next_time = max(next_time + interval, time.monotonic())
+            self._stopping.wait(next_time - time.monotonic())
+
+    def start(self) -> None:
+        for url in self.urls:
+            thread = threading.Thread(target=self._run, args=(url,), name=f"probe-{url}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout=self.timeout + 5.0)
+        self._end_time = time.monotonic()
+
+    def __enter__(self) -> LoadProbe:
+        self.start()
+        return self
+
+    def __exit__(
+            self,
+            exc_type: Optional[type[BaseException]],
+            exc_val: Optional[BaseException],
+            exc_tb: Optional[TracebackType],
+          ) -> None:
+        self.stop()
+
+    def get_results(self) -> List[LoadProbeResult]:
+        """Summarize the requests made so far to each URL"""
+        end_time = time.monotonic() if self._end_time is None else self._end_time
+        result: List[LoadProbeResult] = []
+        for url in self.urls:
+            samples = list(self._samples[url])
+            failed = 0
+            longest_outage = 0.0
+            outage_start: Optional[float] = None
+            last_error: Optional[str] = None
+            for sample_time, error in samples:
+                if error is not None:
+                    failed += 1
+                    last_error = error
+                    if outage_start is None:
+                        outage_start = sample_time
+                elif outage_start is not None:
+                    longest_outage = max(longest_outage, sample_time - outage_start)
+                    outage_start = None
+            if outage_start is not None:
+                longest_outage = max(longest_outage, end_time - outage_start)
+            result.append(LoadProbeResult(url, len(samples), failed, longest_outage, last_error))
+        return result
+
+def format_load_probe_results(results: List[LoadProbeResult]) -> str:
+    """Format load probe results as a table"""
+    rows = [ ("URL", "REQUESTS", "FAILED", "LONGEST OUTAGE") ]
+    for r in results:
+        rows.append((r.url, str(r.requests), str(r.failed), f"{r.longest_outage:.2f}s"))
+    return format_table(rows, left_columns=1)
+
+def get_traefik_canary_run_args(stack: DockerComposeStack, service_name: str="traefik") -> List[str]:
+    """
+    Get the `docker run` arguments for a canary of a stack's Traefik service: the service's
+    image, command and bind mounts, on its networks, with a fast healthcheck, but with no
+    published ports, no named volumes (so it cannot touch the ACME store), and none of the
+    service's labels (so no Traefik routes to it).
+    """
+    service = get_compose_model(stack).services.get(service_name)
+    if service is None:
+        raise HubError(f"Stack '{stack.name}' has no service '{service_name}'")
+    if not service.image:
+        raise HubError(f"Service '{service_name}' of stack '{stack.name}' has no image")
+    args = [ "run", "--detach", "--name", TRAEFIK_CANARY_CONTAINER_NAME, "--label", "tp-hub.canary=traefik" ]
+    for network in service.networks[:1]:
+        args += [ "--network", network ]
+    for volume in service.volumes:
+        if volume.type == "bind" and volume.source is not None:
+            args += [ "--volume", f"{volume.source}:{volume.target}:{'ro' if volume.read_only else 'rw'}" ]
+    test = (service.data.get('healthcheck') or {}).get('test')
+    if isinstance(test, list) and len(test) > 1 and test[0] in ("CMD", "CMD-SHELL"):
+        health_cmd = shlex.join(test[1:]) if test[0] == "CMD" else test[1]
+        args += [ "--health-cmd", health_cmd, "--health-interval", "1s", "--health-retries", "30", "--health-timeout", "3s" ]
+    args.append(service.image)
+    command = service.data.get('command') or []
+    args += shlex.split(command) if isinstance(command, str) else [ str(x) for x in command ]
+    return args
+
+def remove_traefik_canary() -> None:
+    """Remove the canary container, if it exists"""
+    if inspect_docker_container(TRAEFIK_CANARY_CONTAINER_NAME) is not None:
+        docker_call_output([ "rm", "--force", TRAEFIK_CANARY_CONTAINER_NAME ])
+
+def run_traefik_canary(stack: DockerComposeStack, timeout: float=DEFAULT_CANARY_TIMEOUT) -> float:
+    """
+    Start a canary of the stack's Traefik service and wait for it to become healthy. The canary
+    is left running; call remove_traefik_canary() when done with it.
+
+    Returns:
+        The seconds the canary took to become healthy.
+
+    Raises:
+        HubError: The canary exited, became unhealthy, or did not become healthy in time. The
+            message includes the tail of its log. The canary is removed.
+    """
+    remove_traefik_canary()
+    start_time = time.monotonic()
+    docker_call_output(get_traefik_canary_run_args(stack))
+    problem: Optional[str] = None
+    while True:
+        data = inspect_docker_container(TRAEFIK_CANARY_CONTAINER_NAME)
+        state = (data or {}).get('State') or {}
+        health = (state.get('Health') or {}).get('Status')
+        if state.get('Status') != 'running':
+            problem = f"exited with code {state.get('ExitCode')}"
+        elif health == 'healthy':
+            return time.monotonic() - start_time
+        elif health == 'unhealthy':
+            problem = "became unhealthy"
+        elif health is None:
+            # No healthcheck; running is the best available evidence
+            return time.monotonic() - start_time
+        elif time.monotonic() - start_time > timeout:
+            problem = f"did not become healthy within {timeout:g} seconds"
+        if problem is not None:
+            try:
+                logs = get_docker_container_logs(TRAEFIK_CANARY_CONTAINER_NAME, tail=20).rstrip()
+            except Exception as e:
+                logs = f"(unable to get logs: {e})"
+            remove_traefik_canary()
+            raise HubError(f"Traefik canary {problem}; the running Traefik was not replaced. Canary log:\n{logs}")
+        time.sleep(0.5)
@@ -0,0 +1,477 @@
+#
+# Copyright (c) 2023 Samuel J. McKelvie
+#
+# MIT License - See LICENSE file accompanying this package.
+#
+
+"""
+An index of Traefik HTTP routers defined by docker-compose labels and by the Traefik
+file provider, and a detector for duplicate router names and overlapping routing rules.
+
+Traefik only reports these problems at runtime, as warnings in its log. Building the index
+at `hub build` time surfaces them before anything is deployed.
+
+Rules are parsed into a disjunction of alternatives, each of which constrains the host
+(Host/HostHeader; HostRegexp is treated as matching any host) and the path
+(Path/PathPrefix). Other matchers (Method, Headers, Query, ClientIP, ...) and negations
+make an alternative "inexact": it may match less than its host/path constraints suggest.
+Routers are then bucketed by (entrypoint, host), and within a bucket path matchers are
+sorted so that all overlapping path matchers are found by binary search, giving
+O(n log n) detection plus output size.
+"""
+
+from __future__ import annotations
+
+import re
+from bisect import bisect_left
+
+from .internal_types import *
+from .pkg_logging import logger
+
+class TraefikRuleError(HubError):
+    """A Traefik rule expression could not be parsed"""
+    pass
+
+ANY_HOST = '*'
+"""Host key for alternatives that match any host"""
+
+ALL_ENTRYPOINTS = '*'
+"""Entrypoint name for routers that do not specify entrypoints (they attach to all default entrypoints)"""
+
+class PathMatcher:
+    """A single path constraint: kind is 'any', 'path' or 'prefix'"""
+    kind: str
+    value: str
+
+    def __init__(self, kind: str, value: str=''):
+        self.kind = kind
+        self.value = value
+
+    def overlaps(self, other: PathMatcher) -> bool:
+        if self.kind == 'any' or other.kind == 'any':
+            return True
+        if self.kind == 'path' and other.kind == 'path':
+            return self.value == other.value
+        if self.kind == 'prefix' and other.kind == 'prefix':
+            return self.value.startswith(other.value) or other.value.startswith(self.value)
+        prefix, path = (self, other) if self.kind == 'prefix' else (other, self)
+        return path.value.startswith(prefix.value)
+
+    def to_jsonable(self) -> JsonableDict:
+        return dict(kind=self.kind, value=self.value)
+
+    def __repr__(self) -> str:
+        return f"PathMatcher({self.kind!r}, {self.value!r})"
+
+class RuleAlternative:
+    """One disjunct of a parsed rule"""
+    hosts: Optional[List[str]]
+    """Lower-cased hosts matched, or None if any host matches"""
+
+    paths: Optional[List[PathMatcher]]
+    """Path matchers (any one of which may match), or None if any path matches"""
+
+    exact: bool
+    """False if other matchers or negations further restrict this alternative"""
+
+    def __init__(self, hosts: Optional[List[str]]=None, paths: Optional[List[PathMatcher]]=None, exact: bool=True):
+        self.hosts = hosts
+        self.paths = paths
+        self.exact = exact
+
+    def conjoin(self, other: RuleAlternative) -> RuleAlternative:
+        exact = self.exact and other.exact
+        if self.hosts is None:
+            hosts = other.hosts
+        elif other.hosts is None:
+            hosts = self.hosts
+        else:
+            hosts = sorted(set(self.hosts) & set(other.hosts))
+        if self.paths is None:
+            paths = other.paths
+        elif other.paths is None:
+            paths = self.paths
+        else:
+            # Two path constraints on the same request; keep the more specific set and
+            # note that the result is approximate.
+            paths = other.paths if all(p.kind == 'path' for p in other.paths) else self.paths
+            exact = False
+        return RuleAlternative(hosts, paths, exact)
+
+    def to_jsonable(self) -> JsonableDict:
+        return dict(
+            hosts=self.hosts,
+            paths=None if self.paths is None else [p.to_jsonable() for p in self.paths],
+            exact=self.exact,
+          )
+
+_token_re = re.compile(r"\s*(?:(?P<op>&&|\|\||[()!,])|(?P<str>`[^`]*`|\"(?:[^\"\\]|\\.)*\")|(?P<ident>[A-Za-z][A-Za-z0-9]*))")
+
+def _tokenize_rule(rule: str) -> List[Tuple[str, str]]:
+    tokens: List[Tuple[str, str]] = []
+    i = 0
+    n = len(rule)
+    while i < n:
+        if rule[i:].strip() == '':
+            break
+        m = _token_re.match(rule, i)
+        if m is None:
+            raise TraefikRuleError(f"Unexpected character at offset {i} in rule {rule!r}")
+        if m.group('op') is not None:
+            tokens.append(('op', m.group('op')))
+        elif m.group('str') is not None:
+            tokens.append(('str', m.group('str')[1:-1]))
+        else:
+            tokens.append(('ident', m.group('ident')))
+        i = m.end()
+    return tokens
+
+class _RuleParser:
+    def __init__(self, rule: str):
+        self.rule = rule
+        self.tokens = _tokenize_rule(rule)
+        self.pos = 0
+
+    def peek(self) -> Optional[Tuple[str, str]]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def expect(self, kind: str, value: Optional[str]=None) -> str:
+        tok = self.peek()
+        if tok is None or tok[0] != kind or (value is not None and tok[1] != value):
+            raise TraefikRuleError(f"Expected {value or kind} at token {self.pos} in rule {self.rule!r}")
+        self.pos += 1
+        return tok[1]
+
+    def parse(self) -> List[RuleAlternative]:
+        result = self.parse_or()
+        if self.peek() is not None:
+            raise TraefikRuleError(f"Unexpected trailing tokens in rule {self.rule!r}")
+        return result
+
+    def parse_or(self) -> List[RuleAlternative]:
+        result = self.parse_and()
+        while self.peek() == ('op', '||'):
+            self.pos += 1
+            result = result + self.parse_and()
+        return result
+
+    def parse_and(self) -> List[RuleAlternative]:
+        result = self.parse_unary()
+        while self.peek() == ('op', '&&'):
+            self.pos += 1
+            rhs = self.parse_unary()
+            result = [ a.conjoin(b) for a in result for b in rhs ]
+        return result
+
+    def parse_unary(self) -> List[RuleAlternative]:
+        tok = self.peek()
+        if tok == ('op', '!'):
+            self.pos += 1
+            self.parse_unary()
+            # A negation can match almost anything; treat it as an inexact wildcard
+            return [ RuleAlternative(exact=False) ]
+        if tok == ('op', '('):
+            self.pos += 1
+            result = self.parse_or()
+            self.expect('op', ')')
+            return result
+        return self.parse_matcher()
+
+    def parse_matcher(self) -> List[RuleAlternative]:
+        name = self.expect('ident')
+        self.expect('op', '(')
+        args: List[str] = []
+        if self.peek() != ('op', ')'):
+            args.append(self.expect('str'))
+            while self.peek() == ('op', ','):
+                self.pos += 1
+                args.append(self.expect('str'))
+        self.expect('op', ')')
+        if name in ('Host', 'HostHeader'):
+            return [ RuleAlternative(hosts=sorted(set(a.lower() for a in args))) ]
+        if name == 'HostRegexp':
+            return [ RuleAlternative() ]
+        if name == 'Path':
+            return [ RuleAlternative(paths=[PathMatcher('path', a) for a in args]) ]
+        if name == 'PathPrefix':
+            return [ RuleAlternative(paths=[PathMatcher('prefix', a) for a in args]) ]
+        return [ RuleAlternative(exact=False) ]
+
+def parse_traefik_rule(rule: str) -> List[RuleAlternative]:
+    """
+    Parse a Traefik v2 router rule into a list of alternatives, any one of which may match.
+
+    Raises:
+        TraefikRuleError: The rule is malformed.
+    """
+    return _RuleParser(rule).parse()
+
+class TraefikRouter:
+    """A Traefik HTTP router definition"""
+    name: str
+    """The router name, without provider suffix"""
+
+    provider: str
+    """The Traefik provider that defines the router; "docker" or "file" """
+
+    source: str
+    """Where the router is defined; e.g., "stacks/traefik/docker-compose.yml#traefik" """
+
+    props: Dict[str, str]
+    """The router's properties (rule, entrypoints, service, middlewares, priority, tls, ...)"""
+
+    alternatives: Optional[List[RuleAlternative]]
+    """The parsed rule, or None if there is no rule or it could not be parsed"""
+
+    error: Optional[str]
+    """A description of a problem with the router definition, if any"""
+
+    def __init__(self, name: str, provider: str, source: str, props: Dict[str, str]):
+        self.name = name
+        self.provider = provider
+        self.source = source
+        self.props = props
+        self.alternatives = None
+        self.error = None
+        rule = props.get('rule')
+        if rule is None:
+            self.error = "no rule defined; Traefik will apply its default rule"
+        else:
+            try:
+                self.alternatives = parse_traefik_rule(rule)
+            except TraefikRuleError as e:
+                self.error = str(e)
+
+    @property
+    def qualified_name(self) -> str:
+        return f"{self.name}@{self.provider}"
+
+    @property
+    def rule(self) -> Optional[str]:
+        return self.props.get('rule')
+
+    @property
+    def entrypoints(self) -> List[str]:
+        value = self.props.get('entrypoints')
+        if value is None or value.strip() == '':
+            return [ ALL_ENTRYPOINTS ]
+        return sorted(set(x.strip() for x in value.split(',') if x.strip() != ''))
+
+    @property
+    def priority(self) -> int:
+        """The effective priority. Traefik defaults to the length of the rule."""
+        value = self.props.get('priority')
+        if value is not None:
+            try:
+                return int(value)
+            except ValueError:
+                pass
+        rule = self.rule
+        return 0 if rule is None else len(rule)
+
+    def to_jsonable(self) -> JsonableDict:
+        return dict(
+            name=self.name,
+            provider=self.provider,
+            qualified_name=self.qualified_name,
+            source=self.source,
+            entrypoints=self.entrypoints,
+            priority=self.priority,
+            properties=dict(sorted(self.props.items())),
+            alternatives=None if self.alternatives is None else [a.to_jsonable() for a in self.alternatives],
+            error=self.error,
+          )
+
+_router_label_re = re.compile(r'^traefik\.http\.routers\.(?P<name>[^.]+)\.(?P<prop>.+)$')
+
+def normalize_compose_labels(labels: Any) -> Dict[str, str]:
+    """
+    Convert compose service labels, in either list ("key=value") or mapping form, into a dict.
+    """
+    result: Dict[str, str] = {}
+    if labels is None:
+        return result
+    if isinstance(labels, dict):
+        for k, v in labels.items():
+            result[str(k)] = '' if v is None else str(v)
+    elif isinstance(labels, list):
+        for item in labels:
+            item = str(item)
+            if '=' in item:
+                k, v = item.split('=', 1)
+            else:
+                k, v = item, ''
+            result[k] = v
+    else:
+        raise HubError(f"Invalid compose labels: {labels!r}")
+    return result
+
+def extract_label_routers(labels: Mapping[str, str], source: str) -> List[TraefikRouter]:
+    """
+    Extract the HTTP routers defined by one container's labels. Containers without
+    "traefik.enable=true" are ignored, since the hub's Traefik does not expose containers
+    by default.
+    """
+    if labels.get('traefik.enable', '').strip().lower() != 'true':
+        return []
+    router_props: Dict[str, Dict[str, str]] = {}
+    for k, v in labels.items():
+        m = _router_label_re.match(k)
+        if m is not None:
+            router_props.setdefault(m.group('name'), {})[m.group('prop').lower()] = v
+    return [ TraefikRouter(name, 'docker', source, props) for name, props in sorted(router_props.items()) ]
+
+def extract_file_provider_routers(dynamic_config: Optional[JsonableDict], source: str) -> List[TraefikRouter]:
+    """
+    Extract the HTTP routers defined in a Traefik file-provider dynamic configuration.
+    """
+    result: List[TraefikRouter] = []
+    if not isinstance(dynamic_config, dict):
+        return result
+    routers = (dynamic_config.get('http') or {}).get('routers') or {}
+    for name, router_data in sorted(routers.items()):
+        props: Dict[str, str] = {}
+        for k, v in (router_data or {}).items():
+            if isinstance(v, list):
+                v = ','.join(str(x) for x in v)
+            props[k.lower()] = str(v)
+        result.append(TraefikRouter(name, 'file', source, props))
+    return result
+
+class _IndexEntry:
+    __slots__ = ('router_index', 'path', 'exact')
+
+    def __init__(self, router_index: int, path: PathMatcher, exact: bool):
+        self.router_index = router_index
+        self.path = path
+        self.exact = exact
+
+class TraefikRouterIndex:
+    """
+    Routers indexed by entrypoint and host, with duplicate and overlap detection.
+    """
+    routers: List[TraefikRouter]
+    entrypoints: List[str]
+    """The known entrypoint names; routers without entrypoints attach to all of them"""
+
+    index: Dict[str, Dict[str, List[int]]]
+    """entrypoint -> host (or ANY_HOST) -> indices into routers"""
+
+    duplicates: List[JsonableDict]
+    collisions: List[JsonableDict]
+
+    def __init__(self, routers: List[TraefikRouter], entrypoints: Optional[List[str]]=None):
+        self.routers = routers
+        known = set() if entrypoints is None else set(entrypoints)
+        for router in routers:
+            known.update(ep for ep in router.entrypoints if ep != ALL_ENTRYPOINTS)
+        self.entrypoints = sorted(known)
+        self.index = {}
+        self.duplicates = []
+        self.collisions = []
+        self._find_duplicates()
+        self._build_index()
+
+    def _find_duplicates(self) -> None:
+        by_name: Dict[str, List[int]] = {}
+        for i, router in enumerate(self.routers):
+            by_name.setdefault(router.qualified_name, []).append(i)
+        for name in sorted(by_name.keys()):
+            indices = by_name[name]
+            if len(indices) > 1:
+                self.duplicates.append(dict(
+                    router=name,
+                    sources=[self.routers[i].source for i in indices],
+                  ))
+
+    def _router_entrypoints(self, router: TraefikRouter) -> List[str]:
+        eps = router.entrypoints
+        return self.entrypoints if eps == [ ALL_ENTRYPOINTS ] else eps
+
+    def _build_index(self) -> None:
+        buckets: Dict[Tuple[str, str], List[_IndexEntry]] = {}
+        for i, router in enumerate(self.routers):
+            if router.alternatives is None:
+                continue
+            for ep in self._router_entrypoints(router):
+                for alt in router.alternatives:
+                    hosts = [ ANY_HOST ] if alt.hosts is None else alt.hosts
+                    paths = [ PathMatcher('any') ] if alt.paths is None else alt.paths
+                    for host in hosts:
+                        host_index = self.index.setdefault(ep, {}).setdefault(host, [])
+                        if len(host_index) == 0 or host_index[-1] != i:
+                            host_index.append(i)
+                        bucket = buckets.setdefault((ep, host), [])
+                        for path in paths:
+                            bucket.append(_IndexEntry(i, path, alt.exact))
+
+        seen: Set[Tuple[int, int, str]] = set()
+        for (ep, host), entries in sorted(buckets.items()):
+            if host == ANY_HOST:
+                # Wildcard-host alternatives overlap every host on the entrypoint
+                candidates = [ e for (ep2, _), es in buckets.items() if ep2 == ep for e in es ]
+            else:
+                candidates = entries + buckets.get((ep, ANY_HOST), [])
+            self._find_overlaps(ep, host, entries, candidates, seen)
+
+    def _find_overlaps(
+            self,
+            ep: str,
+            host: str,
+            entries: List[_IndexEntry],
+            candidates: List[_IndexEntry],
+            seen: Set[Tuple[int, int, str]],
+          ) -> None:
+        any_path = [ c for c in candidates if c.path.kind == 'any' ]
+        specific = sorted((c for c in candidates if c.path.kind != 'any'), key=lambda c: c.path.value)
+        values = [ c.path.value for c in specific ]
+        for e in entries:
+            if e.path.kind == 'any':
+                others = candidates
+            else:
+                others = list(any_path)
+                j = bisect_left(values, e.path.value)
+                while j < len(values) and values[j].startswith(e.path.value):
+                    if e.path.kind == 'prefix' or values[j] == e.path.value:
+                        others.append(specific[j])
+                    j += 1
+            for o in others:
+                if o.router_index != e.router_index and e.path.overlaps(o.path):
+                    self._add_collision(ep, host, e, o, seen)
+
+    def _add_collision(self, ep: str, host: str, a: _IndexEntry, b: _IndexEntry, seen: Set[Tuple[int, int, str]]) -> None:
+        if a.router_index > b.router_index:
+            a, b = b, a
+        key = (a.router_index, b.router_index, ep)
+        if key in seen:
+            return
+        seen.add(key)
+        ra = self.routers[a.router_index]
+        rb = self.routers[b.router_index]
+        self.collisions.append(dict(
+            entrypoint=ep,
+            host=host,
+            routers=[ra.qualified_name, rb.qualified_name],
+            sources=[ra.source, rb.source],
+            paths=[a.path.to_jsonable(), b.path.to_jsonable()],
+            priorities=[ra.priority, rb.priority],
+            exact=a.exact and b.exact,
+            ambiguous=ra.priority == rb.priority and a.exact and b.exact,
+          ))
+
+    @property
+    def ambiguous_collisions(self) -> List[JsonableDict]:
+        """Overlaps that Traefik cannot resolve by priority"""
+        return [ c for c in self.collisions if c['ambiguous'] ]
+
+    def to_jsonable(self) -> JsonableDict:
+        return dict(
+            entrypoints=self.entrypoints,
+            routers=[ r.to_jsonable() for r in self.routers ],
+            index={
+                ep: { host: [ self.routers[i].qualified_name for i in indices ] for host, indices in sorted(hosts.items()) }
+                    for ep, hosts in sorted(self.index.items())
+              },
+            duplicates=self.duplicates,
+            collisions=self.collisions,
+          )
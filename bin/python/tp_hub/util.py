@@ -15,6 +15,7 @@ import sys
 import dotenv
 import json
 import re
+import shlex
 import urllib3
 from functools import cache
 import copy
@@ -26,17 +27,23 @@ from tomlkit.container import Container as TOMLContainer
 from .internal_types import *
 from .internal_types import _CMD, _FILE, _ENV
 from .pkg_logging import logger
+from .docker_api import get_docker_engine_client, DockerApiNotFoundError
+from .docker_events import get_docker_resource_cache
+from .docker_group_broker import get_docker_group_broker
 
 from project_init_tools.installer.docker import install_docker, docker_is_installed
 from project_init_tools.installer.docker_compose import install_docker_compose, docker_compose_is_installed
 from project_init_tools.installer.aws_cli import install_aws_cli, aws_cli_is_installed
 from project_init_tools.util import (
+    should_run_with_group,
+    download_url_text,
+)
+from .subprocess_runner import (
     sudo_check_call,
     sudo_check_output,
     sudo_check_call_stderr_exception,
     sudo_check_output_stderr_exception,
-    should_run_with_group,
-    download_url_text,
+    check_call,
 )
 
 from .internal_types import *
@@ -440,22 +447,59 @@ def docker_call_output(
         ))
     return result_bytes.decode("utf-8")
 
+def get_docker_command(args: List[str]) -> List[str]:
+    """
+    Get the command line that runs docker with the given arguments, for callers that manage
+    the process themselves (e.g., asyncio). Like docker_call(), if the login session is not
+    yet in the "docker" group, it goes through the docker group broker, or else runs under
+    `sg docker`.
+    """
+    cmd = ["docker"] + args
+    broker = get_docker_group_broker()
+    if broker is not None:
+        cmd = ["env", f"DOCKER_HOST={broker.docker_host}"] + cmd
+    elif should_run_with_group("docker"):
+        cmd = ["sg", "docker", "-c", shlex.join(cmd)]
+    return cmd
+
+def _docker_cli_inspect_all(kind: str, ls_args: List[str]) -> List[JsonableDict]:
+    """
+    List docker objects of a kind with the docker CLI, in the same format as the Engine API
+    (which is what `docker <kind> inspect` emits).
+    """
+    ids = [ x for x in docker_call_output([kind, "ls", "-q"] + ls_args).split() if x != '' ]
+    if len(ids) == 0:
+        return []
+    result = json.loads(docker_call_output([kind, "inspect"] + ids))
+    assert isinstance(result, list)
+    return result
+
 @cache
+def _get_cli_docker_networks() -> Dict[str, JsonableDict]:
+    return { x['Name']: x for x in _docker_cli_inspect_all("network", ["--no-trunc"]) }
+
 def get_docker_networks() -> Dict[str, JsonableDict]:
     """
-    Get all docker networks
+    Get all docker networks, keyed by name, in Docker Engine API format.
+
+    When the Docker Engine API is accessible, this is a snapshot kept current by the docker
+    event stream, and must not be modified. Otherwise, the result of the first listing with
+    the docker CLI is cached until refresh_docker_networks() is called.
     """
-    data_json = docker_call_output(
-        ["network", "ls", "--format", "json"],
-      )
-    result = ndjson_to_dict(data_json)
-    return result
+    resource_cache = get_docker_resource_cache()
+    if resource_cache is not None:
+        return resource_cache.get("network")
+    return _get_cli_docker_networks()
 
-def refresh_docker_networks() -> None:
+def refresh_docker_networks(name: Optional[str]=None) -> None:
     """
-    Refresh the cache of docker networks
+    Refresh the cache of docker networks, or just one network if name is provided
     """
-    get_docker_networks.cache_clear()
+    resource_cache = get_docker_resource_cache()
+    if resource_cache is not None:
+        resource_cache.refresh("network", name)
+    else:
+        _get_cli_docker_networks.cache_clear()
 
 def create_docker_network(name: str, driver: str="bridge", allow_existing: bool=True) -> None:
     """
@@ -463,26 +507,40 @@ def create_docker_network(name: str, driver: str="bridge", allow_existing: bool=
     """
     if not (allow_existing and name in get_docker_networks()):
         try:
-            docker_call(["network", "create", "--driver", driver, name])
+            client = get_docker_engine_client()
+            if client is not None:
+                client.create_network(name, driver=driver)
+            else:
+                docker_call(["network", "create", "--driver", driver, name])
         finally:
-            refresh_docker_networks()
+            refresh_docker_networks(name)
 
 @cache
+def _get_cli_docker_volumes() -> Dict[str, JsonableDict]:
+    return { x['Name']: x for x in _docker_cli_inspect_all("volume", []) }
+
 def get_docker_volumes() -> Dict[str, JsonableDict]:
     """
-    Get all docker volumes
+    Get all docker volumes, keyed by name, in Docker Engine API format.
+
+    When the Docker Engine API is accessible, this is a snapshot kept current by the docker
+    event stream, and must not be modified. Otherwise, the result of the first listing with
+    the docker CLI is cached until refresh_docker_volumes() is called.
     """
-    data_json = docker_call_output(
-        ["volume", "ls", "--format", "json"],
-      )
-    result = ndjson_to_dict(data_json)
-    return result
+    resource_cache = get_docker_resource_cache()
+    if resource_cache is not None:
+        return resource_cache.get("volume")
+    return _get_cli_docker_volumes()
 
-def refresh_docker_volumes() -> None:
+def refresh_docker_volumes(name: Optional[str]=None) -> None:
     """
-    Refresh the cache of docker volumes
+    Refresh the cache of docker volumes, or just one volume if name is provided
     """
-    get_docker_volumes.cache_clear()
+    resource_cache = get_docker_resource_cache()
+    if resource_cache is not None:
+        resource_cache.refresh("volume", name)
+    else:
+        _get_cli_docker_volumes.cache_clear()
 
 def create_docker_volume(name: str, allow_existing: bool=True) -> None:
     """
@@ -490,9 +548,159 @@ def create_docker_volume(name: str, allow_existing: bool=True) -> None:
     """
     if not (allow_existing and name in get_docker_volumes()):
         try:
-            docker_call(["volume", "create", name])
+            client = get_docker_engine_client()
+            if client is not None:
+                client.create_volume(name)
+            else:
+                docker_call(["volume", "create", name])
         finally:
-            refresh_docker_volumes()
+            refresh_docker_volumes(name)
+
+def _docker_cli_inspect(kind: str, name: str) -> Optional[JsonableDict]:
+    try:
+        result = json.loads(docker_call_output([kind, "inspect", name]))
+    except subprocess.CalledProcessError:
+        return None
+    return result[0] if len(result) > 0 else None
+
+def inspect_docker_volume(name: str) -> Optional[JsonableDict]:
+    """
+    Inspect a docker volume. Returns None if it does not exist.
+    """
+    client = get_docker_engine_client()
+    if client is None:
+        return _docker_cli_inspect("volume", name)
+    try:
+        return client.inspect_volume(name)
+    except DockerApiNotFoundError:
+        return None
+
+def inspect_docker_network(name: str) -> Optional[JsonableDict]:
+    """
+    Inspect a docker network. Returns None if it does not exist.
+    """
+    client = get_docker_engine_client()
+    if client is None:
+        return _docker_cli_inspect("network", name)
+    try:
+        return client.inspect_network(name)
+    except DockerApiNotFoundError:
+        return None
+
+def inspect_docker_container(name: str) -> Optional[JsonableDict]:
+    """
+    Inspect a docker container by name or ID. Returns None if it does not exist.
+    """
+    client = get_docker_engine_client()
+    if client is None:
+        return _docker_cli_inspect("container", name)
+    try:
+        return client.inspect_container(name)
+    except DockerApiNotFoundError:
+        return None
+
+def get_docker_container_logs(name: str, tail: Optional[int]=None) -> str:
+    """
+    Get the combined stdout and stderr logs of a docker container as text.
+
+    Args:
+        name: The container name or ID.
+        tail: If not None, only the last tail lines of each stream.
+    """
+    client = get_docker_engine_client()
+    if client is None:
+        args = ["logs"] + ([] if tail is None else ["--tail", str(tail)]) + [name]
+        return cast(bytes, sudo_check_output(
+            ["docker"] + args,
+            use_sudo=False,
+            run_with_group="docker",
+            stderr=subprocess.STDOUT,
+          )).decode('utf-8', errors='replace')
+    stdout, stderr = client.container_logs(name, tail=tail)
+    return (stdout + stderr).decode('utf-8', errors='replace')
+
+def inspect_docker_image(name: str) -> Optional[JsonableDict]:
+    """
+    Inspect a local docker image by name, tag or ID. Returns None if it is not present locally.
+    """
+    client = get_docker_engine_client()
+    if client is None:
+        return _docker_cli_inspect("image", name)
+    try:
+        return client.inspect_image(name)
+    except DockerApiNotFoundError:
+        return None
+
+def get_docker_containers(all: bool=True, filters: Optional[Mapping[str, List[str]]]=None) -> List[JsonableDict]:
+    """
+    List docker containers in Docker Engine API format (as returned by GET /containers/json).
+
+    Args:
+        all: If True, include stopped containers.
+        filters: Engine API filters, e.g., { "label": [ "com.docker.compose.project=traefik" ] }.
+    """
+    client = get_docker_engine_client()
+    if client is not None:
+        return client.list_containers(all=all, filters=filters)
+    args = ["container", "ls", "-q", "--no-trunc"]
+    if all:
+        args.append("--all")
+    for k, values in (filters or {}).items():
+        for v in values:
+            args += ["--filter", f"{k}={v}"]
+    ids = [ x for x in docker_call_output(args).split() if x != '' ]
+    if len(ids) == 0:
+        return []
+    # `docker inspect` has a different (more detailed) format than the Engine API list; translate
+    # the fields that the list format provides.
+    result: List[JsonableDict] = []
+    for data in json.loads(docker_call_output(["container", "inspect"] + ids)):
+        config = data.get('Config') or {}
+        state = data.get('State') or {}
+        result.append(dict(
+            Id=data['Id'],
+            Names=[ data['Name'] ],
+            Image=config.get('Image'),
+            ImageID=data.get('Image'),
+            Labels=config.get('Labels') or {},
+            State=state.get('Status'),
+            Status=state.get('Status'),
+            Created=data.get('Created'),
+          ))
+    return result
+
+def normalize_image_reference(image: str) -> str:
+    """Add the implicit ":latest" tag to an image reference that has no tag or digest"""
+    if '@' in image:
+        return image
+    _, _, last = image.rpartition('/')
+    return image if ':' in last else image + ":latest"
+
+def get_docker_images(filters: Optional[Mapping[str, List[str]]]=None) -> List[JsonableDict]:
+    """
+    List local docker images in Docker Engine API format (as returned by GET /images/json).
+    """
+    client = get_docker_engine_client()
+    if client is not None:
+        return client.list_images(filters=filters)
+    args = ["image", "ls", "-q", "--no-trunc"]
+    for k, values in (filters or {}).items():
+        for v in values:
+            args += ["--filter", f"{k}={v}"]
+    ids = sorted(set(x for x in docker_call_output(args).split() if x != ''))
+    if len(ids) == 0:
+        return []
+    result: List[JsonableDict] = []
+    for data in json.loads(docker_call_output(["image", "inspect"] + ids)):
+        result.append(dict(
+            Id=data['Id'],
+            RepoTags=data.get('RepoTags') or [],
+            RepoDigests=data.get('RepoDigests') or [],
+            Created=data.get('Created'),
+            Size=data.get('Size'),
+            Labels=(data.get('Config') or {}).get('Labels') or {},
+          ))
+    return result
 
 def docker_compose_call(
         args: List[str],
@@ -668,6 +876,47 @@ def unindent_string_literal(
         disregard_first_line=disregard_first_line,
       )
 
+def format_bytes(n: Optional[float], suffix: str='') -> str:
+    """
+    Format a byte count (or rate) for display, in binary units, e.g., "512B" or "1.5MiB".
+    None is formatted as "-".
+
+    Args:
+        n: The number of bytes, or None if unknown.
+        suffix: Appended to the unit, e.g., "/s" for a rate.
+    """
+    if n is None:
+        return "-"
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if n < 1024:
+            return f"{n:.0f}{unit}{suffix}" if unit == "B" else f"{n:.1f}{unit}{suffix}"
+        n /= 1024
+    return f"{n:.1f}TiB{suffix}"
+
+def format_table(rows: Sequence[Sequence[str]], left_columns: Optional[int]=None) -> str:
+    """
+    Format rows of cells as a table with aligned columns, separated by two spaces. The first
+    row is typically the column headings. Trailing whitespace is removed from each line.
+
+    Args:
+        rows: The rows; each must have the same number of cells.
+        left_columns: The number of leading columns that are left-justified; the rest are
+            right-justified. Defaults to all columns.
+    """
+    if len(rows) == 0:
+        return ""
+    num_columns = len(rows[0])
+    if left_columns is None:
+        left_columns = num_columns
+    widths = [ max(len(row[i]) for row in rows) for i in range(num_columns) ]
+    return "\n".join(
+        "  ".join(
+            cell.ljust(width) if i < left_columns else cell.rjust(width)
+            for i, (cell, width) in enumerate(zip(row, widths))
+          ).rstrip()
+        for row in rows
+      )
+
 # A DNS name part can be 1 to 63 characters long, and can contain only letters, digits, and hyphens.
 # It must not start or end with a hyphen.
 _valid_dns_name_part_re = re.compile("^(?!-)[a-zA-Z\d-]{1,63}(?<!-)$")
@@ -768,4 +1017,4 @@ def atomic_mv(source: str, dest: str, force: bool=True) -> None:
     if force:
         cmd.append('-f')
     cmd.extend([ source, dest ])
-    subprocess.check_call(cmd)
+    check_call(cmd)
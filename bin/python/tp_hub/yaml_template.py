@@ -6,6 +6,12 @@
 
 """
 expand environment variables in YAML
+
+Templates are compiled once into a YAML tree in which every scalar that contains a
+"$" substitution is replaced by a slot. Rendering a compiled template is then a cheap
+tree-walk substitution rather than a text expansion followed by a full YAML parse.
+Compiled templates are cached in memory and persisted under <project>/build/cache,
+keyed by a hash of the template text.
 """
 
 from __future__ import annotations
@@ -13,20 +19,224 @@ from __future__ import annotations
 import os
 import yaml
 import string
+import pickle
+import hashlib
+from threading import Lock
 
 from .internal_types import *
 from .internal_types import _CMD, _FILE, _ENV
 from .pkg_logging import logger
+from .proj_dirs import get_project_build_dir
+
+# Bump whenever the compiled representation changes, to invalidate persisted caches
+YAML_TEMPLATE_COMPILER_VERSION = 1
+
+_STR_TAG = 'tag:yaml.org,2002:str'
+
+class YamlTemplateSlot:
+    """
+    A scalar in a compiled YAML template that contains "$" substitutions.
+    """
+    template: string.Template
+    """The string.Template for the scalar's (already YAML-unescaped) text"""
+
+    plain: bool
+    """True if the scalar was a plain (unquoted) YAML scalar, in which case the
+       substituted text is implicitly typed (int, bool, null, etc.) as YAML would"""
+
+    def __init__(self, text: str, plain: bool):
+        self.template = string.Template(text)
+        self.plain = plain
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            isinstance(other, YamlTemplateSlot) and
+            self.template.template == other.template.template and
+            self.plain == other.plain
+          )
+
+    def __hash__(self) -> int:
+        return hash((self.template.template, self.plain))
+
+    def __repr__(self) -> str:
+        return f"YamlTemplateSlot({self.template.template!r}, plain={self.plain})"
+
+    def render(self, env: Mapping[str, str]) -> Any:
+        text = self.template.substitute(env)
+        if not self.plain:
+            return text
+        return _resolve_plain_scalar(text)
+
+_resolver = yaml.resolver.Resolver()
+_constructor = yaml.constructor.SafeConstructor()
+
+def _resolve_plain_scalar(text: str) -> Any:
+    """
+    Convert the text of a plain (unquoted) YAML scalar into a typed value, exactly
+    as yaml.safe_load would.
+    """
+    tag = _resolver.resolve(yaml.ScalarNode, text, (True, False))
+    if tag == _STR_TAG:
+        return text
+    return _constructor.construct_object(yaml.ScalarNode(tag, text))
+
+class _TemplateLoader(yaml.SafeLoader):
+    """A SafeLoader that constructs YamlTemplateSlot objects for string scalars containing '$'"""
+    pass
+
+def _construct_template_str(loader: _TemplateLoader, node: yaml.ScalarNode) -> Union[str, YamlTemplateSlot]:
+    value = loader.construct_scalar(node)
+    assert isinstance(value, str)
+    if '$' in value:
+        return YamlTemplateSlot(value, plain=node.style is None)
+    return value
+
+_TemplateLoader.add_constructor(_STR_TAG, _construct_template_str)
+
+def _render_node(node: Any, env: Mapping[str, str]) -> Any:
+    if isinstance(node, YamlTemplateSlot):
+        return node.render(env)
+    if isinstance(node, dict):
+        return { _render_node(k, env): _render_node(v, env) for k, v in node.items() }
+    if isinstance(node, list):
+        return [ _render_node(v, env) for v in node ]
+    return node
+
+class CompiledYamlTemplate:
+    """
+    A YAML template that has been parsed once into a tree with substitution slots.
+    """
+    template_hash: str
+    """sha256 hex digest of the template text"""
+
+    tree: Any
+    """The parsed YAML tree, with YamlTemplateSlot objects in place of scalars containing '$'"""
 
-def load_yaml_template_str(template_str: str, env: Optional[Dict[str, str]]= None) -> JsonableDict:
+    fallback_template: Optional[string.Template]
+    """If the template is not valid YAML until it has been expanded (e.g., a substitution
+       inside a flow collection), the whole template text, which is expanded then parsed on
+       every render. None if the template was compiled into a tree."""
+
+    def __init__(self, template_hash: str, tree: Any, fallback_template: Optional[string.Template]=None):
+        self.template_hash = template_hash
+        self.tree = tree
+        self.fallback_template = fallback_template
+
+    def render(self, env: Optional[Mapping[str, str]]=None) -> JsonableDict:
+        """
+        Substitute environment variables into the template, returning the resulting YAML data.
+
+        Raises KeyError if a referenced variable is not in env, as string.Template.substitute does.
+        """
+        if env is None:
+            env = dict(os.environ)
+        if self.fallback_template is not None:
+            return yaml.safe_load(self.fallback_template.substitute(env))
+        return _render_node(self.tree, env)
+
+def get_yaml_template_hash(template_str: str) -> str:
+    """
+    Get the cache key for a template's text
+    """
+    h = hashlib.sha256(f"yaml-template-v{YAML_TEMPLATE_COMPILER_VERSION}\n".encode('utf-8'))
+    h.update(template_str.encode('utf-8'))
+    return h.hexdigest()
+
+def get_yaml_template_cache_dir() -> str:
+    """
+    Get the directory in which compiled templates are persisted
+    """
+    return os.path.join(get_project_build_dir(), "cache", "yaml-templates")
+
+_compiled_cache: Dict[str, CompiledYamlTemplate] = {}
+_compiled_cache_lock = Lock()
+
+def _load_persisted_template(pathname: str, template_hash: str) -> Optional[CompiledYamlTemplate]:
+    try:
+        with open(pathname, 'rb') as f:
+            result = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.debug(f"Ignoring unreadable compiled YAML template cache file {pathname}: {e}")
+        return None
+    if not isinstance(result, CompiledYamlTemplate) or result.template_hash != template_hash:
+        logger.debug(f"Ignoring stale compiled YAML template cache file {pathname}")
+        return None
+    return result
+
+def _save_persisted_template(pathname: str, compiled: CompiledYamlTemplate) -> None:
+    tmp_pathname = f"{pathname}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(pathname), mode=0o700, exist_ok=True)
+        with open(os.open(tmp_pathname, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600), 'wb') as f:
+            pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_pathname, pathname)
+    except OSError as e:
+        # The cache is an optimization only
+        logger.debug(f"Unable to persist compiled YAML template to {pathname}: {e}")
+    finally:
+        if os.path.exists(tmp_pathname):
+            os.unlink(tmp_pathname)
+
+def compile_yaml_template_str(template_str: str, persist: bool=True) -> CompiledYamlTemplate:
+    """
+    Compile a YAML template, using the in-memory cache and (if persist is True) the
+    on-disk cache under <project>/build/cache/yaml-templates.
+    """
+    template_hash = get_yaml_template_hash(template_str)
+    with _compiled_cache_lock:
+        result = _compiled_cache.get(template_hash)
+    if result is not None:
+        return result
+    pathname = os.path.join(get_yaml_template_cache_dir(), f"{template_hash}.pickle")
+    if persist:
+        result = _load_persisted_template(pathname, template_hash)
+    if result is None:
+        try:
+            tree = yaml.load(template_str, Loader=_TemplateLoader)
+            result = CompiledYamlTemplate(template_hash, tree)
+        except yaml.YAMLError as e:
+            logger.debug(f"YAML template is not valid YAML before expansion; falling back to text expansion: {e}")
+            result = CompiledYamlTemplate(template_hash, None, fallback_template=string.Template(template_str))
+        if persist:
+            _save_persisted_template(pathname, result)
+    with _compiled_cache_lock:
+        _compiled_cache[template_hash] = result
+    return result
+
+def compile_yaml_template_file(template_file: str, persist: bool=True) -> CompiledYamlTemplate:
+    """
+    Compile a YAML template file. See compile_yaml_template_str.
+    """
+    with open(template_file, encoding='utf-8') as f:
+        template_str = f.read()
+    return compile_yaml_template_str(template_str, persist=persist)
+
+def clear_yaml_template_cache() -> None:
+    """
+    Clear the in-memory cache of compiled templates. Persisted templates are not removed.
+    """
+    with _compiled_cache_lock:
+        _compiled_cache.clear()
+
+def expand_yaml_template_str(template_str: str, env: Optional[Dict[str, str]]= None) -> JsonableDict:
+    """
+    Expand a YAML template by full text substitution followed by a YAML parse. This is the
+    uncompiled form; it also expands '$' occurrences inside YAML comments and allows
+    substituted values to introduce YAML structure.
+    """
     if env is None:
         env = dict(os.environ)
     expanded = string.Template(template_str).substitute(env)
     result = yaml.safe_load(expanded)
     return result
 
-def load_yaml_template_file(template_file: str, env: Optional[Dict[str, str]]= None) -> JsonableDict:
+def load_yaml_template_str(template_str: str, env: Optional[Dict[str, str]]= None, persist: bool=True) -> JsonableDict:
+    return compile_yaml_template_str(template_str, persist=persist).render(env)
+
+def load_yaml_template_file(template_file: str, env: Optional[Dict[str, str]]= None, persist: bool=True) -> JsonableDict:
     with open(template_file, encoding='utf-8') as f:
         template_str = f.read()
 
-    return load_yaml_template_str(template_str, env=env)
+    return load_yaml_template_str(template_str, env=env, persist=persist)